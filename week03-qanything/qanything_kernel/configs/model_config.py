@@ -1,4 +1,5 @@
 import os
+import json
 from dotenv import load_dotenv
 
 load_dotenv()
@@ -186,6 +187,15 @@ MYSQL_PASSWORD_LOCAL = '123456'
 MYSQL_DATABASE_LOCAL = 'qanything'
 
 LOCAL_OCR_SERVICE_URL = "localhost:7001"
+# 入库时同一文档的多张图片（扫描版PDF的各页等）以multipart原始字节分批发给/ocr_batch，不再每张图片base64一个请求
+OCR_BATCH_SIZE = int(os.getenv("OCR_BATCH_SIZE", "16"))  # 每个请求的图片数
+OCR_BATCH_MAX_BYTES = 32 * 1024 * 1024  # 每个请求的图片总字节数上限，单张超过时单独成批
+OCR_BATCH_MAX_IMAGES = 64  # OCR服务端单个/ocr_batch请求接受的图片数上限
+OCR_PDF_DPI = 200  # 没有文字层的PDF页面渲染成图片做OCR的分辨率
+# OCR服务端：检测在线程池中并发执行，同时在处理的图片的文本行汇集到一起识别
+OCR_INFER_THREADS = int(os.getenv("OCR_INFER_THREADS", "4"))  # 每个OCR服务worker的推理线程数
+OCR_REC_MAX_CROPS = 256  # 一次识别最多汇集的文本行数
+OCR_REC_BATCH_WAIT_MS = 10  # 还有图片在检测时，识别最多为等它们的文本行而推迟的时间
 
 LOCAL_PDF_PARSER_SERVICE_URL = "localhost:9009"
 
@@ -202,6 +212,8 @@ LOCAL_EMBED_MODEL_NAME = 'embed'
 LOCAL_EMBED_MAX_LENGTH = 512
 LOCAL_EMBED_BATCH = 1
 LOCAL_EMBED_THREADS = 1
+LOCAL_EMBED_TOKEN_BUDGET = 8192  # 客户端按token预算把多段文本合并成一次embedding请求，单个请求的token总数上限
+LOCAL_EMBED_CACHE_SIZE = 4096  # 客户端按内容hash缓存的embedding条数（LRU），用于回答与引用段落的相关性计算
 LOCAL_EMBED_PATH = os.path.join(root_path, 'qanything_kernel/dependent_server/embedding_server', 'embedding_model_configs_v0.0.1')
 LOCAL_EMBED_MODEL_PATH = os.path.join(LOCAL_EMBED_PATH, "embed.onnx")
 
@@ -211,6 +223,81 @@ DEFAULT_CHILD_CHUNK_SIZE = 400
 DEFAULT_PARENT_CHUNK_SIZE = 800
 SEPARATORS = ["\n\n", "\n", "。", "，", ",", ".", ""]
 MAX_CHARS = 1000000  # 单个文件最大字符数，超过此字符数将上传失败，改大可能会导致解析超时
+# 入库时为每个chunk预先计算token数所用的tiktoken编码，覆盖常用的OpenAI兼容模型，查询时按模型编码直接读取
+CHUNK_TOKEN_ENCODINGS = ["cl100k_base", "o200k_base"]
+# Documents.json_data的压缩方式: zstd(未安装zstandard时退回zlib) / zlib / none，老数据无论哪种格式都可以读取
+DOCUMENT_COMPRESSION = os.getenv("DOCUMENT_COMPRESSION", "zstd")
+DOCUMENT_COMPRESSION_LEVEL = int(os.getenv("DOCUMENT_COMPRESSION_LEVEL", "3"))  # zstd为1-22；退回zlib时截断到1-9
+DOCUMENT_COMPRESSION_MIN_BYTES = 256  # 小于该字节数的json不压缩，压缩收益抵不过base64膨胀
+# parent chunk内容寻址：相同内容（去掉用户、知识库、文件等归属信息后）在ChunkContent中只存一份，Documents行引用它
+DOCUMENT_DEDUP = os.getenv("DOCUMENT_DEDUP", "1") == "1"
+# 子chunk的headers前缀（会参与embedding）是否带知识库名，默认带（与原来的子chunk文本一致）。
+# 设为0时子chunk不带知识库名，同一文件上传到不同名的知识库时子chunk完全相同，向量可以跨知识库复用
+# （检索效果对比见bench_ingest.py --stage dedup）。切换后只影响新入库的文件，同一知识库内新老文件的前缀会不一致，
+# 建议在部署之初设置，或切换后重新上传已有文件
+CHILD_HEADERS_WITH_KB_NAME = os.getenv("CHILD_HEADERS_WITH_KB_NAME", "1") == "1"
+
+# 入库服务任务队列：worker用SELECT ... FOR UPDATE SKIP LOCKED领取gray文件，处理期间定期续约
+INSERT_WORKER_CONCURRENCY = int(os.getenv("INSERT_WORKER_CONCURRENCY", "2"))  # 每个worker同时处理的文件数
+INSERT_LEASE_SECONDS = 120  # 租约时长，超时未续约（worker崩溃/重启）的任务可被其他worker重新领取
+INSERT_HEARTBEAT_SECONDS = 30  # 续约间隔
+INSERT_MAX_ATTEMPTS = 3  # 同一文件最多被领取的次数，超过后标记为red，避免反复拖垮worker
+INSERT_POLL_INTERVAL = 3  # 没有收到唤醒信号时的兜底轮询间隔(秒)
+# API服务写入File表后，向该目录下每个入库worker的UNIX socket发送唤醒信号（两者不在同一台机器时只靠轮询）
+INSERT_WAKEUP_DIR = os.getenv("INSERT_WAKEUP_DIR", "/tmp/qanything_insert_wakeup")
+# 文件解析在独立的进程池中执行（解析是纯Python代码，在线程中会和入库流程争抢GIL）
+PARSE_PROCESSES = int(os.getenv("PARSE_PROCESSES", "0"))  # 每个入库worker的解析进程数，0表示CPU核数 / worker数
+PARSE_TIMEOUT_SECONDS = 300  # 单个文件的解析超时，子进程内到时抛出异常
+PARSE_KILL_GRACE_SECONDS = 10  # 超时后仍未返回（卡在C扩展中）的子进程，再等这么久就直接杀掉
+PARSE_MAX_TASKS_PER_CHILD = 100  # 子进程解析这么多文件后重建，回收解析库泄漏的内存
+
+# URL文件抓取不到单篇文章时，在解析子进程中用asyncio并发抓取该URL目录下的页面
+CRAWL_CONCURRENCY = int(os.getenv("CRAWL_CONCURRENCY", "16"))  # 同时进行的请求数
+CRAWL_PER_HOST_CONCURRENCY = int(os.getenv("CRAWL_PER_HOST_CONCURRENCY", "4"))  # 同一host同时进行的请求数
+CRAWL_HOST_DELAY = float(os.getenv("CRAWL_HOST_DELAY", "0.1"))  # 同一host相邻两次请求开始的最小间隔(秒)，robots.txt的Crawl-delay更大时以它为准
+CRAWL_MAX_PAGES = int(os.getenv("CRAWL_MAX_PAGES", "500"))
+CRAWL_MAX_DEPTH = int(os.getenv("CRAWL_MAX_DEPTH", "5"))
+CRAWL_MAX_PAGE_BYTES = 5 * 1024 * 1024  # 超过该大小的页面不解析
+CRAWL_REQUEST_TIMEOUT = 20  # 单个请求的超时(秒)
+CRAWL_MAX_SECONDS = PARSE_TIMEOUT_SECONDS - 60  # 整个抓取的时长上限，到时返回已抓到的页面，不等解析超时
+CRAWL_EXTRACT_PROCESSES = int(os.getenv("CRAWL_EXTRACT_PROCESSES", "2"))  # HTML转文本的进程数，0表示在线程中执行
+CRAWL_RESPECT_ROBOTS = os.getenv("CRAWL_RESPECT_ROBOTS", "1") == "1"
+CRAWL_USER_AGENT = os.getenv("CRAWL_USER_AGENT", "Mozilla/5.0 (compatible; QAnything/2.0)")
+# 条件请求缓存：保存每个页面的ETag/Last-Modified和解析结果，重新抓取时服务端返回304直接复用
+CRAWL_CACHE_DIR = os.getenv("CRAWL_CACHE_DIR", os.path.join(root_path, "QANY_DB", "crawl_cache"))
+
+# 单个文件内的入库流水线：split -> embed -> store三个阶段用有界队列衔接，各阶段并发和批大小独立配置
+INGEST_SPLIT_BATCH = int(os.getenv("INGEST_SPLIT_BATCH", "16"))  # 每批切分的parent chunk数，也是后续阶段的批大小
+INGEST_QUEUE_SIZE = int(os.getenv("INGEST_QUEUE_SIZE", "4"))  # 阶段之间最多缓存的批数，满了上游等待
+INGEST_EMBED_CONCURRENCY = int(os.getenv("INGEST_EMBED_CONCURRENCY", "2"))  # 同时进行的embedding请求批数
+INGEST_STORE_CONCURRENCY = int(os.getenv("INGEST_STORE_CONCURRENCY", "2"))  # 同时写入Milvus/ES/MySQL的批数
+INGEST_EMBED_TOKEN_BUDGET = LOCAL_EMBED_TOKEN_BUDGET  # embedding阶段每个请求的token上限
+# 断点续传：已写完的parent随指纹按间隔落盘，解析结果存入FileIngestCheckpoint，重新领取的文件从检查点继续
+INGEST_CHECKPOINT_INTERVAL = float(os.getenv("INGEST_CHECKPOINT_INTERVAL", "10"))  # 指纹检查点的最短落盘间隔(秒)
+PARSE_CHECKPOINT_MIN_SECONDS = 5  # 解析耗时超过该值才保存解析结果，小文件重新解析更快
+INSERT_STALL_SECONDS = int(os.getenv("INSERT_STALL_SECONDS", "120"))  # 入库流水线这么久没有任何进展判定为卡住
+# 入库进度与吞吐：进度计数定期写入File.msg，worker的吞吐定期写入InsertWorkerStats，get_total_status据此估算积压清空时间
+INSERT_PROGRESS_INTERVAL = 3  # 写File.msg的最短间隔(秒)
+INSERT_STATS_WINDOW = 300  # worker吞吐按最近这么多秒内完成的量计算
+INSERT_STATS_INTERVAL = 10  # worker上报吞吐的间隔(秒)，超过3个间隔未上报的worker不计入
+# 多租户公平调度：待入库文件按(user_id, kb_id)分流，按估算字符数做DRR(deficit round robin)轮流领取，
+# 每个用户的配额在其有待入库文件的知识库之间平分；小文件另有快速通道，不必排在大文件后面
+INSERT_DRR_QUANTUM = int(os.getenv("INSERT_DRR_QUANTUM", "200000"))  # 每轮给每个用户增加的配额(估算字符数)
+INSERT_SCHEDULE_HEAD = 16  # 每个(user_id, kb_id)最早的这么多个大文件、小文件参与调度
+INSERT_EXPRESS_MAX_BYTES = int(os.getenv("INSERT_EXPRESS_MAX_BYTES", str(512 * 1024)))  # 不超过该大小的文件走快速通道
+INSERT_EXPRESS_SLOTS = int(os.getenv("INSERT_EXPRESS_SLOTS", "1"))  # 每个worker在INSERT_WORKER_CONCURRENCY之外只给小文件用的并发
+INSERT_USER_MAX_RUNNING = int(os.getenv("INSERT_USER_MAX_RUNNING", "0"))  # 单个用户在所有worker上同时入库的文件数，0不限
+INSERT_KB_MAX_RUNNING = int(os.getenv("INSERT_KB_MAX_RUNNING", "0"))  # 单个知识库同时入库的文件数，0不限
+# 按用户覆盖权重和并发上限，key是File表中的user_id（user_id__user_info），如 {"abc__1234": {"weight": 2, "max_running": 8}}
+INSERT_TENANT_OVERRIDES = json.loads(os.getenv("INSERT_TENANT_OVERRIDES", "{}"))
+
+# 链路追踪配置
+TRACE_ENABLED = os.getenv("TRACE_ENABLED", "true").lower() == "true"
+TRACE_HEADER = "X-QAnything-Trace-Id"  # 跨服务（embedding/rerank/ocr）传递trace id的请求头
+TRACE_EXPORTER = os.getenv("TRACE_EXPORTER", "jsonl")  # jsonl: 写本地文件; otlp: 发送到OTLP/HTTP兼容的collector
+TRACE_JSONL_PATH = os.getenv("TRACE_JSONL_PATH", "./logs/trace_logs/trace.jsonl")
+TRACE_OTLP_ENDPOINT = os.getenv("TRACE_OTLP_ENDPOINT", "http://localhost:4318/v1/traces")
+TRACE_SERVICE_NAME = os.getenv("TRACE_SERVICE_NAME", "qanything")
 
 # llm_config = {
 #     # 回答的最大token数，一般来说对于国内模型一个中文不到1个token，国外模型一个中文1.5-2个token
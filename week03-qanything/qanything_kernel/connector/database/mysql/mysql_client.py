@@ -1,16 +1,22 @@
 from qanything_kernel.configs.model_config import (MYSQL_HOST_LOCAL, MYSQL_PORT_LOCAL, MYSQL_USER_LOCAL,
                                                    MYSQL_PASSWORD_LOCAL,
-                                                   MYSQL_DATABASE_LOCAL, KB_SUFFIX, MILVUS_HOST_LOCAL)
+                                                   MYSQL_DATABASE_LOCAL, KB_SUFFIX, MILVUS_HOST_LOCAL, DOCUMENT_DEDUP)
 from qanything_kernel.utils.custom_log import debug_logger, insert_logger
+from qanything_kernel.utils.json_codec import encode_json_data, decode_json_data
+from qanything_kernel.utils.chunk_content import split_document_json, join_document_json, content_hash, is_content_ref
 import mysql.connector
 from mysql.connector import pooling
 import json
+import re
 from typing import List, Optional, Dict
 import uuid
 from datetime import datetime, timedelta
 from collections import defaultdict
 from mysql.connector.errors import Error as MySQLError
 
+# parent chunk的doc_id：file_id_序号（Python的fullmatch和MySQL的REGEXP共用）
+DOC_ID_PATTERN = re.compile(r'^(.+)_([0-9]+)$')
+
 
 class KnowledgeBaseManager:
     def __init__(self, pool_size=8):
@@ -32,6 +38,7 @@ class KnowledgeBaseManager:
         self.free_cnx = pool_size
         self.used_cnx = 0
         self.create_tables_()
+        self.refresh_documents_schema()
         debug_logger.info("[SUCCESS] 数据库{}连接成功".format(database))
 
     def check_database_(self, host, port, user, password, database_name):
@@ -107,6 +114,47 @@ class KnowledgeBaseManager:
 
         return result
 
+    def execute_many_(self, query, params_list):
+        """
+        executemany（INSERT会被改写为多行INSERT），整批在一个事务中提交，返回影响的行数。
+        失败时回滚并抛出异常：批量写入失败不能被调用方当成写入成功
+        """
+        return self.execute_many_in_transaction_([(query, params_list)])[0]
+
+    def execute_many_in_transaction_(self, statements):
+        """
+        statements: [(query, params_list), ...]，依次executemany，在同一个连接、同一个事务中提交，
+        返回每条语句影响的行数；任何一条失败都整体回滚并抛出异常
+        """
+        try:
+            conn = self.cnxpool.get_connection()
+            self.used_cnx += 1
+            self.free_cnx -= 1
+        except MySQLError as err:
+            debug_logger.error("从连接池获取连接失败：{}".format(err))
+            raise
+
+        results = []
+        cursor = None
+        query = None
+        try:
+            cursor = conn.cursor()
+            for query, params_list in statements:
+                cursor.executemany(query, params_list)
+                results.append(cursor.rowcount)
+            conn.commit()
+        except MySQLError as err:
+            debug_logger.error("批量执行数据库操作失败：{}，SQL：{}".format(err, query))
+            conn.rollback()
+            raise
+        finally:
+            if cursor is not None:
+                cursor.close()
+            conn.close()
+            self.used_cnx -= 1
+            self.free_cnx += 1
+        return results
+
     def create_tables_(self):
         query = """
             CREATE TABLE IF NOT EXISTS User (
@@ -149,7 +197,11 @@ class KnowledgeBaseManager:
                 file_url VARCHAR(2048) DEFAULT '',
                 upload_infos TEXT,
                 chunk_size INT DEFAULT -1,
-                timestamp VARCHAR(255) DEFAULT '197001010000'
+                timestamp VARCHAR(255) DEFAULT '197001010000',
+                lease_owner VARCHAR(128) DEFAULT NULL,
+                lease_expire DATETIME DEFAULT NULL,
+                attempts INT DEFAULT 0,
+                INDEX idx_status_timestamp (status, timestamp)
             );
 
         """
@@ -177,7 +229,10 @@ class KnowledgeBaseManager:
             CREATE TABLE IF NOT EXISTS Documents (
                 id INT AUTO_INCREMENT PRIMARY KEY,
                 doc_id VARCHAR(255) UNIQUE,
-                json_data LONGTEXT
+                file_id VARCHAR(64) DEFAULT NULL,
+                ordinal INT DEFAULT NULL,
+                json_data LONGTEXT,
+                INDEX idx_file_id_ordinal (file_id, ordinal)
             ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;
         """
 
@@ -220,6 +275,57 @@ class KnowledgeBaseManager:
         # create_index_query = "CREATE INDEX IF NOT EXISTS index_timestamp ON QaLogs (timestamp);"
         # self.execute_query_(create_index_query, (), commit=True)
 
+        # 每个文件的parent chunk清单：有序的doc_id及各chunk的token数，入库时写入，问答时用来判断完整文档是否放得下并按范围取数
+        query = """
+            CREATE TABLE IF NOT EXISTS FileChunkManifest (
+                file_id VARCHAR(64) PRIMARY KEY,
+                manifest MEDIUMTEXT,
+                update_time TIMESTAMP DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP
+            ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;
+        """
+        self.execute_query_(query, (), commit=True)
+
+        # 每个parent chunk（及其子chunk）的内容指纹，重新入库同一文件时据此只更新变化的chunk
+        query = """
+            CREATE TABLE IF NOT EXISTS FileChunkFingerprint (
+                file_id VARCHAR(64) PRIMARY KEY,
+                fingerprints MEDIUMTEXT,
+                update_time TIMESTAMP DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP
+            ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;
+        """
+        self.execute_query_(query, (), commit=True)
+
+        # 内容寻址的parent chunk正文，多个知识库中相同的chunk只存一份，Documents.content_hash引用
+        query = """
+            CREATE TABLE IF NOT EXISTS ChunkContent (
+                content_hash VARCHAR(32) PRIMARY KEY,
+                json_data LONGTEXT,
+                create_time TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;
+        """
+        self.execute_query_(query, (), commit=True)
+
+        # 入库断点：解析结果（source_sig标识解析时的源文件），入库中断后重新领取时跳过解析
+        query = """
+            CREATE TABLE IF NOT EXISTS FileIngestCheckpoint (
+                file_id VARCHAR(64) PRIMARY KEY,
+                source_sig VARCHAR(512) NOT NULL,
+                parsed_chunks LONGTEXT,
+                update_time TIMESTAMP DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP
+            ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;
+        """
+        self.execute_query_(query, (), commit=True)
+
+        # 入库worker最近上报的吞吐和正在处理的文件，用于估算积压清空时间
+        query = """
+            CREATE TABLE IF NOT EXISTS InsertWorkerStats (
+                owner VARCHAR(255) PRIMARY KEY,
+                stats TEXT,
+                update_time TIMESTAMP DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP
+            ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;
+        """
+        self.execute_query_(query, (), commit=True)
+
         query = """
             CREATE TABLE IF NOT EXISTS FileImages (
                 id INT AUTO_INCREMENT PRIMARY KEY,
@@ -262,6 +368,18 @@ class KnowledgeBaseManager:
             # 如果没有的话，给QanythingBot添加一列：llm_setting VARCHAR(512)
             "ALTER TABLE QanythingBot ADD COLUMN llm_setting VARCHAR(512) DEFAULT '{}'",
             "ALTER TABLE QanythingBot DROP COLUMN model",
+            # 老版本的Documents表补充file_id和chunk序号列（MySQL 8为INSTANT操作），索引和历史数据回填由
+            # scripts/migrate_documents_file_id.py在线完成，完成前仍按doc_id前缀查询
+            "ALTER TABLE Documents ADD COLUMN file_id VARCHAR(64) DEFAULT NULL",
+            "ALTER TABLE Documents ADD COLUMN ordinal INT DEFAULT NULL",
+            # 入库服务的任务领取/租约字段
+            "ALTER TABLE File ADD COLUMN lease_owner VARCHAR(128) DEFAULT NULL",
+            "ALTER TABLE File ADD COLUMN lease_expire DATETIME DEFAULT NULL",
+            "ALTER TABLE File ADD COLUMN attempts INT DEFAULT 0",
+            "CREATE INDEX idx_status_timestamp ON File (status, timestamp)",
+            # parent chunk内容寻址：引用的ChunkContent，按内容hash查引用数和共享副本
+            "ALTER TABLE Documents ADD COLUMN content_hash VARCHAR(32) DEFAULT NULL",
+            "CREATE INDEX idx_content_hash ON Documents (content_hash)",
         ]
 
         for query in index_queries:
@@ -280,10 +398,15 @@ class KnowledgeBaseManager:
 
         debug_logger.info("All tables and indexes checked/created successfully.")
 
-    def update_file_msg(self, file_id, msg):
+    def update_file_msg(self, file_id, msg, only_status=None):
+        """only_status: 只在文件仍处于该状态时更新，避免入库进度覆盖已写回的最终结果"""
         query = "UPDATE File SET msg = %s WHERE file_id = %s"
+        params = (msg, file_id)
+        if only_status is not None:
+            query += " AND status = %s"
+            params += (only_status,)
         insert_logger.info(f"Update file msg: {file_id} {msg}")
-        self.execute_query_(query, (msg, file_id), commit=True)
+        self.execute_query_(query, params, commit=True)
 
     def update_file_upload_infos(self, file_id, upload_infos):
         upload_infos = json.dumps(upload_infos, ensure_ascii=False)
@@ -453,6 +576,17 @@ class KnowledgeBaseManager:
                             commit=True)
         return "success"
 
+    def requeue_file(self, file_id, file_size, chunk_size, timestamp, file_url=''):
+        """strong模式上传同名文件时沿用原file_id重新入库，入库服务按chunk指纹只更新变化的部分；正在入库的文件不处理"""
+        query = ("UPDATE File SET status = 'gray', file_size = %s, chunk_size = %s, timestamp = %s, file_url = %s, "
+                 "msg = '', attempts = 0, lease_owner = NULL, lease_expire = NULL "
+                 "WHERE file_id = %s AND deleted = 0 AND status IN ('green', 'red')")
+        res = self.execute_query_(query, (file_size, chunk_size, timestamp, file_url, file_id), commit=True,
+                                  check=True)
+        if res:
+            self.delete_parse_checkpoints([file_id])
+        return res
+
     #  更新file中的content_length
     def update_content_length(self, file_id, content_length):
         query = "UPDATE File SET content_length = %s WHERE file_id = %s"
@@ -460,7 +594,7 @@ class KnowledgeBaseManager:
 
     #  更新file中的chunk_number
     def update_chunks_number(self, file_id, chunks_number):
-        query = "UPDATE File SET chunk_size = %s WHERE file_id = %s"
+        query = "UPDATE File SET chunks_number = %s WHERE file_id = %s"
         self.execute_query_(query, (chunks_number, file_id), commit=True)
 
     def update_file_status(self, file_id, status):
@@ -564,16 +698,204 @@ class KnowledgeBaseManager:
         debug_logger.info("delete_files: {}".format(file_ids))
         self.execute_query_(query, (kb_id,), commit=True)
 
+    def refresh_documents_schema(self):
+        """
+        检查Documents表的file_id/ordinal列和索引：
+        - documents_has_file_id: 列已存在，写入时同时填写file_id和ordinal
+        - documents_file_id_ready: 索引已建且历史数据已回填，按文件查询时走(file_id, ordinal)索引
+        - documents_dedup: 有content_hash列且开启了DOCUMENT_DEDUP，parent chunk正文按内容hash存入ChunkContent
+        """
+        query = ("SELECT COLUMN_NAME FROM information_schema.COLUMNS WHERE TABLE_SCHEMA = DATABASE() "
+                 "AND TABLE_NAME = 'Documents' AND COLUMN_NAME IN ('file_id', 'ordinal', 'content_hash')")
+        columns = {row[0] for row in self.execute_query_(query, (), fetch=True) or []}
+        self.documents_has_file_id = {'file_id', 'ordinal'} <= columns
+        self.documents_dedup = DOCUMENT_DEDUP and self.documents_has_file_id and 'content_hash' in columns
+        self.documents_file_id_ready = False
+        if self.documents_has_file_id:
+            query = ("SELECT 1 FROM information_schema.STATISTICS WHERE TABLE_SCHEMA = DATABASE() "
+                     "AND TABLE_NAME = 'Documents' AND INDEX_NAME = 'idx_file_id_ordinal' LIMIT 1")
+            has_index = bool(self.execute_query_(query, (), fetch=True))
+            if has_index:
+                # 只看形如file_id_序号的行，uuid等其他doc_id本来就不带file_id
+                not_backfilled = self.execute_query_(
+                    "SELECT 1 FROM Documents WHERE file_id IS NULL AND doc_id REGEXP %s LIMIT 1",
+                    (DOC_ID_PATTERN.pattern,), fetch=True)
+                self.documents_file_id_ready = not not_backfilled
+        debug_logger.info(f"Documents file_id column: {self.documents_has_file_id}, "
+                          f"file_id index ready: {self.documents_file_id_ready}, dedup: {self.documents_dedup}")
+
+    @staticmethod
+    def split_doc_id(doc_id):
+        # parent chunk的doc_id形如 file_id_序号；markdown表格等整块存入的doc_id是uuid，file_id和ordinal写NULL
+        match = DOC_ID_PATTERN.fullmatch(doc_id)
+        if not match:
+            return None, None
+        return match.group(1), int(match.group(2))
+
     def add_document(self, doc_id, json_data):
-        json_data = json.dumps(json_data, ensure_ascii=False)
+        json_data = encode_json_data(json_data)
         # insert_logger.info("add_document: {}".format(doc_id))
-        query = "INSERT IGNORE INTO Documents (doc_id, json_data) VALUES (%s, %s)"
-        self.execute_query_(query, (doc_id, json_data), commit=True, check=True)
+        if self.documents_has_file_id:
+            file_id, ordinal = self.split_doc_id(doc_id)
+            query = "INSERT IGNORE INTO Documents (doc_id, file_id, ordinal, json_data) VALUES (%s, %s, %s, %s)"
+            self.execute_query_(query, (doc_id, file_id, ordinal, json_data), commit=True, check=True)
+        else:
+            query = "INSERT IGNORE INTO Documents (doc_id, json_data) VALUES (%s, %s)"
+            self.execute_query_(query, (doc_id, json_data), commit=True, check=True)
+
+    def add_documents_bulk(self, docs, batch_size=500, max_batch_bytes=4 * 1024 * 1024) -> int:
+        """
+        批量写入parent chunk，docs: [(doc_id, json_data), ...]
+        按条数和字节数分批，每批一条多行INSERT、一个事务；doc_id已存在时覆盖为新内容（重新入库、update_chunks）
+        任何一批写入失败都抛出MySQLError，由入库流程整体失败重试，不会把没写进去的parent当成已写入
+        """
+        if self.documents_dedup:
+            return self._add_documents_dedup(docs, batch_size, max_batch_bytes)
+        if self.documents_has_file_id:
+            query = ("INSERT INTO Documents (doc_id, file_id, ordinal, json_data) VALUES (%s, %s, %s, %s) "
+                     "ON DUPLICATE KEY UPDATE file_id = VALUES(file_id), ordinal = VALUES(ordinal), "
+                     "json_data = VALUES(json_data)")
+        else:
+            query = ("INSERT INTO Documents (doc_id, json_data) VALUES (%s, %s) "
+                     "ON DUPLICATE KEY UPDATE json_data = VALUES(json_data)")
+        total_rows = 0
+        batch, batch_bytes = [], 0
+        for doc_id, json_data in docs:
+            json_data = encode_json_data(json_data)
+            if self.documents_has_file_id:
+                file_id, ordinal = self.split_doc_id(doc_id)
+                batch.append((doc_id, file_id, ordinal, json_data))
+            else:
+                batch.append((doc_id, json_data))
+            batch_bytes += len(json_data)
+            if len(batch) >= batch_size or batch_bytes >= max_batch_bytes:
+                total_rows += self.execute_many_(query, batch)
+                batch, batch_bytes = [], 0
+        if batch:
+            total_rows += self.execute_many_(query, batch)
+        # ON DUPLICATE KEY UPDATE时，更新的行计为2，新插入的行计为1
+        insert_logger.info(f"add_documents_bulk: {len(docs)} docs, affected rows: {total_rows}")
+        return total_rows
+
+    def _add_documents_dedup(self, docs, batch_size, max_batch_bytes) -> int:
+        """
+        内容寻址写入：Documents只存归属信息和内容hash，正文按hash INSERT IGNORE写入ChunkContent。
+        每批先写内容再写Documents中的引用，两步在同一个事务中提交，任何一步失败都整体回滚并抛出异常，
+        不会留下指向不存在内容的引用；INSERT IGNORE会锁住已存在的内容行，并发的gc_chunk_contents要等提交后
+        才能判断引用数，看到的已经是新引用。覆盖写入的doc_id原来引用的内容，提交后再按引用数回收。
+        """
+        doc_query = ("INSERT INTO Documents (doc_id, file_id, ordinal, json_data, content_hash) "
+                     "VALUES (%s, %s, %s, %s, %s) ON DUPLICATE KEY UPDATE file_id = VALUES(file_id), "
+                     "ordinal = VALUES(ordinal), json_data = VALUES(json_data), content_hash = VALUES(content_hash)")
+        content_query = "INSERT IGNORE INTO ChunkContent (content_hash, json_data) VALUES (%s, %s)"
+        total_rows, shared_rows = 0, 0
+        batch, contents, batch_bytes = [], {}, 0
+
+        def flush():
+            nonlocal total_rows
+            old_hashes = self.get_content_hashes_by_doc_ids([row[0] for row in batch])
+            _, doc_rows = self.execute_many_in_transaction_([(content_query, list(contents.items())),
+                                                             (doc_query, batch)])
+            total_rows += doc_rows
+            self.gc_chunk_contents(set(old_hashes.values()) - {row[4] for row in batch})
+
+        for doc_id, json_data in docs:
+            shared, ref = split_document_json(json_data)
+            ref['content_ref'] = ref_hash = content_hash(shared)
+            file_id, ordinal = self.split_doc_id(doc_id)
+            ref_json = encode_json_data(ref)
+            batch.append((doc_id, file_id, ordinal, ref_json, ref_hash))
+            batch_bytes += len(ref_json)
+            if ref_hash in contents:
+                shared_rows += 1
+            else:
+                contents[ref_hash] = encode_json_data(shared)
+                batch_bytes += len(contents[ref_hash])
+            if len(batch) >= batch_size or batch_bytes >= max_batch_bytes:
+                flush()
+                batch, contents, batch_bytes = [], {}, 0
+        if batch:
+            flush()
+        insert_logger.info(f"add_documents_bulk: {len(docs)} docs, affected rows: {total_rows}, "
+                           f"duplicate contents in batch: {shared_rows}")
+        return total_rows
+
+    def get_content_hashes_by_doc_ids(self, doc_ids, batch_size=500) -> Dict[str, str]:
+        hashes = {}
+        for i in range(0, len(doc_ids), batch_size):
+            batch_doc_ids = doc_ids[i:i + batch_size]
+            query = ("SELECT doc_id, content_hash FROM Documents WHERE doc_id IN ({}) "
+                     "AND content_hash IS NOT NULL").format(','.join(['%s'] * len(batch_doc_ids)))
+            hashes.update(self.execute_query_(query, batch_doc_ids, fetch=True) or [])
+        return hashes
+
+    def get_chunk_contents(self, hashes, batch_size=500) -> Dict[str, Dict]:
+        contents = {}
+        hashes = list(hashes)
+        for i in range(0, len(hashes), batch_size):
+            batch_hashes = hashes[i:i + batch_size]
+            query = "SELECT content_hash, json_data FROM ChunkContent WHERE content_hash IN ({})".format(
+                ','.join(['%s'] * len(batch_hashes)))
+            for ref_hash, json_data in self.execute_query_(query, batch_hashes, fetch=True) or []:
+                contents[ref_hash] = decode_json_data(json_data)
+        return contents
+
+    def get_doc_ids_by_content_hashes(self, hashes, exclude_file_id=None, batch_size=500) -> Dict[str, str]:
+        """其他文件中引用了这些内容的parent chunk，每个内容取一个：{content_hash: doc_id}"""
+        doc_ids = {}
+        hashes = list(hashes)
+        for i in range(0, len(hashes), batch_size):
+            batch_hashes = hashes[i:i + batch_size]
+            query = ("SELECT content_hash, MIN(doc_id) FROM Documents WHERE content_hash IN ({}) AND file_id <> %s "
+                     "GROUP BY content_hash").format(','.join(['%s'] * len(batch_hashes)))
+            doc_ids.update(self.execute_query_(query, (*batch_hashes, exclude_file_id or ''), fetch=True) or [])
+        return doc_ids
+
+    def gc_chunk_contents(self, hashes, batch_size=500) -> int:
+        """删除不再被任何Documents行引用（引用数为0）的内容，返回删除的条数"""
+        hashes = [ref_hash for ref_hash in hashes if ref_hash]
+        total_deleted = 0
+        for i in range(0, len(hashes), batch_size):
+            batch_hashes = hashes[i:i + batch_size]
+            query = ("DELETE FROM ChunkContent WHERE content_hash IN ({}) AND NOT EXISTS "
+                     "(SELECT 1 FROM Documents WHERE Documents.content_hash = ChunkContent.content_hash)").format(
+                ','.join(['%s'] * len(batch_hashes)))
+            total_deleted += self.execute_query_(query, batch_hashes, commit=True, check=True) or 0
+        if total_deleted:
+            debug_logger.info(f"gc chunk contents: {total_deleted} of {len(hashes)} released")
+        return total_deleted
+
+    def _resolve_content_refs(self, json_datas: List[Dict]) -> List[Optional[Dict]]:
+        """把Documents中的内容引用还原为完整的文档json，引用的内容缺失时对应位置为None"""
+        hashes = {json_data['content_ref'] for json_data in json_datas if is_content_ref(json_data)}
+        if not hashes:
+            return json_datas
+        contents = self.get_chunk_contents(hashes)
+        resolved = []
+        for json_data in json_datas:
+            if is_content_ref(json_data):
+                shared = contents.get(json_data['content_ref'])
+                if shared is None:
+                    debug_logger.error(f"chunk content {json_data['content_ref']} not found")
+                    resolved.append(None)
+                    continue
+                json_data = join_document_json(shared, json_data)
+            resolved.append(json_data)
+        return resolved
 
     def update_document(self, doc_id, update_content):
         ori_doc_json = self.get_document_by_doc_id(doc_id)
         ori_doc_json['kwargs']['page_content'] = update_content
-        new_doc_json = json.dumps(ori_doc_json, ensure_ascii=False)
+        # 内容变了，预先计算的token数失效，重新入库时会再计算
+        ori_doc_json['kwargs']['metadata'].pop('token_counts', None)
+        new_doc_json = encode_json_data(ori_doc_json)
+        if self.documents_dedup:
+            # 修改后的内容不再与其他副本共享，整行保存，原来引用的内容按引用数回收
+            old_hashes = self.get_content_hashes_by_doc_ids([doc_id])
+            query = "UPDATE Documents SET json_data = %s, content_hash = NULL WHERE doc_id = %s"
+            self.execute_query_(query, (new_doc_json, doc_id), commit=True, check=True)
+            self.gc_chunk_contents(old_hashes.values())
+            return
         query = "UPDATE Documents SET json_data = %s WHERE doc_id = %s"
         self.execute_query_(query, (new_doc_json, doc_id), commit=True, check=True)
 
@@ -582,7 +904,30 @@ class KnowledgeBaseManager:
         query = "INSERT INTO Faqs (faq_id, user_id, kb_id, question, answer, nos_keys) VALUES (%s, %s, %s, %s, %s, %s)"
         self.execute_query_(query, (faq_id, user_id, kb_id, question, answer, nos_keys), commit=True)
 
+    def get_document_page_by_file_id(self, file_id, start_ordinal, limit) -> List[Dict]:
+        """按(file_id, ordinal)索引取从start_ordinal开始的limit个chunk（keyset分页，不使用OFFSET）"""
+        query = ("SELECT doc_id, json_data FROM Documents WHERE file_id = %s AND ordinal >= %s "
+                 "ORDER BY ordinal LIMIT %s")
+        rows = self.execute_query_(query, (file_id, start_ordinal, limit), fetch=True) or []
+        json_datas = []
+        for (doc_id, _), json_data in zip(rows, self._resolve_content_refs([decode_json_data(row[1]) for row in rows])):
+            if json_data is None:
+                continue
+            json_data['kwargs']['chunk_id'] = doc_id
+            json_datas.append(json_data)
+        return json_datas
+
+    def count_documents_by_file_id(self, file_id) -> int:
+        if self.documents_file_id_ready:
+            res = self.execute_query_("SELECT COUNT(*) FROM Documents WHERE file_id = %s", (file_id,), fetch=True)
+        else:
+            res = self.execute_query_("SELECT COUNT(*) FROM Documents WHERE doc_id LIKE %s", (f"{file_id}_%",),
+                                      fetch=True)
+        return res[0][0] if res else 0
+
     def get_document_by_file_id(self, file_id, batch_size=100) -> Optional[List]:
+        if self.documents_file_id_ready:
+            return self._get_document_by_file_id_keyset(file_id, batch_size=max(batch_size, 500))
         # 初始化结果列表
         all_json_datas = []
 
@@ -599,12 +944,13 @@ class KnowledgeBaseManager:
                 break  # 如果没有更多数据，跳出循环
 
             doc_ids = [doc[0].split('_')[1] for doc in doc_all]
-            json_datas = [json.loads(doc[1]) for doc in doc_all]
+            json_datas = self._resolve_content_refs([decode_json_data(doc[1]) for doc in doc_all])
             for doc_id, json_data in zip(doc_ids, json_datas):
+                if json_data is None:
+                    continue
                 json_data['kwargs']['chunk_id'] = file_id + '_' + str(doc_id)
-
-            # 将doc_id和json_data打包并追加到结果列表
-            all_json_datas.extend(zip(doc_ids, json_datas))
+                # 将doc_id和json_data打包并追加到结果列表
+                all_json_datas.append((doc_id, json_data))
 
             offset += batch_size  # 更新offset
 
@@ -617,11 +963,120 @@ class KnowledgeBaseManager:
             return sorted_json_datas
         return None
 
+    def _get_document_by_file_id_keyset(self, file_id, batch_size=500) -> Optional[List]:
+        # 按(file_id, ordinal)索引顺序扫描，每批从上一批最后一个序号之后开始，已是有序结果无需再排序
+        query = ("SELECT doc_id, ordinal, json_data FROM Documents WHERE file_id = %s AND ordinal > %s "
+                 "ORDER BY ordinal LIMIT %s")
+        sorted_json_datas = []
+        last_ordinal = -1
+        while True:
+            rows = self.execute_query_(query, (file_id, last_ordinal, batch_size), fetch=True)
+            if not rows:
+                break
+            json_datas = self._resolve_content_refs([decode_json_data(row[2]) for row in rows])
+            for (doc_id, _, _), json_data in zip(rows, json_datas):
+                if json_data is None:
+                    continue
+                json_data['kwargs']['chunk_id'] = doc_id
+                sorted_json_datas.append(json_data)
+            last_ordinal = rows[-1][1]
+            if len(rows) < batch_size:
+                break
+        debug_logger.info(f"get_document: file_id: {file_id}, mysql parent documents res: {len(sorted_json_datas)}")
+        return sorted_json_datas or None
+
+    def get_documents_by_doc_ids(self, doc_ids, batch_size=500) -> Dict[str, Dict]:
+        """按doc_id(唯一索引)批量取parent chunk，返回{doc_id: json_data}"""
+        docs = {}
+        for i in range(0, len(doc_ids), batch_size):
+            batch_doc_ids = doc_ids[i:i + batch_size]
+            query = "SELECT doc_id, json_data FROM Documents WHERE doc_id IN ({})".format(
+                ','.join(['%s'] * len(batch_doc_ids)))
+            rows = self.execute_query_(query, batch_doc_ids, fetch=True) or []
+            for (doc_id, _), json_data in zip(rows, self._resolve_content_refs([decode_json_data(row[1])
+                                                                                for row in rows])):
+                if json_data is None:
+                    continue
+                json_data['kwargs']['chunk_id'] = doc_id
+                docs[doc_id] = json_data
+        return docs
+
+    def upsert_chunk_manifest(self, file_id, chunks, merge=False):
+        """
+        写入文件的chunk清单，chunks: [[doc_id, {encoding: tokens}], ...]
+        merge为True时只更新传入的chunk（如update_chunks重新入库单个chunk），否则整体覆盖
+        """
+        if merge:
+            ori_chunks = self.get_chunk_manifest(file_id)
+            if ori_chunks is None:
+                # 没有清单的老文件，只合并一部分chunk会得到不完整的清单，不如不写
+                return
+            merged = dict((doc_id, counts) for doc_id, counts in ori_chunks)
+            merged.update((doc_id, counts) for doc_id, counts in chunks)
+            chunks = [[doc_id, counts] for doc_id, counts in merged.items()]
+        chunks.sort(key=lambda x: int(x[0].split('_')[-1]))
+        manifest = json.dumps({'chunks': chunks}, ensure_ascii=False)
+        query = ("INSERT INTO FileChunkManifest (file_id, manifest) VALUES (%s, %s) "
+                 "ON DUPLICATE KEY UPDATE manifest = VALUES(manifest)")
+        self.execute_query_(query, (file_id, manifest), commit=True)
+
+    def get_chunk_manifest(self, file_id) -> Optional[List]:
+        query = "SELECT manifest FROM FileChunkManifest WHERE file_id = %s"
+        res = self.execute_query_(query, (file_id,), fetch=True)
+        if not res:
+            return None
+        return json.loads(res[0][0])['chunks']
+
+    def upsert_chunk_fingerprints(self, file_id, fingerprints: Dict):
+        query = ("INSERT INTO FileChunkFingerprint (file_id, fingerprints) VALUES (%s, %s) "
+                 "ON DUPLICATE KEY UPDATE fingerprints = VALUES(fingerprints)")
+        self.execute_query_(query, (file_id, json.dumps(fingerprints, ensure_ascii=False)), commit=True)
+
+    def get_chunk_fingerprints(self, file_id) -> Optional[Dict]:
+        query = "SELECT fingerprints FROM FileChunkFingerprint WHERE file_id = %s"
+        res = self.execute_query_(query, (file_id,), fetch=True)
+        if not res:
+            return None
+        return json.loads(res[0][0])
+
+    def delete_chunk_fingerprints(self, file_ids):
+        query = "DELETE FROM FileChunkFingerprint WHERE file_id IN ({})".format(','.join(['%s'] * len(file_ids)))
+        self.execute_query_(query, list(file_ids), commit=True)
+
+    def save_parse_checkpoint(self, file_id, source_sig, chunks):
+        query = ("INSERT INTO FileIngestCheckpoint (file_id, source_sig, parsed_chunks) VALUES (%s, %s, %s) "
+                 "ON DUPLICATE KEY UPDATE source_sig = VALUES(source_sig), parsed_chunks = VALUES(parsed_chunks)")
+        self.execute_query_(query, (file_id, source_sig, encode_json_data(chunks)), commit=True)
+
+    def get_parse_checkpoint(self, file_id, source_sig) -> Optional[List]:
+        """源文件没变时返回保存的解析结果（LocalFileForInsert.dump_chunks()的格式）"""
+        query = "SELECT parsed_chunks FROM FileIngestCheckpoint WHERE file_id = %s AND source_sig = %s"
+        res = self.execute_query_(query, (file_id, source_sig), fetch=True)
+        if not res:
+            return None
+        return decode_json_data(res[0][0])
+
+    def delete_parse_checkpoints(self, file_ids):
+        if not file_ids:
+            return
+        query = "DELETE FROM FileIngestCheckpoint WHERE file_id IN ({})".format(','.join(['%s'] * len(file_ids)))
+        self.execute_query_(query, list(file_ids), commit=True)
+
+    def delete_documents_by_doc_ids(self, doc_ids, batch_size=500):
+        total_deleted = 0
+        for i in range(0, len(doc_ids), batch_size):
+            batch_doc_ids = doc_ids[i:i + batch_size]
+            old_hashes = self.get_content_hashes_by_doc_ids(batch_doc_ids) if self.documents_dedup else {}
+            query = "DELETE FROM Documents WHERE doc_id IN ({})".format(','.join(['%s'] * len(batch_doc_ids)))
+            total_deleted += self.execute_query_(query, batch_doc_ids, commit=True, check=True) or 0
+            self.gc_chunk_contents(set(old_hashes.values()))
+        return total_deleted
+
     def get_document_by_doc_id(self, doc_id) -> Optional[Dict]:
         query = "SELECT json_data FROM Documents WHERE doc_id = %s"
         doc_all = self.execute_query_(query, (doc_id,), fetch=True)
         if doc_all:
-            doc = json.loads(doc_all[0][0])
+            doc = self._resolve_content_refs([decode_json_data(doc_all[0][0])])[0]
             # debug_logger.info(f"get_document: doc_id: {doc_id}")
             return doc
         else:
@@ -643,12 +1098,29 @@ class KnowledgeBaseManager:
         #  获取所有形如"file_id_"开头的doc_id的documents，然后再删除
         total_deleted = 0
         for file_id in file_ids:
+            if self.documents_file_id_ready:
+                content_hashes = []
+                if self.documents_dedup:
+                    # 先记下文件引用的内容，删完Documents后回收引用数为0的
+                    res = self.execute_query_("SELECT DISTINCT content_hash FROM Documents WHERE file_id = %s "
+                                              "AND content_hash IS NOT NULL", (file_id,), fetch=True) or []
+                    content_hashes = [row[0] for row in res]
+                # 走(file_id, ordinal)索引分批删除，避免一次删除大量行造成长事务
+                while True:
+                    res = self.execute_query_("DELETE FROM Documents WHERE file_id = %s LIMIT 1000", (file_id,),
+                                              commit=True, check=True)
+                    total_deleted += res or 0
+                    if not res or res < 1000:
+                        break
+                self.gc_chunk_contents(content_hashes)
+                continue
             query = f"SELECT doc_id FROM Documents WHERE doc_id LIKE \"{file_id}_%\""
             doc_ids = self.execute_query_(query, None, fetch=True)
             debug_logger.info(f"Found documents to delete: {doc_ids}, {file_id}")
 
             if doc_ids:
                 doc_ids = [doc_id[0] for doc_id in doc_ids]
+                content_hashes = self.get_content_hashes_by_doc_ids(doc_ids) if self.documents_dedup else {}
                 batch_size = 100
                 for i in range(0, len(doc_ids), batch_size):
                     batch_doc_ids = doc_ids[i:i + batch_size]
@@ -656,6 +1128,11 @@ class KnowledgeBaseManager:
                         ','.join(['%s'] * len(batch_doc_ids)))
                     res = self.execute_query_(delete_query, batch_doc_ids, commit=True, check=True)
                     total_deleted += res
+                self.gc_chunk_contents(set(content_hashes.values()))
+        if file_ids:
+            delete_query = "DELETE FROM FileChunkManifest WHERE file_id IN ({})".format(','.join(['%s'] * len(file_ids)))
+            self.execute_query_(delete_query, list(file_ids), commit=True)
+            self.delete_chunk_fingerprints(file_ids)
         debug_logger.info(f"Deleted documents count: {total_deleted}")
 
     def delete_faqs(self, faq_ids):
@@ -877,6 +1354,28 @@ class KnowledgeBaseManager:
         query = "SELECT file_id, file_name FROM File WHERE status = %s AND deleted = 0"
         return self.execute_query_(query, (status,), fetch=True)
 
+    def get_insert_backlog(self) -> Dict[str, List[int]]:
+        """待入库(gray)和入库中(yellow)的文件数与总字节数：{status: [文件数, 字节数]}"""
+        query = ("SELECT status, COUNT(*), COALESCE(SUM(file_size), 0) FROM File "
+                 "WHERE deleted = 0 AND status IN ('gray', 'yellow') GROUP BY status")
+        res = self.execute_query_(query, (), fetch=True) or []
+        return {status: [int(count), int(size)] for status, count, size in res}
+
+    def upsert_insert_worker_stats(self, owner, stats: Dict):
+        query = ("INSERT INTO InsertWorkerStats (owner, stats) VALUES (%s, %s) "
+                 "ON DUPLICATE KEY UPDATE stats = VALUES(stats), update_time = CURRENT_TIMESTAMP")
+        self.execute_query_(query, (owner, json.dumps(stats, ensure_ascii=False)), commit=True)
+
+    def get_insert_worker_stats(self, max_age) -> List[Dict]:
+        """最近max_age秒内上报过的worker"""
+        query = "SELECT stats FROM InsertWorkerStats WHERE update_time >= NOW() - INTERVAL %s SECOND"
+        res = self.execute_query_(query, (max_age,), fetch=True) or []
+        return [json.loads(row[0]) for row in res]
+
+    def delete_insert_worker_stats(self, owner):
+        query = "DELETE FROM InsertWorkerStats WHERE owner = %s"
+        self.execute_query_(query, (owner,), commit=True)
+
     def get_file_location(self, file_id):
         query = "SELECT file_location FROM File WHERE file_id = %s"
         result = self.execute_query_(query, (file_id,), fetch=True)
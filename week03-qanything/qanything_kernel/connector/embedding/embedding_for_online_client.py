@@ -1,9 +1,14 @@
 """Wrapper around YouDao embedding models."""
-from typing import List
+from typing import List, Optional
 from qanything_kernel.utils.custom_log import debug_logger, embed_logger
-from qanything_kernel.utils.general_utils import get_time_async, get_time
+from qanything_kernel.utils.general_utils import get_time_async, get_time, num_tokens_embed
+from qanything_kernel.utils.tracing import get_trace_headers
 from langchain_core.embeddings import Embeddings
-from qanything_kernel.configs.model_config import LOCAL_EMBED_SERVICE_URL, LOCAL_RERANK_BATCH
+from qanything_kernel.configs.model_config import (LOCAL_EMBED_SERVICE_URL, LOCAL_RERANK_BATCH, LOCAL_EMBED_MAX_LENGTH,
+                                                   LOCAL_EMBED_TOKEN_BUDGET, LOCAL_EMBED_CACHE_SIZE)
+from collections import OrderedDict
+import numpy as np
+import hashlib
 import traceback
 import aiohttp
 import asyncio
@@ -21,35 +26,79 @@ class YouDaoEmbeddings(Embeddings):
         self.model_version = 'local_v20240725'
         self.url = f"http://{LOCAL_EMBED_SERVICE_URL}/embedding"
         self.session = requests.Session()
+        self._cache = OrderedDict()  # sha1(text) -> np.ndarray，LRU
         super().__init__()
 
     async def _get_embedding_async(self, session, queries):
         data = {'texts': queries}
-        async with session.post(self.url, json=data) as response:
+        async with session.post(self.url, json=data, headers=get_trace_headers()) as response:
             return await response.json()
 
+    @staticmethod
+    def token_budget_batches(texts: List[str], token_budget: int = LOCAL_EMBED_TOKEN_BUDGET) -> List[List[str]]:
+        """按token预算把文本顺序切成若干批，服务端会截断到LOCAL_EMBED_MAX_LENGTH，所以单条最多按该长度计"""
+        batches, batch, batch_tokens = [], [], 0
+        for text in texts:
+            tokens = min(num_tokens_embed(text), LOCAL_EMBED_MAX_LENGTH)
+            if batch and batch_tokens + tokens > token_budget:
+                batches.append(batch)
+                batch, batch_tokens = [], 0
+            batch.append(text)
+            batch_tokens += tokens
+        if batch:
+            batches.append(batch)
+        return batches
+
     @get_time_async
-    async def aembed_documents(self, texts: List[str]) -> List[List[float]]:
-        batch_size = LOCAL_RERANK_BATCH  # 增大客户端批处理大小
-        # 向上取整
-        embed_logger.info(f'embedding texts number: {len(texts) / batch_size}')
+    async def aembed_documents(self, texts: List[str], token_budget: Optional[int] = None) -> List[List[float]]:
+        """token_budget为None时按LOCAL_RERANK_BATCH条数分批，否则按token预算合并成尽量少的请求"""
+        if token_budget is None:
+            batch_size = LOCAL_RERANK_BATCH  # 增大客户端批处理大小
+            batches = [texts[i:i + batch_size] for i in range(0, len(texts), batch_size)]
+        else:
+            batches = self.token_budget_batches(texts, token_budget)
+        embed_logger.info(f'embedding texts number: {len(texts)}, batches: {len(batches)}')
         all_embeddings = []
         async with aiohttp.ClientSession() as session:
-            tasks = [self._get_embedding_async(session, texts[i:i + batch_size])
-                     for i in range(0, len(texts), batch_size)]
+            tasks = [self._get_embedding_async(session, batch) for batch in batches]
             results = await asyncio.gather(*tasks)
             for result in results:
                 all_embeddings.extend(result)
         debug_logger.info(f'success embedding number: {len(all_embeddings)}')
         return all_embeddings
 
+    async def aembed_documents_cached(self, texts: List[str],
+                                      token_budget: int = LOCAL_EMBED_TOKEN_BUDGET) -> np.ndarray:
+        """按内容hash缓存embedding，只对未命中的文本发起一次按token预算合并的请求，返回(len(texts), dim)的float32矩阵"""
+        keys = [hashlib.sha1(text.encode('utf-8')).hexdigest() for text in texts]
+        found, missing = {}, {}
+        for key, text in zip(keys, texts):
+            if key in found or key in missing:
+                continue
+            vector = self._cache.get(key)
+            if vector is None:
+                missing[key] = text
+            else:
+                self._cache.move_to_end(key)
+                found[key] = vector
+        if missing:
+            embeddings = await self.aembed_documents(list(missing.values()), token_budget=token_budget)
+            for key, embedding in zip(missing, embeddings):
+                vector = np.asarray(embedding, dtype=np.float32)
+                found[key] = vector
+                self._cache[key] = vector
+            while len(self._cache) > LOCAL_EMBED_CACHE_SIZE:
+                self._cache.popitem(last=False)
+        embed_logger.info('embedding cache hit: %s/%s', len(found) - len(missing), len(found))
+        return np.stack([found[key] for key in keys])
+
     async def aembed_query(self, text: str) -> List[float]:
         return (await self.aembed_documents([text]))[0]
 
     def _get_embedding_sync(self, texts):
         data = {'texts': [_process_query(text) for text in texts]}
         try:
-            response = self.session.post(self.url, json=data)
+            response = self.session.post(self.url, json=data, headers=get_trace_headers())
             response.raise_for_status()
             result = response.json()
             return result
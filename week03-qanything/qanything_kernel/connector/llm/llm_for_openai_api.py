@@ -4,6 +4,8 @@ from typing import List, Optional
 import json
 from qanything_kernel.connector.llm.base import AnswerResult
 from qanything_kernel.utils.custom_log import debug_logger
+from qanything_kernel.utils.tracing import get_trace_headers
+from qanything_kernel.utils.general_utils import strip_figure_references
 import tiktoken
 
 
@@ -70,19 +72,38 @@ class OpenAILLM:
             total_tokens *= 1.1  # 保留一定余量，由于metadata信息的嵌入导致token比计算的会多一些
         return int(total_tokens)
 
-    def num_tokens_from_docs(self, docs):
-        total_tokens = 0
-        for doc in docs:
-            # 对每个文本进行分词
-            tokens = self.tokenizer.encode(doc.page_content, disallowed_special=())
-            # 累加tokens数量
-            total_tokens += len(tokens)
+    def _raw_doc_tokens(self, doc, content):
+        # 优先使用入库时预先计算的token数（compute_chunk_token_counts，统计的是去掉图片引用后的内容），
+        # 长度对不上说明内容被改过或含图片引用，重新计算
+        token_counts = doc.metadata.get('token_counts')
+        if token_counts and token_counts.get('content_len') == len(content) and self.tokenizer.name in token_counts:
+            return token_counts[self.tokenizer.name]
+        return len(self.tokenizer.encode(content, disallowed_special=()))
+
+    def with_token_margin(self, total_tokens):
         if self.use_cl100k_base:
             total_tokens *= 1.2
         else:
             total_tokens *= 1.1  # 保留一定余量，由于metadata信息的嵌入导致token比计算的会多一些
         return int(total_tokens)
 
+    def num_tokens_from_doc(self, doc):
+        """单个文档(不含图片引用)的token数，与num_tokens_from_messages([doc_valid_content])结果一致"""
+        return self.with_token_margin(self._raw_doc_tokens(doc, strip_figure_references(doc.page_content)))
+
+    def num_tokens_from_doc_headers(self, doc):
+        """文档headers字段的token数，与num_tokens_from_messages([f"headers={headers}"])结果一致"""
+        headers = doc.metadata.get('headers')
+        token_counts = doc.metadata.get('token_counts') or {}
+        cached = token_counts.get('headers_' + self.tokenizer.name)
+        if cached is not None:
+            return self.with_token_margin(cached)
+        return self.num_tokens_from_messages([f"headers={headers}"])
+
+    def num_tokens_from_docs(self, docs):
+        total_tokens = sum(self._raw_doc_tokens(doc, doc.page_content) for doc in docs)
+        return self.with_token_margin(total_tokens)
+
     async def _call(self, messages: List[dict], streaming: bool = False) -> str:
         try:
 
@@ -94,7 +115,8 @@ class OpenAILLM:
                     max_tokens=self.max_token,
                     temperature=self.temperature,
                     top_p=self.top_p,
-                    stop=self.stop_words
+                    stop=self.stop_words,
+                    extra_headers=get_trace_headers()
                 )
                 for event in response:
                     if not isinstance(event, dict):
@@ -114,7 +136,8 @@ class OpenAILLM:
                     max_tokens=self.max_token,
                     temperature=self.temperature,
                     top_p=self.top_p,
-                    stop=self.stop_words
+                    stop=self.stop_words,
+                    extra_headers=get_trace_headers()
                 )
 
                 event_text = response.choices[0].message.content if response.choices else ""
@@ -1,10 +1,8 @@
 from qanything_kernel.configs.model_config import VECTOR_SEARCH_TOP_K, VECTOR_SEARCH_SCORE_THRESHOLD, \
     PROMPT_TEMPLATE, STREAMING, SYSTEM, INSTRUCTIONS, SIMPLE_PROMPT_TEMPLATE, CUSTOM_PROMPT_TEMPLATE, \
-    LOCAL_RERANK_MODEL_NAME, LOCAL_EMBED_MAX_LENGTH, SEPARATORS
+    LOCAL_RERANK_MODEL_NAME, LOCAL_EMBED_MAX_LENGTH, SEPARATORS, LOCAL_EMBED_TOKEN_BUDGET
 from typing import List, Tuple, Union, Dict
 import time
-from scipy.spatial import cKDTree
-from scipy.spatial.distance import cosine
 from scipy.stats import gmean
 from qanything_kernel.connector.embedding.embedding_for_online_client import YouDaoEmbeddings
 from qanything_kernel.connector.rerank.rerank_for_online_client import YouDaoRerank
@@ -20,8 +18,10 @@ from qanything_kernel.utils.general_utils import (get_time, clear_string, get_ti
                                                   cosine_similarity, clear_string_is_equal, num_tokens_embed,
                                                   num_tokens_rerank, deduplicate_documents, replace_image_references)
 from qanything_kernel.utils.custom_log import debug_logger, qa_logger, rerank_logger
+from qanything_kernel.utils.tracing import span
 from qanything_kernel.core.chains.condense_q_chain import RewriteQuestionChain
 from qanything_kernel.core.tools.web_search_tool import duckduckgo_search
+import asyncio
 import copy
 import requests
 import json
@@ -183,22 +183,22 @@ class LocalDocQA:
             检索到的相关文档列表
         """
         source_documents = []
-        start_time = time.perf_counter()
-        
-        # 执行文档检索，支持向量检索和混合检索
-        query_docs = await retriever.get_retrieved_documents(query, partition_keys=kb_ids, time_record=time_record,
-                                                             hybrid_search=hybrid_search, top_k=top_k)
-        
-        # 容错处理：如果检索失败，重启Milvus客户端并重试
-        if len(query_docs) == 0:
-            debug_logger.warning("MILVUS SEARCH ERROR, RESTARTING MILVUS CLIENT!")
-            retriever.vectorstore_client = VectorStoreMilvusClient()
-            debug_logger.warning("MILVUS CLIENT RESTARTED!")
+        with span('retriever_search', record_key='retriever_search', time_record=time_record, kb_ids=str(kb_ids),
+                  hybrid_search=hybrid_search, top_k=top_k) as search_span:
+            # 执行文档检索，支持向量检索和混合检索
             query_docs = await retriever.get_retrieved_documents(query, partition_keys=kb_ids, time_record=time_record,
-                                                                    hybrid_search=hybrid_search, top_k=top_k)
-        
-        end_time = time.perf_counter()
-        time_record['retriever_search'] = round(end_time - start_time, 2)
+                                                                 hybrid_search=hybrid_search, top_k=top_k)
+
+            # 容错处理：如果检索失败，重启Milvus客户端并重试
+            if len(query_docs) == 0:
+                debug_logger.warning("MILVUS SEARCH ERROR, RESTARTING MILVUS CLIENT!")
+                retriever.vectorstore_client = VectorStoreMilvusClient()
+                debug_logger.warning("MILVUS CLIENT RESTARTED!")
+                search_span.set_attribute('retried', True)
+                query_docs = await retriever.get_retrieved_documents(query, partition_keys=kb_ids, time_record=time_record,
+                                                                     hybrid_search=hybrid_search, top_k=top_k)
+            search_span.set_attribute('docs', len(query_docs))
+
         debug_logger.info(f"retriever_search time: {time_record['retriever_search']}s")
         
         # 处理检索结果，添加元数据和分数标准化
@@ -217,7 +217,7 @@ class LocalDocQA:
             
             source_documents.append(doc)
         
-        debug_logger.info(f"embed scores: {[doc.metadata['score'] for doc in source_documents]}")
+        debug_logger.info("embed scores: %s", [doc.metadata['score'] for doc in source_documents])
         return source_documents
 
     def reprocess_source_documents(self, custom_llm: OpenAILLM, query: str,
@@ -260,16 +260,11 @@ class LocalDocQA:
         # 计算文档可用的token数量 = 总窗口 - 输出预留 - 安全边界 - 各固定部分
         limited_token_nums = custom_llm.token_window - custom_llm.max_token - custom_llm.offcut_token - query_token_num - history_token_num - template_token_num - reference_field_token_num
 
-        debug_logger.info(f"=============================================")
-        debug_logger.info(f"token_window = {custom_llm.token_window}")
-        debug_logger.info(f"max_token = {custom_llm.max_token}")
-        debug_logger.info(f"offcut_token = {custom_llm.offcut_token}")
-        debug_logger.info(f"limited token nums: {limited_token_nums}")
-        debug_logger.info(f"template token nums: {template_token_num}")
-        debug_logger.info(f"reference_field token nums: {reference_field_token_num}")
-        debug_logger.info(f"query token nums: {query_token_num}")
-        debug_logger.info(f"history token nums: {history_token_num}")
-        debug_logger.info(f"=============================================")
+        debug_logger.info("token_window = %s, max_token = %s, offcut_token = %s, limited token nums: %s, "
+                          "template token nums: %s, reference_field token nums: %s, query token nums: %s, "
+                          "history token nums: %s", custom_llm.token_window, custom_llm.max_token,
+                          custom_llm.offcut_token, limited_token_nums, template_token_num, reference_field_token_num,
+                          query_token_num, history_token_num)
 
         tokens_msg = """
         token_window = {custom_llm.token_window}, max_token = {custom_llm.max_token},       
@@ -295,10 +290,9 @@ class LocalDocQA:
             if file_id not in not_repeated_file_ids:
                 not_repeated_file_ids.append(file_id)
                 if 'headers' in doc.metadata:
-                    headers = f"headers={doc.metadata['headers']}"
-                    headers_token_num = custom_llm.num_tokens_from_messages([headers])
-            doc_valid_content = re.sub(r'!\[figure]\(.*?\)', '', doc.page_content)
-            doc_token_num = custom_llm.num_tokens_from_messages([doc_valid_content])
+                    headers_token_num = custom_llm.num_tokens_from_doc_headers(doc)
+            # 入库时已预先计算token数，这里直接读取，不再对长parent chunk重复tokenize
+            doc_token_num = custom_llm.num_tokens_from_doc(doc)
             doc_token_num += headers_token_num
             if total_token_num + doc_token_num <= limited_token_nums:
                 new_source_docs.append(doc)
@@ -306,7 +300,8 @@ class LocalDocQA:
             else:
                 break
 
-        debug_logger.info(f"new_source_docs token nums: {custom_llm.num_tokens_from_docs(new_source_docs)}")
+        # 直接复用累加好的token数，避免仅为打日志再把所有文档tokenize一遍
+        debug_logger.info("new_source_docs token nums: %s", total_token_num)
         return new_source_docs, limited_token_nums, tokens_msg
 
     def generate_prompt(self, query, source_docs, prompt_template):
@@ -343,7 +338,6 @@ class LocalDocQA:
             for doc_id in doc_ids:
                 doc_json = self.milvus_summary.get_document_by_doc_id(doc_id)
                 if doc_json is None:
-                    docs.append(None)
                     continue
                 user_id, file_id, file_name, kb_id = doc_json['kwargs']['metadata']['user_id'], \
                     doc_json['kwargs']['metadata']['file_id'], doc_json['kwargs']['metadata']['file_name'], \
@@ -369,17 +363,48 @@ class LocalDocQA:
                 return docs
             except Exception as e:
                 debug_logger.error(f"query tokens: {num_tokens_rerank(query)}, rerank error: {e}")
-                embed1 = await self.embeddings.aembed_query(query)
-                for doc in docs:
-                    embed2 = await self.embeddings.aembed_query(doc.page_content)
-                    doc.metadata['score'] = cosine_similarity(embed1, embed2)
-                return docs
+                return await self.score_docs_by_embedding(query, docs, use_stored=doc_strs is None)
         else:
-            embed1 = await self.embeddings.aembed_query(query)
-            for doc in docs:
-                embed2 = await self.embeddings.aembed_query(doc.page_content)
-                doc.metadata['score'] = cosine_similarity(embed1, embed2)
+            return await self.score_docs_by_embedding(query, docs, use_stored=doc_strs is None)
+
+    async def score_docs_by_embedding(self, query, docs: List[Document], use_stored=True):
+        """
+        用embedding余弦相似度给文档打分（rerank不可用时的兜底）
+        - query向量: 调用方（/get_rerank_results接口）只传入query和文档，没有检索阶段的向量，计算一次
+        - 文档向量: 优先使用Milvus中已存的child向量（取与query最相似的child），没有的再一次性按token预算批量计算
+        """
+        if not docs:
             return docs
+        query_embedding = await self.embeddings.aembed_query(query)
+        query_vec = np.asarray(query_embedding, dtype=np.float32)
+        query_vec /= np.linalg.norm(query_vec) or 1.0
+
+        doc_vectors = [None] * len(docs)
+        if use_stored:
+            doc_ids = [doc.metadata['doc_id'] for doc in docs if doc.metadata.get('doc_id')]
+            with span('get_stored_vectors', doc_ids=len(doc_ids)) as s:
+                chunk_vectors = await asyncio.to_thread(self.milvus_kb.get_chunk_vectors, doc_ids)
+                s.set_attribute('hit', len(chunk_vectors))
+            for idx, doc in enumerate(docs):
+                vectors = chunk_vectors.get(doc.metadata.get('doc_id'))
+                if vectors:
+                    doc_vectors[idx] = np.asarray(vectors, dtype=np.float32)
+        missing = [idx for idx, vectors in enumerate(doc_vectors) if vectors is None]
+        if missing:
+            with span('embed_docs', docs=len(missing)):
+                embeddings = await self.embeddings.aembed_documents([docs[idx].page_content for idx in missing],
+                                                                    token_budget=LOCAL_EMBED_TOKEN_BUDGET)
+            for idx, embedding in zip(missing, embeddings):
+                doc_vectors[idx] = np.asarray([embedding], dtype=np.float32)
+
+        for doc, vectors in zip(docs, doc_vectors):
+            norms = np.linalg.norm(vectors, axis=1)
+            norms[norms == 0] = 1.0
+            similarity = float(np.max(vectors @ query_vec / norms))
+            # 与cosine_similarity一致，映射到0-1之间
+            doc.metadata['score'] = (similarity + 1) / 2
+        return docs
+
 
     async def prepare_source_documents(self, custom_llm: OpenAILLM, retrieval_documents: List[Document],
                                        limited_token_nums: int, rerank: bool):
@@ -419,31 +444,31 @@ class LocalDocQA:
         # 获取问题的scores
         question_scores = [doc.metadata['score'] for doc in reference_docs]
 
-        # 计算LLM回答的embedding
-        llm_answer_embedding = await self.embeddings.aembed_query(llm_answer)
-
-        # 计算所有引用文档分段的embeddings
-        all_segments_docs = self.doc_splitter.split_documents(reference_docs)
-        all_segments = [doc.page_content for doc in all_segments_docs]
-        reference_embeddings = await self.embeddings.aembed_documents(all_segments)
-
-        # 将嵌入向量转换为numpy数组以便使用scipy的cosine函数
-        llm_answer_embedding = np.array(llm_answer_embedding)
-        reference_embeddings = np.array(reference_embeddings)
-
-        # 构建KD树
-        tree = cKDTree(reference_embeddings)
-
-        # 使用KD树找到最相似的分段
-        _, indices = tree.query(llm_answer_embedding.reshape(1, -1), k=top_k)
-        if isinstance(indices[0], np.int64):
-            indices = [indices]
-
-        # 计算每个文档的分段数量，以便根据索引找到对应的文档
-        doc_segment_lengths = [len(self.doc_splitter.split_documents([doc])) for doc in reference_docs]
+        # 逐个文档切分，同时记录每个分段属于哪个文档
+        with span('relevance_split', docs=len(reference_docs)) as s:
+            all_segments_docs, segment_doc_ids = [], []
+            for doc_id, doc in enumerate(reference_docs):
+                segments = self.doc_splitter.split_documents([doc])
+                all_segments_docs.extend(segments)
+                segment_doc_ids.extend([doc_id] * len(segments))
+            s.set_attribute('segments', len(all_segments_docs))
+        if not all_segments_docs:
+            return []
 
-        # 创建一个累积的段落索引，用于根据段落找到文档ID
-        cumulative_lengths = np.cumsum([0] + doc_segment_lengths)
+        # LLM回答和所有分段一起计算embedding：按内容hash缓存，未命中的按token预算合并成尽量少的请求
+        with span('relevance_embed', segments=len(all_segments_docs)):
+            vectors = await self.embeddings.aembed_documents_cached(
+                [llm_answer] + [doc.page_content for doc in all_segments_docs])
+        llm_answer_embedding, reference_embeddings = vectors[0], vectors[1:]
+
+        # 分段数量很少（几十到几百），一次矩阵乘法算出所有余弦相似度，再用argpartition取top_k，无需构建KD树
+        with span('relevance_topk', segments=len(all_segments_docs), top_k=top_k):
+            norms = np.linalg.norm(reference_embeddings, axis=1) * (np.linalg.norm(llm_answer_embedding) or 1.0)
+            norms[norms == 0] = 1.0
+            similarities = reference_embeddings @ llm_answer_embedding / norms
+            k = min(top_k, len(similarities))
+            indices = np.argpartition(-similarities, k - 1)[:k] if k < len(similarities) else np.arange(k)
+            indices = indices[np.argsort(-similarities[indices])]
 
         # 定义加权几何平均函数
         def weighted_geometric_mean(scores, weights):
@@ -451,15 +476,10 @@ class LocalDocQA:
 
         # 计算相似度和综合得分
         relevant_docs = []
-        for doc_index in indices[0]:
+        for doc_index in indices:
             # 根据doc_index找到对应的文档ID
-            doc_id = np.searchsorted(cumulative_lengths, doc_index, side='right') - 1
-
-            # 获取该文档内的实际分段索引
-            segment_index_in_doc = doc_index - cumulative_lengths[doc_id]
-
-            # 计算1 - cosine距离来计算相似度
-            similarity_llm = 1 - cosine(llm_answer_embedding, reference_embeddings[doc_index])
+            doc_id = segment_doc_ids[doc_index]
+            similarity_llm = similarities[doc_index]
             rerank_score = question_scores[doc_id]
 
             # 设置rerank分数和LLM回答与文档余弦相似度的权重
@@ -541,7 +561,7 @@ class LocalDocQA:
                     HumanMessage(content=msg[0]),
                     AIMessage(content=msg[1]),
                 ]
-            debug_logger.info(f"formatted_chat_history: {formatted_chat_history}")
+            debug_logger.info("formatted_chat_history: %s", formatted_chat_history)
 
             rewrite_q_chain = RewriteQuestionChain(model_name=model, openai_api_base=api_base, openai_api_key=api_key)
             full_prompt = rewrite_q_chain.condense_q_prompt.format(
@@ -557,16 +577,14 @@ class LocalDocQA:
             debug_logger.info(
                 f"Subtract formatted_chat_history: {len(chat_history) * 2} -> {len(formatted_chat_history)}")
             try:
-                t1 = time.perf_counter()
-                condense_question = await rewrite_q_chain.condense_q_chain.ainvoke(
-                    {
-                        "chat_history": formatted_chat_history,
-                        "question": query,
-                    },
-                )
-                t2 = time.perf_counter()
-                # 时间保留两位小数
-                time_record['condense_q_chain'] = round(t2 - t1, 2)
+                with span('condense_q_chain', record_key='condense_q_chain', time_record=time_record,
+                          history_messages=len(formatted_chat_history)):
+                    condense_question = await rewrite_q_chain.condense_q_chain.ainvoke(
+                        {
+                            "chat_history": formatted_chat_history,
+                            "question": query,
+                        },
+                    )
                 time_record['rewrite_completion_tokens'] = custom_llm.num_tokens_from_messages([condense_question])
                 debug_logger.info(f"condense_q_chain time: {time_record['condense_q_chain']}s")
             except Exception as e:
@@ -591,34 +609,33 @@ class LocalDocQA:
             source_documents = []
 
         if need_web_search:
-            t1 = time.perf_counter()
-            web_search_results = self.web_page_search(query, top_k=3)
-            web_splitter = RecursiveCharacterTextSplitter(
-                separators=SEPARATORS,
-                chunk_size=web_chunk_size,
-                chunk_overlap=int(web_chunk_size / 4),
-                length_function=num_tokens_embed,
-            )
-            web_search_results = web_splitter.split_documents(web_search_results)
-
-            current_doc_id = 0
-            current_file_id = web_search_results[0].metadata['file_id']
-            for doc in web_search_results:
-                if doc.metadata['file_id'] == current_file_id:
-                    doc.metadata['doc_id'] = current_file_id + '_' + str(current_doc_id)
-                    current_doc_id += 1
-                else:
-                    current_file_id = doc.metadata['file_id']
-                    current_doc_id = 0
-                    doc.metadata['doc_id'] = current_file_id + '_' + str(current_doc_id)
-                    current_doc_id += 1
-                doc_json = doc.to_json()
-                if doc_json['kwargs'].get('metadata') is None:
-                    doc_json['kwargs']['metadata'] = doc.metadata
-                self.milvus_summary.add_document(doc_id=doc.metadata['doc_id'], json_data=doc_json)
-
-            t2 = time.perf_counter()
-            time_record['web_search'] = round(t2 - t1, 2)
+            with span('web_search', record_key='web_search', time_record=time_record) as web_span:
+                web_search_results = self.web_page_search(query, top_k=3)
+                web_splitter = RecursiveCharacterTextSplitter(
+                    separators=SEPARATORS,
+                    chunk_size=web_chunk_size,
+                    chunk_overlap=int(web_chunk_size / 4),
+                    length_function=num_tokens_embed,
+                )
+                web_search_results = web_splitter.split_documents(web_search_results)
+
+                current_doc_id = 0
+                current_file_id = web_search_results[0].metadata['file_id']
+                for doc in web_search_results:
+                    if doc.metadata['file_id'] == current_file_id:
+                        doc.metadata['doc_id'] = current_file_id + '_' + str(current_doc_id)
+                        current_doc_id += 1
+                    else:
+                        current_file_id = doc.metadata['file_id']
+                        current_doc_id = 0
+                        doc.metadata['doc_id'] = current_file_id + '_' + str(current_doc_id)
+                        current_doc_id += 1
+                    doc_json = doc.to_json()
+                    if doc_json['kwargs'].get('metadata') is None:
+                        doc_json['kwargs']['metadata'] = doc.metadata
+                    self.milvus_summary.add_document(doc_id=doc.metadata['doc_id'], json_data=doc_json)
+
+                web_span.set_attribute('docs', len(web_search_results))
             source_documents += web_search_results
 
         # if kb_ids and not source_documents:
@@ -631,21 +648,18 @@ class LocalDocQA:
         source_documents = deduplicate_documents(source_documents)
         if rerank and len(source_documents) > 1 and num_tokens_rerank(query) <= 300:
             try:
-                t1 = time.perf_counter()
                 debug_logger.info(f"use rerank, rerank docs num: {len(source_documents)}")
-                source_documents = await self.rerank.arerank_documents(condense_question, source_documents)
-                t2 = time.perf_counter()
-                time_record['rerank'] = round(t2 - t1, 2)
+                with span('rerank', record_key='rerank', time_record=time_record, docs=len(source_documents)):
+                    source_documents = await self.rerank.arerank_documents(condense_question, source_documents)
                 # 过滤掉低分的文档
                 debug_logger.info(f"rerank step1 num: {len(source_documents)}")
-                debug_logger.info(f"rerank step1 scores: {[doc.metadata['score'] for doc in source_documents]}")
+                debug_logger.info("rerank step1 scores: %s", [doc.metadata['score'] for doc in source_documents])
                 if len(source_documents) > 1:
                     if filtered_documents := [doc for doc in source_documents if doc.metadata['score'] >= 0.28]:
                         source_documents = filtered_documents
                     debug_logger.info(f"rerank step2 num: {len(source_documents)}")
                     saved_docs = [source_documents[0]]
                     for doc in source_documents[1:]:
-                        debug_logger.info(f"rerank doc score: {doc.metadata['score']}")
                         relative_difference = (saved_docs[0].metadata['score'] - doc.metadata['score']) / saved_docs[0].metadata['score']
                         if relative_difference > 0.5:
                             break
@@ -702,46 +716,45 @@ class LocalDocQA:
                 prompt_template = PROMPT_TEMPLATE.replace("{{system}}", system_prompt).replace("{{instructions}}",
                                                                                                INSTRUCTIONS)
 
-            t1 = time.perf_counter()
-            retrieval_documents, limited_token_nums, tokens_msg = self.reprocess_source_documents(custom_llm=custom_llm,
-                                                                                                  query=query,
-                                                                                                  source_docs=source_documents,
-                                                                                                  history=chat_history,
-                                                                                                  prompt_template=prompt_template)
-
-            if len(retrieval_documents) < len(source_documents):
-                # 重新处理后文档数量减少，说明由于tokens不足而被裁切
-                if len(retrieval_documents) == 0:  # 说明被裁切后文档数量为0
-                    debug_logger.error(f"limited_token_nums: {limited_token_nums} < {web_chunk_size}!")
-                    res = (
-                        f"抱歉，由于留给相关文档使用的token数量不足(docs_available_token_nums: {limited_token_nums} < 文本分片大小: {web_chunk_size})，"
-                        f"\n无法保证回答质量，请在模型配置中提高【总Token数量】或减少【输出Tokens数量】或减少【上下文消息数量】再继续提问。"
-                        f"\n计算方式：{tokens_msg}")
-                    async for response, history in self.generate_response(query, res, condense_question, source_documents,
-                                                                          time_record, chat_history, streaming,
-                                                                          'TOKENS_NOT_ENOUGH'):
-                        yield response, history
-                    return
-
-                extra_msg = (
-                    f"\n\nWARNING: 由于留给相关文档使用的token数量不足(docs_available_token_nums: {limited_token_nums})，"
-                    f"\n检索到的部分文档chunk被裁切，原始来源数量：{len(source_documents)}，裁切后数量：{len(retrieval_documents)}，"
-                    f"\n可能会影响回答质量，尤其是问题涉及的相关内容较多时。"
-                    f"\n可在模型配置中提高【总Token数量】或减少【输出Tokens数量】或减少【上下文消息数量】再继续提问。\n")
-
-            source_documents, retrieval_documents = await self.prepare_source_documents(custom_llm,
-                                                                                        retrieval_documents,
-                                                                                        limited_token_nums,
-                                                                                        rerank)
-
-            for doc in source_documents:
-                if doc.metadata.get('images', []):
-                    total_images_number += len(doc.metadata['images'])
-                    doc.page_content = replace_image_references(doc.page_content, doc.metadata['file_id'])
-            debug_logger.info(f"total_images_number: {total_images_number}")
-
-            t2 = time.perf_counter()
-            time_record['reprocess'] = round(t2 - t1, 2)
+            with span('reprocess', record_key='reprocess', time_record=time_record) as reprocess_span:
+                retrieval_documents, limited_token_nums, tokens_msg = self.reprocess_source_documents(custom_llm=custom_llm,
+                                                                                                      query=query,
+                                                                                                      source_docs=source_documents,
+                                                                                                      history=chat_history,
+                                                                                                      prompt_template=prompt_template)
+
+                # 重新处理后文档数量减少，说明由于tokens不足而被裁切；裁切到0个时在span结束后返回提示（span内不能yield）
+                if 0 < len(retrieval_documents) < len(source_documents):
+                    extra_msg = (
+                        f"\n\nWARNING: 由于留给相关文档使用的token数量不足(docs_available_token_nums: {limited_token_nums})，"
+                        f"\n检索到的部分文档chunk被裁切，原始来源数量：{len(source_documents)}，裁切后数量：{len(retrieval_documents)}，"
+                        f"\n可能会影响回答质量，尤其是问题涉及的相关内容较多时。"
+                        f"\n可在模型配置中提高【总Token数量】或减少【输出Tokens数量】或减少【上下文消息数量】再继续提问。\n")
+
+                if retrieval_documents:
+                    source_documents, retrieval_documents = await self.prepare_source_documents(custom_llm,
+                                                                                                retrieval_documents,
+                                                                                                limited_token_nums,
+                                                                                                rerank)
+
+                    for doc in source_documents:
+                        if doc.metadata.get('images', []):
+                            total_images_number += len(doc.metadata['images'])
+                            doc.page_content = replace_image_references(doc.page_content, doc.metadata['file_id'])
+                    debug_logger.info(f"total_images_number: {total_images_number}")
+                    reprocess_span.set_attributes(source_docs=len(source_documents), images=total_images_number)
+
+            if not retrieval_documents:  # 说明被裁切后文档数量为0
+                debug_logger.error(f"limited_token_nums: {limited_token_nums} < {web_chunk_size}!")
+                res = (
+                    f"抱歉，由于留给相关文档使用的token数量不足(docs_available_token_nums: {limited_token_nums} < 文本分片大小: {web_chunk_size})，"
+                    f"\n无法保证回答质量，请在模型配置中提高【总Token数量】或减少【输出Tokens数量】或减少【上下文消息数量】再继续提问。"
+                    f"\n计算方式：{tokens_msg}")
+                async for response, history in self.generate_response(query, res, condense_question, source_documents,
+                                                                      time_record, chat_history, streaming,
+                                                                      'TOKENS_NOT_ENOUGH'):
+                    yield response, history
+                return
         else:
             if custom_prompt:
                 # escaped_custom_prompt = custom_prompt.replace('{', '{{').replace('}', '}}')
@@ -762,85 +775,143 @@ class LocalDocQA:
             yield source_documents, None
             return
 
-        t1 = time.perf_counter()
-        has_first_return = False
-
-        acc_resp = ''
-        prompt = self.generate_prompt(query=query,
-                                      source_docs=source_documents,
-                                      prompt_template=prompt_template)
-        # debug_logger.info(f"prompt: {prompt}")
-        est_prompt_tokens = num_tokens(prompt) + num_tokens(str(chat_history))
-        async for answer_result in custom_llm.generatorAnswer(prompt=prompt, history=chat_history, streaming=streaming):
-            resp = answer_result.llm_output["answer"]
-            if 'answer' in resp:
-                acc_resp += json.loads(resp[6:])['answer']
-            prompt = answer_result.prompt
-            history = answer_result.history
-            total_tokens = answer_result.total_tokens
-            prompt_tokens = answer_result.prompt_tokens
-            completion_tokens = answer_result.completion_tokens
-            history[-1][0] = query
-            response = {"query": query,
-                        "prompt": prompt,
-                        "result": resp,
-                        "condense_question": condense_question,
-                        "retrieval_documents": retrieval_documents,
-                        "source_documents": source_documents}
-            time_record['prompt_tokens'] = prompt_tokens if prompt_tokens != 0 else est_prompt_tokens
-            time_record['completion_tokens'] = completion_tokens if completion_tokens != 0 else num_tokens(acc_resp)
-            time_record['total_tokens'] = total_tokens if total_tokens != 0 else time_record['prompt_tokens'] + \
-                                                                                 time_record['completion_tokens']
-            if has_first_return is False:
-                first_return_time = time.perf_counter()
-                has_first_return = True
-                time_record['llm_first_return'] = round(first_return_time - t1, 2)
-            if resp[6:].startswith("[DONE]"):
-                if extra_msg is not None:
-                    msg_response = {"query": query,
-                                "prompt": prompt,
-                                "result": f"data: {json.dumps({'answer': extra_msg}, ensure_ascii=False)}",
-                                "condense_question": condense_question,
-                                "retrieval_documents": retrieval_documents,
-                                "source_documents": source_documents}
-                    yield msg_response, history
-                last_return_time = time.perf_counter()
-                time_record['llm_completed'] = round(last_return_time - t1, 2) - time_record['llm_first_return']
-                history[-1][1] = acc_resp
-                if total_images_number != 0:  # 如果有图片，需要处理回答带图的情况
-                    docs_with_images = [doc for doc in source_documents if doc.metadata.get('images', [])]
-                    time1 = time.perf_counter()
-                    relevant_docs = await self.calculate_relevance_optimized(
-                        question=query,
-                        llm_answer=acc_resp,
-                        reference_docs=docs_with_images,
-                        top_k=1
-                    )
-                    show_images = ["\n### 引用图文如下：\n"]
-                    for doc in relevant_docs:
-                        print(f"文档: {doc['document']}...")  # 只打印前50个字符
-                        print(f"最相关段落: {doc['segment']}...")  # 打印最相关段落的前100个字符
-                        print(f"与LLM回答的相似度: {doc['similarity_llm']:.4f}")
-                        print(f"原始问题相关性分数: {doc['question_score']:.4f}")
-                        print(f"综合得分: {doc['combined_score']:.4f}")
-                        print()
-                        for image in doc['document'].metadata.get('images', []):
-                            image_str = replace_image_references(image, doc['document'].metadata['file_id'])
-                            debug_logger.info(f"image_str: {image} -> {image_str}")
-                            show_images.append(image_str + '\n')
-                    debug_logger.info(f"show_images: {show_images}")
-                    time_record['obtain_images'] = round(time.perf_counter() - last_return_time, 2)
-                    time2 = time.perf_counter()
-                    debug_logger.info(f"obtain_images time: {time2 - time1}s")
-                    time_record["obtain_images_time"] = round(time2 - time1, 2)
-                    if len(show_images) > 1:
-                        response['show_images'] = show_images
-            yield response, history
-
-    def get_completed_document(self, file_id, limit=None):
-        sorted_json_datas = self.milvus_summary.get_document_by_file_id(file_id)
-        if limit:
-            sorted_json_datas = sorted_json_datas[limit[0]: limit[1] + 1]
+        # 生成过程跨越多次yield，span不设为当前span（detached），不会在yield之间泄漏给消费方
+        with span('llm_generate', time_record=time_record, detached=True, model=model,
+                  streaming=streaming) as llm_span:
+            has_first_return = False
+
+            acc_resp = ''
+            prompt = self.generate_prompt(query=query,
+                                          source_docs=source_documents,
+                                          prompt_template=prompt_template)
+            # debug_logger.info(f"prompt: {prompt}")
+            est_prompt_tokens = num_tokens(prompt) + num_tokens(str(chat_history))
+            llm_span.set_attribute('docs', len(source_documents))
+            async for answer_result in custom_llm.generatorAnswer(prompt=prompt, history=chat_history, streaming=streaming):
+                resp = answer_result.llm_output["answer"]
+                if 'answer' in resp:
+                    acc_resp += json.loads(resp[6:])['answer']
+                prompt = answer_result.prompt
+                history = answer_result.history
+                total_tokens = answer_result.total_tokens
+                prompt_tokens = answer_result.prompt_tokens
+                completion_tokens = answer_result.completion_tokens
+                history[-1][0] = query
+                response = {"query": query,
+                            "prompt": prompt,
+                            "result": resp,
+                            "condense_question": condense_question,
+                            "retrieval_documents": retrieval_documents,
+                            "source_documents": source_documents}
+                time_record['prompt_tokens'] = prompt_tokens if prompt_tokens != 0 else est_prompt_tokens
+                time_record['completion_tokens'] = completion_tokens if completion_tokens != 0 else num_tokens(acc_resp)
+                time_record['total_tokens'] = total_tokens if total_tokens != 0 else time_record['prompt_tokens'] + \
+                                                                                     time_record['completion_tokens']
+                if has_first_return is False:
+                    has_first_return = True
+                    time_record['llm_first_return'] = round(llm_span.elapsed, 2)
+                    llm_span.set_attribute('first_return', time_record['llm_first_return'])
+                if resp[6:].startswith("[DONE]"):
+                    if extra_msg is not None:
+                        msg_response = {"query": query,
+                                    "prompt": prompt,
+                                    "result": f"data: {json.dumps({'answer': extra_msg}, ensure_ascii=False)}",
+                                    "condense_question": condense_question,
+                                    "retrieval_documents": retrieval_documents,
+                                    "source_documents": source_documents}
+                        yield msg_response, history
+                    time_record['llm_completed'] = round(llm_span.elapsed, 2) - time_record['llm_first_return']
+                    llm_span.set_attributes(prompt_tokens=time_record['prompt_tokens'],
+                                            completion_tokens=time_record['completion_tokens'])
+                    history[-1][1] = acc_resp
+                    if total_images_number != 0:  # 如果有图片，需要处理回答带图的情况
+                        docs_with_images = [doc for doc in source_documents if doc.metadata.get('images', [])]
+                        with span('obtain_images', record_key='obtain_images_time', time_record=time_record,
+                                  docs=len(docs_with_images)):
+                            relevant_docs = await self.calculate_relevance_optimized(
+                                question=query,
+                                llm_answer=acc_resp,
+                                reference_docs=docs_with_images,
+                                top_k=1
+                            )
+                        show_images = ["\n### 引用图文如下：\n"]
+                        for doc in relevant_docs:
+                            print(f"文档: {doc['document']}...")  # 只打印前50个字符
+                            print(f"最相关段落: {doc['segment']}...")  # 打印最相关段落的前100个字符
+                            print(f"与LLM回答的相似度: {doc['similarity_llm']:.4f}")
+                            print(f"原始问题相关性分数: {doc['question_score']:.4f}")
+                            print(f"综合得分: {doc['combined_score']:.4f}")
+                            print()
+                            for image in doc['document'].metadata.get('images', []):
+                                image_str = replace_image_references(image, doc['document'].metadata['file_id'])
+                                debug_logger.info(f"image_str: {image} -> {image_str}")
+                                show_images.append(image_str + '\n')
+                        debug_logger.info("show_images: %s", show_images)
+                        time_record['obtain_images'] = round(llm_span.elapsed, 2) - time_record['llm_first_return'] - \
+                                                       time_record['llm_completed']
+                        debug_logger.info(f"obtain_images time: {time_record['obtain_images_time']}s")
+                        if len(show_images) > 1:
+                            response['show_images'] = show_images
+                yield response, history
+
+    def _get_chunk_manifest(self, file_id, memo):
+        key = ('manifest', file_id)
+        if key not in memo:
+            memo[key] = self.milvus_summary.get_chunk_manifest(file_id)
+        return memo[key]
+
+    def _get_file_chunks(self, file_id, limit, memo):
+        """
+        按序号取文件的parent chunk，limit为[最小序号, 最大序号]
+        有chunk清单时按doc_id索引一次性取回需要的chunk，已取过的chunk记在memo里不再重复取；
+        没有清单的老文件退回按file_id前缀扫描整个文件
+        """
+        manifest = self._get_chunk_manifest(file_id, memo)
+        if manifest is None:
+            key = ('file_chunks', file_id)
+            if key not in memo:
+                memo[key] = self.milvus_summary.get_document_by_file_id(file_id)
+            sorted_json_datas = memo[key]
+            if limit:
+                sorted_json_datas = sorted_json_datas[limit[0]: limit[1] + 1]
+            return sorted_json_datas
+        doc_ids = [doc_id for doc_id, _ in manifest
+                   if not limit or limit[0] <= int(doc_id.split('_')[-1]) <= limit[1]]
+        docs = memo.setdefault('docs', {})
+        missing_doc_ids = [doc_id for doc_id in doc_ids if doc_id not in docs]
+        if missing_doc_ids:
+            docs.update(self.milvus_summary.get_documents_by_doc_ids(missing_doc_ids))
+        return [docs[doc_id] for doc_id in doc_ids if doc_id in docs]
+
+    def estimate_file_tokens(self, file_id, custom_llm: OpenAILLM, limit=None, memo=None):
+        """根据chunk清单估算完整文档（或limit范围内）的token数，没有清单或清单里没有当前模型编码的计数时返回None"""
+        memo = {} if memo is None else memo
+        key = ('tokens', file_id, tuple(limit) if limit else None, custom_llm.tokenizer.name)
+        if key in memo:
+            return memo[key]
+        manifest = self._get_chunk_manifest(file_id, memo)
+        total_tokens = None
+        if manifest is not None:
+            total_tokens = 0
+            for doc_id, token_counts in manifest:
+                if limit and not limit[0] <= int(doc_id.split('_')[-1]) <= limit[1]:
+                    continue
+                if custom_llm.tokenizer.name not in token_counts:
+                    total_tokens = None
+                    break
+                total_tokens += token_counts[custom_llm.tokenizer.name] + 1  # 每个chunk后拼接的'\n\n'
+            if total_tokens is not None:
+                total_tokens = custom_llm.with_token_margin(total_tokens)
+        memo[key] = total_tokens
+        return total_tokens
+
+    def get_completed_document(self, file_id, limit=None, memo=None):
+        # memo为单次请求内的缓存，同一文件(同一范围)在一次请求中最多拼接一次
+        memo = {} if memo is None else memo
+        key = ('completed', file_id, tuple(limit) if limit else None)
+        if key in memo:
+            return memo[key]
+        sorted_json_datas = self._get_file_chunks(file_id, limit, memo)
 
         completed_content_with_figure = ''
         completed_content = ''
@@ -855,8 +926,11 @@ class LocalDocQA:
                 doc.page_content = f"{faq_dict['question']}：{faq_dict['answer']}"
             completed_content_with_figure += doc.page_content + '\n\n'
             completed_content += re.sub(r'!\[figure]\(.*?\)', '', doc.page_content) + '\n\n' # 删除图片
-        completed_doc_with_figure = Document(page_content=completed_content_with_figure, metadata=sorted_json_datas[0]['kwargs']['metadata'])
-        completed_doc = Document(page_content=completed_content, metadata=sorted_json_datas[0]['kwargs']['metadata'])
+        # 复制一份metadata，避免改动memo中缓存的chunk；首个chunk的token数对完整文档无意义
+        metadata = dict(sorted_json_datas[0]['kwargs']['metadata'])
+        metadata.pop('token_counts', None)
+        completed_doc_with_figure = Document(page_content=completed_content_with_figure, metadata=metadata)
+        completed_doc = Document(page_content=completed_content, metadata=metadata)
         # FIX metadata
         has_table = False
         images = []
@@ -880,101 +954,95 @@ class LocalDocQA:
         #         doc.page_content = re.sub(r'!\[figure]\(.*?\)', '', doc.page_content)  # 删除图片
         #     completed_content += doc.page_content + '\n\n'
         # completed_doc = Document(page_content=completed_content, metadata=sorted_json_datas[0]['kwargs']['metadata'])
+        memo[key] = (completed_doc, completed_doc_with_figure)
         return completed_doc, completed_doc_with_figure
 
+    def _fit_completed_document(self, file_id, limit, budget, custom_llm: OpenAILLM, memo):
+        """
+        拼接文件的完整文档（或limit范围内的连续chunk），token数超出budget时返回(None, None, tokens)
+        有chunk清单时先按清单估算，超出预算就不再从MySQL取数；否则取回拼接后再精确计算
+        """
+        estimated_tokens = self.estimate_file_tokens(file_id, custom_llm, limit, memo)
+        if estimated_tokens is not None and estimated_tokens > budget:
+            return None, None, estimated_tokens
+        completed_doc, completed_doc_with_figure = self.get_completed_document(file_id, limit, memo)
+        doc_tokens = custom_llm.num_tokens_from_docs([completed_doc])
+        if doc_tokens > budget:
+            return None, None, doc_tokens
+        return completed_doc, completed_doc_with_figure, doc_tokens
+
     def aggregate_documents(self, source_documents, limited_token_nums, custom_llm, rerank):
         # 聚合文档，具体逻辑是帮我判断所有候选是否集中在一个或两个文件中，是的话直接返回这一个或两个完整文档，如果tokens不够则截取文档中的完整上下文
-        first_file_dict = {}
-        ori_first_docs = []
-        second_file_dict = {}
-        ori_second_docs = []
+        file_docs = {}  # file_id -> 该文件的候选文档，按出现顺序
         for doc in source_documents:
             file_id = doc.metadata['file_id']
-            if not first_file_dict:
-                first_file_dict['file_id'] = file_id
-                first_file_dict['doc_ids'] = [int(doc.metadata['doc_id'].split('_')[-1])]
-                ori_first_docs.append(doc)
-                if rerank:
-                    first_file_dict['score'] = max(
-                        [doc.metadata['score'] for doc in source_documents if doc.metadata['file_id'] == file_id])
-                else:
-                    first_file_dict['score'] = min(
-                        [doc.metadata['score'] for doc in source_documents if doc.metadata['file_id'] == file_id])
-            elif first_file_dict['file_id'] == file_id:
-                first_file_dict['doc_ids'].append(int(doc.metadata['doc_id'].split('_')[-1]))
-                ori_first_docs.append(doc)
-            elif not second_file_dict:
-                second_file_dict['file_id'] = file_id
-                second_file_dict['doc_ids'] = [int(doc.metadata['doc_id'].split('_')[-1])]
-                ori_second_docs.append(doc)
-                if rerank:
-                    second_file_dict['score'] = max(
-                        [doc.metadata['score'] for doc in source_documents if doc.metadata['file_id'] == file_id])
-                else:
-                    second_file_dict['score'] = min(
-                        [doc.metadata['score'] for doc in source_documents if doc.metadata['file_id'] == file_id])
-            elif second_file_dict['file_id'] == file_id:
-                second_file_dict['doc_ids'].append(int(doc.metadata['doc_id'].split('_')[-1]))
-                ori_second_docs.append(doc)
-            else:  # 如果有第三个文件，直接返回
-                return []
-
-        ori_first_docs_tokens = custom_llm.num_tokens_from_docs(ori_first_docs)
+            if file_id not in file_docs:
+                if len(file_docs) == 2:  # 如果有第三个文件，直接返回
+                    return []
+                file_docs[file_id] = []
+            file_docs[file_id].append(doc)
+        if not file_docs:
+            return []
+
+        memo = {}  # 单次请求内的缓存：chunk清单、已取回的chunk、拼好的完整文档和token估算
+        (first_file_id, ori_first_docs), *second_file = file_docs.items()
+        second_file_id, ori_second_docs = second_file[0] if second_file else (None, [])
         ori_second_docs_tokens = custom_llm.num_tokens_from_docs(ori_second_docs)
 
+        def file_score(docs):
+            scores = [doc.metadata['score'] for doc in docs]
+            return max(scores) if rerank else min(scores)
+
+        def doc_limit(docs):
+            # 候选chunk序号的最小值和最大值
+            doc_ids = [int(doc.metadata['doc_id'].split('_')[-1]) for doc in docs]
+            return [min(doc_ids), max(doc_ids)]
+
         new_docs = []
-        first_completed_doc, first_completed_doc_with_figure = self.get_completed_document(first_file_dict['file_id'])
-        first_completed_doc.metadata['score'] = first_file_dict['score']
-        first_doc_tokens = custom_llm.num_tokens_from_docs([first_completed_doc])
-        if first_doc_tokens + ori_second_docs_tokens > limited_token_nums:
+        first_doc, first_doc_with_figure, first_doc_tokens = self._fit_completed_document(
+            first_file_id, None, limited_token_nums - ori_second_docs_tokens, custom_llm, memo)
+        if first_doc is None:
             if len(ori_first_docs) == 1:
                 debug_logger.info(f"first_file_docs number is one")
                 return new_docs
-            # 获取first_file_dict['doc_ids']的最小值和最大值
-            doc_limit = [min(first_file_dict['doc_ids']), max(first_file_dict['doc_ids'])]
-            first_completed_doc_limit, first_completed_doc_limit_with_figure = self.get_completed_document(
-                first_file_dict['file_id'], doc_limit)
-            first_completed_doc_limit.metadata['score'] = first_file_dict['score']
-            first_doc_tokens = custom_llm.num_tokens_from_docs([first_completed_doc_limit])
-            if first_doc_tokens + ori_second_docs_tokens > limited_token_nums:
-                debug_logger.info(
-                    f"first_limit_doc_tokens {doc_limit}: {first_doc_tokens} + ori_second_docs_tokens: {ori_second_docs_tokens} > limited_token_nums: {limited_token_nums}")
+            limit = doc_limit(ori_first_docs)
+            first_doc, first_doc_with_figure, first_doc_tokens = self._fit_completed_document(
+                first_file_id, limit, limited_token_nums - ori_second_docs_tokens, custom_llm, memo)
+            if first_doc is None:
+                debug_logger.info("first_limit_doc_tokens %s: %s + ori_second_docs_tokens: %s > limited_token_nums: %s",
+                                  limit, first_doc_tokens, ori_second_docs_tokens, limited_token_nums)
                 return new_docs
-            else:
-                debug_logger.info(
-                    f"first_limit_doc_tokens {doc_limit}: {first_doc_tokens} + ori_second_docs_tokens: {ori_second_docs_tokens} <= limited_token_nums: {limited_token_nums}")
-                new_docs.append(first_completed_doc_limit_with_figure)
+            debug_logger.info("first_limit_doc_tokens %s: %s + ori_second_docs_tokens: %s <= limited_token_nums: %s",
+                              limit, first_doc_tokens, ori_second_docs_tokens, limited_token_nums)
         else:
-            debug_logger.info(
-                f"first_doc_tokens: {first_doc_tokens} + ori_second_docs_tokens: {ori_second_docs_tokens} <= limited_token_nums: {limited_token_nums}")
-            new_docs.append(first_completed_doc_with_figure)
-        if second_file_dict:
-            second_completed_doc, second_completed_doc_with_figure = self.get_completed_document(second_file_dict['file_id'])
-            second_completed_doc.metadata['score'] = second_file_dict['score']
-            second_doc_tokens = custom_llm.num_tokens_from_docs([second_completed_doc])
-            if first_doc_tokens + second_doc_tokens > limited_token_nums:
+            debug_logger.info("first_doc_tokens: %s + ori_second_docs_tokens: %s <= limited_token_nums: %s",
+                              first_doc_tokens, ori_second_docs_tokens, limited_token_nums)
+        first_doc.metadata['score'] = file_score(ori_first_docs)
+        new_docs.append(first_doc_with_figure)
+
+        if second_file_id is not None:
+            second_doc, second_doc_with_figure, second_doc_tokens = self._fit_completed_document(
+                second_file_id, None, limited_token_nums - first_doc_tokens, custom_llm, memo)
+            if second_doc is None:
                 if len(ori_second_docs) == 1:
                     debug_logger.info(f"second_file_docs number is one")
                     new_docs.extend(ori_second_docs)
                     return new_docs
-                doc_limit = [min(second_file_dict['doc_ids']), max(second_file_dict['doc_ids'])]
-                second_completed_doc_limit, second_completed_doc_limit_with_figure = self.get_completed_document(
-                    second_file_dict['file_id'], doc_limit)
-                second_completed_doc_limit.metadata['score'] = second_file_dict['score']
-                second_doc_tokens = custom_llm.num_tokens_from_docs([second_completed_doc_limit])
-                if first_doc_tokens + second_doc_tokens > limited_token_nums:
-                    debug_logger.info(
-                        f"first_doc_tokens: {first_doc_tokens} + second_limit_doc_tokens {doc_limit}: {second_doc_tokens} > limited_token_nums: {limited_token_nums}")
+                limit = doc_limit(ori_second_docs)
+                second_doc, second_doc_with_figure, second_doc_tokens = self._fit_completed_document(
+                    second_file_id, limit, limited_token_nums - first_doc_tokens, custom_llm, memo)
+                if second_doc is None:
+                    debug_logger.info("first_doc_tokens: %s + second_limit_doc_tokens %s: %s > limited_token_nums: %s",
+                                      first_doc_tokens, limit, second_doc_tokens, limited_token_nums)
                     new_docs.extend(ori_second_docs)
                     return new_docs
-                else:
-                    debug_logger.info(
-                        f"first_doc_tokens: {first_doc_tokens} + second_limit_doc_tokens {doc_limit}: {second_doc_tokens} <= limited_token_nums: {limited_token_nums}")
-                    new_docs.append(second_completed_doc_limit_with_figure)
+                debug_logger.info("first_doc_tokens: %s + second_limit_doc_tokens %s: %s <= limited_token_nums: %s",
+                                  first_doc_tokens, limit, second_doc_tokens, limited_token_nums)
             else:
-                debug_logger.info(
-                    f"first_doc_tokens: {first_doc_tokens} + second_doc_tokens: {second_doc_tokens} <= limited_token_nums: {limited_token_nums}")
-                new_docs.append(second_completed_doc_with_figure)
+                debug_logger.info("first_doc_tokens: %s + second_doc_tokens: %s <= limited_token_nums: %s",
+                                  first_doc_tokens, second_doc_tokens, limited_token_nums)
+            second_doc.metadata['score'] = file_score(ori_second_docs)
+            new_docs.append(second_doc_with_figure)
         return new_docs
 
     def incomplete_table(self, source_documents, limited_token_nums, custom_llm):
@@ -7,10 +7,11 @@ import os
 
 
 class LocalFile:
-    def __init__(self, user_id, kb_id, file: Union[File, str, Dict], file_name):
+    def __init__(self, user_id, kb_id, file: Union[File, str, Dict], file_name, file_id=None):
         self.user_id = user_id
         self.kb_id = kb_id
-        self.file_id = uuid.uuid4().hex
+        # 传入file_id表示strong模式下重新上传同名文件，沿用原file_id做增量入库
+        self.file_id = file_id or uuid.uuid4().hex
         self.file_name = file_name
         self.file_url = ''
         if isinstance(file, Dict):
@@ -34,7 +35,7 @@ class LocalFile:
             file_dir = os.path.join(upload_path, self.kb_id, self.file_id)
             os.makedirs(file_dir, exist_ok=True)
             self.file_location = os.path.join(file_dir, self.file_name)
-            #  如果文件不存在：
-            if not os.path.exists(self.file_location):
+            #  如果文件不存在，或者是重新上传（内容可能已修改）：
+            if file_id is not None or not os.path.exists(self.file_location):
                 with open(self.file_location, 'wb') as f:
                     f.write(self.file_content)
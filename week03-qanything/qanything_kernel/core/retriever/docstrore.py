@@ -11,9 +11,9 @@ from typing import (
     Tuple,
     TypeVar
 )
+import asyncio
 import os
 import json
-from tqdm import tqdm
 
 
 V = TypeVar("V")
@@ -25,6 +25,14 @@ class MysqlStore(InMemoryStore):
         super().__init__()
 
 
+    @staticmethod
+    def document_json(doc: Document) -> dict:
+        """写入Documents表的json，内容hash也按它计算"""
+        doc_json = doc.to_json()
+        if doc_json['kwargs'].get('metadata') is None:
+            doc_json['kwargs']['metadata'] = doc.metadata
+        return doc_json
+
     def mset(self, key_value_pairs: Sequence[Tuple[str, V]]) -> None:
         """Set the values for the given keys.
 
@@ -34,13 +42,14 @@ class MysqlStore(InMemoryStore):
         Returns:
             None
         """
-        doc_ids = [doc_id for doc_id, _ in key_value_pairs]
-        insert_logger.info(f"add documents: {len(doc_ids)}")
-        for doc_id, doc in tqdm(key_value_pairs):
-            doc_json = doc.to_json()
-            if doc_json['kwargs'].get('metadata') is None:
-                doc_json['kwargs']['metadata'] = doc.metadata
-            self.mysql_client.add_document(doc_id, doc_json)
+        insert_logger.info(f"add documents: {len(key_value_pairs)}")
+        docs = [(doc_id, self.document_json(doc)) for doc_id, doc in key_value_pairs]
+        # 多行INSERT分批写入，避免每个chunk一次往返和提交
+        self.mysql_client.add_documents_bulk(docs)
+
+    async def amset(self, key_value_pairs: Sequence[Tuple[str, V]]) -> None:
+        # InMemoryStore.amset直接调用mset，批量INSERT会阻塞事件循环，入库流水线中与Milvus、ES的写入无法并发
+        await asyncio.to_thread(self.mset, key_value_pairs)
 
     def mget(self, keys: Sequence[str]) -> List[Optional[V]]:
         """Get the values associated with the given keys.
@@ -54,11 +63,15 @@ class MysqlStore(InMemoryStore):
         """
        
         docs = []
+        # 一次IN查询取出所有parent，内容引用也整批还原，不再每个doc_id各查一次Documents和ChunkContent
+        doc_jsons = self.mysql_client.get_documents_by_doc_ids(list(keys))
         for doc_id in keys:
-            doc_json = self.mysql_client.get_document_by_doc_id(doc_id)
+            doc_json = doc_jsons.get(doc_id)
             if doc_json is None:
+                debug_logger.error(f"get_document: doc_id: {doc_id} not found")
                 docs.append(None)
                 continue
+            doc_json['kwargs'].pop('chunk_id', None)
             # debug_logger.info(f'doc_id: {doc_id} get doc_json: {doc_json}')
             user_id, file_id, file_name, kb_id = doc_json['kwargs']['metadata']['user_id'], doc_json['kwargs']['metadata']['file_id'], doc_json['kwargs']['metadata']['file_name'], doc_json['kwargs']['metadata']['kb_id'] 
             doc_idx = doc_id.split('_')[-1]
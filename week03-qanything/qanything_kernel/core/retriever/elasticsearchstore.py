@@ -21,10 +21,29 @@ class StoreElasticSearchClient:
         except Exception as e:
             debug_logger.error(f"Delete ES document failed with error: {e}")
 
-    def delete_files(self, file_ids, file_chunks):
-        docs_ids = []
-        for file_id, file_chunk in zip(file_ids, file_chunks):
-            # doc_id 是file_id + '_' + i，其中i是range(file_chunk)
-            docs_ids.extend([file_id + '_' + str(i) for i in range(file_chunk)])
-        if docs_ids:
-            self.delete(docs_ids)
+    def delete_files(self, file_ids, file_chunks=None):
+        # 子chunk的ES id由file_id + '_' + 文件内序号改为parent doc_id + '_' + parent内序号，按file_id删除对两种id都适用；
+        # file_chunks保留只为兼容调用方
+        delete_es_files(self.es_store, file_ids)
+
+
+def delete_es_files(es_store: ElasticsearchStore, file_ids):
+    """删除文件在ES中的全部子chunk"""
+    _delete_es_by_terms(es_store, 'metadata.file_id.keyword', file_ids)
+
+
+def delete_es_doc_ids(es_store: ElasticsearchStore, doc_ids, batch_size=1000):
+    """删除parent chunk(doc_id)在ES中的全部子chunk"""
+    for i in range(0, len(doc_ids), batch_size):
+        _delete_es_by_terms(es_store, 'metadata.doc_id.keyword', doc_ids[i:i + batch_size])
+
+
+def _delete_es_by_terms(es_store: ElasticsearchStore, field, values):
+    if not values:
+        return
+    try:
+        res = es_store.client.delete_by_query(index=es_store.index_name, query={"terms": {field: list(values)}},
+                                              refresh=True, conflicts='proceed')
+        debug_logger.info(f"Delete ES documents by {field}: {len(values)}, {values[0]}, deleted: {res.get('deleted')}")
+    except Exception as e:
+        debug_logger.error(f"Delete ES documents by {field} failed with error: {e}")
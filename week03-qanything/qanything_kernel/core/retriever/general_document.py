@@ -1,56 +1,44 @@
 from qanything_kernel.utils.general_utils import get_time, get_table_infos, num_tokens_embed, get_all_subpages, \
     html_to_markdown, clear_string, get_time_async
-from typing import List, Optional
+from typing import Iterable, List, Optional
 from qanything_kernel.configs.model_config import UPLOAD_ROOT_PATH, LOCAL_OCR_SERVICE_URL, IMAGES_ROOT_PATH, \
     DEFAULT_CHILD_CHUNK_SIZE, LOCAL_PDF_PARSER_SERVICE_URL, SEPARATORS
 from langchain.docstore.document import Document
-from qanything_kernel.utils.loader.my_recursive_url_loader import MyRecursiveUrlLoader
+from qanything_kernel.utils.web_crawler import crawl_site
+from qanything_kernel.utils.ocr_client import ocr_images
 from qanything_kernel.utils.custom_log import insert_logger
+from qanything_kernel.utils.tracing import get_trace_headers
 from langchain_community.document_loaders import UnstructuredFileLoader, TextLoader
 from langchain_community.document_loaders import UnstructuredWordDocumentLoader
 from langchain_community.document_loaders import UnstructuredEmailLoader
 from langchain_community.document_loaders import UnstructuredPowerPointLoader
 from qanything_kernel.utils.loader import UnstructuredPaddlePDFLoader
 from langchain.text_splitter import RecursiveCharacterTextSplitter
-from qanything_kernel.utils.loader.csv_loader import CSVLoader
-from qanything_kernel.utils.loader.json_loader import JSONLoader
+from qanything_kernel.utils.loader.table_loader import StreamingCSVLoader, StreamingXLSXLoader
+from qanything_kernel.utils.loader.json_loader import StreamingJSONLoader
 from qanything_kernel.utils.loader.markdown_parser import convert_markdown_to_langchaindoc
 import asyncio
 import aiohttp
 import docx2txt
 import base64
-import pandas as pd
 import os
 import json
 import requests
-import threading
 import re
 import newspaper
 import uuid
 import traceback
-import openpyxl
 import shutil
 import time
 
 
-def get_ocr_result_sync(image_data):
-    try:
-        response = requests.post(f"http://{LOCAL_OCR_SERVICE_URL}/ocr", data=image_data, timeout=120)
-        response.raise_for_status()  # 如果请求返回了错误状态码，将会抛出异常
-        ocr_res = response.text
-        ocr_res = json.loads(ocr_res)
-        return ocr_res['result']
-    except Exception as e:
-        insert_logger.warning(f"ocr error: {traceback.format_exc()}")
-        return None
-
 def get_pdf_result_sync(file_path):
     try:
         data = {
             'filename': file_path,
             'save_dir': os.path.dirname(file_path)
         }
-        headers = {"content-type": "application/json"}
+        headers = get_trace_headers({"content-type": "application/json"})
         response = requests.post(f"http://{LOCAL_PDF_PARSER_SERVICE_URL}/pdfparser", json=data, headers=headers,
                                  timeout=240)
         response.raise_for_status()  # 如果请求返回了错误状态码，将会抛出异常
@@ -62,8 +50,14 @@ def get_pdf_result_sync(file_path):
         return None
 
 
+TABS_PATTERN = re.compile(r'\t+')
+NEWLINES_PATTERN = re.compile(r'\n{3,}')
+FIGURE_PATTERN = re.compile(r'!\[figure]\(\d+-figure-\d+.jpg.*?\)')
+
+
 class LocalFileForInsert:
-    def __init__(self, user_id, kb_id, file_id, file_location, file_name, file_url, chunk_size, mysql_client):
+    def __init__(self, user_id, kb_id, file_id, file_location, file_name, file_url, chunk_size, mysql_client,
+                 faq_dict=None, kb_name=None):
         self.chunk_size = chunk_size
         self.markdown_text_splitter = RecursiveCharacterTextSplitter(separators=SEPARATORS, chunk_size=chunk_size,
                                                                      chunk_overlap=0, length_function=num_tokens_embed)
@@ -78,10 +72,13 @@ class LocalFileForInsert:
         self.faq_dict = {}
         self.file_path = ""
         self.mysql_client = mysql_client
+        self.kb_name = kb_name
         if self.file_location == 'FAQ':
-            faq_info = self.mysql_client.get_faq(self.file_id)
-            user_id, kb_id, question, answer, nos_keys = faq_info
-            self.faq_dict = {'question': question, 'answer': answer, 'nos_keys': nos_keys}
+            if faq_dict is None:
+                faq_info = self.mysql_client.get_faq(self.file_id)
+                user_id, kb_id, question, answer, nos_keys = faq_info
+                faq_dict = {'question': question, 'answer': answer, 'nos_keys': nos_keys}
+            self.faq_dict = faq_dict
         elif self.file_location == 'URL':
             self.file_url = file_url
             upload_path = os.path.join(UPLOAD_ROOT_PATH, user_id)
@@ -90,7 +87,6 @@ class LocalFileForInsert:
             self.file_path = os.path.join(file_dir, self.file_name)
         else:
             self.file_path = self.file_location
-        self.event = threading.Event()
 
     @staticmethod
     @get_time
@@ -100,14 +96,11 @@ class LocalFileForInsert:
             os.makedirs(full_dir_path)
         filename = os.path.split(filepath)[-1]
 
-        # 读取图片
-        img_np = open(filepath, 'rb').read()
-
-        img_data = {
-            "img64": base64.b64encode(img_np).decode("utf-8"),
-        }
-
-        result = get_ocr_result_sync(img_data)
+        # 读取图片，原始字节发给OCR服务
+        with open(filepath, 'rb') as f:
+            result = ocr_images([f.read()])[0]
+        if result is None:
+            raise RuntimeError(f'ocr failed: {filepath}')
 
         ocr_result = [line for line in result if line]
         ocr_result = '\n'.join(ocr_result)
@@ -290,51 +283,6 @@ class LocalFileForInsert:
 
         return None
 
-    @staticmethod
-    def excel_to_markdown(file_path, markdown_path):
-        def clean_cell_content(cell):
-            if cell is None:
-                return ''
-            # 将单元格内容转换为字符串，并替换换行符为空格
-            return re.sub(r'\s+', ' ', str(cell)).strip()
-        basename = os.path.splitext(os.path.basename(file_path))[0]
-        markdown_file = os.path.join(markdown_path, f"{basename}.md")
-
-        workbook = openpyxl.load_workbook(file_path, read_only=True, data_only=True)
-
-        with open(markdown_file, 'w', encoding='utf-8') as md_file:
-            for sheet_name in workbook.sheetnames:
-                sheet = workbook[sheet_name]
-                md_file.write(f"# {sheet_name}\n\n")
-
-                # 获取非空行和列
-                rows = [[clean_cell_content(cell) for cell in row] for row in sheet.iter_rows(values_only=True)]
-                non_empty_rows = [row for row in rows if any(cell != '' for cell in row)]
-
-                if not non_empty_rows:
-                    continue  # 跳过空表格
-
-                max_cols = max(len(row) for row in non_empty_rows)
-
-                # 处理每一行
-                for row_index, row in enumerate(non_empty_rows):
-                    # 补齐空单元格
-                    padded_row = row + [''] * (max_cols - len(row))
-
-                    # 转换为Markdown表格行，使用竖线作为分隔符
-                    markdown_row = '| ' + ' | '.join(padded_row) + ' |'
-                    md_file.write(markdown_row + '\n')
-
-                    # 在第一行后添加分隔符
-                    if row_index == 0:
-                        separator = '|' + '|'.join(['---' for _ in range(max_cols)]) + '|'
-                        md_file.write(separator + '\n')
-
-                md_file.write('\n\n')  # 在每个表格后添加空行
-
-        insert_logger.info(f"转换完成。Markdown 文件已保存为 {markdown_file}")
-        return markdown_file
-
     @staticmethod
     def load_text(file_path):
         encodings = ['utf-8', 'iso-8859-1', 'windows-1252']
@@ -378,8 +326,10 @@ class LocalFileForInsert:
                         Document(page_content=article.text, metadata={"title": article.title, "url": self.file_url})]
                 except Exception as e:
                     insert_logger.error(f"newspaper get url error: {self.file_url}, {traceback.format_exc()}")
-                    loader = MyRecursiveUrlLoader(url=self.file_url)
-                    docs = loader.load()
+                    pages, stats = crawl_site(self.file_url)
+                    insert_logger.info(f"crawl {self.file_url}: {len(pages)} pages, {stats}")
+                    docs = [Document(page_content=page.text, metadata={"title": page.title, "url": page.url})
+                            for page in pages]
         elif self.file_path.lower().endswith(".md"):
             try:
                 docs = convert_markdown_to_langchaindoc(self.file_path)
@@ -417,25 +367,9 @@ class LocalFileForInsert:
                 text = docx2txt.process(self.file_path)
                 docs = [Document(page_content=text)]
         elif self.file_path.lower().endswith(".xlsx"):
-            try:
-                markdown_file = self.excel_to_markdown(self.file_path, os.path.dirname(self.file_path))
-                docs = convert_markdown_to_langchaindoc(markdown_file)
-                docs = self.markdown_process(docs)
-            except Exception as e:
-                insert_logger.warning('Error in Powerful Excel parsing, use openpyxl instead.')
-                docs = []
-                excel_file = pd.ExcelFile(self.file_path)
-                sheet_names = excel_file.sheet_names
-                for idx, sheet_name in enumerate(sheet_names):
-                    xlsx = pd.read_excel(self.file_path, sheet_name=sheet_name, engine='openpyxl')
-                    xlsx = xlsx.dropna(how='all', axis=1)  # 只删除全为空的列
-                    xlsx = xlsx.dropna(how='all', axis=0)  # 只删除全为空的行
-                    csv_file_path = self.file_path[:-5] + f'_{idx}.csv'
-                    xlsx.to_csv(csv_file_path, index=False)
-                    insert_logger.info('xlsx2csv: %s', csv_file_path)
-                    loader = CSVLoader(csv_file_path, autodetect_encoding=True,
-                                       csv_args={"delimiter": ",", "quotechar": '"'})
-                    docs.extend(loader.load())
+            # 按行流式读取，每块带sheet名和表头，不再把整个workbook转成markdown/DataFrame
+            loader = StreamingXLSXLoader(self.file_path, self.child_chunk_size())
+            docs = loader.lazy_load()
         elif self.file_path.lower().endswith(".pptx"):
             loader = UnstructuredPowerPointLoader(self.file_path, strategy="fast")
             docs = loader.load()
@@ -443,42 +377,35 @@ class LocalFileForInsert:
             loader = UnstructuredEmailLoader(self.file_path, strategy="fast")
             docs = loader.load()
         elif self.file_path.lower().endswith(".json"):
-            loader = JSONLoader(self.file_path)
-            docs = loader.load()
+            # 流式展开，输出的块已按子chunk预算分好，不再每条记录一个Document
+            loader = StreamingJSONLoader(self.file_path, self.child_chunk_size())
+            docs = loader.lazy_load()
         elif self.file_path.lower().endswith(".csv"):
-            loader = CSVLoader(self.file_path, autodetect_encoding=True, csv_args={"delimiter": ",", "quotechar": '"'})
-            docs = loader.load()
+            loader = StreamingCSVLoader(self.file_path, self.child_chunk_size(),
+                                        csv_args={"delimiter": ",", "quotechar": '"'})
+            docs = loader.lazy_load()
         else:
             raise TypeError("文件类型不支持，目前仅支持：[md,txt,pdf,jpg,png,jpeg,docx,xlsx,pptx,eml,csv]")
         self.inject_metadata(docs)
 
-    def inject_metadata(self, docs: List[Document]):
-        # 这里给每个docs片段的metadata里注入file_id
+    def child_chunk_size(self) -> int:
+        # 表格按行攒成的块与merge_short_docs合并后的片段一样大，切分出的每个子chunk都带着表头
+        return min(DEFAULT_CHILD_CHUNK_SIZE, int(self.chunk_size / 2))
+
+    def inject_metadata(self, docs: Iterable[Document]):
+        # 这里给每个docs片段的metadata里注入file_id；docs可以是流式loader的生成器
         new_docs = []
+        # 同一文件的知识库名只查询一次
+        kb_name = self.get_kb_name() if docs else None
         for doc in docs:
-            page_content = re.sub(r'\t+', ' ', doc.page_content)  # 将制表符替换为单个空格
-            page_content = re.sub(r'\n{3,}', '\n\n', page_content)  # 将三个或更多换行符替换为两个
+            page_content = TABS_PATTERN.sub(' ', doc.page_content)  # 将制表符替换为单个空格
+            page_content = NEWLINES_PATTERN.sub('\n\n', page_content)  # 将三个或更多换行符替换为两个
             page_content = page_content.strip()  # 去除首尾空白字符
-            new_doc = Document(page_content=page_content)
-            new_doc.metadata["user_id"] = self.user_id
-            new_doc.metadata["kb_id"] = self.kb_id
-            new_doc.metadata["file_id"] = self.file_id
-            new_doc.metadata["file_name"] = self.file_name
-            new_doc.metadata["nos_key"] = self.file_location
-            new_doc.metadata["file_url"] = self.file_url
-            new_doc.metadata["title_lst"] = doc.metadata.get("title_lst", [])
-            new_doc.metadata["has_table"] = doc.metadata.get("has_table", False)
             # 从文本中提取图片数量：![figure]（x-figure-x.jpg）
-            new_doc.metadata["images"] = re.findall(r'!\[figure]\(\d+-figure-\d+.jpg.*?\)', page_content)
-            new_doc.metadata["page_id"] = doc.metadata.get("page_id", 0)
-            kb_name = self.mysql_client.get_knowledge_base_name([self.kb_id])[0][2]
-            metadata_infos = {"知识库名": kb_name, '文件名': self.file_name}
-            new_doc.metadata['headers'] = metadata_infos
-
-            if 'faq_dict' not in doc.metadata:
-                new_doc.metadata['faq_dict'] = {}
-            else:
-                new_doc.metadata['faq_dict'] = doc.metadata['faq_dict']
+            new_doc = Document(page_content=page_content, metadata=self.build_metadata(
+                kb_name, doc.metadata.get("title_lst", []), doc.metadata.get("has_table", False),
+                FIGURE_PATTERN.findall(page_content), doc.metadata.get("page_id", 0),
+                doc.metadata.get('faq_dict', {})))
             new_docs.append(new_doc)
         if new_docs:
             insert_logger.info('langchain analysis content head: %s', new_docs[0].page_content[:100])
@@ -487,32 +414,75 @@ class LocalFileForInsert:
 
         # merge short docs
         insert_logger.info(f"before merge doc lens: {len(new_docs)}")
-        child_chunk_size = min(DEFAULT_CHILD_CHUNK_SIZE, int(self.chunk_size / 2))
-        merged_docs = []
-        for doc_idx, doc in enumerate(new_docs):
-            if not merged_docs:
-                merged_docs.append(doc)
-            else:
-                last_doc = merged_docs[-1]
-                # insert_logger.info(f"doc_idx: {doc_idx}, doc_content: {doc.page_content[:100]}")
-                # insert_logger.info(f"last_doc_len: {num_tokens_embed(last_doc.page_content)}, doc_len: {num_tokens_embed(doc.page_content)}")
-                if num_tokens_embed(last_doc.page_content) + num_tokens_embed(doc.page_content) <= child_chunk_size or \
-                        num_tokens_embed(doc.page_content) < child_chunk_size / 4:
+        self.docs = self.merge_short_docs(new_docs)
+        insert_logger.info(f"after merge doc lens: {len(self.docs)}")
+
+    def get_kb_name(self):
+        # 解析子进程中没有查询过知识库名，由父进程在parse_spec中查好传入
+        if self.kb_name is None:
+            self.kb_name = self.mysql_client.get_knowledge_base_name([self.kb_id])[0][2]
+        return self.kb_name
+
+    def build_metadata(self, kb_name, title_lst, has_table, images, page_id, faq_dict):
+        return {"user_id": self.user_id, "kb_id": self.kb_id, "file_id": self.file_id, "file_name": self.file_name,
+                "nos_key": self.file_location, "file_url": self.file_url, "title_lst": title_lst,
+                "has_table": has_table, "images": images, "page_id": page_id,
+                "headers": {"知识库名": kb_name, '文件名': self.file_name}, "faq_dict": faq_dict}
+
+    def parse_spec(self) -> dict:
+        """在解析子进程中重建本对象所需的参数，都是可以pickle的基本类型"""
+        return {'user_id': self.user_id, 'kb_id': self.kb_id, 'file_id': self.file_id,
+                'file_location': self.file_location, 'file_name': self.file_name, 'file_url': self.file_url,
+                'chunk_size': self.chunk_size, 'faq_dict': self.faq_dict, 'kb_name': self.get_kb_name()}
+
+    def dump_chunks(self) -> List[tuple]:
+        """
+        解析结果转为紧凑的元组(page_content, title_lst, has_table, images, page_id, faq_dict)传回父进程，
+        文件级的公共metadata（user_id、kb_id、headers等）不随每个chunk重复pickle
+        """
+        return [(doc.page_content, doc.metadata['title_lst'], doc.metadata['has_table'], doc.metadata['images'],
+                 doc.metadata['page_id'], doc.metadata['faq_dict']) for doc in self.docs]
+
+    def load_chunks(self, chunks: List[tuple]):
+        kb_name = self.get_kb_name()
+        self.docs = [Document(page_content=page_content, metadata=self.build_metadata(kb_name, *fields))
+                     for page_content, *fields in chunks]
+
+    def merge_short_docs(self, docs: List[Document]) -> List[Document]:
+        """
+        把过短的片段合并到前一个片段中（CSV行、PPT页、JSON叶子节点等会产生大量小片段）。
+        合并后的token数增量维护：两段拼接的token数按 两段之和 - 特殊token数 计算，不再对不断变长的合并文本重复tokenize；
+        合并后的正文先收集到列表中，最后一次性拼接；已合并片段的标题在集合中维护，过滤重复标题行时只遍历一次。
+        """
+        child_chunk_size = self.child_chunk_size()
+        special_tokens = num_tokens_embed('')
+        merged = []  # [doc, 正文片段列表, 当前token数, 已出现标题(clear_string后)的集合]
+        for doc in docs:
+            doc_tokens = num_tokens_embed(doc.page_content)
+            if merged:
+                last = merged[-1]
+                last_doc = last[0]
+                if last[2] + doc_tokens <= child_chunk_size or doc_tokens < child_chunk_size / 4:
                     tmp_content_slices = doc.page_content.split('\n')
-                    # print(last_doc.metadata['title_lst'], tmp_content)
-                    tmp_content_slices_clear = [line for line in tmp_content_slices if clear_string(line) not in
-                                                [clear_string(t) for t in last_doc.metadata['title_lst']]]
-                    tmp_content = '\n'.join(tmp_content_slices_clear)
-                    # for title in last_doc.metadata['title_lst']:
-                    #     tmp_content = tmp_content.replace(title, '')
-                    last_doc.page_content += '\n\n' + tmp_content
-                    # for title in last_doc.metadata['title_lst']:
-                    #     last_doc.page_content = self.remove_substring_after_first(last_doc.page_content, '![figure]')
-                    last_doc.metadata['title_lst'] += doc.metadata.get('title_lst', [])
+                    tmp_content_slices_clear = [line for line in tmp_content_slices if clear_string(line) not in last[3]]
+                    if len(tmp_content_slices_clear) == len(tmp_content_slices):
+                        tmp_content, tmp_tokens = doc.page_content, doc_tokens
+                    else:
+                        tmp_content = '\n'.join(tmp_content_slices_clear)
+                        tmp_tokens = num_tokens_embed(tmp_content)
+                    last[1].append(tmp_content)
+                    last[2] += tmp_tokens - special_tokens
+                    titles = doc.metadata.get('title_lst', [])
+                    last_doc.metadata['title_lst'] += titles
+                    last[3].update(clear_string(t) for t in titles)
                     last_doc.metadata['has_table'] = last_doc.metadata.get('has_table', False) or doc.metadata.get(
                         'has_table', False)
                     last_doc.metadata['images'] += doc.metadata.get('images', [])
-                else:
-                    merged_docs.append(doc)
-        insert_logger.info(f"after merge doc lens: {len(merged_docs)}")
-        self.docs = merged_docs
+                    continue
+            merged.append([doc, [doc.page_content], doc_tokens,
+                           {clear_string(t) for t in doc.metadata.get('title_lst', [])}])
+        merged_docs = []
+        for doc, contents, _, _ in merged:
+            doc.page_content = '\n\n'.join(contents)
+            merged_docs.append(doc)
+        return merged_docs
@@ -0,0 +1,138 @@
+"""
+按内容指纹增量入库，以及中断后的断点续传。
+
+同一文件重新入库（strong模式上传同名文件，沿用原file_id）时，新切分出的parent chunk与已保存的指纹逐个对比：
+- 同一doc_id指纹相同的parent：Milvus、ES、Documents都不动；
+- 指纹不同或新增的parent：删除该doc_id下的旧子chunk后重新写入，子chunk向量按（归一化后的）文本指纹从旧数据中复用，
+  只有新内容需要embedding；
+- 文件变短后多出来的旧parent：三处一并删除。
+doc_id仍是file_id_序号（问答时按序号排序、取相邻chunk），前面插入/删除了parent时后面的doc_id会顺延，
+这些parent需要重新写入，但内容没变，向量全部复用。
+
+指纹同时是入库进度的检查点：一个parent写完Milvus、ES、MySQL三处后才记入指纹，入库过程中按间隔持久化。
+入库服务重启或卡住后重新领取文件时，已记入指纹的parent直接跳过，其余parent先按doc_id删除残留数据再写（幂等），
+残留数据中已经算好的向量照样复用。
+"""
+from qanything_kernel.configs.model_config import CHUNK_TOKEN_ENCODINGS, INGEST_CHECKPOINT_INTERVAL
+from qanything_kernel.utils.custom_log import insert_logger
+from langchain_core.documents import Document
+from typing import Dict, List, Optional
+import asyncio
+import hashlib
+import json
+import re
+import time
+import traceback
+
+# 2: 每个parent的指纹带上token数，chunk清单可以从指纹还原，不再依赖单独写入的清单
+FINGERPRINT_VERSION = 2
+_WHITESPACE = re.compile(r'\s+')
+
+
+def text_fingerprint(text: str) -> str:
+    """合并连续空白后的文本hash，只有空白不同的文本视为相同"""
+    return hashlib.blake2b(_WHITESPACE.sub(' ', text).strip().encode('utf-8'), digest_size=12).hexdigest()
+
+
+def parent_fingerprint(doc: Document) -> str:
+    """覆盖写入Documents的正文和metadata（headers、标题、表格、图片、页码等），需在补充headers前缀之前计算"""
+    metadata = doc.metadata
+    extra = json.dumps([metadata.get(k) for k in ('headers', 'title_lst', 'has_table', 'images', 'page_id',
+                                                  'faq_dict', 'file_url')],
+                       ensure_ascii=False, sort_keys=True, default=str)
+    return text_fingerprint(doc.page_content + '\n' + extra)
+
+
+class IncrementalPlan:
+    def __init__(self, file_id: str, chunk_size: int, documents: List[Document], old: Optional[Dict] = None):
+        self.file_id = file_id
+        self.chunk_size = chunk_size
+        self.doc_ids = [f'{file_id}_{i}' for i in range(len(documents))]
+        self.parent_hashes = [parent_fingerprint(doc) for doc in documents]
+        # 指纹版本或chunk_size变了（子chunk切分不同），整体重新入库
+        self.incremental = bool(old and old.get('version') == FINGERPRINT_VERSION
+                                and old.get('chunk_size') == chunk_size)
+        # doc_id -> [parent指纹, 子chunk指纹列表, token数]，只包含三处都已写完的parent
+        self.old_parents = {doc_id: [parent_hash, child_hashes, token_counts]
+                            for doc_id, parent_hash, child_hashes, token_counts in old['parents']} \
+            if self.incremental else {}
+
+        self.changed = [i for i, (doc_id, parent_hash) in enumerate(zip(self.doc_ids, self.parent_hashes))
+                        if doc_id not in self.old_parents or self.old_parents[doc_id][0] != parent_hash]
+        new_doc_ids = set(self.doc_ids)
+        self.removed_doc_ids = [doc_id for doc_id in self.old_parents if doc_id not in new_doc_ids]
+        # 写入前要按doc_id清理的parent：变动的（可能有旧内容或上次中断时写了一半）和多出来的
+        self.dirty_doc_ids = [self.doc_ids[i] for i in self.changed] + self.removed_doc_ids
+        # 可复用向量的来源：将被清理的parent，以及内容与某个变动parent相同的（位移）
+        changed_hashes = {self.parent_hashes[i] for i in self.changed}
+        dirty = set(self.dirty_doc_ids)
+        self.vector_source_doc_ids = self.dirty_doc_ids + [
+            doc_id for doc_id, (parent_hash, _, _) in self.old_parents.items()
+            if doc_id not in dirty and parent_hash in changed_hashes]
+
+    @property
+    def unchanged_count(self) -> int:
+        return len(self.doc_ids) - len(self.changed)
+
+
+class FingerprintCheckpoint:
+    """
+    指纹即检查点：begin时先从已保存的指纹中去掉待清理的parent，之后每批parent三处写完调用commit，
+    按INGEST_CHECKPOINT_INTERVAL间隔写回MySQL，finish时按doc_id顺序写入最终指纹。
+    """
+
+    def __init__(self, mysql_client, plan: IncrementalPlan, interval: float = INGEST_CHECKPOINT_INTERVAL):
+        self.mysql_client = mysql_client
+        self.plan = plan
+        self.interval = interval
+        dirty = set(plan.dirty_doc_ids)
+        self.parents = {doc_id: entry for doc_id, entry in plan.old_parents.items() if doc_id not in dirty}
+        self.partial = {}  # ES写入失败的parent：Milvus、MySQL已写入，计入chunk清单但不记入指纹
+        self.hashes = dict(zip(plan.doc_ids, plan.parent_hashes))
+        self.last_flush = 0.0
+        self.flushes = 0
+        self._lock = asyncio.Lock()
+
+    def state(self, ordered: bool = False) -> Dict:
+        doc_ids = [doc_id for doc_id in self.plan.doc_ids if doc_id in self.parents] if ordered else self.parents
+        parents = [[doc_id, *self.parents[doc_id]] for doc_id in doc_ids]
+        return {'version': FINGERPRINT_VERSION, 'chunk_size': self.plan.chunk_size, 'parents': parents}
+
+    async def begin(self):
+        # 清理残留数据之前落盘，之后任何时刻中断，指纹里都只有三处完整的parent；落盘失败时不能继续入库
+        await self.flush(strict=True)
+
+    async def commit(self, full_docs, child_hashes: Dict[str, List[str]], complete: bool = True):
+        """只在这批parent的Milvus、Documents都写入成功后调用；complete为False表示ES写入失败"""
+        target = self.parents if complete else self.partial
+        for doc_id, doc in full_docs:
+            counts = {k: v for k, v in doc.metadata.get('token_counts', {}).items() if k in CHUNK_TOKEN_ENCODINGS}
+            target[doc_id] = [self.hashes[doc_id], child_hashes.get(doc_id, []), counts]
+        if time.monotonic() - self.last_flush >= self.interval:
+            await self.flush()
+
+    async def flush(self, ordered: bool = False, strict: bool = False):
+        async with self._lock:
+            state = self.state(ordered)
+            self.last_flush = time.monotonic()
+            try:
+                await asyncio.to_thread(self.mysql_client.upsert_chunk_fingerprints, self.plan.file_id, state)
+                self.flushes += 1
+            except Exception as e:
+                if strict:
+                    raise
+                # 检查点写失败只影响中断后的续传，不影响本次入库
+                insert_logger.error(f"save fingerprints checkpoint failed: {traceback.format_exc()}")
+
+    async def finish(self) -> Dict:
+        await self.flush(ordered=True)
+        return self.state(ordered=True)
+
+    def manifest_chunks(self) -> List:
+        """完整的chunk清单（按doc_id顺序），包含Documents中已写入的所有parent"""
+        written = {**self.parents, **self.partial}
+        return [[doc_id, written[doc_id][2]] for doc_id in self.plan.doc_ids if doc_id in written]
+
+    @property
+    def child_count(self) -> int:
+        return sum(len(entry[1]) for entry in {**self.parents, **self.partial}.values())
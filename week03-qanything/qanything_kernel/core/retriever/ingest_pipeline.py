@@ -0,0 +1,240 @@
+"""
+入库流水线：parent chunk按批依次流经三个阶段
+    split(切分子chunk、计算token数) -> embed(按token预算合并请求embedding服务) -> store(并发写入Milvus、ES、MySQL)
+阶段之间用有界asyncio队列衔接，切分、embedding服务和各存储可以同时工作；队列满时上游等待（背压），内存占用有上限。
+每个阶段统计忙碌时间和利用率(忙碌时间 / (总耗时 * 并发数))，利用率最高的阶段就是瓶颈。
+增量重新入库时传入reuse_vectors（子chunk文本指纹 -> 旧向量），命中的子chunk不再请求embedding服务；
+传入shared_vectors时，剩下的子chunk再按parent内容hash到其他文件/知识库中查找文本相同的子chunk向量。
+传入checkpoint时，每批parent三处都写完后记入检查点；ES写入失败的parent不记入，下次重新入库时补写；
+Milvus或Documents写入失败时抛出异常，整个入库失败，这批parent不记入检查点。
+"""
+from qanything_kernel.configs.model_config import (INGEST_SPLIT_BATCH, INGEST_QUEUE_SIZE, INGEST_EMBED_CONCURRENCY,
+                                                   INGEST_STORE_CONCURRENCY, INGEST_EMBED_TOKEN_BUDGET)
+from qanything_kernel.utils.custom_log import insert_logger
+from qanything_kernel.utils.tracing import span
+from qanything_kernel.core.retriever.incremental import text_fingerprint
+from langchain_core.documents import Document
+from typing import Awaitable, Callable, Dict, List, Optional
+import asyncio
+import time
+import traceback
+
+_DONE = object()
+
+
+class StageStats:
+    def __init__(self, name: str, concurrency: int):
+        self.name = name
+        self.concurrency = concurrency
+        self.busy = 0.0  # 所有并发协程处理批次的耗时之和
+        self.blocked = 0.0  # 下游队列已满、等待放入的耗时（背压）
+        self.batches = 0
+        self.items = 0
+
+    def add(self, cost: float, items: int):
+        self.busy += cost
+        self.batches += 1
+        self.items += items
+
+    def utilization(self, wall: float) -> float:
+        return self.busy / max(wall * self.concurrency, 1e-6)
+
+
+class IngestPipeline:
+    def __init__(self, retriever, es_store=None, time_record: Optional[dict] = None,
+                 split_batch: int = INGEST_SPLIT_BATCH, queue_size: int = INGEST_QUEUE_SIZE,
+                 embed_concurrency: int = INGEST_EMBED_CONCURRENCY, store_concurrency: int = INGEST_STORE_CONCURRENCY,
+                 embed_token_budget: int = INGEST_EMBED_TOKEN_BUDGET, reuse_vectors: Optional[Dict[str, list]] = None,
+                 checkpoint=None, progress=None,
+                 shared_vectors: Optional[Callable[[list], Awaitable[Dict[str, list]]]] = None):
+        self.retriever = retriever
+        self.vectorstore = retriever.vectorstore
+        self.es_store = es_store
+        self.time_record = time_record if time_record is not None else {}
+        self.split_batch = split_batch
+        self.queue_size = queue_size
+        self.embed_concurrency = embed_concurrency
+        self.store_concurrency = store_concurrency
+        self.embed_token_budget = embed_token_budget
+        self.reuse_vectors = reuse_vectors or {}
+        self.checkpoint = checkpoint
+        self.progress = progress
+        self.shared_vectors = shared_vectors
+        self.stats = {'split': StageStats('split', 1), 'embed': StageStats('embed', embed_concurrency),
+                      'store': StageStats('store', store_concurrency)}
+        self.pks = []
+        self.full_docs = []
+        self.child_count = 0
+        self.child_hashes: Dict[str, List[str]] = {}  # parent doc_id -> 子chunk文本指纹
+        self.embedded_count = 0
+        self.shared_count = 0  # 复用其他文件/知识库向量的子chunk数
+        self.docstore_time = 0.0
+
+    async def run(self, documents: List[Document], doc_ids: List[str], add_to_docstore: bool = True):
+        """返回Milvus主键列表，full_docs([(doc_id, parent_doc), ...])保存在self.full_docs中"""
+        self.add_to_docstore = add_to_docstore
+        embed_queue = asyncio.Queue(maxsize=self.queue_size)
+        store_queue = asyncio.Queue(maxsize=self.queue_size)
+        start = time.perf_counter()
+        split_task = asyncio.create_task(self._split(documents, doc_ids, embed_queue))
+        embed_tasks = [asyncio.create_task(self._embed(embed_queue, store_queue))
+                       for _ in range(self.embed_concurrency)]
+        store_tasks = [asyncio.create_task(self._store(store_queue)) for _ in range(self.store_concurrency)]
+
+        async def drive():
+            # 上游结束后给每个下游协程发结束标记
+            await split_task
+            for _ in embed_tasks:
+                await embed_queue.put(_DONE)
+            await asyncio.gather(*embed_tasks)
+            for _ in store_tasks:
+                await store_queue.put(_DONE)
+            await asyncio.gather(*store_tasks)
+
+        driver = asyncio.create_task(drive())
+        tasks = [split_task, *embed_tasks, *store_tasks, driver]
+        try:
+            # 任一阶段出错立即结束整个流水线，避免上游阻塞在已满的队列上
+            done, _ = await asyncio.wait(tasks, return_when=asyncio.FIRST_EXCEPTION)
+            for task in done:
+                if not task.cancelled() and task.exception() is not None:
+                    raise task.exception()
+            await driver
+        finally:
+            for task in tasks:
+                if not task.done():
+                    task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+        if self.pks:
+            # 所有批次写完后flush一次
+            await self.vectorstore.aflush(self.time_record)
+        self._record(time.perf_counter() - start)
+        return self.pks
+
+    async def _split(self, documents, doc_ids, out_queue):
+        stats = self.stats['split']
+        for i in range(0, len(documents), self.split_batch):
+            start = time.perf_counter()
+            # 切分和tokenize在线程中执行，期间事件循环照常调度embed/store阶段和进度上报
+            embed_docs, full_docs = await asyncio.to_thread(self.retriever.build_child_documents,
+                                                            documents[i:i + self.split_batch],
+                                                            doc_ids[i:i + self.split_batch])
+            # ES的doc_id是parent doc_id + '_' + 子chunk在parent内的序号，某个parent变化时不影响其他parent的子chunk
+            es_ids = []
+            for doc in embed_docs:
+                hashes = self.child_hashes.setdefault(doc.metadata[self.retriever.id_key], [])
+                es_ids.append(f'{doc.metadata[self.retriever.id_key]}_{len(hashes)}')
+                hashes.append(text_fingerprint(doc.page_content))
+            stats.add(time.perf_counter() - start, len(full_docs))
+            self.child_count += len(embed_docs)
+            self.full_docs.extend(full_docs)
+            self._advance('split', len(full_docs))
+            self._advance('split_chunks', len(embed_docs))
+            start = time.perf_counter()
+            await out_queue.put((es_ids, embed_docs, full_docs))
+            stats.blocked += time.perf_counter() - start
+
+    async def _embed(self, in_queue, out_queue):
+        stats = self.stats['embed']
+        while True:
+            item = await in_queue.get()
+            if item is _DONE:
+                return
+            es_ids, embed_docs, full_docs = item
+            start = time.perf_counter()
+            texts = [doc.page_content for doc in embed_docs]
+            embeddings = [self.reuse_vectors.get(text_fingerprint(text)) for text in texts] if self.reuse_vectors \
+                else [None] * len(texts)
+            missing = [i for i, embedding in enumerate(embeddings) if embedding is None]
+            if missing and self.shared_vectors is not None:
+                shared = await self.shared_vectors(full_docs)
+                for i in missing:
+                    embeddings[i] = shared.get(text_fingerprint(texts[i]))
+                still_missing = [i for i in missing if embeddings[i] is None]
+                self.shared_count += len(missing) - len(still_missing)
+                missing = still_missing
+            if missing:
+                with span('milvus_embedding', record_key='milvus_embedding_time', time_record=self.time_record,
+                          texts=len(missing)):
+                    new_embeddings = await self.vectorstore.embedding_func.aembed_documents(
+                        [texts[i] for i in missing], token_budget=self.embed_token_budget)
+                for i, embedding in zip(missing, new_embeddings):
+                    embeddings[i] = embedding
+                self.embedded_count += len(missing)
+            stats.add(time.perf_counter() - start, len(embed_docs))
+            self._advance('embed', len(embed_docs))
+            start = time.perf_counter()
+            await out_queue.put((es_ids, embed_docs, embeddings, full_docs))
+            stats.blocked += time.perf_counter() - start
+
+    async def _store(self, in_queue):
+        stats = self.stats['store']
+        while True:
+            item = await in_queue.get()
+            if item is _DONE:
+                return
+            es_ids, embed_docs, embeddings, full_docs = item
+            start = time.perf_counter()
+            # 三处都结束后再看结果：Milvus、Documents写入失败时抛出异常，整个入库失败，不会走到下面的检查点；
+            # ES写入失败只返回False
+            milvus_res, es_ok, docstore_res = await asyncio.gather(self._store_milvus(embed_docs, embeddings),
+                                                                   self._store_es(es_ids, embed_docs),
+                                                                   self._store_docstore(full_docs),
+                                                                   return_exceptions=True)
+            for res in (milvus_res, es_ok, docstore_res):
+                if isinstance(res, BaseException):
+                    raise res
+            stats.add(time.perf_counter() - start, len(embed_docs))
+            if self.checkpoint is not None:
+                # 指纹只记入三处都写入成功的parent，否则之后的增量入库会认为它没变而不再重写
+                await self.checkpoint.commit(full_docs, self.child_hashes, complete=es_ok)
+            self._advance('store', len(full_docs))
+            self._advance('store_chunks', len(embed_docs))
+
+    async def _store_milvus(self, embed_docs, embeddings):
+        if not embed_docs:
+            return
+        pks = await self.vectorstore.ainsert_embeddings([doc.page_content for doc in embed_docs], embeddings,
+                                                        [doc.metadata for doc in embed_docs],
+                                                        time_record=self.time_record)
+        self.pks.extend(pks)
+
+    async def _store_es(self, es_ids, embed_docs) -> bool:
+        if self.es_store is None or not embed_docs:
+            return True
+        try:
+            with span('es_insert', record_key='es_insert_time', time_record=self.time_record,
+                      child_docs=len(embed_docs)):
+                # id固定为parent doc_id + 序号，重复写入是覆盖
+                await self.es_store.aadd_documents(embed_docs, ids=es_ids)
+            return True
+        except Exception as e:
+            insert_logger.error(f"Error in aadd_documents on es_store: {traceback.format_exc()}")
+            return False
+
+    async def _store_docstore(self, full_docs):
+        """写入失败时抛出异常（add_documents_bulk任何一批失败都会抛出），不能吞掉后继续记入检查点"""
+        if not self.add_to_docstore or not full_docs:
+            return
+        start = time.perf_counter()
+        with span('docstore_insert', record_key='docstore_insert_time', time_record=self.time_record,
+                  parent_docs=len(full_docs)):
+            await self.retriever.docstore.amset(full_docs)
+        self.docstore_time += time.perf_counter() - start
+
+    def _advance(self, stage: str, items: int):
+        if self.progress is not None:
+            self.progress.advance(stage, items)
+
+    def _record(self, wall: float):
+        stages = {}
+        for name, stats in self.stats.items():
+            stages[name] = {'busy': round(stats.busy, 2), 'blocked': round(stats.blocked, 2),
+                            'util': round(stats.utilization(wall), 2), 'batches': stats.batches}
+        bottleneck = max(self.stats.values(), key=lambda s: s.utilization(wall)).name
+        self.time_record['pipeline'] = {'wall': round(wall, 2), 'bottleneck': bottleneck, 'stages': stages}
+        if self.docstore_time:
+            self.time_record['docstore_chunks_per_sec'] = round(len(self.full_docs) / self.docstore_time, 1)
+        insert_logger.info(f"ingest pipeline: parents={len(self.full_docs)}, children={self.child_count}, "
+                           f"embedded={self.embedded_count}, shared={self.shared_count}, "
+                           f"wall={wall:.2f}s, bottleneck={bottleneck}, stages={stages}")
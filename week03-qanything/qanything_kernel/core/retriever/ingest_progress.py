@@ -0,0 +1,195 @@
+"""
+入库进度、吞吐统计与卡住检测。
+
+- IngestProgress：单个文件的进度计数（解析的页数、完成的字节数、切分的parent数、embedding的子chunk数、写入的parent/子chunk数），
+  入库流水线每完成一批调用advance，据此计算各阶段速率、完成百分比和ETA，定期写入File.msg；
+- ThroughputMeter：入库worker最近一段时间内各阶段完成的条数，得到worker级别的吞吐，定期写入InsertWorkerStats表；
+- summarize_insert_queue：汇总各worker的吞吐和File表中的积压，估算积压清空所需时间；
+- run_with_stall_detection：只在连续INSERT_STALL_SECONDS没有任何进展时才取消入库，
+  大文件只要在持续推进就不会被固定超时打断。
+"""
+from qanything_kernel.configs.model_config import INSERT_STALL_SECONDS, INSERT_STATS_WINDOW
+from collections import deque
+from typing import Awaitable, Dict, List, Optional
+import asyncio
+import time
+
+# 解析在子进程中完成后才能计数，整体进度中解析占固定比例，其余按写入完成的parent数计算
+PARSE_WEIGHT = 0.1
+
+
+class IngestStalledError(Exception):
+    """入库流水线长时间没有进展"""
+
+
+class IngestProgress:
+    def __init__(self, file_id: str = '', file_size: int = 0, meter: Optional['ThroughputMeter'] = None):
+        self.file_id = file_id
+        self.file_size = max(file_size or 0, 0)
+        self.meter = meter
+        self.start = time.monotonic()
+        self.last_progress = self.start
+        self.counters: Dict[str, int] = {}
+        self.totals: Dict[str, int] = {}
+        self.pipeline_start: Optional[float] = None
+
+    def set_total(self, stage: str, total: int):
+        self.totals[stage] = total
+        self.last_progress = time.monotonic()
+        if self.pipeline_start is None:
+            self.pipeline_start = self.last_progress
+
+    def advance(self, stage: str, items: int = 1):
+        now = time.monotonic()
+        self.counters[stage] = self.counters.get(stage, 0) + items
+        self.last_progress = now
+        if self.meter is not None:
+            self.meter.add(stage, items)
+
+    def idle_seconds(self) -> float:
+        return time.monotonic() - self.last_progress
+
+    def rate(self, stage: str) -> Optional[float]:
+        """流水线开始以来每秒完成的条数；解析和字节数只在结束时计数一次，按整个文件的耗时计算"""
+        if stage not in self.counters:
+            return None
+        start = self.pipeline_start if self.pipeline_start is not None and stage not in ('parse', 'bytes') \
+            else self.start
+        return self.counters[stage] / max(time.monotonic() - start, 1e-3)
+
+    def percent(self) -> int:
+        if 'parse' not in self.counters:
+            return 0
+        total = self.totals.get('store')
+        if total is None:
+            return int(PARSE_WEIGHT * 100)
+        done = min(self.counters.get('store', 0) / total, 1.0) if total else 1.0
+        # 写完之后还有清单、指纹等收尾，完成前最多显示99%
+        return min(int((PARSE_WEIGHT + (1 - PARSE_WEIGHT) * done) * 100), 99)
+
+    def eta(self) -> Optional[float]:
+        """按写入阶段的速率估算剩余秒数，写入还没开始时按embedding速率"""
+        total = self.totals.get('store')
+        if total is None:
+            return None
+        remaining = total - self.counters.get('store', 0)
+        if remaining <= 0:
+            return 0.0
+        rate = self.rate('store')
+        if rate is None:
+            # embedding速率以子chunk计，按已切分的子chunk/parent比例换算为parent
+            embed_rate, parents = self.rate('embed'), self.counters.get('split', 0)
+            if not embed_rate or not parents:
+                return None
+            rate = embed_rate * parents / max(self.counters.get('split_chunks', parents), 1)
+        return remaining / rate
+
+    def snapshot(self) -> Dict:
+        rates = {stage: round(self.rate(stage), 1) for stage in self.counters}
+        eta = self.eta()
+        return {'percent': self.percent(), 'counters': dict(self.counters), 'totals': dict(self.totals),
+                'rates': rates, 'eta': None if eta is None else round(eta, 1),
+                'elapsed': round(time.monotonic() - self.start, 1)}
+
+    def format_msg(self, max_length: int = 255) -> str:
+        """写入File.msg，保留原来的Processing:xx%前缀"""
+        counters = self.counters
+        parts = [f'Processing:{self.percent()}%']
+        if 'parse' in counters:
+            parts.append(f'pages={counters["parse"]}')
+        if 'embed' in counters:
+            parts.append(f'embedded={counters["embed"]}')
+        if 'store' in self.totals:
+            parts.append(f'stored={counters.get("store", 0)}/{self.totals["store"]}')
+        if 'store_chunks' in counters:
+            parts.append(f'chunks={counters["store_chunks"]}')
+        rate = self.rate('embed')
+        if rate:
+            parts.append(f'embed={rate:.0f}/s')
+        eta = self.eta()
+        if eta is not None:
+            parts.append(f'eta={eta:.0f}s')
+        return ' '.join(parts)[:max_length]
+
+
+class ThroughputMeter:
+    """入库worker最近window秒内各阶段完成的条数，以及正在处理的文件"""
+
+    def __init__(self, window: float = INSERT_STATS_WINDOW):
+        self.window = window
+        self.start = time.monotonic()
+        self.events = deque()  # (时间, 阶段, 条数)
+        self.jobs: Dict[str, IngestProgress] = {}
+
+    def add(self, stage: str, items: int):
+        now = time.monotonic()
+        self.events.append((now, stage, items))
+        self._prune(now)
+
+    def _prune(self, now: float):
+        while self.events and self.events[0][0] < now - self.window:
+            self.events.popleft()
+
+    def rates(self) -> Dict[str, float]:
+        now = time.monotonic()
+        self._prune(now)
+        span = min(self.window, max(now - self.start, 1e-3))
+        totals = {}
+        for _, stage, items in self.events:
+            totals[stage] = totals.get(stage, 0) + items
+        return {stage: round(items / span, 2) for stage, items in totals.items()}
+
+    def snapshot(self) -> Dict:
+        jobs = []
+        for file_id, progress in self.jobs.items():
+            eta = progress.eta()
+            jobs.append({'file_id': file_id, 'file_size': progress.file_size, 'percent': progress.percent(),
+                         'eta': None if eta is None else round(eta, 1)})
+        return {'window': self.window, 'rates': self.rates(), 'jobs': jobs}
+
+
+def summarize_insert_queue(backlog: Dict[str, List[int]], worker_stats: List[Dict]) -> Dict:
+    """
+    backlog: {status: [文件数, 字节数]}（gray/yellow），worker_stats: 各worker最近上报的ThroughputMeter.snapshot()。
+    积压字节数 = 待领取文件 + 处理中文件未完成的部分，按各worker入库完成字节数的吞吐之和估算清空时间。
+    """
+    rates = {}
+    remaining_bytes = 0
+    jobs = 0
+    for stats in worker_stats:
+        for stage, rate in stats.get('rates', {}).items():
+            rates[stage] = round(rates.get(stage, 0) + rate, 2)
+        for job in stats.get('jobs', []):
+            jobs += 1
+            remaining_bytes += job['file_size'] * (100 - job['percent']) / 100
+    gray_files, gray_bytes = backlog.get('gray', [0, 0])
+    yellow_files, _ = backlog.get('yellow', [0, 0])
+    backlog_bytes = int(gray_bytes + remaining_bytes)
+    drain_seconds = None
+    if not gray_files and not yellow_files:
+        drain_seconds = 0.0
+    elif rates.get('bytes'):
+        drain_seconds = round(backlog_bytes / rates['bytes'], 1)
+    elif rates.get('files'):
+        drain_seconds = round((gray_files + yellow_files) / rates['files'], 1)
+    return {'backlog_files': gray_files, 'processing_files': yellow_files, 'backlog_bytes': backlog_bytes,
+            'active_workers': len(worker_stats), 'active_jobs': jobs, 'throughput': rates,
+            'drain_seconds': drain_seconds}
+
+
+async def run_with_stall_detection(aw: Awaitable, progress: IngestProgress,
+                                   stall_seconds: float = INSERT_STALL_SECONDS):
+    """等待aw完成；超过stall_seconds没有进展时取消并抛出IngestStalledError"""
+    task = asyncio.ensure_future(aw)
+    try:
+        while True:
+            done, _ = await asyncio.wait({task}, timeout=max(stall_seconds - progress.idle_seconds(), 0.1))
+            if done:
+                return task.result()
+            if progress.idle_seconds() >= stall_seconds:
+                raise IngestStalledError(f'no progress for {progress.idle_seconds():.1f}s, '
+                                         f'counters: {progress.counters}')
+    finally:
+        if not task.done():
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
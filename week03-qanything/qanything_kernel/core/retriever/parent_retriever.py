@@ -1,13 +1,19 @@
 from langchain.retrievers import ParentDocumentRetriever
 from qanything_kernel.core.retriever.vectorstore import VectorStoreMilvusClient
-from qanything_kernel.core.retriever.elasticsearchstore import StoreElasticSearchClient
+from qanything_kernel.core.retriever.elasticsearchstore import (StoreElasticSearchClient, delete_es_files,
+                                                                delete_es_doc_ids)
 from qanything_kernel.connector.database.mysql.mysql_client import KnowledgeBaseManager
 from qanything_kernel.core.retriever.docstrore import MysqlStore
-from qanything_kernel.configs.model_config import DEFAULT_CHILD_CHUNK_SIZE, DEFAULT_PARENT_CHUNK_SIZE, SEPARATORS
+from qanything_kernel.core.retriever.ingest_pipeline import IngestPipeline
+from qanything_kernel.core.retriever.incremental import IncrementalPlan, FingerprintCheckpoint, text_fingerprint
+from qanything_kernel.core.retriever.ingest_progress import IngestProgress
+from qanything_kernel.configs.model_config import (DEFAULT_CHILD_CHUNK_SIZE, DEFAULT_PARENT_CHUNK_SIZE, SEPARATORS,
+                                                   CHUNK_TOKEN_ENCODINGS, CHILD_HEADERS_WITH_KB_NAME)
 from qanything_kernel.utils.custom_log import debug_logger, insert_logger
-from langchain.text_splitter import RecursiveCharacterTextSplitter
-from qanything_kernel.utils.general_utils import num_tokens_embed, get_time_async
-import copy
+from qanything_kernel.utils.splitter import TokenOffsetTextSplitter
+from qanything_kernel.utils.general_utils import num_tokens_embed, get_time_async, compute_chunk_token_counts
+from qanything_kernel.utils.tracing import span
+from qanything_kernel.utils.chunk_content import split_document_json, content_hash
 from typing import List, Optional, Tuple, Dict
 from langchain_core.documents import Document
 from langchain_core.callbacks import (
@@ -15,10 +21,16 @@ from langchain_core.callbacks import (
 )
 from langchain_community.vectorstores.milvus import Milvus
 from langchain_elasticsearch import ElasticsearchStore
+import asyncio
+import json
 import time
 import traceback
 
 
+# 只存在MySQL中的parent chunk里，不写入Milvus/ES的metadata字段
+EMBED_EXCLUDED_METADATA = ('title_lst', 'has_table', 'images', 'file_name', 'nos_key', 'faq_dict', 'page_id')
+
+
 class SelfParentRetriever(ParentDocumentRetriever):
     def set_search_kwargs(self, search_type, **kwargs):
         self.search_type = search_type
@@ -35,7 +47,7 @@ class SelfParentRetriever(ParentDocumentRetriever):
         Returns:
             List of relevant documents
         """
-        debug_logger.info(f"Search: query: {query}, {self.search_type} with {self.search_kwargs}")
+        debug_logger.info("Search: query: %s, %s with %s", query, self.search_type, self.search_kwargs)
         # self.vectorstore.col.load()
         scores = []
         if self.search_type == "mmr":
@@ -62,8 +74,8 @@ class SelfParentRetriever(ParentDocumentRetriever):
         res = [d for d in docs if d is not None]
         sub_docs_lengths = [len(d.page_content) for d in sub_docs]
         res_lengths = [len(d.page_content) for d in res]
-        debug_logger.info(
-            f"Got child docs: {len(sub_docs)}, {sub_docs_lengths} and Parent docs: {len(res)}, {res_lengths}")
+        debug_logger.info("Got child docs: %s, %s and Parent docs: %s, %s", len(sub_docs), sub_docs_lengths, len(res),
+                          res_lengths)
         return res
 
     async def aadd_documents(
@@ -74,141 +86,264 @@ class SelfParentRetriever(ParentDocumentRetriever):
             parent_chunk_size: Optional[int] = None,
             es_store: Optional[ElasticsearchStore] = None,
             single_parent: bool = False,
+            progress: Optional[IngestProgress] = None,
     ) -> Tuple[int, Dict]:
         # insert_logger.info(f"Inserting {len(documents)} complete documents, single_parent: {single_parent}")
         split_start = time.perf_counter()
         if self.parent_splitter is not None and not single_parent:
-            # documents = self.parent_splitter.split_documents(documents)
-            split_documents = []
-            need_split_docs = []
-            for doc in documents:
-                if doc.metadata['has_table'] or num_tokens_embed(doc.page_content) <= parent_chunk_size:
-                    if need_split_docs:
-                        split_documents.extend(self.parent_splitter.split_documents(need_split_docs))
-                        need_split_docs = []
-                    split_documents.append(doc)
-                else:
-                    need_split_docs.append(doc)
-            if need_split_docs:
-                split_documents.extend(self.parent_splitter.split_documents(need_split_docs))
-            documents = split_documents
+            documents = self.split_parent_documents(documents, parent_chunk_size)
         insert_logger.info(f"Inserting {len(documents)} parent documents")
         if ids is None:
-            file_id = documents[0].metadata['file_id']
-            doc_ids = [file_id + '_' + str(i) for i, _ in enumerate(documents)]
             if not add_to_docstore:
                 raise ValueError(
                     "If ids are not passed in, `add_to_docstore` MUST be True"
                 )
-        else:
-            if len(documents) != len(ids):
-                raise ValueError(
-                    "Got uneven list of documents and ids. "
-                    "If `ids` is provided, should be same length as `documents`."
-                )
-            doc_ids = ids
+            return await self._aadd_file_documents(documents, parent_chunk_size, es_store, split_start, progress)
+        if len(documents) != len(ids):
+            raise ValueError(
+                "Got uneven list of documents and ids. "
+                "If `ids` is provided, should be same length as `documents`."
+            )
+
+        time_record = {"split_time": round(time.perf_counter() - split_start, 2)}
+        if progress is not None:
+            progress.set_total('store', len(documents))
+
+        # 子chunk切分、embedding、写入Milvus/ES/MySQL按批流水线执行，耗时和各阶段利用率记录在time_record中
+        pipeline = IngestPipeline(self, es_store=es_store, time_record=time_record, progress=progress)
+        with span('vectorstore_insert', parent_docs=len(documents)):
+            res = await pipeline.run(documents, ids, add_to_docstore=add_to_docstore)
+        time_record['split_time'] = round(time_record['split_time'] + pipeline.stats['split'].busy, 2)
+        insert_logger.info(f'vectorstore insert number: {len(res)}, child documents: {pipeline.child_count}')
+
+        if add_to_docstore:
+            self._save_chunk_manifest(pipeline.full_docs, merge=True)
+            # update_chunks单独改写了chunk，指纹不再可信，下次重新入库时整体重建
+            file_ids = list({doc.metadata['file_id'] for doc in documents})
+            self.docstore.mysql_client.delete_chunk_fingerprints(file_ids)
+        return len(res), time_record
+
+    async def _aadd_file_documents(self, documents: List[Document], parent_chunk_size: int,
+                                   es_store: Optional[ElasticsearchStore], split_start: float,
+                                   progress: Optional[IngestProgress] = None) -> Tuple[int, Dict]:
+        """
+        整个文件入库，doc_id为file_id_序号。文件之前入库过（或上次入库中断）时按parent指纹只写未完成/变化的chunk，
+        写入前先按doc_id清理这些parent的残留数据，重复执行结果相同。
+        """
+        mysql_client = self.docstore.mysql_client
+        file_id = documents[0].metadata['file_id']
+        old = mysql_client.get_chunk_fingerprints(file_id)
+        plan = IncrementalPlan(file_id, parent_chunk_size, documents, old=old)
+        checkpoint = FingerprintCheckpoint(mysql_client, plan)
+        time_record = {"split_time": round(time.perf_counter() - split_start, 2)}
+
+        reuse_vectors = {}
+        with span('incremental_prepare', record_key='incremental_prepare_time', time_record=time_record,
+                  incremental=plan.incremental):
+            if plan.incremental:
+                reuse_vectors = await asyncio.to_thread(self._load_reuse_vectors, plan.vector_source_doc_ids)
+                await checkpoint.begin()
+                await self._delete_dirty(plan, es_store)
+            else:
+                if old or mysql_client.count_documents_by_file_id(file_id) > 0:
+                    # 没有可用指纹（老数据、chunk_size变化），清空后整体重新入库
+                    await self._delete_file(file_id, es_store)
+                # 从这里开始中断的入库，重新领取后都走增量续传
+                await checkpoint.begin()
 
-        docs = []
+        changed_docs = [documents[i] for i in plan.changed]
+        changed_ids = [plan.doc_ids[i] for i in plan.changed]
+        if progress is not None:
+            # 只需要写入变动的parent，未变的不计入进度
+            progress.set_total('store', len(changed_docs))
+        shared_vectors = None
+        if mysql_client.documents_dedup:
+            async def shared_vectors(full_docs):
+                return await self._load_shared_vectors(file_id, full_docs)
+        pipeline = IngestPipeline(self, es_store=es_store, time_record=time_record, reuse_vectors=reuse_vectors,
+                                  checkpoint=checkpoint, progress=progress, shared_vectors=shared_vectors)
+        with span('vectorstore_insert', parent_docs=len(changed_docs)):
+            await pipeline.run(changed_docs, changed_ids)
+        time_record['split_time'] = round(time_record['split_time'] + pipeline.stats['split'].busy, 2)
+
+        await checkpoint.finish()
+        self._save_chunk_manifest_chunks(file_id, checkpoint.manifest_chunks())
+        child_count = checkpoint.child_count
+        time_record['incremental'] = {'changed': len(plan.changed), 'unchanged': plan.unchanged_count,
+                                      'removed': len(plan.removed_doc_ids), 'embedded': pipeline.embedded_count,
+                                      'reused': pipeline.child_count - pipeline.embedded_count - pipeline.shared_count,
+                                      'shared': pipeline.shared_count,
+                                      'checkpoints': checkpoint.flushes}
+        insert_logger.info(f'vectorstore insert file {file_id}: child documents: {child_count}, '
+                           f'incremental: {time_record["incremental"]}')
+        return child_count, time_record
+
+    def _load_reuse_vectors(self, doc_ids: List[str], batch_size: int = 500) -> Dict[str, list]:
+        """取出旧子chunk的向量，按文本指纹索引；查询失败时返回已取到的部分，缺的重新embedding"""
+        vectorstore = self.vectorstore
+        reuse_vectors = {}
+        if vectorstore.col is None:
+            return reuse_vectors
+        try:
+            for i in range(0, len(doc_ids), batch_size):
+                expr = f"doc_id in {json.dumps(doc_ids[i:i + batch_size], ensure_ascii=False)}"
+                rows = vectorstore.get_expr_result(expr, output_fields=[vectorstore._text_field,
+                                                                        vectorstore._vector_field]) or []
+                for row in rows:
+                    reuse_vectors[text_fingerprint(row[vectorstore._text_field])] = row[vectorstore._vector_field]
+        except Exception as e:
+            insert_logger.warning(f"load vectors for reuse failed: {traceback.format_exc()}")
+        return reuse_vectors
+
+    async def _load_shared_vectors(self, file_id: str, full_docs) -> Dict[str, list]:
+        """
+        其他文件（可能在其他知识库）中有内容相同的parent时，取出它们子chunk的向量，按文本指纹索引。
+        子chunk文本带headers前缀，只有前缀也相同（知识库名、文件名一致或关闭CHILD_HEADERS_WITH_KB_NAME）才会命中。
+        """
+        try:
+            hashes = [content_hash(split_document_json(self.docstore.document_json(doc))[0]) for _, doc in full_docs]
+            mysql_client = self.docstore.mysql_client
+            sources = await asyncio.to_thread(mysql_client.get_doc_ids_by_content_hashes, hashes, file_id)
+        except Exception as e:
+            insert_logger.warning(f"find shared chunks failed: {traceback.format_exc()}")
+            return {}
+        if not sources:
+            return {}
+        return await asyncio.to_thread(self._load_reuse_vectors, sorted(set(sources.values())))
+
+    async def _delete_dirty(self, plan: IncrementalPlan, es_store: Optional[ElasticsearchStore]):
+        """Milvus是auto_id，重复插入会产生重复向量，所以待写入的parent先按doc_id删除；ES和Documents按id覆盖"""
+        if plan.dirty_doc_ids and self.vectorstore.col is not None:
+            for i in range(0, len(plan.dirty_doc_ids), 500):
+                expr = f"doc_id in {json.dumps(plan.dirty_doc_ids[i:i + 500], ensure_ascii=False)}"
+                await asyncio.to_thread(self.vectorstore.delete, expr=expr)
+        if plan.dirty_doc_ids and es_store is not None:
+            # 旧内容的子chunk数可能比新内容多，按doc_id删除，不依赖旧的子chunk数
+            await asyncio.to_thread(delete_es_doc_ids, es_store, plan.dirty_doc_ids)
+        if plan.removed_doc_ids:
+            await asyncio.to_thread(self.docstore.mysql_client.delete_documents_by_doc_ids, plan.removed_doc_ids)
+        insert_logger.info(f"file {plan.file_id} incremental: changed {len(plan.changed)}, "
+                           f"unchanged {plan.unchanged_count}, removed {len(plan.removed_doc_ids)}")
+
+    async def _delete_file(self, file_id: str, es_store: Optional[ElasticsearchStore]):
+        if self.vectorstore.col is not None:
+            await asyncio.to_thread(self.vectorstore.delete, expr=f'file_id == "{file_id}"')
+        if es_store is not None:
+            await asyncio.to_thread(delete_es_files, es_store, [file_id])
+        await asyncio.to_thread(self.docstore.mysql_client.delete_documents, [file_id])
+        insert_logger.info(f"file {file_id} has no usable fingerprints, cleared for full re-ingest")
+
+    def split_parent_documents(self, documents: List[Document], parent_chunk_size: int) -> List[Document]:
+        """超过parent_chunk_size的文档切分为多个parent chunk，表格和足够短的文档保持原样"""
+        split_documents = []
+        need_split_docs = []
+        for doc in documents:
+            if doc.metadata['has_table'] or num_tokens_embed(doc.page_content) <= parent_chunk_size:
+                if need_split_docs:
+                    split_documents.extend(self.parent_splitter.split_documents(need_split_docs))
+                    need_split_docs = []
+                split_documents.append(doc)
+            else:
+                need_split_docs.append(doc)
+        if need_split_docs:
+            split_documents.extend(self.parent_splitter.split_documents(need_split_docs))
+        return split_documents
+
+    def build_child_documents(self, documents: List[Document], doc_ids: List[str]):
+        """
+        切分出写入Milvus/ES的子chunk，并给parent补充token数和headers前缀
+        返回(embed_docs, full_docs)，full_docs为[(doc_id, parent_doc), ...]
+        """
+        embed_docs = []
         full_docs = []
         for i, doc in enumerate(documents):
             _id = doc_ids[i]
-            sub_docs = self.child_splitter.split_documents([doc])
+            headers_prefix = f"[headers]({doc.metadata['headers']})\n"
+            child_prefix = headers_prefix
+            if not CHILD_HEADERS_WITH_KB_NAME and isinstance(doc.metadata['headers'], dict):
+                # 子chunk的向量不含知识库名，同一文件上传到不同知识库时向量可以复用
+                child_headers = {k: v for k, v in doc.metadata['headers'].items() if k != '知识库名'}
+                child_prefix = f"[headers]({child_headers})\n"
+            # 每个parent只tokenize一次，子chunk按token offset切分并直接得到token数
+            child_chunks, parent_tokens = self.child_splitter.split_text_with_counts(doc.page_content)
+            prefix_tokens = num_tokens_embed(child_prefix) - self.child_splitter.special_tokens
             if self.child_metadata_fields is not None:
-                for _doc in sub_docs:
-                    _doc.metadata = {
-                        k: _doc.metadata[k] for k in self.child_metadata_fields
-                    }
-            for _doc in sub_docs:
-                _doc.metadata[self.id_key] = _id
-                _doc.page_content = f"[headers]({_doc.metadata['headers']})\n" + _doc.page_content  # 存入page_content，向量检索时会带上headers
-            docs.extend(sub_docs)
-            doc.page_content = f"[headers]({doc.metadata['headers']})\n" + doc.page_content  # 存入page_content，等检索后rerank时会带上headers信息
+                child_metadata = {k: doc.metadata[k] for k in self.child_metadata_fields}
+            else:
+                child_metadata = {k: v for k, v in doc.metadata.items() if k not in EMBED_EXCLUDED_METADATA}
+            child_metadata[self.id_key] = _id
+            for chunk, chunk_tokens in child_chunks:
+                # metadata浅拷贝即可，子chunk只会被读取，不会修改共享的嵌套对象
+                metadata = dict(child_metadata)
+                metadata['embed_tokens'] = chunk_tokens + prefix_tokens
+                # 存入page_content，向量检索时会带上headers
+                embed_docs.append(Document(page_content=child_prefix + chunk, metadata=metadata))
+            # 入库时预先计算parent chunk的token数，问答时reprocess_source_documents直接读取，无需再次tokenize
+            doc.metadata['token_counts'] = compute_chunk_token_counts(doc.page_content, doc.metadata.get('headers'),
+                                                                      embed_tokens=parent_tokens)
+            doc.page_content = headers_prefix + doc.page_content  # 存入page_content，等检索后rerank时会带上headers信息
             full_docs.append((_id, doc))
-        insert_logger.info(f"Inserting {len(docs)} child documents, metadata: {docs[0].metadata}, page_content: {docs[0].page_content[:100]}...")
-        time_record = {"split_time": round(time.perf_counter() - split_start, 2)}
+        return embed_docs, full_docs
 
-        embed_docs = copy.deepcopy(docs)
-        # 补充metadata信息
-        for idx, doc in enumerate(embed_docs):
-            del doc.metadata['title_lst']
-            del doc.metadata['has_table']
-            del doc.metadata['images']
-            del doc.metadata['file_name']
-            del doc.metadata['nos_key']
-            del doc.metadata['faq_dict']
-            del doc.metadata['page_id']
-
-        res = await self.vectorstore.aadd_documents(embed_docs, time_record=time_record)
-        insert_logger.info(f'vectorstore insert number: {len(res)}, {res[0]}')
-        if es_store is not None:
-            try:
-                es_start = time.perf_counter()
-                # docs的doc_id是file_id + '_' + i
-                docs_ids = [doc.metadata['file_id'] + '_' + str(i) for i, doc in enumerate(embed_docs)]
-                es_res = await es_store.aadd_documents(embed_docs, ids=docs_ids)
-                time_record['es_insert_time'] = round(time.perf_counter() - es_start, 2)
-                insert_logger.info(f'es_store insert number: {len(es_res)}, {es_res[0]}')
-            except Exception as e:
-                insert_logger.error(f"Error in aadd_documents on es_store: {traceback.format_exc()}")
+    def _save_chunk_manifest(self, full_docs, merge):
+        # 文件级chunk清单（有序doc_id + 各chunk的token数），供问答时聚合完整文档使用，写失败不影响入库
+        manifest = {}
+        for _id, doc in full_docs:
+            counts = {k: v for k, v in doc.metadata.get('token_counts', {}).items() if k in CHUNK_TOKEN_ENCODINGS}
+            manifest.setdefault(doc.metadata['file_id'], []).append([_id, counts])
+        for file_id, chunks in manifest.items():
+            self._save_chunk_manifest_chunks(file_id, chunks, merge=merge)
 
-        if add_to_docstore:
-            await self.docstore.amset(full_docs)
-        return len(res), time_record
+    def _save_chunk_manifest_chunks(self, file_id, chunks, merge=False):
+        try:
+            self.docstore.mysql_client.upsert_chunk_manifest(file_id, chunks, merge=merge)
+        except Exception as e:
+            insert_logger.error(f"save chunk manifest failed: {traceback.format_exc()}")
 
 
 class ParentRetriever:
     def __init__(self, vectorstore_client: VectorStoreMilvusClient, mysql_client: KnowledgeBaseManager, es_client: StoreElasticSearchClient):
         self.mysql_client = mysql_client
         self.vectorstore_client = vectorstore_client
-        # This text splitter is used to create the parent documents
-        init_parent_splitter = RecursiveCharacterTextSplitter(
-            separators=SEPARATORS,
-            chunk_size=DEFAULT_PARENT_CHUNK_SIZE,
-            chunk_overlap=0,
-            length_function=num_tokens_embed)
-        # # This text splitter is used to create the child documents
-        # # It should create documents smaller than the parent
-        init_child_splitter = RecursiveCharacterTextSplitter(
-            separators=SEPARATORS,
-            chunk_size=DEFAULT_CHILD_CHUNK_SIZE,
-            chunk_overlap=int(DEFAULT_CHILD_CHUNK_SIZE / 4),
-            length_function=num_tokens_embed)
-        self.retriever = SelfParentRetriever(
-            vectorstore=vectorstore_client.local_vectorstore,
-            docstore=MysqlStore(mysql_client),
-            child_splitter=init_child_splitter,
-            parent_splitter=init_parent_splitter,
-        )
+        # 每种parent_chunk_size对应一个retriever（及其parent/child splitter），按需创建后复用
+        self._insert_retrievers: Dict[int, SelfParentRetriever] = {}
+        self.retriever = self._get_insert_retriever(DEFAULT_PARENT_CHUNK_SIZE)
         self.backup_vectorstore: Optional[Milvus] = None
         self.es_store = es_client.es_store
-        self.parent_chunk_size = DEFAULT_PARENT_CHUNK_SIZE
 
-    @get_time_async
-    async def insert_documents(self, docs, parent_chunk_size, single_parent=False):
-        insert_logger.info(f"Inserting {len(docs)} documents, parent_chunk_size: {parent_chunk_size}, single_parent: {single_parent}")
-        if parent_chunk_size != self.parent_chunk_size:
-            self.parent_chunk_size = parent_chunk_size
-            parent_splitter = RecursiveCharacterTextSplitter(
+    def _get_insert_retriever(self, parent_chunk_size: int) -> SelfParentRetriever:
+        retriever = self._insert_retrievers.get(parent_chunk_size)
+        if retriever is None:
+            # This text splitter is used to create the parent documents
+            parent_splitter = TokenOffsetTextSplitter(
                 separators=SEPARATORS,
                 chunk_size=parent_chunk_size,
-                chunk_overlap=0,
-                length_function=num_tokens_embed)
+                chunk_overlap=0)
+            # This text splitter is used to create the child documents
+            # It should create documents smaller than the parent
             child_chunk_size = min(DEFAULT_CHILD_CHUNK_SIZE, int(parent_chunk_size / 2))
-            child_splitter = RecursiveCharacterTextSplitter(
+            child_splitter = TokenOffsetTextSplitter(
                 separators=SEPARATORS,
                 chunk_size=child_chunk_size,
-                chunk_overlap=int(child_chunk_size / 4),
-                length_function=num_tokens_embed)
-            self.retriever = SelfParentRetriever(
+                chunk_overlap=int(child_chunk_size / 4))
+            retriever = SelfParentRetriever(
                 vectorstore=self.vectorstore_client.local_vectorstore,
                 docstore=MysqlStore(self.mysql_client),
                 child_splitter=child_splitter,
-                parent_splitter=parent_splitter
+                parent_splitter=parent_splitter,
             )
+            self._insert_retrievers[parent_chunk_size] = retriever
+        return retriever
+
+    @get_time_async
+    async def insert_documents(self, docs, parent_chunk_size, single_parent=False, progress=None):
+        insert_logger.info(f"Inserting {len(docs)} documents, parent_chunk_size: {parent_chunk_size}, single_parent: {single_parent}")
+        retriever = self._get_insert_retriever(parent_chunk_size)
         # insert_logger.info(f'insert documents: {len(docs)}')
         ids = None if not single_parent else [doc.metadata['doc_id'] for doc in docs]
-        return await self.retriever.aadd_documents(docs, parent_chunk_size=parent_chunk_size,
-                                                   es_store=self.es_store, ids=ids, single_parent=single_parent)
+        return await retriever.aadd_documents(docs, parent_chunk_size=parent_chunk_size,
+                                              es_store=self.es_store, ids=ids, single_parent=single_parent,
+                                              progress=progress)
 
     async def get_retrieved_documents(self, query: str, partition_keys: List[str], time_record: dict,
                                       hybrid_search: bool, top_k: int):
@@ -234,25 +369,23 @@ class ParentRetriever:
         - 在高维空间中寻找最相似的文档向量
         - 擅长理解语义和概念层面的相似性
         """
-        milvus_start_time = time.perf_counter()
-        
-        # 构建过滤表达式：只在指定的知识库中搜索
-        expr = f'kb_id in {partition_keys}'
-        
-        # 设置搜索参数
-        # 注释掉的MMR(Maximal Marginal Relevance)算法可以增加结果多样性，但这里使用简单的相似度搜索
-        # self.retriever.set_search_kwargs("mmr", k=VECTOR_SEARCH_TOP_K, expr=expr)
-        self.retriever.set_search_kwargs("similarity", k=top_k, expr=expr)
-        
-        # 执行向量检索
-        query_docs = await self.retriever.aget_relevant_documents(query)
-        
-        # 标记检索来源，便于后续分析和调试
-        for doc in query_docs:
-            doc.metadata['retrieval_source'] = 'milvus'
-            
-        milvus_end_time = time.perf_counter()
-        time_record['retriever_search_by_milvus'] = round(milvus_end_time - milvus_start_time, 2)
+        with span('retriever_search_by_milvus', record_key='retriever_search_by_milvus', time_record=time_record,
+                  top_k=top_k) as milvus_span:
+            # 构建过滤表达式：只在指定的知识库中搜索
+            expr = f'kb_id in {partition_keys}'
+
+            # 设置搜索参数
+            # 注释掉的MMR(Maximal Marginal Relevance)算法可以增加结果多样性，但这里使用简单的相似度搜索
+            # self.retriever.set_search_kwargs("mmr", k=VECTOR_SEARCH_TOP_K, expr=expr)
+            self.retriever.set_search_kwargs("similarity", k=top_k, expr=expr)
+
+            # 执行向量检索
+            query_docs = await self.retriever.aget_relevant_documents(query)
+
+            # 标记检索来源，便于后续分析和调试
+            for doc in query_docs:
+                doc.metadata['retrieval_source'] = 'milvus'
+            milvus_span.set_attribute('docs', len(query_docs))
 
         # ========== 混合检索开关判断 ==========
         """
@@ -277,50 +410,50 @@ class ParentRetriever:
             # 注释掉的代码显示了另一种构建过滤器的方式
             # filter = []
             # for partition_key in partition_keys:
-            filter = [{"terms": {"metadata.kb_id.keyword": partition_keys}}]
-            
-            # 执行ES检索，获取子文档（chunk级别的文档片段）
-            es_sub_docs = await self.es_store.asimilarity_search(query, k=top_k, filter=filter)
-            
-            # ========== 去重处理：避免重复文档 ==========
-            """
-            为什么需要去重？
-            1. 向量检索和全文检索可能返回相同的文档
-            2. 重复文档会浪费token，降低信息密度
-            3. 影响后续的重排序和过滤效果
-            
-            去重策略：
-            1. 收集已有的Milvus文档ID
-            2. 只添加ES独有的文档
-            3. 确保每个文档只出现一次
-            """
-            es_ids = []
-            milvus_doc_ids = [d.metadata[self.retriever.id_key] for d in query_docs]
-            
-            # 遍历ES检索结果，筛选出不重复的文档ID
-            for d in es_sub_docs:
-                doc_id = d.metadata.get(self.retriever.id_key)
-                if (doc_id and 
-                    doc_id not in es_ids and           # 避免ES内部重复
-                    doc_id not in milvus_doc_ids):     # 避免与Milvus结果重复
-                    es_ids.append(doc_id)
-            
-            # ========== 获取完整文档内容 ==========
-            """
-            为什么需要这一步？
-            1. ES检索返回的是子文档(chunk)，需要获取完整的父文档
-            2. 保持与Milvus检索结果的格式一致性
-            3. 确保后续处理流程的统一性
-            """
-            es_docs = await self.retriever.docstore.amget(es_ids)
-            es_docs = [d for d in es_docs if d is not None]  # 过滤掉可能的None值
-            
-            # 标记ES检索来源
-            for doc in es_docs:
-                doc.metadata['retrieval_source'] = 'es'
-                
-            # 记录ES检索耗时
-            time_record['retriever_search_by_es'] = round(time.perf_counter() - milvus_end_time, 2)
+            with span('retriever_search_by_es', record_key='retriever_search_by_es', time_record=time_record,
+                      top_k=top_k) as es_span:
+                filter = [{"terms": {"metadata.kb_id.keyword": partition_keys}}]
+
+                # 执行ES检索，获取子文档（chunk级别的文档片段）
+                es_sub_docs = await self.es_store.asimilarity_search(query, k=top_k, filter=filter)
+
+                # ========== 去重处理：避免重复文档 ==========
+                """
+                为什么需要去重？
+                1. 向量检索和全文检索可能返回相同的文档
+                2. 重复文档会浪费token，降低信息密度
+                3. 影响后续的重排序和过滤效果
+
+                去重策略：
+                1. 收集已有的Milvus文档ID
+                2. 只添加ES独有的文档
+                3. 确保每个文档只出现一次
+                """
+                es_ids = []
+                milvus_doc_ids = [d.metadata[self.retriever.id_key] for d in query_docs]
+
+                # 遍历ES检索结果，筛选出不重复的文档ID
+                for d in es_sub_docs:
+                    doc_id = d.metadata.get(self.retriever.id_key)
+                    if (doc_id and 
+                        doc_id not in es_ids and           # 避免ES内部重复
+                        doc_id not in milvus_doc_ids):     # 避免与Milvus结果重复
+                        es_ids.append(doc_id)
+
+                # ========== 获取完整文档内容 ==========
+                """
+                为什么需要这一步？
+                1. ES检索返回的是子文档(chunk)，需要获取完整的父文档
+                2. 保持与Milvus检索结果的格式一致性
+                3. 确保后续处理流程的统一性
+                """
+                es_docs = await self.retriever.docstore.amget(es_ids)
+                es_docs = [d for d in es_docs if d is not None]  # 过滤掉可能的None值
+
+                # 标记ES检索来源
+                for doc in es_docs:
+                    doc.metadata['retrieval_source'] = 'es'
+                es_span.set_attributes(sub_docs=len(es_sub_docs), docs=len(es_docs))
             
             # 记录检索统计信息，便于监控和调优
             debug_logger.info(f"Got {len(query_docs)} documents from vectorstore and {len(es_sub_docs)} documents from es, total {len(query_docs) + len(es_docs)} merged documents.")
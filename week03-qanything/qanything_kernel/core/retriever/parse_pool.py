@@ -0,0 +1,182 @@
+"""
+入库服务的文件解析进程池。
+
+split_file_to_docs是纯Python的解析（pandas、python-docx、markdown、newspaper等），放在线程里会被GIL串行化，
+和同一worker中的embedding/写库流程互相拖慢。这里把解析放到spawn方式启动的子进程中：
+- 父进程只传可pickle的parse_spec，子进程重建LocalFileForInsert（需要写表格文档时自建MySQL连接）；
+- 子进程返回紧凑的chunk元组，父进程用文件级的公共metadata还原Document；
+- 子进程内用SIGALRM实现解析超时，超时后仍未返回（卡在C扩展中）的进程直接杀掉并重建进程池，不会留下僵尸线程。
+  子进程开始解析时通过队列上报，杀进程的期限从上报时算起，排队等待空闲进程的文件不会被误判超时。
+"""
+from qanything_kernel.configs.model_config import PARSE_KILL_GRACE_SECONDS, PARSE_MAX_TASKS_PER_CHILD
+from qanything_kernel.core.retriever.general_document import LocalFileForInsert
+from qanything_kernel.utils.custom_log import insert_logger
+from qanything_kernel.utils.tracing import start_trace, get_trace_id, get_trace_headers
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import asyncio
+import multiprocessing
+import os
+import queue
+import signal
+import time
+import uuid
+
+__all__ = ['ParseProcessPool', 'ParseTimeoutError']
+
+_worker_mysql_client = None
+_worker_started_queue = None
+# 父进程检查子进程是否超时的间隔
+_WATCHDOG_INTERVAL_SECONDS = 1.0
+
+
+class ParseTimeoutError(BaseException):
+    """子进程内解析超时，子进程本身仍然可用。继承BaseException，避免被loader中的except Exception吞掉后走兜底解析"""
+
+
+def _raise_parse_timeout(signum, frame):
+    raise ParseTimeoutError('parse timeout')
+
+
+def _get_worker_mysql_client():
+    global _worker_mysql_client
+    if _worker_mysql_client is None:
+        from qanything_kernel.connector.database.mysql.mysql_client import KnowledgeBaseManager
+        _worker_mysql_client = KnowledgeBaseManager(pool_size=1)
+    return _worker_mysql_client
+
+
+class _LazyMysqlClient:
+    """子进程中只有解析带表格的markdown时才需要写MySQL，用到时再建立连接"""
+
+    def __getattr__(self, name):
+        return getattr(_get_worker_mysql_client(), name)
+
+
+def _init_worker(started_queue):
+    global _worker_started_queue
+    _worker_started_queue = started_queue
+
+
+def _parse_in_worker(spec: dict, timeout: float, job_id: str = None) -> list:
+    """在子进程中执行，返回LocalFileForInsert.dump_chunks()的结果"""
+    if job_id is not None and _worker_started_queue is not None:
+        _worker_started_queue.put(job_id)
+    spec = dict(spec)
+    trace_id = spec.pop('trace_id', None)
+    traceparent = spec.pop('traceparent', None)
+    use_alarm = hasattr(signal, 'setitimer')
+    if use_alarm:
+        signal.signal(signal.SIGALRM, _raise_parse_timeout)
+        signal.setitimer(signal.ITIMER_REAL, timeout)
+    try:
+        # 沿用入库任务的trace id，解析中调用OCR/PDF服务时带上
+        with start_trace('parse_file_in_worker', trace_id=trace_id, traceparent=traceparent, file_name=spec['file_name'],
+                         pid=os.getpid()):
+            local_file = LocalFileForInsert(mysql_client=_LazyMysqlClient(), **spec)
+            local_file.split_file_to_docs()
+        return local_file.dump_chunks()
+    finally:
+        if use_alarm:
+            signal.setitimer(signal.ITIMER_REAL, 0)
+
+
+class ParseProcessPool:
+    def __init__(self, processes: int):
+        self.processes = processes
+        self._executor = None
+        self._started_queue = None
+        # 正在等待的任务 -> 子进程开始解析的时间（还在排队时为None）
+        self._started = {}
+
+    def _get_executor(self) -> ProcessPoolExecutor:
+        if self._executor is None:
+            # spawn：子进程不继承父进程的事件循环、线程和数据库连接
+            context = multiprocessing.get_context('spawn')
+            # 每个进程池一个队列，被杀掉的子进程可能正持有旧队列的锁
+            self._started_queue = context.Queue()
+            self._executor = ProcessPoolExecutor(max_workers=self.processes, mp_context=context,
+                                                 max_tasks_per_child=PARSE_MAX_TASKS_PER_CHILD,
+                                                 initializer=_init_worker, initargs=(self._started_queue,))
+        return self._executor
+
+    async def start(self):
+        """预先拉起所有子进程，导入解析库的耗时不计入第一个文件"""
+        start = time.perf_counter()
+        loop = asyncio.get_running_loop()
+        executor = self._get_executor()
+        pids = await asyncio.gather(*[loop.run_in_executor(executor, os.getpid) for _ in range(self.processes)])
+        insert_logger.info(f"parse process pool started: processes={self.processes}, pids={sorted(set(pids))}, "
+                           f"cost={time.perf_counter() - start:.2f}s")
+
+    def _recycle(self, executor: ProcessPoolExecutor):
+        """
+        杀掉子进程并重建进程池。ProcessPoolExecutor没有按任务终止子进程的接口，只能整池回收，
+        池中其他正在解析的文件会收到BrokenProcessPool，由parse重新提交。
+        """
+        if self._executor is not executor:
+            return
+        self._executor = None
+        for process in list((executor._processes or {}).values()):
+            process.kill()
+        executor.shutdown(wait=False)
+
+    def _drain_started(self, started_queue):
+        while True:
+            try:
+                job_id = started_queue.get_nowait()
+            except (queue.Empty, OSError, ValueError):
+                return
+            if job_id in self._started:
+                self._started[job_id] = time.monotonic()
+
+    async def _wait(self, future, started_queue, job_id: str, limit: float):
+        """等待子进程返回，子进程开始解析后超过limit秒仍未返回时抛出asyncio.TimeoutError"""
+        self._started[job_id] = None
+        try:
+            while True:
+                done, _ = await asyncio.wait({future}, timeout=_WATCHDOG_INTERVAL_SECONDS)
+                if done:
+                    return future.result()
+                self._drain_started(started_queue)
+                started = self._started.get(job_id)
+                if started is not None and time.monotonic() - started > limit:
+                    raise asyncio.TimeoutError()
+        finally:
+            self._started.pop(job_id, None)
+            if not future.done():
+                future.cancel()
+
+    async def parse(self, local_file: LocalFileForInsert, timeout: float):
+        """在子进程中解析文件，结果写入local_file.docs；超时抛出asyncio.TimeoutError"""
+        spec = local_file.parse_spec()
+        spec['trace_id'] = get_trace_id()
+        # 子进程的根span挂在父进程当前的span下
+        spec['traceparent'] = get_trace_headers().get('traceparent')
+        loop = asyncio.get_running_loop()
+        for attempt in range(2):
+            executor = self._get_executor()
+            job_id = uuid.uuid4().hex
+            future = loop.run_in_executor(executor, _parse_in_worker, spec, timeout, job_id)
+            try:
+                chunks = await self._wait(future, self._started_queue, job_id, timeout + PARSE_KILL_GRACE_SECONDS)
+                break
+            except ParseTimeoutError:
+                raise asyncio.TimeoutError(f'parse {local_file.file_name} timeout: {timeout}s')
+            except asyncio.TimeoutError:
+                insert_logger.error(f"parse {local_file.file_name} did not stop after timeout, kill parse processes")
+                self._recycle(executor)
+                raise
+            except BrokenProcessPool:
+                # 进程池已被其他超时任务回收时重新提交；否则是子进程崩溃（OOM、段错误等）
+                recycled = self._executor is not executor
+                self._recycle(executor)
+                if attempt or not recycled:
+                    raise
+                insert_logger.warning(f"parse process pool was recycled, resubmit {local_file.file_name}")
+        local_file.load_chunks(chunks)
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
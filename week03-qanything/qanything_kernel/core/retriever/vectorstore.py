@@ -5,9 +5,11 @@ from qanything_kernel.utils.custom_log import debug_logger, insert_logger
 from qanything_kernel.configs.model_config import MILVUS_PORT, MILVUS_COLLECTION_NAME, MILVUS_HOST_LOCAL
 from qanything_kernel.connector.embedding.embedding_for_online_client import YouDaoEmbeddings
 from qanything_kernel.utils.general_utils import get_time, get_time_async
+from qanything_kernel.utils.tracing import span
 from langchain_community.vectorstores.milvus import Milvus
 from pymilvus.orm.collection import MutationResult
 import asyncio
+import json
 import time
 
 
@@ -164,24 +166,42 @@ class SelfMilvus(Milvus):
     ) -> List[str]:
         """Asynchronously run texts through embeddings and add to the vectorstore."""
         # 从kwargs中获取time_record
-        time_record = kwargs.get('time_record', {})
+        time_record = kwargs.pop('time_record', {})
+        texts = list(texts)
+
+        # Assuming self.embedding_func has an async method embed_documents_async
+        with span('milvus_embedding', record_key='milvus_embedding_time', time_record=time_record, texts=len(texts)):
+            try:
+                embeddings = await self.embedding_func.aembed_documents(texts)
+            except NotImplementedError:
+                embeddings = [await self.embedding_func.aembed_query(x) for x in texts]
+        pks = await self.ainsert_embeddings(texts, embeddings, metadatas, timeout=timeout, batch_size=batch_size,
+                                            ids=ids, time_record=time_record, **kwargs)
+        await self.aflush(time_record)
+        return pks
+
+    async def ainsert_embeddings(
+            self,
+            texts: List[str],
+            embeddings: List[List[float]],
+            metadatas: Optional[List[dict]] = None,
+            timeout: Optional[int] = None,
+            batch_size: int = 1000,
+            *,
+            ids: Optional[List[str]] = None,
+            time_record: Optional[dict] = None,
+            **kwargs: Any,
+    ) -> List[str]:
+        """写入已经算好的向量，入库流水线中embedding和写入是两个独立的阶段"""
+        time_record = time_record if time_record is not None else {}
 
         from pymilvus import Collection, MilvusException
 
-        texts = list(texts)
         if not self.auto_id:
             assert isinstance(ids, list), "A list of valid ids are required when auto_id is False."
             assert len(set(ids)) == len(texts), "Different lengths of texts and unique ids are provided."
             assert all(len(x.encode()) <= 65_535 for x in ids), "Each id should be a string less than 65535 bytes."
 
-        # Assuming self.embedding_func has an async method embed_documents_async
-        embedding_start = time.perf_counter()
-        try:
-            embeddings = await self.embedding_func.aembed_documents(texts)
-        except NotImplementedError:
-            embeddings = [await self.embedding_func.aembed_query(x) for x in texts]
-        time_record['milvus_embedding_time'] = round(time.perf_counter() - embedding_start, 2)
-
         if len(embeddings) == 0:
             insert_logger.info("Nothing to insert, skipping.")
             return []
@@ -228,39 +248,46 @@ class SelfMilvus(Milvus):
 
         pks: list[str] = []
 
-        insert_start = time.perf_counter()
-        assert isinstance(self.col, Collection)
-        for i in range(0, total_count, batch_size):
-            # Grab end index
-            end = min(i + batch_size, total_count)
-            # Convert dict to list of lists batch for insertion
-            insert_list = [
-                insert_dict[x][i:end] for x in self.fields if x in insert_dict
-            ]
-            # Insert into the collection.
-            try:
-                res: MutationResult = await asyncio.to_thread(
-                    self.col.insert, insert_list, timeout=timeout, **kwargs
-                )
-                # insert_logger.info(f"insert: {res}, insert keys: {res.primary_keys}")
-                insert_logger.info(f"insert: {res}")
-                pks.extend(res.primary_keys)
-            except MilvusException as e:
-                insert_logger.error(
-                    "Failed to insert batch starting at entity: %s/%s", i, total_count
-                )
-                raise e
-            self.inserted_since_last_flush += end - i
-
-        time_record['milvus_insert_time'] = round(time.perf_counter() - insert_start, 2)
-
-        asyncio.create_task(asyncio.to_thread(self.col.flush))
-        # if self._should_flush():
-        #     self._milvus_flush()
-
-        # self.col.flush()
+        with span('milvus_insert', record_key='milvus_insert_time', time_record=time_record, entities=total_count):
+            assert isinstance(self.col, Collection)
+            for i in range(0, total_count, batch_size):
+                # Grab end index
+                end = min(i + batch_size, total_count)
+                # Convert dict to list of lists batch for insertion
+                insert_list = [
+                    insert_dict[x][i:end] for x in self.fields if x in insert_dict
+                ]
+                # Insert into the collection.
+                try:
+                    res: MutationResult = await asyncio.to_thread(
+                        self.col.insert, insert_list, timeout=timeout, **kwargs
+                    )
+                    # insert_logger.info(f"insert: {res}, insert keys: {res.primary_keys}")
+                    insert_logger.info(f"insert: {res}")
+                    pks.extend(res.primary_keys)
+                except MilvusException as e:
+                    insert_logger.error(
+                        "Failed to insert batch starting at entity: %s/%s", i, total_count
+                    )
+                    raise e
+                self.inserted_since_last_flush += end - i
+
+        # 不在这里flush：入库流水线每批都会调用，逐批flush会产生大量小segment并触发Milvus的flush限流，
+        # 由调用方在整个文件写完后调用aflush
         return pks
 
+    async def aflush(self, time_record: Optional[dict] = None):
+        """整个文件写完后flush一次；失败只记录日志，数据已写入，Milvus会按自己的策略seal"""
+        try:
+            with span('milvus_flush', record_key='milvus_flush_time', time_record=time_record,
+                      entities=self.inserted_since_last_flush):
+                await asyncio.to_thread(self.col.flush)
+        except Exception as e:
+            insert_logger.error(f"Failed to flush milvus collection: {e}")
+            return
+        self.last_flush_time = time.time()
+        self.inserted_since_last_flush = 0
+
 
 class VectorStoreMilvusClient:
     def __init__(self):
@@ -284,6 +311,22 @@ class VectorStoreMilvusClient:
             partial(self.local_vectorstore.get_pks, expr=expr, timeout=timeout))
         return future.result()
 
+    def get_chunk_vectors(self, doc_ids: List[str]) -> dict:
+        """取出parent文档(doc_id)下已入库的child向量，返回{doc_id: [vector, ...]}，查询失败时返回空字典"""
+        if not doc_ids:
+            return {}
+        vectorstore = self.local_vectorstore
+        expr = f"doc_id in {json.dumps(list(doc_ids), ensure_ascii=False)}"
+        try:
+            rows = vectorstore.get_expr_result(expr, output_fields=['doc_id', vectorstore._vector_field]) or []
+        except Exception as e:
+            debug_logger.warning(f'get chunk vectors failed, expr: {expr}, error: {e}')
+            return {}
+        chunk_vectors = {}
+        for row in rows:
+            chunk_vectors.setdefault(row['doc_id'], []).append(row[vectorstore._vector_field])
+        return chunk_vectors
+
     # def delete_chunks(self, chunk_ids):
     #     res = self.vectorstore.delete(expr=f"chunk_id in {chunk_ids}")
     #     debug_logger.info(f'milvus delete chunk number: {len(chunk_ids)} res: {res}')
@@ -14,8 +14,9 @@ from sanic import Sanic
 from sanic.response import json
 from qanything_kernel.dependent_server.embedding_server.embedding_async_backend import EmbeddingAsyncBackend
 from qanything_kernel.dependent_server.embedding_server.embedding_onnx_backend import EmbeddingOnnxBackend
-from qanything_kernel.configs.model_config import LOCAL_EMBED_MODEL_PATH, LOCAL_EMBED_THREADS
+from qanything_kernel.configs.model_config import LOCAL_EMBED_MODEL_PATH, LOCAL_EMBED_THREADS, TRACE_HEADER
 from qanything_kernel.utils.general_utils import get_time_async
+from qanything_kernel.utils.tracing import start_trace
 import argparse
 
 # 接收外部参数mode
@@ -40,7 +41,10 @@ async def embedding(request):
     # onnx_backend: EmbeddingAsyncBackend = request.app.ctx.onnx_backend
     onnx_backend: EmbeddingOnnxBackend = request.app.ctx.onnx_backend
     # result_data = await onnx_backend.embed_documents_async(texts)
-    result_data = onnx_backend.predict(texts)
+    # 沿用调用方传来的trace id，把模型推理耗时挂到同一条链路上
+    with start_trace('embedding_server', trace_id=request.headers.get(TRACE_HEADER),
+                     traceparent=request.headers.get('traceparent'), texts=len(texts)):
+        result_data = onnx_backend.predict(texts)
     # print("local embedding result number:", len(result_data), flush=True)
     # print("local embedding result:", result_data, flush=True)
 
@@ -13,18 +13,27 @@ print(root_dir)
 from sanic import Sanic, response
 from qanything_kernel.utils.custom_log import insert_logger
 from qanything_kernel.utils.general_utils import get_time_async
+from qanything_kernel.utils.tracing import start_trace, span
 from qanything_kernel.core.retriever.general_document import LocalFileForInsert
 from qanything_kernel.core.retriever.vectorstore import VectorStoreMilvusClient
 from qanything_kernel.connector.database.mysql.mysql_client import KnowledgeBaseManager
 from qanything_kernel.core.retriever.elasticsearchstore import StoreElasticSearchClient
 from qanything_kernel.core.retriever.parent_retriever import ParentRetriever
+from qanything_kernel.core.retriever.parse_pool import ParseProcessPool
+from qanything_kernel.core.retriever.ingest_progress import IngestProgress, IngestStalledError, ThroughputMeter, \
+    run_with_stall_detection, summarize_insert_queue
+from qanything_kernel.utils.insert_wakeup import InsertWakeupListener
+from qanything_kernel.utils.insert_scheduler import FairScheduler, PendingFile
 from qanything_kernel.configs.model_config import MYSQL_HOST_LOCAL, MYSQL_PORT_LOCAL, \
-    MYSQL_USER_LOCAL, MYSQL_PASSWORD_LOCAL, MYSQL_DATABASE_LOCAL, MAX_CHARS
+    MYSQL_USER_LOCAL, MYSQL_PASSWORD_LOCAL, MYSQL_DATABASE_LOCAL, MAX_CHARS, INSERT_WORKER_CONCURRENCY, \
+    INSERT_LEASE_SECONDS, INSERT_HEARTBEAT_SECONDS, INSERT_MAX_ATTEMPTS, INSERT_POLL_INTERVAL, PARSE_PROCESSES, \
+    PARSE_TIMEOUT_SECONDS, PARSE_CHECKPOINT_MIN_SECONDS, INSERT_STALL_SECONDS, INSERT_PROGRESS_INTERVAL, \
+    INSERT_STATS_INTERVAL, INSERT_SCHEDULE_HEAD, INSERT_EXPRESS_SLOTS
 from sanic.worker.manager import WorkerManager
 import asyncio
+import socket
 import traceback
 import time
-import random
 import aiomysql
 import argparse
 import json
@@ -53,29 +62,57 @@ db_config = {
 }
 
 
+def parse_source_sig(file_location, file_url, chunk_size):
+    """解析结果检查点对应的源文件，文件被覆盖（strong模式重新上传）后不再命中"""
+    if os.path.isfile(file_location):
+        stat = os.stat(file_location)
+        return f'{stat.st_size}:{stat.st_mtime_ns}:{chunk_size}'
+    return f'{file_url or file_location}:{chunk_size}'[:512]
+
+
+async def parse_file(parse_pool, mysql_client, local_file, parse_timeout_seconds, time_record):
+    """有解析结果检查点时直接还原，否则在解析进程池中解析，耗时较长的保存检查点"""
+    source_sig = parse_source_sig(local_file.file_location, local_file.file_url, local_file.chunk_size)
+    try:
+        chunks = await asyncio.to_thread(mysql_client.get_parse_checkpoint, local_file.file_id, source_sig)
+    except Exception as e:
+        insert_logger.error(f"load parse checkpoint failed: {traceback.format_exc()}")
+        chunks = None
+    if chunks is not None:
+        local_file.load_chunks(chunks)
+        time_record['parse_resumed'] = True
+        insert_logger.info(f'resume {local_file.file_name} from parse checkpoint: {len(chunks)} chunks')
+        return
+    start = time.perf_counter()
+    # 在解析子进程中执行，超时的子进程会被杀掉
+    await parse_pool.parse(local_file, parse_timeout_seconds)
+    if time.perf_counter() - start >= PARSE_CHECKPOINT_MIN_SECONDS:
+        try:
+            await asyncio.to_thread(mysql_client.save_parse_checkpoint, local_file.file_id, source_sig,
+                                    local_file.dump_chunks())
+        except Exception as e:
+            insert_logger.error(f"save parse checkpoint failed: {traceback.format_exc()}")
+
+
 @get_time_async
-async def process_data(retriever, milvus_kb, mysql_client, file_info, time_record):
-    parse_timeout_seconds = 300
-    insert_timeout_seconds = 300
+async def process_data(retriever, milvus_kb, mysql_client, parse_pool, file_info, time_record, progress):
+    parse_timeout_seconds = PARSE_TIMEOUT_SECONDS
     content_length = -1
     status = 'green'
     process_start = time.perf_counter()
     insert_logger.info(f'Start insert file: {file_info}')
-    _, file_id, user_id, file_name, kb_id, file_location, file_size, file_url, chunk_size = file_info
+    _, file_id, user_id, file_name, kb_id, file_location, file_size, file_url, chunk_size = file_info[:9]
     # 获取格式为'2021-08-01 00:00:00'的时间戳
     insert_timestamp = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime())
     mysql_client.update_knowlegde_base_latest_insert_time(kb_id, insert_timestamp)
     local_file = LocalFileForInsert(user_id, kb_id, file_id, file_location, file_name, file_url, chunk_size, mysql_client)
     msg = "success"
     chunks_number = 0
-    mysql_client.update_file_msg(file_id, f'Processing:{random.randint(1, 5)}%')
     # 这里是把文件做向量化，然后写入Milvus的逻辑
     start = time.perf_counter()
     try:
-        await asyncio.wait_for(
-            asyncio.to_thread(local_file.split_file_to_docs),
-            timeout=parse_timeout_seconds
-        )
+        with span('split_file_to_docs', record_key='parse_time', time_record=time_record, file_name=file_name):
+            await parse_file(parse_pool, mysql_client, local_file, parse_timeout_seconds, time_record)
         content_length = sum([len(doc.page_content) for doc in local_file.docs])
         if content_length > MAX_CHARS:
             status = 'red'
@@ -86,7 +123,6 @@ async def process_data(retriever, milvus_kb, mysql_client, file_info, time_recor
             msg = f"{file_name} content_length is 0, file content is empty or The URL exists anti-crawling or requires login."
             return status, content_length, chunks_number, msg
     except asyncio.TimeoutError:
-        local_file.event.set()
         insert_logger.error(f'Timeout: split_file_to_docs took longer than {parse_timeout_seconds} seconds')
         status = 'red'
         msg = f"split_file_to_docs timeout: {parse_timeout_seconds}s"
@@ -99,26 +135,27 @@ async def process_data(retriever, milvus_kb, mysql_client, file_info, time_recor
         msg = f"split_file_to_docs error"
         return status, content_length, chunks_number, msg
     end = time.perf_counter()
-    time_record['parse_time'] = round(end - start, 2)
     insert_logger.info(f'parse time: {end - start} {len(local_file.docs)}')
-    mysql_client.update_file_msg(file_id, f'Processing:{random.randint(5, 75)}%')
+    # 非分页的文件page_id都是0，按1页计
+    progress.advance('parse', len({doc.metadata.get('page_id', 0) for doc in local_file.docs}))
 
     try:
         start = time.perf_counter()
-        chunks_number, insert_time_record = await asyncio.wait_for(
-            retriever.insert_documents(local_file.docs, chunk_size),
-            timeout=insert_timeout_seconds)
+        with span('insert_documents', docs=len(local_file.docs), chunk_size=chunk_size) as insert_span:
+            # 不设总耗时上限，只在流水线长时间没有进展时取消；已写完的parent保存在指纹检查点中，重试时跳过
+            chunks_number, insert_time_record = await run_with_stall_detection(
+                retriever.insert_documents(local_file.docs, chunk_size, progress=progress), progress)
+            insert_span.set_attribute('chunks_number', chunks_number)
         insert_time = time.perf_counter()
         time_record.update(insert_time_record)
         insert_logger.info(f'insert time: {insert_time - start}')
         mysql_client.update_chunks_number(local_file.file_id, chunks_number)
-    except asyncio.TimeoutError:
-        insert_logger.error(f'Timeout: milvus insert took longer than {insert_timeout_seconds} seconds')
-        expr = f'file_id == \"{local_file.file_id}\"'
-        milvus_kb.delete_expr(expr)
+        progress.advance('bytes', file_size or 0)
+    except IngestStalledError as e:
+        insert_logger.error(f'Stalled: milvus insert of {file_name}: {e}')
         status = 'red'
-        time_record['insert_timeout'] = True
-        msg = f"milvus insert timeout: {insert_timeout_seconds}s"
+        time_record['insert_stalled'] = True
+        msg = f"milvus insert stalled: no progress for {INSERT_STALL_SECONDS}s"
         return status, content_length, chunks_number, msg
     except Exception as e:
         error_info = f'milvus insert error: {traceback.format_exc()}'
@@ -128,99 +165,239 @@ async def process_data(retriever, milvus_kb, mysql_client, file_info, time_recor
         msg = f"milvus insert error"
         return status, content_length, chunks_number, msg
 
-    mysql_client.update_file_msg(file_id, f'Processing:{random.randint(75, 100)}%')
+    time_record['progress'] = progress.snapshot()
     time_record['upload_total_time'] = round(time.perf_counter() - process_start, 2)
     mysql_client.update_file_upload_infos(file_id, time_record)
     insert_logger.info(f'insert_files_to_milvus: {user_id}, {kb_id}, {file_id}, {file_name}, {status}')
-    msg = json.dumps(time_record, ensure_ascii=False)
+    # 流水线各阶段的利用率、增量入库统计只保存在upload_infos中，File.msg长度有限
+    msg = json.dumps({k: v for k, v in time_record.items() if k not in ('pipeline', 'incremental', 'progress')},
+                     ensure_ascii=False)
     return status, content_length, chunks_number, msg
 
 
+async def expire_exhausted_files(pool):
+    """租约过期且已达到最大领取次数的文件不再重试，直接标记为red"""
+    async with pool.acquire() as conn:
+        async with conn.cursor() as cur:
+            await cur.execute(
+                "UPDATE File SET status = 'red', msg = %s, lease_owner = NULL, lease_expire = NULL "
+                "WHERE status = 'yellow' AND lease_expire < NOW() AND attempts >= %s",
+                (f"insert failed after {INSERT_MAX_ATTEMPTS} attempts", INSERT_MAX_ATTEMPTS))
+            await conn.commit()
+            if cur.rowcount:
+                insert_logger.warning(f"mark {cur.rowcount} files red after {INSERT_MAX_ATTEMPTS} attempts")
+
+
+# 可领取的文件：gray文件，以及租约已过期（worker崩溃或重启）且未达到最大领取次数的yellow文件
+CLAIMABLE = ("deleted = 0 AND (status = 'gray' OR "
+             "(status = 'yellow' AND lease_expire < NOW() AND attempts < %s))")
+
+
+async def claim_files(pool, owner, scheduler, free_slots, express_slots):
+    """
+    按多租户公平调度领取文件，返回[(file_info, 是否走快速通道)]：
+    先不加锁地取出每个(user_id, kb_id)最早的INSERT_SCHEDULE_HEAD个大文件和小文件，以及各流在所有worker上
+    正在入库的文件数，由scheduler挑选；再对选中的文件FOR UPDATE SKIP LOCKED加锁领取，已被其他worker领走的跳过。
+    """
+    async with pool.acquire() as conn:
+        async with conn.cursor() as cur:
+            try:
+                await cur.execute(
+                    "SELECT id, user_id, kb_id, file_name, file_size FROM ("
+                    "SELECT id, user_id, kb_id, file_name, file_size, timestamp, ROW_NUMBER() OVER ("
+                    "PARTITION BY user_id, kb_id, file_size > 0 AND file_size <= %s "
+                    "ORDER BY timestamp ASC, id ASC) AS rn "
+                    f"FROM File WHERE {CLAIMABLE}) AS heads WHERE rn <= %s ORDER BY timestamp ASC, id ASC",
+                    (scheduler.express_max_bytes, INSERT_MAX_ATTEMPTS, INSERT_SCHEDULE_HEAD))
+                pending = [PendingFile(*row) for row in await cur.fetchall()]
+                selected = []
+                if pending:
+                    await cur.execute(
+                        "SELECT user_id, kb_id, COUNT(*) FROM File WHERE deleted = 0 AND status = 'yellow' "
+                        "AND lease_expire >= NOW() GROUP BY user_id, kb_id")
+                    running = {(user_id, kb_id): count for user_id, kb_id, count in await cur.fetchall()}
+                    selected = scheduler.select(pending, running, free_slots, express_slots)
+                if not selected:
+                    await conn.commit()
+                    return []
+                placeholders = ','.join(['%s'] * len(selected))
+                await cur.execute(
+                    f"SELECT id FROM File WHERE id IN ({placeholders}) AND {CLAIMABLE} FOR UPDATE SKIP LOCKED",
+                    (*[file.id for file, _ in selected], INSERT_MAX_ATTEMPTS))
+                ids = [row[0] for row in await cur.fetchall()]
+                if not ids:
+                    await conn.commit()
+                    return []
+                placeholders = ','.join(['%s'] * len(ids))
+                await cur.execute(
+                    "UPDATE File SET status = 'yellow', lease_owner = %s, lease_expire = NOW() + INTERVAL %s SECOND, "
+                    f"attempts = attempts + 1 WHERE id IN ({placeholders})", (owner, INSERT_LEASE_SECONDS, *ids))
+                await cur.execute(
+                    "SELECT id, file_id, user_id, file_name, kb_id, file_location, file_size, file_url, chunk_size, "
+                    f"attempts FROM File WHERE id IN ({placeholders})", ids)
+                file_infos = {file_info[0]: file_info for file_info in await cur.fetchall()}
+                await conn.commit()
+                # 按调度顺序返回
+                return [(file_infos[file.id], express) for file, express in selected if file.id in file_infos]
+            except Exception:
+                await conn.rollback()
+                raise
+
+
+async def heartbeat(pool, owner, id):
+    """处理期间定期续约，防止长时间处理的文件被其他worker当作失联任务重新领取"""
+    while True:
+        await asyncio.sleep(INSERT_HEARTBEAT_SECONDS)
+        try:
+            async with pool.acquire() as conn:
+                async with conn.cursor() as cur:
+                    await cur.execute(
+                        "UPDATE File SET lease_expire = NOW() + INTERVAL %s SECOND WHERE id = %s AND lease_owner = %s",
+                        (INSERT_LEASE_SECONDS, id, owner))
+                    await conn.commit()
+                    if cur.rowcount == 0:
+                        insert_logger.warning(f"lease of file {id} is lost, owner: {owner}")
+        except Exception as e:
+            insert_logger.error(f"heartbeat error: {traceback.format_exc()}")
+
+
+async def report_progress(mysql_client, file_id, progress):
+    """按INSERT_PROGRESS_INTERVAL把进度写入File.msg，没有变化时不写"""
+    last_msg = None
+    while True:
+        msg = progress.format_msg()
+        if msg != last_msg:
+            try:
+                await asyncio.to_thread(mysql_client.update_file_msg, file_id, msg, 'yellow')
+                last_msg = msg
+            except Exception as e:
+                insert_logger.error(f"report progress error: {traceback.format_exc()}")
+        await asyncio.sleep(INSERT_PROGRESS_INTERVAL)
+
+
+async def report_worker_stats(mysql_client, owner, meter):
+    """按INSERT_STATS_INTERVAL上报本worker的吞吐和正在处理的文件，供get_total_status估算积压清空时间"""
+    try:
+        while True:
+            try:
+                await asyncio.to_thread(mysql_client.upsert_insert_worker_stats, owner,
+                                        {'owner': owner, **meter.snapshot()})
+            except Exception as e:
+                insert_logger.error(f"report worker stats error: {traceback.format_exc()}")
+            await asyncio.sleep(INSERT_STATS_INTERVAL)
+    finally:
+        try:
+            await asyncio.to_thread(mysql_client.delete_insert_worker_stats, owner)
+        except Exception as e:
+            insert_logger.error(f"delete worker stats error: {traceback.format_exc()}")
+
+
+async def run_job(pool, owner, retriever, milvus_kb, mysql_client, parse_pool, meter, file_info):
+    id, file_id, file_name, attempts = file_info[0], file_info[1], file_info[3], file_info[9]
+    heartbeat_task = asyncio.create_task(heartbeat(pool, owner, id))
+    progress = IngestProgress(file_id, file_info[6], meter)
+    meter.jobs[file_id] = progress
+    progress_task = asyncio.create_task(report_progress(mysql_client, file_id, progress))
+    time_record = {}
+    status, content_length, chunks_number, msg = 'red', -1, 0, 'insert error'
+    try:
+        # 现在处理数据
+        with start_trace('insert_file', time_record=time_record, file_id=file_id,
+                         kb_id=file_info[4], file_size=file_info[6]) as trace_span:
+            status, content_length, chunks_number, msg = await process_data(retriever, milvus_kb, mysql_client,
+                                                                            parse_pool, file_info, time_record,
+                                                                            progress)
+            trace_span.set_attributes(status=status, chunks_number=chunks_number)
+        insert_logger.info('time_record: ' + json.dumps(time_record, ensure_ascii=False))
+        if time_record.get('insert_stalled') and attempts < INSERT_MAX_ATTEMPTS:
+            # 卡住的文件放回队列，重新领取后从检查点继续
+            status, msg = 'gray', f"insert stalled, retry from checkpoint ({attempts}/{INSERT_MAX_ATTEMPTS})"
+    except Exception as e:
+        insert_logger.error(f"process_files Error {traceback.format_exc()}")
+    finally:
+        heartbeat_task.cancel()
+        progress_task.cancel()
+        meter.jobs.pop(file_id, None)
+        if status == 'green':
+            meter.add('files', 1)
+    try:
+        # 更新文件处理后的状态和相关信息，同时释放租约；租约已被其他worker接管时不覆盖
+        async with pool.acquire() as conn:
+            async with conn.cursor() as cur:
+                await cur.execute(
+                    "UPDATE File SET status=%s, content_length=%s, chunks_number=%s, msg=%s, lease_owner=NULL, "
+                    "lease_expire=NULL WHERE id=%s AND lease_owner=%s",
+                    (status, content_length, chunks_number, msg, id, owner))
+                await conn.commit()
+                if cur.rowcount == 0:
+                    insert_logger.warning(f"file {file_id} lease is lost, skip status update")
+        insert_logger.info(f"UPDATE FILE: {file_id}, {file_name}, {status}")
+        if status != 'gray':
+            # 入库结束，解析结果检查点不再需要
+            await asyncio.to_thread(mysql_client.delete_parse_checkpoints, [file_id])
+    except Exception as e:
+        # 状态没有写回时租约会过期，文件将被重新领取
+        insert_logger.error('MySQL 连接异常：' + str(e))
+
+
 async def check_and_process(pool):
     process_type = 'MainProcess' if 'SANIC_WORKER_NAME' not in os.environ else os.environ['SANIC_WORKER_NAME']
     worker_id = int(process_type.split('-')[-2])
-    insert_logger.info(f"{os.getpid()} worker_id is {worker_id}")
+    owner = f"{socket.gethostname()}-{os.getpid()}"
+    insert_logger.info(f"{os.getpid()} worker_id is {worker_id}, owner: {owner}, "
+                       f"concurrency: {INSERT_WORKER_CONCURRENCY}, express slots: {INSERT_EXPRESS_SLOTS}")
     mysql_client = KnowledgeBaseManager()
     milvus_kb = VectorStoreMilvusClient()
     es_client = StoreElasticSearchClient()
     retriever = ParentRetriever(milvus_kb, mysql_client, es_client)
-    while True:
-        sleep_time = 3
-        # worker_id 根据时间变化，每x分钟变一次，获取当前时间的分钟数
-        minutes = int(int(time.strftime("%M", time.localtime())) / INSERT_WORKERS)
-        dynamic_worker_id = (worker_id + minutes) % INSERT_WORKERS
-        id = None
-        try:
-            async with pool.acquire() as conn:  # 获取连接
-                async with conn.cursor() as cur:  # 创建游标
-                    query = f"""
-                        SELECT id, timestamp, file_id, file_name FROM File
-                        WHERE status = 'gray' AND MOD(id, %s) = %s AND deleted = 0
-                        ORDER BY timestamp ASC LIMIT 1;
-                    """
-
-                    await cur.execute(query, (INSERT_WORKERS, dynamic_worker_id))
-
-                    file_to_update = await cur.fetchone()
-
-                    if file_to_update:
-                        insert_logger.info(f"{worker_id}, file_to_update: {file_to_update}")
-                        # 把files_to_update按照timestamp排序, 获取时间最早的那条记录的id
-                        # file_to_update = sorted(files_to_update, key=lambda x: x[1])[0]
-
-                        id, timestamp, file_id, file_name = file_to_update
-                        # 更新这条记录的状态
-                        await cur.execute("""
-                            UPDATE File SET status='yellow'
-                            WHERE id=%s;
-                        """, (id,))
-                        await conn.commit()
-                        insert_logger.info(f"UPDATE FILE: {timestamp}, {file_id}, {file_name}, yellow")
-
-                        await cur.execute(
-                            "SELECT id, file_id, user_id, file_name, kb_id, file_location, file_size, file_url, "
-                            "chunk_size FROM File WHERE id=%s", (id,))
-                        file_info = await cur.fetchone()
-
-                        time_record = {}
-                        # 现在处理数据
-                        status, content_length, chunks_number, msg = await process_data(retriever, milvus_kb,
-                                                                                        mysql_client,
-                                                                                        file_info, time_record)
-
-                        insert_logger.info('time_record: ' + json.dumps(time_record, ensure_ascii=False))
-                        # 更新文件处理后的状态和相关信息
-                        await cur.execute(
-                            "UPDATE File SET status=%s, content_length=%s, chunks_number=%s, msg=%s WHERE id=%s",
-                            (status, content_length, chunks_number, msg, file_info[0]))
-                        await conn.commit()
-                        insert_logger.info(f"UPDATE FILE: {timestamp}, {file_id}, {file_name}, {status}")
-                        sleep_time = 0.1
-                    else:
-                        await conn.commit()
-        except Exception as e:
-            insert_logger.error('MySQL或Milvus 连接异常：' + str(e))
-            try:
-                async with pool.acquire() as conn:
-                    async with conn.cursor() as cur:
-                        insert_logger.error(f"process_files Error {traceback.format_exc()}")
-                        # 如果file的status是yellow，就改为red
-                        if id is not None:
-                            await cur.execute("UPDATE File SET status='red' WHERE id=%s AND status='yellow'", (id,))
-                            await conn.commit()
-
-                            await cur.execute(
-                                "SELECT id, file_id, user_id, file_name, kb_id, file_location, file_size FROM File WHERE id=%s",
-                                (id,))
-                            file_info = await cur.fetchone()
-
-                            insert_logger.info(f"UPDATE FILE: {timestamp}, {file_id}, {file_name}, yellow2red")
-                            _, file_id, user_id, file_name, kb_id, file_location, file_size = file_info
-                            # await post_data(user_id=user_id, charsize=-1, docid=file_id, status='red', msg="Milvus service exception")
-            except Exception as e:
-                insert_logger.error('MySQL 二次连接异常：' + str(e))
-        finally:
-            await asyncio.sleep(sleep_time)
+    parse_pool = ParseProcessPool(PARSE_PROCESSES or max(1, (os.cpu_count() or 1) // INSERT_WORKERS))
+    await parse_pool.start()
+    meter = ThroughputMeter()
+    app.ctx.mysql_client = mysql_client
+    stats_task = asyncio.create_task(report_worker_stats(mysql_client, owner, meter))
+    wakeup = InsertWakeupListener(f"worker-{os.getpid()}")
+    wakeup.start()
+    scheduler = FairScheduler()
+    running, express_running = set(), set()
+    try:
+        while True:
+            # 先清除信号再领取，领取期间到达的信号会让下一次等待立即返回
+            wakeup.event.clear()
+            free_slots = INSERT_WORKER_CONCURRENCY - len(running)
+            express_slots = INSERT_EXPRESS_SLOTS - len(express_running)
+            if free_slots > 0 or express_slots > 0:
+                try:
+                    await expire_exhausted_files(pool)
+                    for file_info, express in await claim_files(pool, owner, scheduler, max(free_slots, 0),
+                                                                max(express_slots, 0)):
+                        insert_logger.info(f"{worker_id}, claim file: {file_info}, express: {express}")
+                        task = asyncio.create_task(run_job(pool, owner, retriever, milvus_kb, mysql_client,
+                                                           parse_pool, meter, file_info))
+                        lane = express_running if express else running
+                        lane.add(task)
+                        task.add_done_callback(lane.discard)
+                except Exception as e:
+                    insert_logger.error('MySQL 连接异常：' + str(e))
+            # 等待任一任务完成（有空闲槽位）、唤醒信号，或者兜底轮询
+            wakeup_waiter = asyncio.ensure_future(wakeup.event.wait())
+            await asyncio.wait(running | express_running | {wakeup_waiter}, timeout=INSERT_POLL_INTERVAL,
+                               return_when=asyncio.FIRST_COMPLETED)
+            wakeup_waiter.cancel()
+    finally:
+        stats_task.cancel()
+        wakeup.close()
+        parse_pool.close()
+
+
+@app.get('/api/insert_stats')
+async def insert_stats(request):
+    """所有入库worker的吞吐、积压文件数和字节数，以及积压清空时间估算"""
+    mysql_client = getattr(request.app.ctx, 'mysql_client', None)
+    if mysql_client is None:
+        return response.json({"code": 503, "msg": "insert worker not ready"})
+    backlog = await asyncio.to_thread(mysql_client.get_insert_backlog)
+    worker_stats = await asyncio.to_thread(mysql_client.get_insert_worker_stats, INSERT_STATS_INTERVAL * 3)
+    return response.json({"code": 200, "msg": "success", "stats": summarize_insert_queue(backlog, worker_stats)})
 
 
 @app.listener('after_server_stop')
@@ -1,8 +1,9 @@
-import copy
 import time
 import os
 from qanything_kernel.dependent_server.ocr_server.operators import *
 from qanything_kernel.dependent_server.ocr_server.postprocess import build_post_process
+from qanything_kernel.dependent_server.ocr_server.crop import filter_det_boxes, get_rotate_crop_image, \
+    get_rotate_crop_images
 import numpy as np
 import onnxruntime as ort
 
@@ -390,20 +391,7 @@ class TextDetector(object):
         return points
 
     def filter_tag_det_res(self, dt_boxes, image_shape):
-        img_height, img_width = image_shape[0:2]
-        dt_boxes_new = []
-        for box in dt_boxes:
-            if isinstance(box, list):
-                box = np.array(box)
-            box = self.order_points_clockwise(box)
-            box = self.clip_det_res(box, img_height, img_width)
-            rect_width = int(np.linalg.norm(box[0] - box[1]))
-            rect_height = int(np.linalg.norm(box[0] - box[3]))
-            if rect_width <= 3 or rect_height <= 3:
-                continue
-            dt_boxes_new.append(box)
-        dt_boxes = np.array(dt_boxes_new)
-        return dt_boxes
+        return filter_det_boxes(dt_boxes, image_shape)
 
     def filter_tag_det_res_only_clip(self, dt_boxes, image_shape):
         img_height, img_width = image_shape[0:2]
@@ -455,38 +443,7 @@ class OCRQAnything(object):
         self.crop_image_res_index = 0
 
     def get_rotate_crop_image(self, img, points):
-        '''
-        img_height, img_width = img.shape[0:2]
-        left = int(np.min(points[:, 0]))
-        right = int(np.max(points[:, 0]))
-        top = int(np.min(points[:, 1]))
-        bottom = int(np.max(points[:, 1]))
-        img_crop = img[top:bottom, left:right, :].copy()
-        points[:, 0] = points[:, 0] - left
-        points[:, 1] = points[:, 1] - top
-        '''
-        assert len(points) == 4, "shape of points must be 4*2"
-        img_crop_width = int(
-            max(
-                np.linalg.norm(points[0] - points[1]),
-                np.linalg.norm(points[2] - points[3])))
-        img_crop_height = int(
-            max(
-                np.linalg.norm(points[0] - points[3]),
-                np.linalg.norm(points[1] - points[2])))
-        pts_std = np.float32([[0, 0], [img_crop_width, 0],
-                              [img_crop_width, img_crop_height],
-                              [0, img_crop_height]])
-        M = cv2.getPerspectiveTransform(points, pts_std)
-        dst_img = cv2.warpPerspective(
-            img,
-            M, (img_crop_width, img_crop_height),
-            borderMode=cv2.BORDER_REPLICATE,
-            flags=cv2.INTER_CUBIC)
-        dst_img_height, dst_img_width = dst_img.shape[0:2]
-        if dst_img_height * 1.0 / dst_img_width >= 1.5:
-            dst_img = np.rot90(dst_img)
-        return dst_img
+        return get_rotate_crop_image(img, points)
 
     def sorted_boxes(self, dt_boxes):
         """
@@ -541,6 +498,18 @@ class OCRQAnything(object):
             return ""
         return text
 
+    def detect_crops(self, img):
+        """检测文本框，按阅读顺序排序后裁剪出每个文本行，返回(文本框, 裁剪图)；预处理失败时返回(None, None)"""
+        dt_boxes, elapse = self.text_detector(img)
+        if dt_boxes is None:
+            return None, None
+        dt_boxes = self.sorted_boxes(dt_boxes)
+        img_crop_list = get_rotate_crop_images(img, dt_boxes)
+        return dt_boxes, img_crop_list
+
+    def filter_results(self, rec_res):
+        return [text for text, score in rec_res if score >= self.drop_score]
+
     def __call__(self, img, cls=True):
         time_dict = {'det': 0, 'rec': 0, 'cls': 0, 'all': 0}
 
@@ -548,42 +517,13 @@ class OCRQAnything(object):
             return None, None, time_dict
 
         start = time.time()
-        ori_im = img.copy()
-        # print(img.shape)
-        dt_boxes, elapse = self.text_detector(img)
-        time_dict['det'] = elapse
-
+        dt_boxes, img_crop_list = self.detect_crops(img)
         if dt_boxes is None:
-            end = time.time()
-            time_dict['all'] = end - start
+            time_dict['all'] = time.time() - start
             return None, None, time_dict
-        # else:
-        #     cron_logger.debug("dt_boxes num : {}, elapsed : {}".format(
-        #         len(dt_boxes), elapse))
-        img_crop_list = []
-
-        dt_boxes = self.sorted_boxes(dt_boxes)
-
-        for bno in range(len(dt_boxes)):
-            tmp_box = copy.deepcopy(dt_boxes[bno])
-            img_crop = self.get_rotate_crop_image(ori_im, tmp_box)
-            img_crop_list.append(img_crop)
 
         rec_res, elapse = self.text_recognizer(img_crop_list)
-
-        time_dict['rec'] = elapse
-        # cron_logger.debug("rec_res num  : {}, elapsed : {}".format(
-        #     len(rec_res), elapse))
-
-        filter_boxes, filter_rec_res = [], []
-        for box, rec_result in zip(dt_boxes, rec_res):
-            text, score = rec_result
-            if score >= self.drop_score:
-                filter_boxes.append(box)
-                filter_rec_res.append(rec_result)
-        end = time.time()
-        time_dict['all'] = end - start
-        return [item[0] for item in list(filter_rec_res)]
+        return self.filter_results(rec_res)
 
 
 if __name__ == '__main__':
@@ -10,18 +10,24 @@ root_dir = os.path.dirname(os.path.dirname(os.path.dirname(os.path.dirname(curre
 sys.path.append(root_dir)
 print(root_dir)
 
-import copy
 import time
 import os
 from qanything_kernel.dependent_server.ocr_server.operators import *
 from qanything_kernel.dependent_server.ocr_server.postprocess import build_post_process
+from qanything_kernel.dependent_server.ocr_server.crop import filter_det_boxes, get_rotate_crop_image, \
+    get_rotate_crop_images
 from qanything_kernel.utils.general_utils import safe_get
-from qanything_kernel.configs.model_config import OCR_MODEL_PATH
+from qanything_kernel.dependent_server.ocr_server.recognition_pool import RecognitionPool, decode_image
+from qanything_kernel.configs.model_config import OCR_MODEL_PATH, TRACE_HEADER, OCR_BATCH_MAX_IMAGES, \
+    OCR_INFER_THREADS, OCR_REC_MAX_CROPS, OCR_REC_BATCH_WAIT_MS
+from concurrent.futures import ThreadPoolExecutor
+from qanything_kernel.utils.tracing import start_trace
 import numpy as np
 import onnxruntime as ort
 from sanic import Sanic, response
 from sanic.request import Request
 from sanic.response import json
+import asyncio
 import base64
 import argparse
 
@@ -417,20 +423,7 @@ class TextDetector(object):
         return points
 
     def filter_tag_det_res(self, dt_boxes, image_shape):
-        img_height, img_width = image_shape[0:2]
-        dt_boxes_new = []
-        for box in dt_boxes:
-            if isinstance(box, list):
-                box = np.array(box)
-            box = self.order_points_clockwise(box)
-            box = self.clip_det_res(box, img_height, img_width)
-            rect_width = int(np.linalg.norm(box[0] - box[1]))
-            rect_height = int(np.linalg.norm(box[0] - box[3]))
-            if rect_width <= 3 or rect_height <= 3:
-                continue
-            dt_boxes_new.append(box)
-        dt_boxes = np.array(dt_boxes_new)
-        return dt_boxes
+        return filter_det_boxes(dt_boxes, image_shape)
 
     def filter_tag_det_res_only_clip(self, dt_boxes, image_shape):
         img_height, img_width = image_shape[0:2]
@@ -482,38 +475,7 @@ class OCRQAnything(object):
         self.crop_image_res_index = 0
 
     def get_rotate_crop_image(self, img, points):
-        '''
-        img_height, img_width = img.shape[0:2]
-        left = int(np.min(points[:, 0]))
-        right = int(np.max(points[:, 0]))
-        top = int(np.min(points[:, 1]))
-        bottom = int(np.max(points[:, 1]))
-        img_crop = img[top:bottom, left:right, :].copy()
-        points[:, 0] = points[:, 0] - left
-        points[:, 1] = points[:, 1] - top
-        '''
-        assert len(points) == 4, "shape of points must be 4*2"
-        img_crop_width = int(
-            max(
-                np.linalg.norm(points[0] - points[1]),
-                np.linalg.norm(points[2] - points[3])))
-        img_crop_height = int(
-            max(
-                np.linalg.norm(points[0] - points[3]),
-                np.linalg.norm(points[1] - points[2])))
-        pts_std = np.float32([[0, 0], [img_crop_width, 0],
-                              [img_crop_width, img_crop_height],
-                              [0, img_crop_height]])
-        M = cv2.getPerspectiveTransform(points, pts_std)
-        dst_img = cv2.warpPerspective(
-            img,
-            M, (img_crop_width, img_crop_height),
-            borderMode=cv2.BORDER_REPLICATE,
-            flags=cv2.INTER_CUBIC)
-        dst_img_height, dst_img_width = dst_img.shape[0:2]
-        if dst_img_height * 1.0 / dst_img_width >= 1.5:
-            dst_img = np.rot90(dst_img)
-        return dst_img
+        return get_rotate_crop_image(img, points)
 
     def sorted_boxes(self, dt_boxes):
         """
@@ -568,6 +530,18 @@ class OCRQAnything(object):
             return ""
         return text
 
+    def detect_crops(self, img):
+        """检测文本框，按阅读顺序排序后裁剪出每个文本行，返回(文本框, 裁剪图)；预处理失败时返回(None, None)"""
+        dt_boxes, elapse = self.text_detector(img)
+        if dt_boxes is None:
+            return None, None
+        dt_boxes = self.sorted_boxes(dt_boxes)
+        img_crop_list = get_rotate_crop_images(img, dt_boxes)
+        return dt_boxes, img_crop_list
+
+    def filter_results(self, rec_res):
+        return [text for text, score in rec_res if score >= self.drop_score]
+
     def __call__(self, img, cls=True):
         time_dict = {'det': 0, 'rec': 0, 'cls': 0, 'all': 0}
 
@@ -575,42 +549,13 @@ class OCRQAnything(object):
             return None, None, time_dict
 
         start = time.time()
-        ori_im = img.copy()
-        # print(img.shape)
-        dt_boxes, elapse = self.text_detector(img)
-        time_dict['det'] = elapse
-
+        dt_boxes, img_crop_list = self.detect_crops(img)
         if dt_boxes is None:
-            end = time.time()
-            time_dict['all'] = end - start
+            time_dict['all'] = time.time() - start
             return None, None, time_dict
-        # else:
-        #     cron_logger.debug("dt_boxes num : {}, elapsed : {}".format(
-        #         len(dt_boxes), elapse))
-        img_crop_list = []
-
-        dt_boxes = self.sorted_boxes(dt_boxes)
-
-        for bno in range(len(dt_boxes)):
-            tmp_box = copy.deepcopy(dt_boxes[bno])
-            img_crop = self.get_rotate_crop_image(ori_im, tmp_box)
-            img_crop_list.append(img_crop)
 
         rec_res, elapse = self.text_recognizer(img_crop_list)
-
-        time_dict['rec'] = elapse
-        # cron_logger.debug("rec_res num  : {}, elapsed : {}".format(
-        #     len(rec_res), elapse))
-
-        filter_boxes, filter_rec_res = [], []
-        for box, rec_result in zip(dt_boxes, rec_res):
-            text, score = rec_result
-            if score >= self.drop_score:
-                filter_boxes.append(box)
-                filter_rec_res.append(rec_result)
-        end = time.time()
-        time_dict['all'] = end - start
-        return [item[0] for item in list(filter_rec_res)]
+        return self.filter_results(rec_res)
 
 
 app = Sanic("OCRService")
@@ -620,6 +565,18 @@ app = Sanic("OCRService")
 async def setup_ocr(app, loop):
     device = 'cpu' if not args.use_gpu else 'cuda'
     app.ctx.ocr = OCRQAnything(model_dir=OCR_MODEL_PATH, device=device)
+    # 推理放到线程池中，推理期间事件循环仍可接收、解码其他请求
+    app.ctx.executor = ThreadPoolExecutor(max_workers=OCR_INFER_THREADS, thread_name_prefix='ocr_infer')
+    app.ctx.rec_pool = RecognitionPool(app.ctx.ocr, app.ctx.executor, max_crops=OCR_REC_MAX_CROPS,
+                                       wait_seconds=OCR_REC_BATCH_WAIT_MS / 1000)
+    app.ctx.rec_pool.start()
+
+
+@app.after_server_stop
+async def shutdown_ocr(app, loop):
+    app.ctx.rec_pool.close()
+    app.ctx.executor.shutdown(wait=False, cancel_futures=True)
+
 
 @app.post("/ocr")
 async def ocr_api(request: Request):
@@ -630,16 +587,42 @@ async def ocr_api(request: Request):
 
     try:
         img_data = base64.b64decode(img64)
-        img = cv2.imdecode(np.frombuffer(img_data, np.uint8), cv2.IMREAD_COLOR)
+        img = await asyncio.get_running_loop().run_in_executor(app.ctx.executor, decode_image, img_data)
     except Exception as e:
         return json({"error": "Invalid image data"}, status=400)
 
     if img is None:
         return json({"error": "Invalid image file"}, status=400)
 
-    result = app.ctx.ocr(img)
+    with start_trace('ocr_server', trace_id=request.headers.get(TRACE_HEADER),
+                     traceparent=request.headers.get('traceparent')):
+        result = await app.ctx.rec_pool.ocr_image(img)
     return json({"result": result})
 
 
+@app.post("/ocr_batch")
+async def ocr_batch_api(request: Request):
+    """
+    multipart/form-data，每个images字段是一张图片的原始字节（jpg/png等），不需要base64。
+    results与上传顺序一致，无法解码的图片结果为null并记录在errors中
+    """
+    images = request.files.getlist('images') if request.files else None
+    if not images:
+        return json({"error": "No image data provided"}, status=400)
+    if len(images) > OCR_BATCH_MAX_IMAGES:
+        return json({"error": f"Too many images: {len(images)} > {OCR_BATCH_MAX_IMAGES}"}, status=413)
+
+    async def ocr_one(image):
+        img = await asyncio.get_running_loop().run_in_executor(app.ctx.executor, decode_image, image.body)
+        return None if img is None else await app.ctx.rec_pool.ocr_image(img)
+
+    with start_trace('ocr_server_batch', trace_id=request.headers.get(TRACE_HEADER),
+                     traceparent=request.headers.get('traceparent'), images=len(images)):
+        # 同一请求的图片并发检测，文本行一起识别
+        results = await asyncio.gather(*[ocr_one(image) for image in images])
+    errors = [{"index": i, "error": "Invalid image file"} for i, result in enumerate(results) if result is None]
+    return json({"results": results, "errors": errors})
+
+
 if __name__ == '__main__':
     app.run(host="0.0.0.0", port=7001, workers=args.workers)
@@ -100,6 +100,10 @@ class DBPostProcess(object):
         '''
         _bitmap: single map with shape (1, H, W),
                 whose values are binarized as {0, 1}
+
+        原来每个轮廓在Python循环里依次求最小外接矩形、fillPoly打分、shapely求扩张距离、缩放，文本密集的页面上千个轮廓。
+        现在每一步对所有候选框一起做：打分用积分图，扩张距离和缩放用numpy批量计算，只有pyclipper扩张仍逐个进行，
+        结果与逐个计算一致。
         '''
 
         bitmap = _bitmap
@@ -112,45 +116,60 @@ class DBPostProcess(object):
         elif len(outs) == 2:
             contours, _ = outs[0], outs[1]
 
-        num_contours = min(len(contours), self.max_candidates)
-
-        boxes = []
-        scores = []
-        for index in range(num_contours):
-            contour = contours[index]
-            points, sside = self.get_mini_boxes(contour)
-            if sside < self.min_size:
-                continue
-            points = np.array(points)
-            if self.score_mode == "fast":
-                score = self.box_score_fast(pred, points.reshape(-1, 2))
-            else:
-                score = self.box_score_slow(pred, contour)
-            if self.box_thresh > score:
-                continue
-
-            box = self.unclip(points, self.unclip_ratio).reshape(-1, 1, 2)
-            box, sside = self.get_mini_boxes(box)
-            if sside < self.min_size + 2:
-                continue
-            box = np.array(box)
-
-            box[:, 0] = np.clip(
-                np.round(box[:, 0] / width * dest_width), 0, dest_width)
-            box[:, 1] = np.clip(
-                np.round(box[:, 1] / height * dest_height), 0, dest_height)
-            boxes.append(box.astype("int32"))
-            scores.append(score)
-        return np.array(boxes, dtype="int32"), scores
-
-    def unclip(self, box, unclip_ratio):
-        poly = Polygon(box)
-        distance = poly.area * unclip_ratio / poly.length
+        contours = contours[:self.max_candidates]
+        points, ssides = self.get_mini_boxes_batch(contours)
+        keep = np.flatnonzero(ssides >= self.min_size)
+        points = points[keep]
+        if self.score_mode == "fast":
+            scores = self.box_scores_fast(pred, points)
+        else:
+            scores = np.array([self.box_score_slow(pred, contours[i]) for i in keep], dtype=np.float64)
+        keep = np.flatnonzero(~(self.box_thresh > scores))
+        points, scores = points[keep], scores[keep]
+
+        distances = self.unclip_distances(points, self.unclip_ratio)
+        expanded = [self.unclip(box, self.unclip_ratio, distance).reshape(-1, 1, 2)
+                    for box, distance in zip(points, distances)]
+        boxes, ssides = self.get_mini_boxes_batch(expanded)
+        keep = np.flatnonzero(ssides >= self.min_size + 2)
+        if not len(keep):
+            return np.array([], dtype="int32"), []
+        boxes, scores = boxes[keep], scores[keep]
+
+        boxes[:, :, 0] = np.clip(
+            np.round(boxes[:, :, 0] / width * dest_width), 0, dest_width)
+        boxes[:, :, 1] = np.clip(
+            np.round(boxes[:, :, 1] / height * dest_height), 0, dest_height)
+        return boxes.astype("int32"), scores.tolist()
+
+    def unclip(self, box, unclip_ratio, distance=None):
+        if distance is None:
+            poly = Polygon(box)
+            distance = poly.area * unclip_ratio / poly.length
         offset = pyclipper.PyclipperOffset()
         offset.AddPath(box, pyclipper.JT_ROUND, pyclipper.ET_CLOSEDPOLYGON)
-        expanded = np.array(offset.Execute(distance))
+        expanded = np.array(offset.Execute(float(distance)))
         return expanded
 
+    @staticmethod
+    def unclip_distances(boxes, unclip_ratio):
+        '''
+        unclip扩张距离（面积 * unclip_ratio / 周长）的批量版本，boxes为(N, 4, 2)，
+        面积和周长按shapely(GEOS)的公式和求和顺序计算，避免每个框构造一次Polygon
+        '''
+        pts = boxes.astype(np.float64)
+        x, y = pts[:, :, 0], pts[:, :, 1]
+        area = np.zeros(len(pts))
+        # GEOS Area::ofRing：以第一个点为原点的鞋带公式
+        for i in range(1, 4):
+            area = area + (x[:, i] - x[:, 0]) * (y[:, i - 1] - y[:, (i + 1) % 4])
+        area = np.abs(area / 2.0)
+        length = np.zeros(len(pts))
+        for i in range(4):
+            dx, dy = x[:, (i + 1) % 4] - x[:, i], y[:, (i + 1) % 4] - y[:, i]
+            length = length + np.sqrt(dx * dx + dy * dy)
+        return area * unclip_ratio / length
+
     def get_mini_boxes(self, contour):
         bounding_box = cv2.minAreaRect(contour)
         points = sorted(list(cv2.boxPoints(bounding_box)), key=lambda x: x[0])
@@ -174,6 +193,60 @@ class DBPostProcess(object):
         ]
         return box, min(bounding_box[1])
 
+    def get_mini_boxes_batch(self, contours):
+        '''
+        get_mini_boxes的批量版本：返回(N, 4, 2)的顶点（左上、右上、右下、左下）和(N,)的短边长度
+        '''
+        rects = [cv2.minAreaRect(contour) for contour in contours]
+        if not rects:
+            return np.zeros((0, 4, 2), dtype=np.float32), np.zeros(0)
+        points = np.stack([cv2.boxPoints(rect) for rect in rects])
+        # 与sorted(key=x)一致的稳定排序
+        order = np.argsort(points[:, :, 0], axis=1, kind='stable')
+        points = np.take_along_axis(points, order[:, :, None], axis=1)
+        left = points[:, 1, 1] > points[:, 0, 1]
+        right = points[:, 3, 1] > points[:, 2, 1]
+        order = np.stack([np.where(left, 0, 1), np.where(right, 2, 3),
+                          np.where(right, 3, 2), np.where(left, 1, 0)], axis=1)
+        points = np.take_along_axis(points, order[:, :, None], axis=1)
+        return points, np.array([min(rect[1]) for rect in rects])
+
+    def box_scores_fast(self, bitmap, boxes):
+        '''
+        box_score_fast的批量版本，boxes为(N, 4, 2)。
+        box_score_fast把顶点平移到bbox内截断为整数后fillPoly，整数顶点围成与坐标轴平行的矩形时（横排文本的绝大多数），
+        mask就是这个矩形（含边界，超出bbox的部分被裁掉），均值用积分图直接求出；其余文本框仍逐个fillPoly。
+        '''
+        if not len(boxes):
+            return np.zeros(0)
+        h, w = bitmap.shape[:2]
+        integral = cv2.integral(bitmap, sdepth=cv2.CV_64F)
+        xs, ys = boxes[:, :, 0], boxes[:, :, 1]
+        xmin = np.clip(np.floor(xs.min(axis=1)).astype("int32"), 0, w - 1)
+        xmax = np.clip(np.ceil(xs.max(axis=1)).astype("int32"), 0, w - 1)
+        ymin = np.clip(np.floor(ys.min(axis=1)).astype("int32"), 0, h - 1)
+        ymax = np.clip(np.ceil(ys.max(axis=1)).astype("int32"), 0, h - 1)
+        # 与box_score_fast相同：平移后存回float32，再截断为int32
+        cols = (xs - xmin[:, None]).astype(np.float32).astype("int32")
+        rows = (ys - ymin[:, None]).astype(np.float32).astype("int32")
+        rect = ((cols[:, 0] == cols[:, 3]) & (cols[:, 1] == cols[:, 2]) &
+                (rows[:, 0] == rows[:, 1]) & (rows[:, 2] == rows[:, 3])) | \
+               ((cols[:, 0] == cols[:, 1]) & (cols[:, 2] == cols[:, 3]) &
+                (rows[:, 0] == rows[:, 3]) & (rows[:, 1] == rows[:, 2]))
+        c0 = np.maximum(cols.min(axis=1), 0) + xmin
+        c1 = np.minimum(cols.max(axis=1), xmax - xmin) + xmin
+        r0 = np.maximum(rows.min(axis=1), 0) + ymin
+        r1 = np.minimum(rows.max(axis=1), ymax - ymin) + ymin
+        # mask为空时cv2.mean返回0
+        count = np.maximum(c1 - c0 + 1, 0) * np.maximum(r1 - r0 + 1, 0)
+        c0, c1 = np.clip(c0, 0, w - 1), np.clip(c1, 0, w - 1)
+        r0, r1 = np.clip(r0, 0, h - 1), np.clip(r1, 0, h - 1)
+        total = integral[r1 + 1, c1 + 1] - integral[r0, c1 + 1] - integral[r1 + 1, c0] + integral[r0, c0]
+        scores = np.where(count > 0, total / np.maximum(count, 1), 0.0)
+        for i in np.flatnonzero(~rect):
+            scores[i] = self.box_score_fast(bitmap, boxes[i])
+        return scores
+
     def box_score_fast(self, bitmap, _box):
         '''
         box_score_fast: use bbox mean score as the mean score
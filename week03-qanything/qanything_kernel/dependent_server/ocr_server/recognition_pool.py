@@ -0,0 +1,105 @@
+"""
+OCR服务的推理调度。原来/ocr在async handler里同步执行整个OCR，并发请求完全串行，推理期间连新连接都接不了。
+
+- 检测和裁剪在线程池中执行（onnxruntime推理、cv2运算时释放GIL），事件循环只负责收发请求；
+- 识别由RecognitionPool在单独的线程中统一执行（不排在检测任务后面）：同时在处理的各张图片的文本行裁剪图汇集到一起，
+  TextRecognizer按宽高比排序后按rec_batch_num分批推理，宽高比相近的文本行在同一批里，padding更少，批也更满。
+  单张图片时不等待直接识别。
+"""
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from typing import List, Optional, Tuple
+import asyncio
+import cv2
+import numpy as np
+
+__all__ = ['RecognitionPool', 'decode_image']
+
+
+def decode_image(data: bytes) -> Optional[np.ndarray]:
+    if not data:
+        return None
+    return cv2.imdecode(np.frombuffer(data, np.uint8), cv2.IMREAD_COLOR)
+
+
+class RecognitionPool:
+    def __init__(self, ocr, executor, max_crops: int = 256, wait_seconds: float = 0.01):
+        self.ocr = ocr
+        self.executor = executor
+        self.rec_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='ocr_rec')
+        self.max_crops = max_crops
+        self.wait_seconds = wait_seconds
+        self.active = 0  # 已开始检测、还没提交识别的图片数
+        self.queue: Optional[asyncio.Queue] = None
+        self.task: Optional[asyncio.Task] = None
+        self.batches = 0
+        self.crops = 0
+
+    def start(self):
+        self.queue = asyncio.Queue()
+        self.task = asyncio.get_running_loop().create_task(self._run())
+
+    def close(self):
+        if self.task is not None:
+            self.task.cancel()
+        self.rec_executor.shutdown(wait=False, cancel_futures=True)
+
+    @contextmanager
+    def _track(self):
+        self.active += 1
+        try:
+            yield
+        finally:
+            self.active -= 1
+
+    async def ocr_image(self, img: np.ndarray) -> List[str]:
+        """检测 + 裁剪在线程池中执行，识别与其他并发图片的文本行合批，返回过滤低分后的文本行"""
+        loop = asyncio.get_running_loop()
+        with self._track():
+            dt_boxes, crops = await loop.run_in_executor(self.executor, self.ocr.detect_crops, img)
+            if not crops:
+                return []
+            future = loop.create_future()
+            self.queue.put_nowait((crops, future))
+        rec_res = await future
+        return self.ocr.filter_results(rec_res)
+
+    async def _collect(self) -> List[Tuple[list, asyncio.Future]]:
+        """取出排队的识别请求；还有图片正在检测时最多再等wait_seconds，让它们的文本行进入同一次识别"""
+        loop = asyncio.get_running_loop()
+        items = [await self.queue.get()]
+        count = len(items[0][0])
+        deadline = loop.time() + self.wait_seconds
+        while count < self.max_crops:
+            if not self.queue.empty():
+                item = self.queue.get_nowait()
+            elif self.active and loop.time() < deadline:
+                try:
+                    item = await asyncio.wait_for(self.queue.get(), deadline - loop.time())
+                except asyncio.TimeoutError:
+                    break
+            else:
+                break
+            items.append(item)
+            count += len(item[0])
+        return items
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            items = await self._collect()
+            crops = [crop for item_crops, _ in items for crop in item_crops]
+            try:
+                rec_res, elapse = await loop.run_in_executor(self.rec_executor, self.ocr.text_recognizer, crops)
+            except Exception as e:
+                for _, future in items:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+            self.batches += 1
+            self.crops += len(crops)
+            offset = 0
+            for item_crops, future in items:
+                if not future.done():
+                    future.set_result(rec_res[offset:offset + len(item_crops)])
+                offset += len(item_crops)
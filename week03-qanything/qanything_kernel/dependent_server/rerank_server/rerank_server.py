@@ -14,8 +14,9 @@ from sanic import Sanic
 from sanic.response import json
 from qanything_kernel.dependent_server.rerank_server.rerank_async_backend import RerankAsyncBackend
 from qanything_kernel.dependent_server.rerank_server.rerank_onnx_backend import RerankOnnxBackend
-from qanything_kernel.configs.model_config import LOCAL_RERANK_MODEL_PATH, LOCAL_RERANK_THREADS
+from qanything_kernel.configs.model_config import LOCAL_RERANK_MODEL_PATH, LOCAL_RERANK_THREADS, TRACE_HEADER
 from qanything_kernel.utils.general_utils import get_time_async
+from qanything_kernel.utils.tracing import start_trace
 import argparse
 
 # 接收外部参数mode
@@ -41,7 +42,10 @@ async def rerank(request):
     # onnx_backend: RerankAsyncBackend = request.app.ctx.onnx_backend
 
     # result_data = await onnx_backend.get_rerank_async(query, passages)
-    result_data = onnx_backend.get_rerank(query, passages)
+    # 沿用调用方传来的trace id，把模型推理耗时挂到同一条链路上
+    with start_trace('rerank_server', trace_id=request.headers.get(TRACE_HEADER),
+                     traceparent=request.headers.get('traceparent'), passages=len(passages)):
+        result_data = onnx_backend.get_rerank(query, passages)
     # print("local rerank query:", query, flush=True)
     # print("local rerank passages number:", len(passages), flush=True)
 
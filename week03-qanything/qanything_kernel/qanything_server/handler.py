@@ -5,8 +5,11 @@ from qanything_kernel.core.local_doc_qa import LocalDocQA
 from qanything_kernel.utils.custom_log import debug_logger, qa_logger
 from qanything_kernel.configs.model_config import (BOT_DESC, BOT_IMAGE, BOT_PROMPT, BOT_WELCOME,
                                                    DEFAULT_PARENT_CHUNK_SIZE, MAX_CHARS, VECTOR_SEARCH_TOP_K,
-                                                   UPLOAD_ROOT_PATH, IMAGES_ROOT_PATH)
+                                                   UPLOAD_ROOT_PATH, IMAGES_ROOT_PATH, TRACE_HEADER, INSERT_STATS_INTERVAL)
 from qanything_kernel.utils.general_utils import *
+from qanything_kernel.utils.tracing import start_trace
+from qanything_kernel.utils.insert_wakeup import notify_insert_workers
+from qanything_kernel.core.retriever.ingest_progress import summarize_insert_queue
 from langchain.schema import Document
 from sanic.response import ResponseStream
 from sanic.response import json as sanic_json
@@ -60,6 +63,27 @@ def sync_function_with_args(arg1, arg2):
     print(f"同步函数执行完毕，参数值：arg1={arg1}, arg2={arg2}")
 
 
+def get_reusable_file_ids(local_doc_qa: LocalDocQA, user_id, kb_id, file_names):
+    """strong模式下已入库结束（green/red）的同名文件沿用原file_id，重新入库时只更新内容变化的chunk"""
+    exist_files = local_doc_qa.milvus_summary.check_file_exist_by_name(user_id, kb_id, file_names)
+    return {file_name: file_id for file_id, file_name, _, status in exist_files if status in ('green', 'red')}
+
+
+def register_upload_file(local_doc_qa: LocalDocQA, local_file: LocalFile, file, reused: bool, chunk_size, timestamp):
+    """写入File表等待入库服务领取，沿用原file_id时改为重新排队；返回(local_file, msg)"""
+    milvus_summary = local_doc_qa.milvus_summary
+    file_size = len(local_file.file_content)
+    if reused:
+        if milvus_summary.requeue_file(local_file.file_id, file_size, chunk_size, timestamp, local_file.file_url):
+            return local_file, "requeue"
+        # 原文件已被重新领取入库，作为新文件上传
+        debug_logger.info(f"{local_file.file_name} {local_file.file_id} is processing, upload as new file")
+        local_file = LocalFile(local_file.user_id, local_file.kb_id, file, local_file.file_name)
+    msg = milvus_summary.add_file(local_file.file_id, local_file.user_id, local_file.kb_id, local_file.file_name,
+                                  file_size, local_file.file_location, chunk_size, timestamp, local_file.file_url)
+    return local_file, msg
+
+
 @get_time_async
 async def new_knowledge_base(req: request):
     local_doc_qa: LocalDocQA = req.app.ctx.local_doc_qa
@@ -147,6 +171,7 @@ async def upload_weblink(req: request):
     debug_logger.info("chunk_size: %s", chunk_size)
 
     exist_file_names = []
+    reuse_file_ids = {}
     if mode == 'soft':
         exist_files = local_doc_qa.milvus_summary.check_file_exist_by_name(user_id, kb_id, file_names)
         exist_file_names = [f[1] for f in exist_files]
@@ -154,6 +179,8 @@ async def upload_weblink(req: request):
             file_id, file_name, file_size, status = exist_file
             debug_logger.info(f"{url}, {status}, existed files, skip upload")
             # await post_data(user_id, -1, file_id, status, msg='existed files, skip upload')
+    else:
+        reuse_file_ids = get_reusable_file_ids(local_doc_qa, user_id, kb_id, file_names)
     now = datetime.now()
     timestamp = now.strftime("%Y%m%d%H%M")
 
@@ -161,16 +188,17 @@ async def upload_weblink(req: request):
     for url, file_name in zip(urls, file_names):
         if file_name in exist_file_names:
             continue
-        local_file = LocalFile(user_id, kb_id, url, file_name)
+        reuse_file_id = reuse_file_ids.pop(file_name, None)
+        local_file = LocalFile(user_id, kb_id, url, file_name, file_id=reuse_file_id)
+        local_file, msg = register_upload_file(local_doc_qa, local_file, url, reuse_file_id is not None, chunk_size,
+                                               timestamp)
         file_id = local_file.file_id
-        file_size = len(local_file.file_content)
-        file_location = local_file.file_location
-        msg = local_doc_qa.milvus_summary.add_file(file_id, user_id, kb_id, file_name, file_size, file_location,
-                                                   chunk_size, timestamp, url)
         debug_logger.info(f"{url}, {file_name}, {file_id}, {msg}")
         data.append({"file_id": file_id, "file_name": file_name, "file_url": url, "status": "gray", "bytes": 0,
                      "timestamp": timestamp})
         # asyncio.create_task(local_doc_qa.insert_files_to_milvus(user_id, kb_id, [local_file]))
+    if data:
+        notify_insert_workers()  # 唤醒入库服务立即领取，不必等待轮询
     if exist_file_names:
         msg = f'warning，当前的mode是soft，无法上传同名文件{exist_file_names}，如果想强制上传同名文件，请设置mode：strong'
     else:
@@ -232,6 +260,7 @@ async def upload_files(req: request):
         file_names.append(file_name)
 
     exist_file_names = []
+    reuse_file_ids = {}
     if mode == 'soft':
         exist_files = local_doc_qa.milvus_summary.check_file_exist_by_name(user_id, kb_id, file_names)
         exist_file_names = [f[1] for f in exist_files]
@@ -239,6 +268,8 @@ async def upload_files(req: request):
             file_id, file_name, file_size, status = exist_file
             debug_logger.info(f"{file_name}, {status}, existed files, skip upload")
             # await post_data(user_id, -1, file_id, status, msg='existed files, skip upload')
+    else:
+        reuse_file_ids = get_reusable_file_ids(local_doc_qa, user_id, kb_id, file_names)
 
     now = datetime.now()
     timestamp = now.strftime("%Y%m%d%H%M")
@@ -247,7 +278,8 @@ async def upload_files(req: request):
     for file, file_name in zip(files, file_names):
         if file_name in exist_file_names:
             continue
-        local_file = LocalFile(user_id, kb_id, file, file_name)
+        reuse_file_id = reuse_file_ids.pop(file_name, None)
+        local_file = LocalFile(user_id, kb_id, file, file_name, file_id=reuse_file_id)
         chars = fast_estimate_file_char_count(local_file.file_location)
         debug_logger.info(f"{file_name} char_size: {chars}")
         if chars and chars > MAX_CHARS:
@@ -255,18 +287,18 @@ async def upload_files(req: request):
             # return sanic_json({"code": 2003, "msg": f"fail, file {file_name} chars is too much, max length is {MAX_CHARS}."})
             failed_files.append(file_name)
             continue
+        local_file, msg = register_upload_file(local_doc_qa, local_file, file, reuse_file_id is not None, chunk_size,
+                                               timestamp)
         file_id = local_file.file_id
-        file_size = len(local_file.file_content)
-        file_location = local_file.file_location
         local_files.append(local_file)
-        msg = local_doc_qa.milvus_summary.add_file(file_id, user_id, kb_id, file_name, file_size, file_location,
-                                                   chunk_size, timestamp)
         debug_logger.info(f"{file_name}, {file_id}, {msg}")
         data.append(
             {"file_id": file_id, "file_name": file_name, "status": "gray", "bytes": len(local_file.file_content),
              "timestamp": timestamp, "estimated_chars": chars})
 
     # asyncio.create_task(local_doc_qa.insert_files_to_milvus(user_id, kb_id, local_files))
+    if data:
+        notify_insert_workers()  # 唤醒入库服务立即领取，不必等待轮询
     if exist_file_names:
         msg = f'warning，当前的mode是soft，无法上传同名文件{exist_file_names}，如果想强制上传同名文件，请设置mode：strong'
     elif failed_files:
@@ -360,6 +392,8 @@ async def upload_faqs(req: request):
             {"file_id": file_id, "file_name": file_name, "status": "gray", "length": file_size,
              "timestamp": timestamp})
     debug_logger.info(f"end insert {len(faqs)} faqs to mysql, user_id: {user_id}, kb_id: {kb_id}")
+    if data:
+        notify_insert_workers()
 
     msg = "success，后台正在飞速上传文件，请耐心等待"
     return sanic_json({"code": 200, "msg": msg, "data": data})
@@ -482,6 +516,7 @@ async def delete_knowledge_base(req: request):
         file_chunks = [file_info[8] for file_info in file_infos]
         asyncio.create_task(run_in_background(local_doc_qa.es_client.delete_files, file_ids, file_chunks))
         local_doc_qa.milvus_summary.delete_documents(file_ids)
+        local_doc_qa.milvus_summary.delete_parse_checkpoints(file_ids)
         local_doc_qa.milvus_summary.delete_faqs(file_ids)
 
         # delete kb_id file dir
@@ -550,6 +585,7 @@ async def delete_docs(req: request):
 
     local_doc_qa.milvus_summary.delete_files(kb_id, valid_file_ids)
     local_doc_qa.milvus_summary.delete_documents(valid_file_ids)
+    local_doc_qa.milvus_summary.delete_parse_checkpoints(valid_file_ids)
     local_doc_qa.milvus_summary.delete_faqs(valid_file_ids)
     # list file_ids
     for file_id in file_ids:
@@ -601,7 +637,15 @@ async def get_total_status(req: request):
                                           'red': len(red_file_infos),
                                           'gray': len(gray_file_infos)}
 
-    return sanic_json({"code": 200, "status": res})
+    # 全局的入库积压和各入库worker的吞吐，估算积压清空时间
+    queue = None
+    try:
+        backlog = local_doc_qa.milvus_summary.get_insert_backlog()
+        worker_stats = local_doc_qa.milvus_summary.get_insert_worker_stats(INSERT_STATS_INTERVAL * 3)
+        queue = summarize_insert_queue(backlog, worker_stats)
+    except Exception as e:
+        debug_logger.error(f"get insert queue stats error: {e}")
+    return sanic_json({"code": 200, "status": res, "queue": queue})
 
 
 @get_time_async
@@ -760,6 +804,8 @@ async def local_doc_chat(req: request):
     debug_logger.info("chunk_size: %s", chunk_size)
 
     time_record = {}
+    # 优先沿用网关/前端传入的trace id，便于端到端串联
+    trace_id = req.headers.get(TRACE_HEADER) or uuid.uuid4().hex
     if kb_ids:
         not_exist_kb_ids = local_doc_qa.milvus_summary.check_kb_exist(user_id, kb_ids)
         if not_exist_kb_ids:
@@ -788,109 +834,114 @@ async def local_doc_chat(req: request):
         debug_logger.info("start generate answer")
 
         async def generate_answer(response):
-            debug_logger.info("start generate...")
-            async for resp, next_history in local_doc_qa.get_knowledge_based_answer(model=model,
-                                                                                    max_token=max_token,
-                                                                                    kb_ids=kb_ids,
-                                                                                    query=question,
-                                                                                    retriever=local_doc_qa.retriever,
-                                                                                    chat_history=history,
-                                                                                    streaming=True,
-                                                                                    rerank=rerank,
-                                                                                    custom_prompt=custom_prompt,
-                                                                                    time_record=time_record,
-                                                                                    need_web_search=need_web_search,
-                                                                                    hybrid_search=hybrid_search,
-                                                                                    web_chunk_size=chunk_size,
-                                                                                    temperature=temperature,
-                                                                                    api_base=api_base,
-                                                                                    api_key=api_key,
-                                                                                    api_context_length=api_context_length,
-                                                                                    top_p=top_p,
-                                                                                    top_k=top_k
-                                                                                    ):
-                chunk_data = resp["result"]
-                if not chunk_data:
-                    continue
-                chunk_str = chunk_data[6:]
-                if chunk_str.startswith("[DONE]"):
-                    retrieval_documents = format_source_documents(resp["retrieval_documents"])
-                    source_documents = format_source_documents(resp["source_documents"])
-                    result = next_history[-1][1]
-                    # result = resp['result']
-                    time_record['chat_completed'] = round(time.perf_counter() - preprocess_start, 2)
-                    if time_record.get('llm_completed', 0) > 0:
-                        time_record['tokens_per_second'] = round(
-                            len(result) / time_record['llm_completed'], 2)
-                    formatted_time_record = format_time_record(time_record)
-                    chat_data = {'user_id': user_id, 'kb_ids': kb_ids, 'query': question, "model": model,
-                                 "product_source": request_source, 'time_record': formatted_time_record,
-                                 'history': history,
-                                 'condense_question': resp['condense_question'], 'prompt': resp['prompt'],
-                                 'result': result, 'retrieval_documents': retrieval_documents,
-                                 'source_documents': source_documents, 'bot_id': bot_id}
-                    local_doc_qa.milvus_summary.add_qalog(**chat_data)
-                    qa_logger.info("chat_data: %s", chat_data)
-                    debug_logger.info("response: %s", chat_data['result'])
-                    stream_res = {
-                        "code": 200,
-                        "msg": "success stream chat",
-                        "question": question,
-                        "response": result,
-                        "model": model,
-                        "history": next_history,
-                        "condense_question": resp['condense_question'],
-                        "source_documents": source_documents,
-                        "retrieval_documents": retrieval_documents,
-                        "time_record": formatted_time_record,
-                        "show_images": resp.get('show_images', [])
-                    }
-                else:
-                    time_record['rollback_length'] = resp.get('rollback_length', 0)
-                    if 'first_return' not in time_record:
-                        time_record['first_return'] = round(time.perf_counter() - preprocess_start, 2)
-                    chunk_js = json.loads(chunk_str)
-                    delta_answer = chunk_js["answer"]
-                    stream_res = {
-                        "code": 200,
-                        "msg": "success",
-                        "question": "",
-                        "response": delta_answer,
-                        "history": [],
-                        "source_documents": [],
-                        "retrieval_documents": [],
-                        "time_record": format_time_record(time_record),
-                    }
-                await response.write(f"data: {json.dumps(stream_res, ensure_ascii=False)}\n\n")
-                if chunk_str.startswith("[DONE]"):
-                    await response.eof()
-                await asyncio.sleep(0.001)
+            with start_trace('local_doc_chat', trace_id=trace_id, time_record=time_record, user_id=user_id,
+                             model=model, streaming=True, preprocess=time_record['preprocess']):
+                debug_logger.info("start generate...")
+                async for resp, next_history in local_doc_qa.get_knowledge_based_answer(model=model,
+                                                                                        max_token=max_token,
+                                                                                        kb_ids=kb_ids,
+                                                                                        query=question,
+                                                                                        retriever=local_doc_qa.retriever,
+                                                                                        chat_history=history,
+                                                                                        streaming=True,
+                                                                                        rerank=rerank,
+                                                                                        custom_prompt=custom_prompt,
+                                                                                        time_record=time_record,
+                                                                                        need_web_search=need_web_search,
+                                                                                        hybrid_search=hybrid_search,
+                                                                                        web_chunk_size=chunk_size,
+                                                                                        temperature=temperature,
+                                                                                        api_base=api_base,
+                                                                                        api_key=api_key,
+                                                                                        api_context_length=api_context_length,
+                                                                                        top_p=top_p,
+                                                                                        top_k=top_k
+                                                                                        ):
+                    chunk_data = resp["result"]
+                    if not chunk_data:
+                        continue
+                    chunk_str = chunk_data[6:]
+                    if chunk_str.startswith("[DONE]"):
+                        retrieval_documents = format_source_documents(resp["retrieval_documents"])
+                        source_documents = format_source_documents(resp["source_documents"])
+                        result = next_history[-1][1]
+                        # result = resp['result']
+                        time_record['chat_completed'] = round(time.perf_counter() - preprocess_start, 2)
+                        if time_record.get('llm_completed', 0) > 0:
+                            time_record['tokens_per_second'] = round(
+                                len(result) / time_record['llm_completed'], 2)
+                        formatted_time_record = format_time_record(time_record)
+                        chat_data = {'user_id': user_id, 'kb_ids': kb_ids, 'query': question, "model": model,
+                                     "product_source": request_source, 'time_record': formatted_time_record,
+                                     'history': history,
+                                     'condense_question': resp['condense_question'], 'prompt': resp['prompt'],
+                                     'result': result, 'retrieval_documents': retrieval_documents,
+                                     'source_documents': source_documents, 'bot_id': bot_id}
+                        local_doc_qa.milvus_summary.add_qalog(**chat_data)
+                        qa_logger.info("chat_data: %s", chat_data)
+                        debug_logger.info("response: %s", chat_data['result'])
+                        stream_res = {
+                            "code": 200,
+                            "msg": "success stream chat",
+                            "question": question,
+                            "response": result,
+                            "model": model,
+                            "history": next_history,
+                            "condense_question": resp['condense_question'],
+                            "source_documents": source_documents,
+                            "retrieval_documents": retrieval_documents,
+                            "time_record": formatted_time_record,
+                            "trace_id": trace_id,
+                            "show_images": resp.get('show_images', [])
+                        }
+                    else:
+                        time_record['rollback_length'] = resp.get('rollback_length', 0)
+                        if 'first_return' not in time_record:
+                            time_record['first_return'] = round(time.perf_counter() - preprocess_start, 2)
+                        chunk_js = json.loads(chunk_str)
+                        delta_answer = chunk_js["answer"]
+                        stream_res = {
+                            "code": 200,
+                            "msg": "success",
+                            "question": "",
+                            "response": delta_answer,
+                            "history": [],
+                            "source_documents": [],
+                            "retrieval_documents": [],
+                            "time_record": format_time_record(time_record),
+                        }
+                    await response.write(f"data: {json.dumps(stream_res, ensure_ascii=False)}\n\n")
+                    if chunk_str.startswith("[DONE]"):
+                        await response.eof()
+                    await asyncio.sleep(0.001)
 
         response_stream = ResponseStream(generate_answer, content_type='text/event-stream')
         return response_stream
 
     else:
-        async for resp, history in local_doc_qa.get_knowledge_based_answer(model=model,
-                                                                           max_token=max_token,
-                                                                           kb_ids=kb_ids,
-                                                                           query=question,
-                                                                           retriever=local_doc_qa.retriever,
-                                                                           chat_history=history, streaming=False,
-                                                                           rerank=rerank,
-                                                                           custom_prompt=custom_prompt,
-                                                                           time_record=time_record,
-                                                                           only_need_search_results=only_need_search_results,
-                                                                           need_web_search=need_web_search,
-                                                                           hybrid_search=hybrid_search,
-                                                                           web_chunk_size=chunk_size,
-                                                                           temperature=temperature,
-                                                                           api_base=api_base,
-                                                                           api_key=api_key,
-                                                                           api_context_length=api_context_length,
-                                                                           top_p=top_p,
-                                                                           top_k=top_k
-                                                                           ):
-            pass
+        with start_trace('local_doc_chat', trace_id=trace_id, time_record=time_record, user_id=user_id,
+                         model=model, streaming=False, preprocess=time_record['preprocess']):
+            async for resp, history in local_doc_qa.get_knowledge_based_answer(model=model,
+                                                                               max_token=max_token,
+                                                                               kb_ids=kb_ids,
+                                                                               query=question,
+                                                                               retriever=local_doc_qa.retriever,
+                                                                               chat_history=history, streaming=False,
+                                                                               rerank=rerank,
+                                                                               custom_prompt=custom_prompt,
+                                                                               time_record=time_record,
+                                                                               only_need_search_results=only_need_search_results,
+                                                                               need_web_search=need_web_search,
+                                                                               hybrid_search=hybrid_search,
+                                                                               web_chunk_size=chunk_size,
+                                                                               temperature=temperature,
+                                                                               api_base=api_base,
+                                                                               api_key=api_key,
+                                                                               api_context_length=api_context_length,
+                                                                               top_p=top_p,
+                                                                               top_k=top_k
+                                                                               ):
+                pass
         if only_need_search_results:
             return sanic_json(
                 {"code": 200, "question": question, "source_documents": format_source_documents(resp)})
@@ -909,7 +960,7 @@ async def local_doc_chat(req: request):
                            "response": resp["result"], "model": model,
                            "history": history, "condense_question": resp['condense_question'],
                            "source_documents": source_documents, "retrieval_documents": retrieval_documents,
-                           "time_record": formatted_time_record})
+                           "time_record": formatted_time_record, "trace_id": trace_id})
 
 
 @get_time_async
@@ -998,16 +1049,21 @@ async def get_doc_completed(req: request):
     page_id = safe_get(req, 'page_id', 1)  # 默认为第一页
     page_limit = safe_get(req, 'page_limit', 10)  # 默认每页显示10条记录
 
-    sorted_json_datas = local_doc_qa.milvus_summary.get_document_by_file_id(file_id)
-    # completed_doc = local_doc_qa.get_completed_document(file_id)
-    # for json_data in sorted_json_datas:
-    #     completed_text += json_data['kwargs']['page_content'] + '\n'
-    #     if len(completed_text) > 10000:
-    #         return sanic_json({"code": 200, "msg": "failed, completed_text too long, the max length is 10000"})
-    chunks = [json_data['kwargs'] for json_data in sorted_json_datas]
-
-    # 计算总记录数
-    total_count = len(chunks)
+    milvus_summary = local_doc_qa.milvus_summary
+    if milvus_summary.documents_file_id_ready:
+        # chunk序号从0连续编号，第page_id页即从序号(page_id - 1) * page_limit开始，走(file_id, ordinal)索引只取当前页
+        total_count = milvus_summary.count_documents_by_file_id(file_id)
+        chunks = None
+    else:
+        sorted_json_datas = milvus_summary.get_document_by_file_id(file_id) or []
+        # completed_doc = local_doc_qa.get_completed_document(file_id)
+        # for json_data in sorted_json_datas:
+        #     completed_text += json_data['kwargs']['page_content'] + '\n'
+        #     if len(completed_text) > 10000:
+        #         return sanic_json({"code": 200, "msg": "failed, completed_text too long, the max length is 10000"})
+        chunks = [json_data['kwargs'] for json_data in sorted_json_datas]
+        # 计算总记录数
+        total_count = len(chunks)
     # 计算总页数
     total_pages = (total_count + page_limit - 1) // page_limit
     if page_id > total_pages and total_count != 0:
@@ -1016,7 +1072,11 @@ async def get_doc_completed(req: request):
     start_index = (page_id - 1) * page_limit
     end_index = start_index + page_limit
     # 截取当前页的数据
-    current_page_chunks = chunks[start_index:end_index]
+    if chunks is None:
+        current_page_chunks = [json_data['kwargs'] for json_data in
+                               milvus_summary.get_document_page_by_file_id(file_id, start_index, page_limit)]
+    else:
+        current_page_chunks = chunks[start_index:end_index]
     for chunk in current_page_chunks:
         chunk['page_content'] = replace_image_references(chunk['page_content'], file_id)
 
@@ -0,0 +1,61 @@
+"""
+parent chunk的内容寻址存储。
+
+同一份文档上传到多个知识库时，各副本的parent chunk除了归属信息（用户、知识库、文件、headers前缀、token数等）外完全相同。
+开启DOCUMENT_DEDUP后，Documents表每行只保存归属信息和内容hash，正文和其余metadata按hash存入ChunkContent表，
+多个(kb_id, file_id)共享同一份内容：
+    Documents.json_data   {"content_ref": <hash>, "owner": {归属metadata}, "prefixed": 正文是否带headers前缀}
+    ChunkContent.json_data 去掉归属信息和headers前缀后的文档json
+内容的引用计数就是Documents.content_hash上引用它的行数，删除Documents行后计数为0的内容一并删除。
+"""
+from typing import Dict, Tuple
+import hashlib
+import json
+
+__all__ = ['OWNER_METADATA_KEYS', 'split_document_json', 'join_document_json', 'content_hash', 'is_content_ref']
+
+# 随副本变化的metadata：归属信息、含知识库名/文件名的headers及依赖它的token数、每次入库随机生成的表格doc_id
+OWNER_METADATA_KEYS = ('user_id', 'kb_id', 'file_id', 'file_name', 'nos_key', 'file_url', 'headers', 'token_counts',
+                       'table_doc_id', 'doc_id')
+
+
+def headers_prefix(headers) -> str:
+    # 与build_child_documents给parent正文补充的前缀一致
+    return f"[headers]({headers})\n"
+
+
+def split_document_json(doc_json: Dict) -> Tuple[Dict, Dict]:
+    """拆分为(可共享的内容, Documents中保存的引用)，引用中的content_ref由调用方按content_hash填写"""
+    kwargs = doc_json['kwargs']
+    metadata = kwargs.get('metadata') or {}
+    owner = {k: metadata[k] for k in OWNER_METADATA_KEYS if k in metadata}
+    page_content = kwargs.get('page_content', '')
+    prefix = headers_prefix(metadata['headers']) if metadata.get('headers') else None
+    prefixed = bool(prefix) and page_content.startswith(prefix)
+    shared_kwargs = dict(kwargs)
+    shared_kwargs['page_content'] = page_content[len(prefix):] if prefixed else page_content
+    shared_kwargs['metadata'] = {k: v for k, v in metadata.items() if k not in OWNER_METADATA_KEYS}
+    shared = dict(doc_json)
+    shared['kwargs'] = shared_kwargs
+    return shared, {'owner': owner, 'prefixed': prefixed}
+
+
+def join_document_json(shared: Dict, ref: Dict) -> Dict:
+    """由共享内容和Documents中的引用还原完整的文档json（返回新对象，不修改共享内容）"""
+    owner = ref.get('owner', {})
+    kwargs = dict(shared['kwargs'])
+    kwargs['metadata'] = {**kwargs.get('metadata', {}), **owner}
+    if ref.get('prefixed') and owner.get('headers'):
+        kwargs['page_content'] = headers_prefix(owner['headers']) + kwargs['page_content']
+    doc_json = dict(shared)
+    doc_json['kwargs'] = kwargs
+    return doc_json
+
+
+def content_hash(shared: Dict) -> str:
+    raw = json.dumps(shared, ensure_ascii=False, sort_keys=True, default=str)
+    return hashlib.blake2b(raw.encode('utf-8'), digest_size=16).hexdigest()
+
+
+def is_content_ref(json_data) -> bool:
+    return isinstance(json_data, dict) and 'content_ref' in json_data
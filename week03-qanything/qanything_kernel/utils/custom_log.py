@@ -1,5 +1,8 @@
 import logging
+from logging.handlers import QueueHandler, QueueListener
 from concurrent_log_handler import ConcurrentRotatingFileHandler
+import atexit
+import queue
 import time
 import os
 
@@ -33,90 +36,151 @@ qa_log_folder = './logs/qa_logs'
 rerank_log_folder = './logs/rerank_logs'
 embed_log_folder = './logs/embed_logs'
 insert_log_folder = './logs/insert_logs'
-# 确保日志文件夹存在
-if not os.path.exists(debug_log_folder):
-    os.makedirs(debug_log_folder)
-if not os.path.exists(qa_log_folder):
-    os.makedirs(qa_log_folder)
-if not os.path.exists(rerank_log_folder):
-    os.makedirs(rerank_log_folder)
-if not os.path.exists(embed_log_folder):
-    os.makedirs(embed_log_folder)
-if not os.path.exists(insert_log_folder):
-    os.makedirs(insert_log_folder)
 # 定义日志文件的完整路径，包括文件夹和文件名
 # log_file = os.path.join(log_folder, f'log_{current_time}.log')
 
-# 创建一个 logger 实例
-qa_logger = logging.getLogger('qa_logger')
-debug_logger = logging.getLogger('debug_logger')
-rerank_logger = logging.getLogger('rerank_logger')
-embed_logger = logging.getLogger('embed_logger')
-insert_logger = logging.getLogger('insert_logger')
-# 设置 logger 的日志级别为 INFO，即只记录 INFO 及以上级别的日志信息
-qa_logger.setLevel(logging.INFO)
-debug_logger.setLevel(logging.INFO)
-rerank_logger.setLevel(logging.INFO)
-embed_logger.setLevel(logging.INFO)
-insert_logger.setLevel(logging.INFO)
-
-debug_handler = ConcurrentRotatingFileHandler(os.path.join(debug_log_folder, "debug.log"), "a", 64 * 1024 * 1024, 256)
-# 定义日志格式
-# 创建一个自定义字段，用于表示是主进程还是子进程
-process_type = 'MainProcess' if 'SANIC_WORKER_NAME' not in os.environ else os.environ['SANIC_WORKER_NAME']
-
-# 创建一个带有自定义字段的格式器
-formatter = logging.Formatter(f"%(asctime)s - [PID: %(process)d][{process_type}] - [Function: %(funcName)s] - %(levelname)s - %(message)s")
-
-# formatter = logging.Formatter("%(asctime)s - %(name)s - [PID: %(process)d] - %(levelname)s - %(message)s")
-# 设置日志格式
-debug_handler.setFormatter(formatter)
-
-# 将 handler 添加到 logger 中，这样 logger 就可以使用这个 handler 来记录日志了
-debug_logger.addHandler(debug_handler)
-
-qa_handler = ConcurrentRotatingFileHandler(os.path.join(qa_log_folder, "qa.log"), "a", 64 * 1024 * 1024, 256)
-# 定义日志格式
-formatter = logging.Formatter("%(asctime)s %(message)s")
-# 设置日志格式
-qa_handler.setFormatter(formatter)
+# 日志写入方式：默认先写入进程内队列，由后台线程统一落盘，避免业务线程每条日志都去抢跨进程文件锁
+LOG_USE_QUEUE = os.getenv("LOG_USE_QUEUE", "true").lower() == "true"
+# 单条日志消息的最大字符数，超出部分截断（0表示不截断），qa日志记录完整问答，单独放宽
+LOG_MAX_MESSAGE_CHARS = int(os.getenv("LOG_MAX_MESSAGE_CHARS", 4096))
+LOG_MAX_QA_MESSAGE_CHARS = int(os.getenv("LOG_MAX_QA_MESSAGE_CHARS", 65536))
+# 延迟格式化时，列表参数最多保留的元素个数（超出部分以...(+N more)标记）
+LOG_MAX_ARG_ITEMS = int(os.getenv("LOG_MAX_ARG_ITEMS", 64))
 
-# 将 handler 添加到 logger 中，这样 logger 就可以使用这个 handler 来记录日志了
-qa_logger.addHandler(qa_handler)
 
+class TruncatingFormatter(logging.Formatter):
+    """超长的日志消息截断后再输出"""
 
-rerank_handler = ConcurrentRotatingFileHandler(os.path.join(rerank_log_folder, "rerank.log"), "a", 64 * 1024 * 1024, 256)
-# 定义日志格式
-formatter = logging.Formatter("%(asctime)s %(message)s")
-# 设置日志格式
-rerank_handler.setFormatter(formatter)
+    def __init__(self, fmt=None, max_chars=0):
+        super().__init__(fmt)
+        self.max_chars = max_chars
+
+    def formatMessage(self, record):
+        if self.max_chars and len(record.message) > self.max_chars:
+            record.message = record.message[:self.max_chars] + \
+                             f"...[truncated {len(record.message) - self.max_chars} chars]"
+        return super().formatMessage(record)
+
+
+class _TruncatedList(list):
+    """截断后的列表参数，输出时在末尾标出省略的元素个数，不会被误当成完整列表"""
+
+    def __init__(self, items, omitted):
+        super().__init__(items)
+        self.omitted = omitted
+
+    def __repr__(self):
+        return f"{super().__repr__()[:-1]}, ...(+{self.omitted} more)]"
+
+    __str__ = __repr__
+
+
+def _snapshot_arg(arg):
+    # 列表/字典等容器在真正落盘前可能被业务代码修改，这里只做一次C层面的浅拷贝，代价远小于即时格式化
+    if isinstance(arg, list):
+        if LOG_MAX_ARG_ITEMS and len(arg) > LOG_MAX_ARG_ITEMS:
+            return _TruncatedList(arg[:LOG_MAX_ARG_ITEMS], len(arg) - LOG_MAX_ARG_ITEMS)
+        return arg[:]
+    if isinstance(arg, dict):
+        return dict(arg)
+    if isinstance(arg, set):
+        return set(arg)
+    return arg
+
+
+class LazyQueueHandler(QueueHandler):
+    """
+    与标准QueueHandler不同，这里不在调用线程里格式化消息：
+    msg % args 和时间、格式拼接都放到后台监听线程中完成，调用方只付出入队的开销。
+    队列是进程内的，record不需要pickle，exc_info可以原样传递。
+    """
+
+    def prepare(self, record):
+        if record.args:
+            if isinstance(record.args, dict):
+                record.args = {k: _snapshot_arg(v) for k, v in record.args.items()}
+            else:
+                record.args = tuple(_snapshot_arg(arg) for arg in record.args)
+        return record
+
+
+class _LoggerRouter(logging.Handler):
+    """一个进程只启动一个QueueListener，按logger名字把日志分发到各自的文件handler"""
+
+    def __init__(self):
+        super().__init__()
+        self.routes = {}
+
+    def handle(self, record):
+        handler = self.routes.get(record.name)
+        if handler is not None and record.levelno >= handler.level:
+            handler.handle(record)
+        return True
+
+
+_log_router = _LoggerRouter()
+_queue_handlers = []
+_log_queue = None
+_log_listener = None
+
+
+def _start_log_listener():
+    global _log_queue, _log_listener
+    _log_queue = queue.SimpleQueue()
+    for handler in _queue_handlers:
+        handler.queue = _log_queue
+    _log_listener = QueueListener(_log_queue, _log_router)
+    _log_listener.start()
+
+
+def _stop_log_listener():
+    if _log_listener is not None and _log_listener._thread is not None:
+        _log_listener.stop()
+
+
+def _restart_log_listener_after_fork():
+    # fork出的子进程没有父进程的监听线程，队列也可能处于加锁状态，需要重新创建
+    global _log_listener
+    _log_listener = None
+    _start_log_listener()
 
-# 将 handler 添加到 logger 中，这样 logger 就可以使用这个 handler 来记录日志了
-rerank_logger.addHandler(rerank_handler)
 
+def build_logger(name, log_folder, file_name, fmt, max_chars=LOG_MAX_MESSAGE_CHARS, use_queue=LOG_USE_QUEUE):
+    """创建写入 log_folder/file_name 的logger，文件按64MB滚动、保留256份"""
+    if not os.path.exists(log_folder):
+        os.makedirs(log_folder, exist_ok=True)
+    logger = logging.getLogger(name)
+    # 设置 logger 的日志级别为 INFO，即只记录 INFO 及以上级别的日志信息
+    logger.setLevel(logging.INFO)
+    file_handler = ConcurrentRotatingFileHandler(os.path.join(log_folder, file_name), "a", 64 * 1024 * 1024, 256)
+    file_handler.setFormatter(TruncatingFormatter(fmt, max_chars))
+    if use_queue:
+        _log_router.routes[name] = file_handler
+        handler = LazyQueueHandler(_log_queue)
+        _queue_handlers.append(handler)
+    else:
+        handler = file_handler
+    # 将 handler 添加到 logger 中，这样 logger 就可以使用这个 handler 来记录日志了
+    logger.addHandler(handler)
+    logger.propagate = False  # 关闭日志传播
+    return logger
+
+
+if LOG_USE_QUEUE:
+    _start_log_listener()
+    atexit.register(_stop_log_listener)
+    os.register_at_fork(after_in_child=_restart_log_listener_after_fork)
 
-embed_handler = ConcurrentRotatingFileHandler(os.path.join(embed_log_folder, "embed.log"), "a", 64 * 1024 * 1024, 256)
-# 定义日志格式
-formatter = logging.Formatter("%(asctime)s %(message)s")
-# 设置日志格式
-embed_handler.setFormatter(formatter)
-
-# 将 handler 添加到 logger 中，这样 logger 就可以使用这个 handler 来记录日志了
-embed_logger.addHandler(embed_handler)
-
-insert_handler = ConcurrentRotatingFileHandler(os.path.join(insert_log_folder, "insert.log"), "a", 64 * 1024 * 1024, 256)
-# 定义日志格式
-formatter = logging.Formatter(f"%(asctime)s - [PID: %(process)d][{process_type}] - [Function: %(funcName)s] - %(levelname)s - %(message)s")
-# 设置日志格式
-insert_handler.setFormatter(formatter)
+# 创建一个自定义字段，用于表示是主进程还是子进程
+process_type = 'MainProcess' if 'SANIC_WORKER_NAME' not in os.environ else os.environ['SANIC_WORKER_NAME']
+# 创建一个带有自定义字段的格式
+process_format = f"%(asctime)s - [PID: %(process)d][{process_type}] - [Function: %(funcName)s] - %(levelname)s - %(message)s"
+simple_format = "%(asctime)s %(message)s"
 
-# 将 handler 添加到 logger 中，这样 logger 就可以使用这个 handler 来记录日志了
-insert_logger.addHandler(insert_handler)
+debug_logger = build_logger('debug_logger', debug_log_folder, "debug.log", process_format)
+qa_logger = build_logger('qa_logger', qa_log_folder, "qa.log", simple_format, max_chars=LOG_MAX_QA_MESSAGE_CHARS)
+rerank_logger = build_logger('rerank_logger', rerank_log_folder, "rerank.log", simple_format)
+embed_logger = build_logger('embed_logger', embed_log_folder, "embed.log", simple_format)
+insert_logger = build_logger('insert_logger', insert_log_folder, "insert.log", process_format)
 
 print(debug_logger, qa_logger, rerank_logger, embed_logger, insert_logger)
-
-qa_logger.propagate = False  # 关闭日志传播
-debug_logger.propagate = False  # 关闭日志传播
-rerank_logger.propagate = False  # 关闭日志传播
-embed_logger.propagate = False  # 关闭日志传播
-insert_logger.propagate = False  # 关闭日志传播
@@ -1,7 +1,8 @@
 from sanic.request import Request
 from sanic.exceptions import BadRequest
 from qanything_kernel.utils.custom_log import debug_logger, embed_logger, rerank_logger
-from qanything_kernel.configs.model_config import (KB_SUFFIX, UPLOAD_ROOT_PATH, LOCAL_EMBED_PATH, LOCAL_RERANK_PATH)
+from qanything_kernel.configs.model_config import (KB_SUFFIX, UPLOAD_ROOT_PATH, LOCAL_EMBED_PATH, LOCAL_RERANK_PATH,
+                                                   CHUNK_TOKEN_ENCODINGS)
 from transformers import AutoTokenizer
 import pandas as pd
 import inspect
@@ -14,6 +15,7 @@ import re
 import requests
 import aiohttp
 from functools import wraps
+from typing import Optional
 import tiktoken
 from openpyxl.utils import get_column_letter
 from openpyxl import load_workbook
@@ -38,7 +40,8 @@ __all__ = ['isURL', 'get_time', 'get_time_async', 'format_source_documents', 'sa
            'clear_string', 'simplify_filename', 'string_bytes_length', 'correct_kb_id', 'clear_kb_id',
            'clear_string_is_equal', 'export_qalogs_to_excel', 'deduplicate_documents', 'fast_estimate_file_char_count',
            'check_user_id_and_user_info', 'get_table_infos', 'format_time_record', 'get_time_range',
-           'html_to_markdown', "num_tokens_embed", "num_tokens_rerank", "get_all_subpages", "replace_image_references", 'check_and_transform_excel']
+           'html_to_markdown', "num_tokens_embed", "num_tokens_rerank", "get_all_subpages", "replace_image_references", 'check_and_transform_excel',
+           'compute_chunk_token_counts', 'strip_figure_references']
 
 
 def get_invalid_user_id_msg(user_id):
@@ -242,6 +245,30 @@ def num_tokens_rerank(text: str) -> int:
     return len(rerank_tokenizer.encode(text, add_special_tokens=True))
 
 
+def strip_figure_references(text: str) -> str:
+    """去掉图片引用，生成prompt和计算token时都不包含图片"""
+    return re.sub(r'!\[figure]\(.*?\)', '', text)
+
+
+def compute_chunk_token_counts(page_content: str, headers=None, embed_tokens: Optional[int] = None) -> dict:
+    """
+    入库时一次性计算chunk的token数，存入metadata['token_counts']，查询阶段直接读取而不再重复tokenize。
+    LLM编码统计的是去掉图片引用后的内容（与reprocess_source_documents一致），content_len用于查询时校验内容未被修改。
+    embed_tokens: 切分时已经得到的embedding token数，传入则不再重复计算
+    """
+    valid_content = strip_figure_references(page_content)
+    if embed_tokens is None:
+        embed_tokens = num_tokens_embed(page_content)
+    token_counts = {'content_len': len(valid_content), 'embed': embed_tokens}
+    for encoding_name in CHUNK_TOKEN_ENCODINGS:
+        encoding = tiktoken.get_encoding(encoding_name)
+        token_counts[encoding_name] = len(encoding.encode(valid_content, disallowed_special=()))
+        if headers:
+            token_counts['headers_' + encoding_name] = len(encoding.encode(f"headers={headers}",
+                                                                           disallowed_special=()))
+    return token_counts
+
+
 def shorten_data(data):
     # copy data，不要修改原始数据
     data = data.copy()
@@ -0,0 +1,153 @@
+"""
+入库队列的多租户公平调度。原来worker按时间顺序领取gray文件，一个用户一次上传几千个文件，其他用户都要排在后面。
+
+待入库文件按(user_id, kb_id)分成若干流，FairScheduler.select从各流最早的文件中挑出本次要领取的文件：
+- DRR(deficit round robin)：每轮给每个流增加配额，流的队首文件估算字符数不超过累计配额时领取并扣除，
+  大文件要攒几轮配额，小文件多的流一轮能领多个，各用户长期得到的处理量（字符数）大致相同；
+- 用户的配额按权重计算，再在其当前有待入库文件的知识库之间平分，建很多知识库不能多占；
+- 快速通道：不超过INSERT_EXPRESS_MAX_BYTES的小文件在worker的额外并发上按流轮转领取，不必等前面的大文件；
+- 并发上限：用户、知识库在所有worker上同时入库的文件数达到上限后本次跳过，不累积配额。
+调度状态（各流的配额、轮转位置）保存在每个worker的内存中，并发上限按File表中未过期的yellow文件统计。
+"""
+from qanything_kernel.configs.model_config import (INSERT_DRR_QUANTUM, INSERT_EXPRESS_MAX_BYTES,
+                                                   INSERT_USER_MAX_RUNNING, INSERT_KB_MAX_RUNNING,
+                                                   INSERT_TENANT_OVERRIDES, MAX_CHARS)
+from typing import Dict, List, NamedTuple, Optional, Tuple
+import math
+import os
+
+__all__ = ['PendingFile', 'FairScheduler', 'estimate_chars']
+
+# 每字节大致对应的正文字符数（中文UTF-8每字3字节；Office文档是压缩包且含样式；图片只有OCR出的少量文字）
+CHARS_PER_BYTE = {'.txt': 0.5, '.md': 0.5, '.csv': 0.5, '.json': 0.4, '.eml': 0.3, '.pdf': 0.1, '.docx': 0.3,
+                  '.pptx': 0.05, '.xlsx': 0.5, '.jpg': 0.001, '.jpeg': 0.001, '.png': 0.001}
+DEFAULT_CHARS_PER_BYTE = 0.3
+MIN_COST_CHARS = 1000  # 解析、建立连接等固定开销；URL文件上传时大小为0，也按这个估算
+
+Flow = Tuple[str, str]
+
+
+class PendingFile(NamedTuple):
+    id: int
+    user_id: str
+    kb_id: str
+    file_name: str
+    file_size: int
+
+    @property
+    def flow(self) -> Flow:
+        return self.user_id, self.kb_id
+
+
+def estimate_chars(file_name: str, file_size: int) -> int:
+    """按扩展名和文件大小估算解析后的字符数，超过MAX_CHARS的文件解析后会直接失败，按MAX_CHARS计"""
+    ratio = CHARS_PER_BYTE.get(os.path.splitext(file_name or '')[-1].lower(), DEFAULT_CHARS_PER_BYTE)
+    return int(min(max((file_size or 0) * ratio, MIN_COST_CHARS), MAX_CHARS))
+
+
+class _DeficitRoundRobin:
+    def __init__(self):
+        self.deficits: Dict[Flow, float] = {}
+        self.ring: List[Flow] = []  # 轮转顺序，新出现的流排在最后，跨调用保持
+
+    def pick(self, queues: Dict[Flow, List[PendingFile]], slots: int, quantum, cost, admit,
+             on_pick) -> List[PendingFile]:
+        """quantum(flow)、cost(file)：每轮配额和文件开销；admit(flow)：是否未达并发上限；on_pick(file)：领取后计入并发数"""
+        # 没有待入库文件的流出队，配额清零（标准DRR，空闲的流不能攒配额）
+        self.ring = [flow for flow in self.ring if queues.get(flow)]
+        self.ring.extend(flow for flow in queues if queues[flow] and flow not in self.ring)
+        self.deficits = {flow: self.deficits.get(flow, 0.0) for flow in self.ring}
+        picked = []
+        heads = {flow: 0 for flow in self.ring}
+        while len(picked) < slots:
+            eligible = [flow for flow in self.ring if heads[flow] < len(queues[flow]) and admit(flow)]
+            if not eligible:
+                break
+            # 跳过所有流都领不到文件的轮次：一次补足到最先能领取的那一轮
+            rounds = min(max(math.ceil((cost(queues[flow][heads[flow]]) - self.deficits[flow]) / quantum(flow)), 1)
+                         for flow in eligible)
+            for flow in eligible:
+                self.deficits[flow] += quantum(flow) * (rounds - 1)
+            last = None
+            for flow in eligible:
+                self.deficits[flow] += quantum(flow)
+                queue = queues[flow]
+                while (len(picked) < slots and heads[flow] < len(queue) and admit(flow)
+                       and cost(queue[heads[flow]]) <= self.deficits[flow]):
+                    self.deficits[flow] -= cost(queue[heads[flow]])
+                    picked.append(queue[heads[flow]])
+                    on_pick(queue[heads[flow]])
+                    heads[flow] += 1
+                    last = flow
+                if heads[flow] >= len(queue):
+                    self.deficits[flow] = 0.0
+                if len(picked) >= slots:
+                    break
+            if last is not None:
+                # 下次从最后领到文件的流之后开始轮转
+                pos = self.ring.index(last) + 1
+                self.ring = self.ring[pos:] + self.ring[:pos]
+        return picked
+
+
+class FairScheduler:
+    def __init__(self, quantum: int = INSERT_DRR_QUANTUM, express_max_bytes: int = INSERT_EXPRESS_MAX_BYTES,
+                 user_max_running: int = INSERT_USER_MAX_RUNNING, kb_max_running: int = INSERT_KB_MAX_RUNNING,
+                 overrides: Optional[Dict[str, Dict]] = None):
+        self.quantum = quantum
+        self.express_max_bytes = express_max_bytes
+        self.user_max_running = user_max_running
+        self.kb_max_running = kb_max_running
+        self.overrides = INSERT_TENANT_OVERRIDES if overrides is None else overrides
+        self.main = _DeficitRoundRobin()
+        self.express = _DeficitRoundRobin()
+
+    def is_express(self, file: PendingFile) -> bool:
+        return 0 < file.file_size <= self.express_max_bytes
+
+    def weight(self, user_id: str) -> float:
+        return float(self.overrides.get(user_id, {}).get('weight', 1))
+
+    def user_limit(self, user_id: str) -> int:
+        return int(self.overrides.get(user_id, {}).get('max_running', self.user_max_running))
+
+    def select(self, pending: List[PendingFile], running: Dict[Flow, int], free_slots: int,
+               express_slots: int = 0) -> List[Tuple[PendingFile, bool]]:
+        """
+        pending: 各流最早的待入库文件（同一流内按入队顺序），running: 各流在所有worker上正在入库的文件数。
+        返回[(文件, 是否走快速通道)]，先是快速通道领取的小文件，再是普通通道按DRR领取的文件。
+        """
+        user_running, kb_running = {}, dict(running)
+        for (user_id, _), count in running.items():
+            user_running[user_id] = user_running.get(user_id, 0) + count
+        queues: Dict[Flow, List[PendingFile]] = {}
+        for file in pending:
+            queues.setdefault(file.flow, []).append(file)
+        kbs_per_user = {}
+        for user_id, _ in queues:
+            kbs_per_user[user_id] = kbs_per_user.get(user_id, 0) + 1
+
+        def admit(flow: Flow) -> bool:
+            user_limit = self.user_limit(flow[0])
+            if user_limit and user_running.get(flow[0], 0) >= user_limit:
+                return False
+            return not self.kb_max_running or kb_running.get(flow, 0) < self.kb_max_running
+
+        def take(file: PendingFile):
+            # 同一次调度中领取的文件也计入并发数
+            user_running[file.user_id] = user_running.get(file.user_id, 0) + 1
+            kb_running[file.flow] = kb_running.get(file.flow, 0) + 1
+
+        selected = []
+        if express_slots > 0:
+            small = {flow: [file for file in files if self.is_express(file)] for flow, files in queues.items()}
+            # 快速通道按文件个数在流之间轮转
+            selected = [(file, True) for file in self.express.pick(small, express_slots,
+                                                                   lambda flow: self.weight(flow[0]),
+                                                                   lambda file: 1, admit, take)]
+        taken = {file.id for file, _ in selected}
+        remaining = {flow: [file for file in files if file.id not in taken] for flow, files in queues.items()}
+        selected += [(file, False) for file in self.main.pick(
+            remaining, free_slots, lambda flow: self.quantum * self.weight(flow[0]) / kbs_per_user[flow[0]],
+            lambda file: estimate_chars(file.file_name, file.file_size), admit, take)]
+        return selected
@@ -0,0 +1,91 @@
+"""
+入库任务的唤醒信号。入库服务的每个worker在INSERT_WAKEUP_DIR下监听一个UNIX datagram socket，
+API服务写入File表后调用notify_insert_workers()给所有worker发一个字节，worker收到后立即领取任务，
+不必等到下一次轮询。信号只是提示，丢失时worker仍会按INSERT_POLL_INTERVAL轮询兜底。
+"""
+import asyncio
+import os
+import socket
+from qanything_kernel.configs.model_config import INSERT_WAKEUP_DIR
+from qanything_kernel.utils.custom_log import debug_logger, insert_logger
+
+__all__ = ['notify_insert_workers', 'InsertWakeupListener']
+
+_AF_UNIX = getattr(socket, 'AF_UNIX', None)
+
+
+def notify_insert_workers() -> int:
+    """非阻塞地唤醒本机所有入库worker，返回成功发送的个数；入库服务未启动或不在本机时返回0"""
+    if _AF_UNIX is None:
+        return 0
+    try:
+        names = [name for name in os.listdir(INSERT_WAKEUP_DIR) if name.endswith('.sock')]
+    except FileNotFoundError:
+        return 0
+    sent = 0
+    with socket.socket(_AF_UNIX, socket.SOCK_DGRAM) as sock:
+        sock.setblocking(False)
+        for name in names:
+            path = os.path.join(INSERT_WAKEUP_DIR, name)
+            try:
+                sock.sendto(b'1', path)
+                sent += 1
+            except BlockingIOError:
+                sent += 1  # 接收缓冲区已满，说明该worker已有未处理的唤醒信号
+            except (ConnectionRefusedError, FileNotFoundError):
+                # worker已退出，清理残留的socket文件
+                try:
+                    os.unlink(path)
+                except OSError:
+                    pass
+            except OSError as e:
+                debug_logger.warning(f"notify insert worker {path} failed: {e}")
+    return sent
+
+
+class InsertWakeupListener:
+    """在当前事件循环上监听唤醒信号，收到后置位event，由调用方clear"""
+
+    def __init__(self, name: str):
+        self.path = os.path.join(INSERT_WAKEUP_DIR, f'{name}.sock')
+        self.event = asyncio.Event()
+        self._sock = None
+
+    def start(self):
+        if _AF_UNIX is None:
+            insert_logger.warning("UNIX socket is not supported, insert worker only polls")
+            return
+        try:
+            os.makedirs(INSERT_WAKEUP_DIR, exist_ok=True)
+            if os.path.exists(self.path):
+                os.unlink(self.path)
+            sock = socket.socket(_AF_UNIX, socket.SOCK_DGRAM)
+            sock.setblocking(False)
+            sock.bind(self.path)
+            asyncio.get_running_loop().add_reader(sock.fileno(), self._on_readable)
+            self._sock = sock
+            insert_logger.info(f"insert wakeup listener: {self.path}")
+        except OSError as e:
+            insert_logger.warning(f"start insert wakeup listener failed, only poll: {e}")
+
+    def _on_readable(self):
+        try:
+            while True:
+                self._sock.recv(64)
+        except (BlockingIOError, InterruptedError):
+            pass
+        self.event.set()
+
+    def close(self):
+        if self._sock is None:
+            return
+        try:
+            asyncio.get_running_loop().remove_reader(self._sock.fileno())
+        except RuntimeError:
+            pass
+        self._sock.close()
+        self._sock = None
+        try:
+            os.unlink(self.path)
+        except OSError:
+            pass
@@ -0,0 +1,100 @@
+"""
+Documents.json_data的压缩编解码
+
+列类型仍是LONGTEXT，压缩后的字节用base64编码，通过前缀区分存储格式，老数据无需迁移即可读取：
+    {...}            未压缩的json
+    zstd:<base64>    zstd压缩
+    zlib:<base64>    zlib压缩
+"""
+import base64
+import json
+import threading
+import zlib
+
+from qanything_kernel.configs.model_config import (DOCUMENT_COMPRESSION, DOCUMENT_COMPRESSION_LEVEL,
+                                                   DOCUMENT_COMPRESSION_MIN_BYTES)
+from qanything_kernel.utils.custom_log import debug_logger
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+__all__ = ['encode_json_data', 'decode_json_data', 'json_data_format', 'resolve_compression', 'compression_level']
+
+ZSTD_PREFIX = 'zstd:'
+ZLIB_PREFIX = 'zlib:'
+# 各算法支持的压缩级别，DOCUMENT_COMPRESSION_LEVEL超出范围时截断
+LEVEL_RANGES = {'zstd': (1, 22), 'zlib': (1, 9)}
+
+# zstandard的压缩/解压对象不能被多个线程同时使用，每个线程各自持有一份
+_local = threading.local()
+
+
+def compression_level(compression: str, level: int = DOCUMENT_COMPRESSION_LEVEL) -> int:
+    if compression not in LEVEL_RANGES:
+        return level
+    low, high = LEVEL_RANGES[compression]
+    return min(max(level, low), high)
+
+
+def resolve_compression(compression: str = DOCUMENT_COMPRESSION, level: int = DOCUMENT_COMPRESSION_LEVEL) -> str:
+    compression = (compression or 'none').lower()
+    if compression == 'zstd' and zstandard is None:
+        debug_logger.warning('zstandard is not installed, fall back to zlib for Documents.json_data')
+        compression = 'zlib'
+    if compression not in ('zstd', 'zlib', 'none'):
+        raise ValueError(f'unsupported document compression: {compression}')
+    if compression_level(compression, level) != level:
+        # 例如按zstd配置了19，退回zlib后zlib.compress会直接报错
+        debug_logger.warning(f'DOCUMENT_COMPRESSION_LEVEL={level} is out of range for {compression}, '
+                             f'use {compression_level(compression, level)}')
+    return compression
+
+
+_compression = resolve_compression()
+
+
+def _zstd_compressor():
+    if getattr(_local, 'compressor', None) is None:
+        _local.compressor = zstandard.ZstdCompressor(level=compression_level('zstd'))
+    return _local.compressor
+
+
+def _zstd_decompressor():
+    if getattr(_local, 'decompressor', None) is None:
+        _local.decompressor = zstandard.ZstdDecompressor()
+    return _local.decompressor
+
+
+def encode_json_data(json_data, compression: str = None) -> str:
+    """把文档json序列化为存入Documents.json_data的字符串"""
+    compression = _compression if compression is None else compression
+    raw = json.dumps(json_data, ensure_ascii=False)
+    if compression == 'none':
+        return raw
+    raw_bytes = raw.encode('utf-8')
+    if len(raw_bytes) < DOCUMENT_COMPRESSION_MIN_BYTES:
+        return raw
+    if compression == 'zstd':
+        return ZSTD_PREFIX + base64.b64encode(_zstd_compressor().compress(raw_bytes)).decode('ascii')
+    return ZLIB_PREFIX + base64.b64encode(zlib.compress(raw_bytes, compression_level('zlib'))).decode('ascii')
+
+
+def decode_json_data(stored: str):
+    """解析Documents.json_data，兼容未压缩和各种压缩格式"""
+    if stored.startswith(ZSTD_PREFIX):
+        if zstandard is None:
+            raise RuntimeError('Documents.json_data is zstd compressed but zstandard is not installed')
+        return json.loads(_zstd_decompressor().decompress(base64.b64decode(stored[len(ZSTD_PREFIX):])))
+    if stored.startswith(ZLIB_PREFIX):
+        return json.loads(zlib.decompress(base64.b64decode(stored[len(ZLIB_PREFIX):])))
+    return json.loads(stored)
+
+
+def json_data_format(stored: str) -> str:
+    if stored.startswith(ZSTD_PREFIX):
+        return 'zstd'
+    if stored.startswith(ZLIB_PREFIX):
+        return 'zlib'
+    return 'none'
@@ -1,9 +1,17 @@
 import json
-from typing import Any, Dict, List, Optional, Sequence
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Sequence, Tuple
 from langchain_core.documents import Document
 from langchain_community.document_loaders.base import BaseLoader
 from langchain_community.document_loaders.helpers import detect_file_encodings
+from qanything_kernel.utils.splitter import LineGrouper
+from qanything_kernel.utils.loader.table_loader import detect_text_encoding
 from io import TextIOWrapper
+import codecs
+
+try:
+    import ijson
+except ImportError:  # 没有安装ijson时整体json.load后按同样的事件流展开
+    ijson = None
 
 
 class JSONLoader(BaseLoader):
@@ -114,6 +122,167 @@ class JSONLoader(BaseLoader):
                 items.append(f"{new_key}: {v}")
         return items
 
+_END = object()
+CYCLE_MARK = '<cycle>'
+
+
+def iter_object_events(obj) -> Iterator[Tuple[str, Any]]:
+    """
+    对已解析的对象生成与ijson.parse相同的(event, value)事件流，用显式栈代替递归，任意深度都不会栈溢出；
+    当前路径上已经出现过的容器（循环引用）作为CYCLE_MARK叶子输出，不再展开。
+    """
+    on_path = set()
+    stack = [(None, iter([(None, obj)]), False)]  # (容器id, 子元素迭代器, 是否dict)
+    while stack:
+        container_id, children, is_map = stack[-1]
+        child = next(children, _END)
+        if child is _END:
+            stack.pop()
+            if container_id is not None:
+                on_path.discard(container_id)
+                yield ('end_map' if is_map else 'end_array'), None
+            continue
+        key, value = child
+        if is_map:
+            yield 'map_key', key
+        if isinstance(value, (dict, list, tuple)):
+            if id(value) in on_path:
+                yield 'string', CYCLE_MARK
+                continue
+            on_path.add(id(value))
+            if isinstance(value, dict):
+                yield 'start_map', None
+                stack.append((id(value), iter(value.items()), True))
+            else:
+                yield 'start_array', None
+                stack.append((id(value), iter(enumerate(value)), False))
+        else:
+            yield 'string' if isinstance(value, str) else 'number', value
+
+
+class _JSONFlattener:
+    """
+    把事件流展开为"路径: 值"的行并分块。根容器的每个子元素（数组元素或顶层key）是一条记录：
+    - 记录不超过预算时整条记录占一行（与JSONLoader一样是"k: v & k.sub: v"，去掉了前后的分隔线），多条记录攒成一块；
+    - 记录超过预算时按路径分块：每块以"# 记录路径"开头，叶子按记录内的相对路径逐行输出，不必等整条记录读完。
+    超过max_depth的路径只保留前max_depth层，后面用"..."代替。
+    """
+
+    def __init__(self, token_budget: int, max_depth: int):
+        self.grouper = LineGrouper(token_budget)
+        # 按字符数判断记录是否超出预算：embedding模型的token至少覆盖一个字符，字符数不超过预算时token数也不会超
+        self.record_chars_budget = token_budget
+        self.max_depth = max_depth
+        self.path: List[Any] = []
+        self.frames: List[List] = []  # [是否dict, 数组当前下标]
+        self.record_lines: List[str] = []
+        self.record_chars = 0
+        self.record_split = False
+        self.truncated = 0  # 路径超过max_depth的叶子数
+
+    def feed(self, events: Iterable[Tuple[str, Any]]) -> Iterator[Document]:
+        for event, value in events:
+            if event == 'map_key':
+                self.path[-1] = value
+            elif event in ('start_map', 'start_array'):
+                self._begin_value()
+                self.frames.append([event == 'start_map', -1])
+                self.path.append(None)
+            elif event in ('end_map', 'end_array'):
+                self.frames.pop()
+                self.path.pop()
+                if len(self.frames) == 1:
+                    yield from self._end_record()
+            else:
+                self._begin_value()
+                yield from self._leaf(value)
+                if len(self.frames) <= 1:
+                    yield from self._end_record()
+        yield from self._docs(self.grouper.flush(), self.grouper.head)
+
+    def _begin_value(self):
+        if self.frames and not self.frames[-1][0]:
+            self.frames[-1][1] += 1
+            self.path[-1] = self.frames[-1][1]
+
+    def _leaf(self, value) -> Iterator[Document]:
+        keys = tuple(self.path)
+        if len(keys) > self.max_depth:
+            keys = keys[:self.max_depth] + ('...',)
+            self.truncated += 1
+        if self.record_split:
+            yield from self._add(self._line(keys[1:], value))
+            return
+        self.record_lines.append((keys, value))
+        self.record_chars += len(str(value)) + sum(len(str(k)) + 1 for k in keys)
+        if self.record_chars > self.record_chars_budget:
+            # 整条记录放不进一块，改为按路径分块，已读的行先输出
+            self.record_split = True
+            yield from self._set_head(f'# {self.path[0]}' if self.path else '')
+            lines, self.record_lines, self.record_chars = self.record_lines, [], 0
+            for keys, value in lines:
+                yield from self._add(self._line(keys[1:], value))
+
+    def _end_record(self) -> Iterator[Document]:
+        if self.record_split:
+            # 按路径分块的记录结束，剩余的行按记录路径输出，之后的记录重新攒成一行
+            yield from self._set_head(None)
+            self.record_split = False
+        elif self.record_lines:
+            # 根是数组时记录的下标没有含义，与JSONLoader一样不写；根是对象时保留顶层key
+            skip = 0 if self.frames and self.frames[0][0] else 1
+            yield from self._add(' & '.join(self._line(keys[skip:], value) for keys, value in self.record_lines))
+        self.record_lines, self.record_chars = [], 0
+
+    @staticmethod
+    def _line(keys, value) -> str:
+        key = '.'.join(str(k) for k in keys)
+        return f'{key}: {value}' if key else str(value)
+
+    def _add(self, line: str) -> Iterator[Document]:
+        head = self.grouper.head
+        yield from self._docs(self.grouper.add(line), head)
+
+    def _set_head(self, head: Optional[str]) -> Iterator[Document]:
+        # 之前攒的行按旧的块头输出
+        old_head = self.grouper.head
+        yield from self._docs(self.grouper.set_head(head), old_head)
+
+    @staticmethod
+    def _docs(chunks: List[str], head: str) -> Iterator[Document]:
+        for chunk in chunks:
+            yield Document(page_content=chunk, metadata={'title_lst': [head] if head else [], 'has_table': False})
+
+
+class StreamingJSONLoader(BaseLoader):
+    """
+    ijson流式解析JSON文件，按事件流迭代展开（不递归），直接输出按子chunk预算分好的块，不再每个叶子/记录一个Document。
+    内存占用只与当前块和路径深度有关；UTF-8以外的编码或没有安装ijson时整体读入后按同样的方式展开。
+    """
+
+    def __init__(self, file_path: str, token_budget: int, max_depth: int = 64):
+        self.file_path = file_path
+        self.token_budget = token_budget
+        self.max_depth = max_depth
+
+    def lazy_load(self) -> Iterator[Document]:
+        flattener = _JSONFlattener(self.token_budget, self.max_depth)
+        encoding = detect_text_encoding(self.file_path)
+        if ijson is not None and encoding == 'utf-8-sig':
+            with open(self.file_path, 'rb') as f:
+                if f.read(3) != codecs.BOM_UTF8:
+                    f.seek(0)
+                events = ((event, value) for _, event, value in ijson.parse(f, use_float=True))
+                yield from flattener.feed(events)
+        else:
+            with open(self.file_path, 'r', encoding=encoding) as f:
+                data = json.load(f)
+            yield from flattener.feed(iter_object_events(data))
+
+    def load(self) -> List[Document]:
+        return list(self.lazy_load())
+
+
 if __name__ == "__main__":
     loader = JSONLoader("test/test.json")
     docs = loader.load()
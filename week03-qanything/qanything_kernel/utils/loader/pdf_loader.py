@@ -3,6 +3,8 @@ from typing import List, Callable
 
 from langchain.document_loaders.unstructured import UnstructuredFileLoader
 from unstructured.partition.text import partition_text
+from qanything_kernel.configs.model_config import OCR_BATCH_SIZE, OCR_PDF_DPI
+from qanything_kernel.utils.ocr_client import ocr_images
 import os
 import fitz
 from tqdm import tqdm
@@ -28,18 +30,29 @@ class UnstructuredPaddlePDFLoader(UnstructuredFileLoader):
             doc = fitz.open(filepath)
             txt_file_path = os.path.join(full_dir_path, "{}.txt".format(os.path.split(filepath)[-1]))
             img_name = os.path.join(full_dir_path, 'tmp.png')
+            page_texts = []
+            # 没有文字层的页面（扫描件）渲染成png，攒够一批再发给OCR服务，只在内存中保留一批图片
+            pending_pages, pending_images = [], []
+
+            def flush_ocr():
+                for page_no, result in zip(pending_pages, ocr_images(pending_images)):
+                    page_texts[page_no] = '\n'.join(line for line in result or [] if line)
+                pending_pages.clear()
+                pending_images.clear()
+
+            for i in tqdm(range(doc.page_count)):
+                page = doc.load_page(i)
+                result = page.get_text()
+                page_texts.append(result)
+                if not result.strip() and page.get_images():
+                    pending_pages.append(i)
+                    pending_images.append(page.get_pixmap(dpi=OCR_PDF_DPI).tobytes('png'))
+                    if len(pending_images) >= OCR_BATCH_SIZE:
+                        flush_ocr()
+            if pending_images:
+                flush_ocr()
             with open(txt_file_path, 'w', encoding='utf-8') as fout:
-                for i in tqdm(range(doc.page_count)):
-                    page = doc.load_page(i)
-                    # pix = page.get_pixmap(dpi=300)
-                    # img = np.frombuffer(pix.samples, dtype=np.uint8).reshape((pix.h, pix.w, pix.n))
-                    #
-                    # img_data = {"img64": base64.b64encode(img).decode("utf-8"), "height": pix.h, "width": pix.w,
-                    #             "channels": pix.n}
-                    # result = self.ocr_engine(img_data)
-                    # result = [line for line in result if line]
-                    # ocr_result = [i[1][0] for line in result for i in line]
-                    result = page.get_text()
+                for result in page_texts:
                     fout.write(result + '\n\n')
             if os.path.exists(img_name):
                 os.remove(img_name)
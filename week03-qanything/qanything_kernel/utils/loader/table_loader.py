@@ -0,0 +1,153 @@
+"""
+CSV/XLSX按行流式读取，边读边把若干行攒成markdown表格块，读取时只保留攒好的块，不再有整表的中间结果。
+
+原来XLSX先用openpyxl把整个sheet读成列表转成markdown文件，再整体解析、按表格切分（失败时pandas读入整个sheet再转CSV）；
+CSV每行生成一个Document，全部读完后再合并。大表格会让入库进程OOM。
+这里每个块都以表头开头（XLSX还带sheet名），按子chunk的token预算切分，单独检索到任意一块时都能看到列名。
+"""
+from qanything_kernel.utils.splitter import LineGrouper
+from langchain_core.documents import Document
+from langchain_community.document_loaders.base import BaseLoader
+from typing import Dict, Iterator, List, Optional, Sequence
+import codecs
+import csv
+import openpyxl
+import re
+
+WHITESPACE_PATTERN = re.compile(r'\s+')
+
+
+def clean_cell(cell) -> str:
+    if cell is None:
+        return ''
+    # 单元格内的换行、制表符会破坏markdown表格，合并为一个空格
+    return WHITESPACE_PATTERN.sub(' ', str(cell)).strip()
+
+
+def trim_row(cells: List[str]) -> List[str]:
+    """去掉行尾的空单元格（openpyxl按sheet的最大列数返回每一行）"""
+    end = len(cells)
+    while end and not cells[end - 1]:
+        end -= 1
+    return cells[:end]
+
+
+def markdown_row(cells: Sequence[str], width: int) -> str:
+    return '| ' + ' | '.join(list(cells) + [''] * (width - len(cells))) + ' |'
+
+
+def table_head(header: List[str], title: str = '') -> str:
+    lines = [title] if title else []
+    lines.append(markdown_row(header, len(header)))
+    lines.append('|' + '|'.join(['---'] * len(header)) + '|')
+    return '\n'.join(lines)
+
+
+def detect_text_encoding(file_path: str, candidates: Sequence[str] = ('utf-8-sig', 'gb18030'),
+                         block_size: int = 1 << 20) -> str:
+    """按块增量解码校验编码，不把整个文件读入内存；都不合法时用latin-1（任意字节都能解码）"""
+    for encoding in candidates:
+        decoder = codecs.getincrementaldecoder(encoding)()
+        try:
+            with open(file_path, 'rb') as f:
+                while block := f.read(block_size):
+                    decoder.decode(block)
+                decoder.decode(b'', final=True)
+            return encoding
+        except UnicodeDecodeError:
+            continue
+    return 'latin-1'
+
+
+class _TableStream:
+    """一张表（CSV文件或XLSX的一个sheet）：第一个非空行作为表头，之后的行按预算攒成块"""
+
+    def __init__(self, token_budget: int, title: str = '', metadata: Optional[Dict] = None):
+        self.grouper = LineGrouper(token_budget)
+        self.title = title
+        self.metadata = metadata or {}
+        self.header: Optional[List[str]] = None
+        self.rows = 0
+
+    def add(self, cells: List[str]) -> Iterator[Document]:
+        if not cells:
+            return
+        if self.header is None:
+            self.header = cells
+            self.grouper.set_head(table_head(self.header, self.title))
+            return
+        if len(cells) > len(self.header):
+            # 后面的行比表头宽，补上空列名，之后的块用新的表头
+            self.header = self.header + [''] * (len(cells) - len(self.header))
+            yield from self._docs(self.grouper.set_head(table_head(self.header, self.title)))
+        self.rows += 1
+        yield from self._docs(self.grouper.add(markdown_row(cells, len(self.header))))
+
+    def finish(self) -> Iterator[Document]:
+        if self.header is not None and not self.rows:
+            # 只有表头的表也保留
+            yield from self._docs([table_head(self.header, self.title)])
+        yield from self._docs(self.grouper.flush())
+
+    def _docs(self, chunks: List[str]) -> Iterator[Document]:
+        for chunk in chunks:
+            yield Document(page_content=chunk, metadata={'title_lst': [self.title] if self.title else [],
+                                                         'has_table': True, **self.metadata})
+
+
+class StreamingCSVLoader(BaseLoader):
+    """
+    csv.reader逐行读取，与CSVLoader一样用同一列上一个非空值填充空单元格（合并单元格导出的CSV）。
+    """
+
+    def __init__(self, file_path: str, token_budget: int, encoding: Optional[str] = None,
+                 csv_args: Optional[Dict] = None):
+        self.file_path = file_path
+        self.token_budget = token_budget
+        self.encoding = encoding
+        self.csv_args = csv_args or {}
+
+    def lazy_load(self) -> Iterator[Document]:
+        encoding = self.encoding or detect_text_encoding(self.file_path)
+        table = _TableStream(self.token_budget, metadata={'csv_source': self.file_path})
+        last_non_empty = []
+        with open(self.file_path, newline='', encoding=encoding) as csvfile:
+            for row in csv.reader(csvfile, **self.csv_args):
+                cells = trim_row([clean_cell(cell) for cell in row])
+                if table.header is not None and cells:
+                    cells += [''] * (len(table.header) - len(cells))
+                    last_non_empty += [''] * (len(cells) - len(last_non_empty))
+                    for i, cell in enumerate(cells):
+                        if cell:
+                            last_non_empty[i] = cell
+                        else:
+                            cells[i] = last_non_empty[i]
+                yield from table.add(cells)
+        yield from table.finish()
+
+    def load(self) -> List[Document]:
+        return list(self.lazy_load())
+
+
+class StreamingXLSXLoader(BaseLoader):
+    """openpyxl只读模式逐行读取各个sheet，每个块以sheet名和表头开头"""
+
+    def __init__(self, file_path: str, token_budget: int):
+        self.file_path = file_path
+        self.token_budget = token_budget
+
+    def lazy_load(self) -> Iterator[Document]:
+        workbook = openpyxl.load_workbook(self.file_path, read_only=True, data_only=True)
+        try:
+            for sheet in workbook.worksheets:
+                # 有的生成工具写入的dimension不准确，只读模式会按它截断，重置后按实际内容读取
+                sheet.reset_dimensions()
+                table = _TableStream(self.token_budget, title=f'# {sheet.title}')
+                for row in sheet.iter_rows(values_only=True):
+                    yield from table.add(trim_row([clean_cell(cell) for cell in row]))
+                yield from table.finish()
+        finally:
+            workbook.close()
+
+    def load(self) -> List[Document]:
+        return list(self.lazy_load())
@@ -0,0 +1,86 @@
+"""
+入库时调用OCR服务。
+
+原来每张图片base64编码后作为表单字段单独发一个/ocr请求：请求体比图片大三分之一以上，两端都要编解码，每张图片一次往返。
+ocr_images把同一文档的多张图片按OCR_BATCH_SIZE、OCR_BATCH_MAX_BYTES分批，以multipart原始字节发给/ocr_batch，
+结果与输入顺序一致；OCR服务还是旧版本（没有/ocr_batch）时退回逐张调用/ocr，某一批请求失败时该批逐张重试。
+"""
+from qanything_kernel.configs.model_config import LOCAL_OCR_SERVICE_URL, OCR_BATCH_SIZE, OCR_BATCH_MAX_BYTES
+from qanything_kernel.utils.custom_log import insert_logger
+from qanything_kernel.utils.tracing import get_trace_headers
+from typing import List, Optional, Sequence
+import base64
+import requests
+import traceback
+
+__all__ = ['get_ocr_result_sync', 'ocr_images', 'batch_images']
+
+# 解析子进程内复用连接
+_session = requests.Session()
+_batch_supported = True
+
+
+def get_ocr_result_sync(image_data):
+    try:
+        response = _session.post(f"http://{LOCAL_OCR_SERVICE_URL}/ocr", data=image_data, headers=get_trace_headers(),
+                                 timeout=120)
+        response.raise_for_status()  # 如果请求返回了错误状态码，将会抛出异常
+        return response.json()['result']
+    except Exception as e:
+        insert_logger.warning(f"ocr error: {traceback.format_exc()}")
+        return None
+
+
+def batch_images(images: Sequence[bytes], batch_size: int = OCR_BATCH_SIZE,
+                 max_bytes: int = OCR_BATCH_MAX_BYTES) -> List[List[int]]:
+    """按图片数和总字节数分批，返回每批图片的下标"""
+    batches, batch, batch_bytes = [], [], 0
+    for i, image in enumerate(images):
+        if batch and (len(batch) >= batch_size or batch_bytes + len(image) > max_bytes):
+            batches.append(batch)
+            batch, batch_bytes = [], 0
+        batch.append(i)
+        batch_bytes += len(image)
+    if batch:
+        batches.append(batch)
+    return batches
+
+
+def _post_batch(images: List[bytes]) -> Optional[List[Optional[List[str]]]]:
+    """返回None表示服务端不支持/ocr_batch"""
+    files = [('images', (f'{i}', image, 'application/octet-stream')) for i, image in enumerate(images)]
+    # 单张图片/ocr的超时是120秒，批量请求按图片数放宽
+    response = _session.post(f"http://{LOCAL_OCR_SERVICE_URL}/ocr_batch", files=files, headers=get_trace_headers(),
+                             timeout=120 + 10 * len(images))
+    if response.status_code in (404, 405):
+        return None
+    response.raise_for_status()
+    results = response.json()['results']
+    if len(results) != len(images):
+        raise ValueError(f'ocr_batch returned {len(results)} results for {len(images)} images')
+    for error in response.json().get('errors', []):
+        insert_logger.warning(f"ocr_batch image error: {error}")
+    return results
+
+
+def ocr_images(images: Sequence[bytes]) -> List[Optional[List[str]]]:
+    """每张图片（编码后的jpg/png等字节）识别出的文本行，顺序与输入一致；失败的图片为None"""
+    global _batch_supported
+    results: List[Optional[List[str]]] = [None] * len(images)
+    for batch in batch_images(images):
+        if _batch_supported:
+            try:
+                batch_results = _post_batch([images[i] for i in batch])
+            except Exception as e:
+                # 超时、5xx等整批失败时逐张重试，不让一张图片的问题拖累同批的其他图片
+                insert_logger.warning(f"ocr_batch error, retry {len(batch)} images via /ocr: {traceback.format_exc()}")
+            else:
+                if batch_results is not None:
+                    for i, result in zip(batch, batch_results):
+                        results[i] = result
+                    continue
+                insert_logger.warning('ocr server has no /ocr_batch, fall back to /ocr per image')
+                _batch_supported = False
+        for i in batch:
+            results[i] = get_ocr_result_sync({"img64": base64.b64encode(images[i]).decode("utf-8")})
+    return results
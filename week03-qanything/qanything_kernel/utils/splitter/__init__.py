@@ -1,2 +1,4 @@
 from .chinese_text_splitter import ChineseTextSplitter
 from .ZhTitleEnhance import zh_title_enhance
+from .token_offset_splitter import TokenOffsetTextSplitter
+from .line_grouper import LineGrouper
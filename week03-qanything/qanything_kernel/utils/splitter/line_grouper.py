@@ -0,0 +1,64 @@
+from qanything_kernel.utils.general_utils import embedding_tokenizer
+from typing import List, Optional
+
+
+class LineGrouper:
+    """
+    把流式产生的行（表格行、JSON叶子等）攒成不超过token_budget的块，每块以head开头（sheet名和表头、JSON路径等），
+    单独检索到任意一块时都能看到列名。行先缓存batch_size条再批量tokenize，块内token数按各行之和累加，
+    不对拼接后的文本重复tokenize；单行超过预算时单独成块，由后续的切分处理。
+    """
+
+    def __init__(self, token_budget: int, batch_size: int = 1000, tokenizer=None):
+        self.token_budget = token_budget
+        self.batch_size = batch_size
+        self.tokenizer = tokenizer or embedding_tokenizer
+        # 与num_tokens_embed一致，每块计入一次[CLS]/[SEP]等特殊token
+        self.special_tokens = len(self.tokenizer.encode('', add_special_tokens=True))
+        self.head = ''
+        self.head_tokens = 0
+        self.pending: List[str] = []  # 还没计算token数的行
+        self.lines: List[str] = []  # 当前块的行
+        self.tokens = 0
+        self.chunks = 0
+
+    def count(self, texts: List[str]) -> List[int]:
+        if getattr(self.tokenizer, 'is_fast', False):
+            return [len(ids) for ids in self.tokenizer(texts, add_special_tokens=False)['input_ids']]
+        return [len(self.tokenizer.encode(text, add_special_tokens=False)) for text in texts]
+
+    def set_head(self, head: Optional[str]) -> List[str]:
+        """更换块头（新的sheet、表头变宽），之前攒的行先按旧块头输出"""
+        chunks = self.flush()
+        self.head = head or ''
+        self.head_tokens = self.count([self.head])[0] if self.head else 0
+        return chunks
+
+    def add(self, line: str) -> List[str]:
+        """返回因这一行而攒满的块（通常为空）"""
+        self.pending.append(line)
+        if len(self.pending) >= self.batch_size:
+            return self._drain()
+        return []
+
+    def flush(self) -> List[str]:
+        chunks = self._drain() if self.pending else []
+        if self.lines:
+            chunks.append(self._emit())
+        return chunks
+
+    def _drain(self) -> List[str]:
+        chunks = []
+        for line, tokens in zip(self.pending, self.count(self.pending)):
+            if self.lines and self.special_tokens + self.head_tokens + self.tokens + tokens > self.token_budget:
+                chunks.append(self._emit())
+            self.lines.append(line)
+            self.tokens += tokens
+        self.pending = []
+        return chunks
+
+    def _emit(self) -> str:
+        text = '\n'.join([self.head, *self.lines]) if self.head else '\n'.join(self.lines)
+        self.lines, self.tokens = [], 0
+        self.chunks += 1
+        return text
@@ -0,0 +1,128 @@
+from langchain.text_splitter import TextSplitter
+from langchain.docstore.document import Document
+from typing import Iterable, List, Optional, Tuple
+from bisect import bisect_left, bisect_right
+import re
+from qanything_kernel.utils.general_utils import embedding_tokenizer
+
+
+class TokenOffsetTextSplitter(TextSplitter):
+    """
+    切分规则与RecursiveCharacterTextSplitter(length_function=num_tokens_embed)一致（分隔符保留在下一段开头、去掉首尾空白），
+    区别是每段文本只tokenize一次：根据token的字符offset计算任意字符区间的token数，递归切分和合并都在字符区间上进行，
+    不再对子串反复tokenize。区间token数 = 与区间有重叠的token数 + 特殊token数，边界处与子串单独tokenize的结果可能相差1个token。
+    """
+
+    def __init__(self, separators: Optional[List[str]] = None, tokenizer=None, **kwargs):
+        tokenizer = tokenizer or embedding_tokenizer
+        kwargs.setdefault('length_function', lambda text: len(tokenizer.encode(text, add_special_tokens=True)))
+        super().__init__(keep_separator=True, **kwargs)
+        self._separators = separators or ["\n\n", "\n", " ", ""]
+        self._patterns = [re.compile(re.escape(s)) if s else None for s in self._separators]
+        self._tokenizer = tokenizer
+        # 与num_tokens_embed一致，每段都计入[CLS]/[SEP]等特殊token
+        self.special_tokens = len(tokenizer.encode('', add_special_tokens=True))
+
+    def _token_length_func(self, text: str):
+        if not getattr(self._tokenizer, 'is_fast', False):
+            # 慢速tokenizer不支持offset_mapping，退回对子串tokenize
+            return lambda a, b: self._length_function(text[a:b])
+        offsets = self._tokenizer(text, add_special_tokens=False, return_offsets_mapping=True)['offset_mapping']
+        starts = [start for start, _ in offsets]
+        ends = [end for _, end in offsets]
+        special_tokens = self.special_tokens
+
+        def length(a: int, b: int) -> int:
+            if a >= b:
+                return special_tokens
+            return bisect_left(starts, b) - bisect_right(ends, a) + special_tokens
+
+        return length
+
+    def split_text_with_counts(self, text: str) -> Tuple[List[Tuple[str, int]], int]:
+        """返回[(chunk, chunk的token数), ...]和整段文本的token数"""
+        length = self._token_length_func(text)
+        spans = []
+        for a, b in self._split_spans(text, 0, len(text), 0, length):
+            chunk = text[a:b]
+            if self._strip_whitespace:
+                stripped = chunk.strip()
+                a += len(chunk) - len(chunk.lstrip())
+                b = a + len(stripped)
+                chunk = stripped
+            if chunk:
+                spans.append((chunk, length(a, b)))
+        return spans, length(0, len(text))
+
+    def split_text(self, text: str) -> List[str]:
+        return [chunk for chunk, _ in self.split_text_with_counts(text)[0]]
+
+    def _split_spans(self, text, a, b, level, length) -> List[Tuple[int, int]]:
+        separator_level, next_level = len(self._separators) - 1, None
+        for i in range(level, len(self._separators)):
+            if self._patterns[i] is None:
+                separator_level = i
+                break
+            if self._patterns[i].search(text, a, b):
+                separator_level = i
+                next_level = i + 1 if i + 1 < len(self._separators) else None
+                break
+
+        pattern = self._patterns[separator_level]
+        if pattern is None:
+            pieces = [(p, p + 1) for p in range(a, b)]
+        else:
+            # 分隔符保留在下一段的开头
+            bounds = [m.start() for m in pattern.finditer(text, a, b)]
+            pieces = [(s, e) for s, e in zip([a] + bounds, bounds + [b]) if s < e]
+
+        final_spans, good_pieces = [], []
+        for s, e in pieces:
+            n = length(s, e)
+            if n < self._chunk_size:
+                good_pieces.append((s, e, n))
+                continue
+            if good_pieces:
+                final_spans.extend(self._merge_spans(good_pieces))
+                good_pieces = []
+            if next_level is None:
+                final_spans.append((s, e))
+            else:
+                final_spans.extend(self._split_spans(text, s, e, next_level, length))
+        if good_pieces:
+            final_spans.extend(self._merge_spans(good_pieces))
+        return final_spans
+
+    def _merge_spans(self, pieces) -> List[Tuple[int, int]]:
+        # 与TextSplitter._merge_splits相同的合并/重叠逻辑，分隔符已保留在片段中，拼接用的空串也计入特殊token数
+        separator_len = self.special_tokens
+        spans, current, total = [], [], 0
+        for s, e, n in pieces:
+            if total + n + (separator_len if current else 0) > self._chunk_size:
+                if current:
+                    spans.append((current[0][0], current[-1][1]))
+                    while total > self._chunk_overlap or (
+                            total + n + (separator_len if current else 0) > self._chunk_size and total > 0):
+                        total -= current[0][2] + (separator_len if len(current) > 1 else 0)
+                        current.pop(0)
+            current.append((s, e, n))
+            total += n + (separator_len if len(current) > 1 else 0)
+        if current:
+            spans.append((current[0][0], current[-1][1]))
+        return spans
+
+    def create_documents(self, texts: List[str], metadatas: Optional[List[dict]] = None) -> List[Document]:
+        """metadata只做浅拷贝，子chunk共享父文档中的headers等嵌套对象，入库流程不会修改它们"""
+        _metadatas = metadatas or [{}] * len(texts)
+        documents = []
+        for i, text in enumerate(texts):
+            for chunk in self.split_text(text):
+                documents.append(Document(page_content=chunk, metadata=dict(_metadatas[i])))
+        return documents
+
+    def split_documents(self, documents: Iterable[Document]) -> List[Document]:
+        texts, metadatas = [], []
+        for doc in documents:
+            texts.append(doc.page_content)
+            metadatas.append(doc.metadata)
+        return self.create_documents(texts, metadatas=metadatas)
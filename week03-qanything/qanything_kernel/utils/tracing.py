@@ -0,0 +1,383 @@
+"""
+轻量级链路追踪
+
+基于contextvars记录span，trace id随asyncio任务/asyncio.to_thread自动传递，并通过TRACE_HEADER请求头
+传给embedding/rerank/ocr等模型服务，从而把一次问答或一次入库的各阶段耗时串成一棵调用树。
+
+用法:
+    with start_trace('local_doc_chat', time_record=time_record, user_id=user_id):
+        with span('rerank', record_key='rerank', docs=len(docs)) as s:
+            ...
+            s.set_attribute('kept', len(kept))
+
+    @traced('get_source_documents')
+    async def get_source_documents(...): ...
+
+time_record仍然保留，作为span的派生汇总：带record_key的span结束时把耗时累加到当前trace绑定的time_record中，
+同名阶段多次执行时累加而不是互相覆盖。
+"""
+import contextvars
+import functools
+import inspect
+import json
+import os
+import queue
+import threading
+import time
+import uuid
+import atexit
+from typing import Any, Dict, List, Optional
+
+import requests
+
+from qanything_kernel.configs.model_config import (TRACE_ENABLED, TRACE_HEADER, TRACE_EXPORTER, TRACE_JSONL_PATH,
+                                                   TRACE_OTLP_ENDPOINT, TRACE_SERVICE_NAME)
+from qanything_kernel.utils.custom_log import debug_logger
+
+__all__ = ['Span', 'span', 'start_trace', 'traced', 'get_trace_id', 'get_current_span', 'get_trace_headers',
+           'parse_traceparent', 'set_span_attributes', 'JsonlSpanExporter', 'OTLPHttpSpanExporter', 'set_span_exporter']
+
+_trace_id_var: contextvars.ContextVar[Optional[str]] = contextvars.ContextVar('qa_trace_id', default=None)
+_current_span_var: contextvars.ContextVar[Optional['Span']] = contextvars.ContextVar('qa_current_span', default=None)
+_time_record_var: contextvars.ContextVar[Optional[dict]] = contextvars.ContextVar('qa_time_record', default=None)
+
+
+def _new_trace_id():
+    return uuid.uuid4().hex
+
+
+def _new_span_id():
+    return os.urandom(8).hex()
+
+
+class Span:
+    __slots__ = ('name', 'trace_id', 'span_id', 'parent_id', 'attributes', 'record_key', 'time_record',
+                 'start_ns', '_start', 'duration', 'status')
+
+    def __init__(self, name: str, trace_id: str, parent_id: Optional[str], record_key: Optional[str],
+                 time_record: Optional[dict], attributes: Dict[str, Any]):
+        self.name = name
+        self.trace_id = trace_id
+        self.span_id = _new_span_id()
+        self.parent_id = parent_id
+        self.record_key = record_key
+        self.time_record = time_record
+        self.attributes = attributes
+        self.start_ns = time.time_ns()
+        self._start = time.perf_counter()
+        self.duration = None
+        self.status = 'ok'
+
+    def set_attribute(self, key: str, value: Any):
+        self.attributes[key] = value
+
+    def set_attributes(self, **kwargs):
+        self.attributes.update(kwargs)
+
+    @property
+    def elapsed(self) -> float:
+        """从span开始到现在的耗时（秒），用于流式输出中计算首包时间等"""
+        return time.perf_counter() - self._start
+
+    def to_dict(self) -> dict:
+        return {
+            'trace_id': self.trace_id,
+            'span_id': self.span_id,
+            'parent_id': self.parent_id,
+            'name': self.name,
+            'start_ns': self.start_ns,
+            'end_ns': self.start_ns + int((self.duration or 0) * 1e9),
+            'duration': round(self.duration or 0, 4),
+            'status': self.status,
+            'attributes': self.attributes,
+        }
+
+
+class span:
+    """
+    span上下文管理器，同时支持with和async with。
+    detached为True时span只计时、挂在当前span下面，不成为当前span（不修改contextvars）：
+    用在跨yield的异步生成器中，否则span会在两次yield之间泄漏给消费方，生成器在另一个Context中被关闭时reset还会报错
+    """
+
+    def __init__(self, name: str, record_key: Optional[str] = None, time_record: Optional[dict] = None,
+                 detached: bool = False, **attributes):
+        self.name = name
+        self.record_key = record_key
+        self.time_record = time_record
+        self.detached = detached
+        self.attributes = attributes
+        self._span: Optional[Span] = None
+        self._tokens = None
+
+    def __enter__(self) -> Span:
+        trace_id = _trace_id_var.get()
+        trace_token = None
+        if trace_id is None:
+            # 没有外层trace时自动开启一个新trace，保证单独调用也能被记录
+            trace_id = _new_trace_id()
+            if not self.detached:
+                trace_token = _trace_id_var.set(trace_id)
+        parent = _current_span_var.get()
+        time_record = self.time_record if self.time_record is not None else _time_record_var.get()
+        self._span = Span(self.name, trace_id, parent.span_id if parent else None, self.record_key, time_record,
+                          self.attributes)
+        self._tokens = None if self.detached else (trace_token, _current_span_var.set(self._span))
+        return self._span
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        s = self._span
+        s.duration = time.perf_counter() - s._start
+        if exc_type is not None and issubclass(exc_type, GeneratorExit):
+            # 流式输出中途被关闭（客户端断开等）
+            s.status = 'cancelled'
+        elif exc_type is not None:
+            s.status = 'error'
+            s.attributes['error'] = f'{exc_type.__name__}: {exc_val}'
+        if self._tokens is not None:
+            trace_token, span_token = self._tokens
+            _current_span_var.reset(span_token)
+            if trace_token is not None:
+                _trace_id_var.reset(trace_token)
+        if s.record_key and s.time_record is not None:
+            s.time_record[s.record_key] = round(s.time_record.get(s.record_key, 0) + s.duration, 2)
+        _export(s)
+        return False
+
+    async def __aenter__(self) -> Span:
+        return self.__enter__()
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        return self.__exit__(exc_type, exc_val, exc_tb)
+
+
+def parse_traceparent(traceparent: Optional[str]):
+    """解析W3C traceparent（00-<trace id>-<parent span id>-<flags>），返回(trace_id, span_id)，格式不对时返回(None, None)"""
+    parts = (traceparent or '').strip().lower().split('-')
+    if len(parts) != 4 or len(parts[1]) != 32 or len(parts[2]) != 16:
+        return None, None
+    try:
+        int(parts[1], 16), int(parts[2], 16)
+    except ValueError:
+        return None, None
+    if parts[1] == '0' * 32 or parts[2] == '0' * 16:
+        return None, None
+    return parts[1], parts[2]
+
+
+class start_trace(span):
+    """
+    开启一个新的trace（根span），可继承上游传入的trace id，并绑定本次请求的time_record。
+    传入上游的traceparent时，根span挂在上游发起请求的span下面，跨服务的span连成一棵树。
+    """
+
+    def __init__(self, name: str, trace_id: Optional[str] = None, time_record: Optional[dict] = None,
+                 record_key: Optional[str] = None, traceparent: Optional[str] = None, **attributes):
+        super().__init__(name, record_key=record_key, time_record=time_record, **attributes)
+        parent_trace_id, self.parent_span_id = parse_traceparent(traceparent)
+        if trace_id and parent_trace_id and trace_id != parent_trace_id:
+            # 两个请求头不是同一条链路，以TRACE_HEADER为准，不挂父span
+            self.parent_span_id = None
+        self.trace_id = trace_id or parent_trace_id or _new_trace_id()
+        self._root_tokens = None
+
+    def __enter__(self) -> Span:
+        self._root_tokens = (_trace_id_var.set(self.trace_id), _current_span_var.set(None),
+                             _time_record_var.set(self.time_record))
+        root = super().__enter__()
+        root.parent_id = self.parent_span_id
+        return root
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        super().__exit__(exc_type, exc_val, exc_tb)
+        trace_token, span_token, record_token = self._root_tokens
+        _time_record_var.reset(record_token)
+        _current_span_var.reset(span_token)
+        _trace_id_var.reset(trace_token)
+        return False
+
+
+def traced(name: Optional[str] = None, record_key: Optional[str] = None):
+    """把函数整体包在一个span中，兼容同步和异步函数"""
+
+    def decorator(func):
+        span_name = name or func.__qualname__
+
+        if inspect.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                with span(span_name, record_key=record_key):
+                    return await func(*args, **kwargs)
+
+            return async_wrapper
+
+        @functools.wraps(func)
+        def sync_wrapper(*args, **kwargs):
+            with span(span_name, record_key=record_key):
+                return func(*args, **kwargs)
+
+        return sync_wrapper
+
+    return decorator
+
+
+def get_trace_id() -> Optional[str]:
+    return _trace_id_var.get()
+
+
+def get_current_span() -> Optional[Span]:
+    return _current_span_var.get()
+
+
+def set_span_attributes(**kwargs):
+    """给当前span追加属性（如token数、文档数），不在span中时忽略"""
+    s = _current_span_var.get()
+    if s is not None:
+        s.attributes.update(kwargs)
+
+
+def get_trace_headers(headers: Optional[dict] = None) -> dict:
+    """返回附带trace id的请求头，供调用下游模型服务时使用"""
+    headers = dict(headers) if headers else {}
+    trace_id = _trace_id_var.get()
+    if trace_id:
+        headers[TRACE_HEADER] = trace_id
+        s = _current_span_var.get()
+        if s is not None:
+            # 同时带上W3C traceparent，方便对接标准的追踪系统
+            headers['traceparent'] = f'00-{trace_id}-{s.span_id}-01'
+    return headers
+
+
+class JsonlSpanExporter:
+    """每个span一行json，写到本地文件"""
+
+    def __init__(self, path: str = TRACE_JSONL_PATH):
+        self.path = path
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+
+    def export(self, spans: List[dict]):
+        lines = ''.join(json.dumps(s, ensure_ascii=False, default=str) + '\n' for s in spans)
+        with open(self.path, 'a', encoding='utf-8') as f:
+            f.write(lines)
+
+
+def _otlp_value(value):
+    if isinstance(value, bool):
+        return {'boolValue': value}
+    if isinstance(value, int):
+        return {'intValue': str(value)}
+    if isinstance(value, float):
+        return {'doubleValue': value}
+    return {'stringValue': str(value)}
+
+
+class OTLPHttpSpanExporter:
+    """按OTLP/HTTP JSON格式发送到collector（如otel-collector/jaeger），只依赖requests"""
+
+    def __init__(self, endpoint: str = TRACE_OTLP_ENDPOINT, service_name: str = TRACE_SERVICE_NAME):
+        self.endpoint = endpoint
+        self.service_name = service_name
+        self.session = requests.Session()
+
+    def export(self, spans: List[dict]):
+        otlp_spans = []
+        for s in spans:
+            item = {
+                'traceId': s['trace_id'],
+                'spanId': s['span_id'],
+                'name': s['name'],
+                'kind': 1,
+                'startTimeUnixNano': str(s['start_ns']),
+                'endTimeUnixNano': str(s['end_ns']),
+                'attributes': [{'key': k, 'value': _otlp_value(v)} for k, v in s['attributes'].items()],
+                'status': {'code': {'ok': 1, 'error': 2}.get(s['status'], 0)},
+            }
+            if s['parent_id']:
+                item['parentSpanId'] = s['parent_id']
+            otlp_spans.append(item)
+        payload = {'resourceSpans': [{
+            'resource': {'attributes': [{'key': 'service.name', 'value': {'stringValue': self.service_name}}]},
+            'scopeSpans': [{'scope': {'name': 'qanything_kernel.utils.tracing'}, 'spans': otlp_spans}],
+        }]}
+        self.session.post(self.endpoint, json=payload, timeout=3)
+
+
+class _BatchSpanProcessor:
+    """后台线程批量导出span，避免在事件循环里做文件/网络IO"""
+
+    def __init__(self, exporter, max_batch: int = 256, interval: float = 1.0):
+        self.exporter = exporter
+        self.max_batch = max_batch
+        self.interval = interval
+        self.queue = queue.SimpleQueue()
+        self._thread = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def _ensure_thread(self):
+        # 多进程(sanic workers/fork)下每个进程需要自己的导出线程
+        if self._pid != os.getpid():
+            with self._lock:
+                if self._pid != os.getpid():
+                    self._pid = os.getpid()
+                    self._thread = threading.Thread(target=self._run, name='span-exporter', daemon=True)
+                    self._thread.start()
+
+    def submit(self, s: Span):
+        self._ensure_thread()
+        self.queue.put(s.to_dict())
+
+    def _drain(self, block: bool) -> List[dict]:
+        batch = []
+        try:
+            if block:
+                batch.append(self.queue.get(timeout=self.interval))
+            while len(batch) < self.max_batch:
+                batch.append(self.queue.get_nowait())
+        except queue.Empty:
+            pass
+        return batch
+
+    def _export(self, batch):
+        if not batch:
+            return
+        try:
+            self.exporter.export(batch)
+        except Exception as e:
+            debug_logger.warning(f'export {len(batch)} spans failed: {e}')
+
+    def _run(self):
+        while True:
+            self._export(self._drain(block=True))
+
+    def flush(self):
+        while True:
+            batch = self._drain(block=False)
+            if not batch:
+                break
+            self._export(batch)
+
+
+def _build_exporter():
+    if TRACE_EXPORTER == 'otlp':
+        return OTLPHttpSpanExporter()
+    return JsonlSpanExporter()
+
+
+_processor: Optional[_BatchSpanProcessor] = _BatchSpanProcessor(_build_exporter()) if TRACE_ENABLED else None
+if _processor is not None:
+    atexit.register(_processor.flush)
+
+
+def set_span_exporter(exporter):
+    """替换span导出器，传None则关闭导出（span和time_record汇总依旧生效）"""
+    global _processor
+    if _processor is not None:
+        _processor.flush()
+    _processor = _BatchSpanProcessor(exporter) if exporter is not None else None
+
+
+def _export(s: Span):
+    if _processor is not None:
+        _processor.submit(s)
@@ -0,0 +1,368 @@
+"""
+URL文件的并发抓取。原来newspaper抓不到单篇文章时用MyRecursiveUrlLoader逐个页面阻塞请求（每个页面还请求两次），
+几百个页面的文档站要抓很多分钟，一直占着入库worker的解析并发。
+
+AsyncCrawler在解析子进程中用asyncio抓取起始URL所在目录下的页面：
+- 全局最多concurrency个请求，同一host最多per_host_concurrency个，相邻请求开始间隔不小于host_delay和robots.txt的Crawl-delay；
+- 链接按normalize_url规范化后去重，遵守robots.txt（用户提交的起始URL本身除外），跳过明显不是网页的扩展名；
+- 条件请求缓存：页面的ETag/Last-Modified和解析结果保存在CRAWL_CACHE_DIR，重新抓取时服务端返回304直接复用；
+- HTML转文本（html2text，纯Python）在进程池中执行，不阻塞事件循环上的其他请求。
+超过max_pages、max_depth、max_seconds后不再抓取新页面，返回已抓到的页面。
+"""
+from qanything_kernel.configs.model_config import (CRAWL_CONCURRENCY, CRAWL_PER_HOST_CONCURRENCY, CRAWL_HOST_DELAY,
+                                                   CRAWL_MAX_PAGES, CRAWL_MAX_DEPTH, CRAWL_MAX_PAGE_BYTES,
+                                                   CRAWL_REQUEST_TIMEOUT, CRAWL_MAX_SECONDS, CRAWL_EXTRACT_PROCESSES,
+                                                   CRAWL_RESPECT_ROBOTS, CRAWL_USER_AGENT, CRAWL_CACHE_DIR)
+from qanything_kernel.utils.custom_log import insert_logger
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import asynccontextmanager
+from typing import Dict, List, NamedTuple, Optional, Tuple
+from urllib.parse import parse_qsl, quote, urlencode, urljoin, urlsplit, urlunsplit
+from urllib.robotparser import RobotFileParser
+from bs4 import BeautifulSoup, UnicodeDammit
+import aiohttp
+import asyncio
+import hashlib
+import html2text
+import json
+import multiprocessing
+import os
+import re
+import time
+
+try:
+    import lxml  # noqa: F401
+    HTML_PARSER = 'lxml'
+except ImportError:
+    HTML_PARSER = 'html.parser'
+
+__all__ = ['CrawledPage', 'AsyncCrawler', 'ConditionalCache', 'normalize_url', 'extract_page', 'crawl_site']
+
+DEFAULT_PORTS = {'http': 80, 'https': 443}
+PERCENT_ESCAPE_PATTERN = re.compile(r'%[0-9a-fA-F]{2}')
+SKIP_EXTENSIONS = ('.pdf', '.zip', '.gz', '.tar', '.rar', '.7z', '.exe', '.dmg', '.png', '.jpg', '.jpeg', '.gif',
+                   '.svg', '.webp', '.ico', '.css', '.js', '.mp3', '.mp4', '.avi', '.mov', '.woff', '.woff2', '.ttf')
+
+
+class CrawledPage(NamedTuple):
+    url: str
+    depth: int
+    title: str
+    text: str
+    from_cache: bool
+
+
+def _remove_dot_segments(path: str) -> str:
+    segments = path.split('/')
+    output = []
+    for segment in segments:
+        if segment == '..':
+            if len(output) > 1:
+                output.pop()
+        elif segment != '.':
+            output.append(segment)
+    if segments[-1] in ('.', '..'):
+        output.append('')
+    return '/'.join(output) or '/'
+
+
+def _quote_part(part: str, safe: str) -> str:
+    # 已有的%XX保留并统一为大写，中文等字符编码后与浏览器复制出来的编码形式一致
+    return PERCENT_ESCAPE_PATTERN.sub(lambda m: m.group(0).upper(), quote(part, safe=safe + '%'))
+
+
+def normalize_url(url: str, base: Optional[str] = None) -> Optional[str]:
+    """
+    用于去重的规范形式：scheme/host小写、去掉默认端口和用户信息、去掉fragment、规范化路径中的./..和百分号编码、
+    query参数排序。非http(s)链接（mailto:、javascript:等）返回None
+    """
+    try:
+        parts = urlsplit(urljoin(base, url.strip()) if base else url.strip())
+        scheme = parts.scheme.lower()
+        if scheme not in DEFAULT_PORTS or not parts.hostname:
+            return None
+        host = parts.hostname.lower()
+        port = parts.port
+    except ValueError:
+        # 端口不是数字、IPv6地址不完整等
+        return None
+    if ':' in host:
+        host = f'[{host}]'
+    netloc = host if port is None or port == DEFAULT_PORTS[scheme] else f'{host}:{port}'
+    path = _quote_part(_remove_dot_segments(parts.path or '/'), safe="/:@!$&'()*+,;=-._~")
+    query = urlencode(sorted(parse_qsl(parts.query, keep_blank_values=True)), quote_via=quote)
+    return urlunsplit((scheme, netloc, path, query, ''))
+
+
+def crawl_scope(url: str) -> str:
+    """起始URL所在的目录，只抓取这个前缀下的页面"""
+    parts = urlsplit(url)
+    return urlunsplit((parts.scheme, parts.netloc, parts.path[:parts.path.rfind('/') + 1], '', ''))
+
+
+def extract_page(body: bytes, url: str, charset: Optional[str] = None) -> Tuple[str, str, List[str]]:
+    """在进程池中执行：返回(标题, 正文, 页面中的链接)。<meta name="robots">为noindex时正文为空，nofollow时不返回链接"""
+    markup = UnicodeDammit(body, [charset] if charset else [], is_html=True).unicode_markup or ''
+    soup = BeautifulSoup(markup, HTML_PARSER)
+    title = soup.title.get_text(strip=True) if soup.title else ''
+    robots_meta = soup.find('meta', attrs={'name': re.compile('^robots$', re.I)})
+    directives = (robots_meta.get('content') or '').lower() if robots_meta else ''
+    links = []
+    if 'nofollow' not in directives and 'none' not in directives:
+        base = soup.find('base', href=True)
+        base_url = urljoin(url, base['href']) if base else url
+        for a in soup.find_all('a', href=True):
+            if 'nofollow' not in (a.get('rel') or []):
+                links.append(urljoin(base_url, a['href']))
+    if 'noindex' in directives or 'none' in directives:
+        return title, '', links
+    # 与general_utils.html_to_markdown的配置一致，这里单独创建，进程池子进程不必导入tokenizer等依赖
+    converter = html2text.HTML2Text()
+    converter.ignore_images = True
+    converter.ignore_emphasis = True
+    converter.ignore_links = True
+    converter.body_width = 0
+    converter.tables = True
+    return title, converter.handle(markup).strip(), links
+
+
+class ConditionalCache:
+    """每个规范化URL一个json文件：{"etag", "last_modified", "title", "text", "links"}"""
+
+    def __init__(self, cache_dir: str):
+        self.cache_dir = cache_dir
+
+    def _path(self, url: str) -> str:
+        digest = hashlib.sha1(url.encode('utf-8')).hexdigest()
+        return os.path.join(self.cache_dir, digest[:2], digest + '.json')
+
+    def get(self, url: str) -> Optional[Dict]:
+        try:
+            with open(self._path(url), encoding='utf-8') as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            return None
+        return entry if entry.get('url') == url else None
+
+    def put(self, url: str, entry: Dict):
+        path = self._path(url)
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp_path = f'{path}.{os.getpid()}.tmp'
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump({'url': url, **entry}, f, ensure_ascii=False)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            insert_logger.warning(f'crawl cache write failed: {url}, {e}')
+
+
+class _Host:
+    """同一host的并发和请求间隔，以及它的robots.txt"""
+
+    def __init__(self, concurrency: int, delay: float):
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.delay = delay
+        self.next_start = 0.0
+        self.robots: Optional[RobotFileParser] = None
+        self.robots_lock = asyncio.Lock()
+
+    @asynccontextmanager
+    async def slot(self):
+        async with self.semaphore:
+            now = asyncio.get_running_loop().time()
+            start = max(now, self.next_start)
+            self.next_start = start + self.delay
+            if start > now:
+                await asyncio.sleep(start - now)
+            yield
+
+
+class AsyncCrawler:
+    def __init__(self, concurrency: int = CRAWL_CONCURRENCY, per_host_concurrency: int = CRAWL_PER_HOST_CONCURRENCY,
+                 host_delay: float = CRAWL_HOST_DELAY, max_pages: int = CRAWL_MAX_PAGES,
+                 max_depth: int = CRAWL_MAX_DEPTH, max_seconds: float = CRAWL_MAX_SECONDS,
+                 extract_processes: int = CRAWL_EXTRACT_PROCESSES, respect_robots: bool = CRAWL_RESPECT_ROBOTS,
+                 cache_dir: Optional[str] = CRAWL_CACHE_DIR, user_agent: str = CRAWL_USER_AGENT):
+        self.concurrency = concurrency
+        self.per_host_concurrency = per_host_concurrency
+        self.host_delay = host_delay
+        self.max_pages = max_pages
+        self.max_depth = max_depth
+        self.max_seconds = max_seconds
+        self.extract_processes = extract_processes
+        self.respect_robots = respect_robots
+        self.cache = ConditionalCache(cache_dir) if cache_dir else None
+        self.user_agent = user_agent
+        self.stats: Dict[str, int] = {}
+
+    def _count(self, key: str, n: int = 1):
+        self.stats[key] = self.stats.get(key, 0) + n
+
+    async def crawl(self, start_url: str) -> List[CrawledPage]:
+        """按发现顺序返回抓到的页面（不含正文为空的页面），self.stats为各类计数"""
+        start = normalize_url(start_url)
+        if start is None:
+            return []
+        self.stats = {}
+        self.scope = crawl_scope(start)
+        self.seen = {start}
+        self.hosts: Dict[str, _Host] = {}
+        self.pages: Dict[int, CrawledPage] = {}
+        self.discovered = 1
+        loop = asyncio.get_running_loop()
+        self.deadline = loop.time() + self.max_seconds
+        queue = asyncio.Queue()
+        queue.put_nowait((start, 0, 0))
+        # spawn：子进程只需导入本模块，不继承解析进程中的事件循环和连接
+        executor = ProcessPoolExecutor(self.extract_processes, mp_context=multiprocessing.get_context('spawn')) \
+            if self.extract_processes > 0 else None
+        begin = time.perf_counter()
+        timeout = aiohttp.ClientTimeout(total=CRAWL_REQUEST_TIMEOUT)
+        connector = aiohttp.TCPConnector(limit=self.concurrency, limit_per_host=self.per_host_concurrency)
+        try:
+            async with aiohttp.ClientSession(timeout=timeout, connector=connector,
+                                             headers={'User-Agent': self.user_agent}) as session:
+                workers = [asyncio.create_task(self._worker(session, queue, executor))
+                           for _ in range(self.concurrency)]
+                joined = asyncio.ensure_future(queue.join())
+                await asyncio.wait([joined, *workers], return_when=asyncio.FIRST_COMPLETED)
+                for task in [joined, *workers]:
+                    task.cancel()
+                await asyncio.gather(joined, *workers, return_exceptions=True)
+                # worker只会因为except Exception之外的异常（解析超时等）提前结束，继续向上抛
+                for task in workers:
+                    if not task.cancelled() and task.exception() is not None:
+                        raise task.exception()
+        finally:
+            if executor is not None:
+                executor.shutdown(wait=False, cancel_futures=True)
+        self.stats['seconds'] = round(time.perf_counter() - begin, 2)
+        return [self.pages[order] for order in sorted(self.pages)]
+
+    async def _worker(self, session: aiohttp.ClientSession, queue: asyncio.Queue, executor):
+        loop = asyncio.get_running_loop()
+        while True:
+            url, depth, order = await queue.get()
+            try:
+                if loop.time() > self.deadline:
+                    self._count('skipped_deadline')
+                    continue
+                await self._visit(session, queue, executor, url, depth, order)
+            except Exception as e:
+                self._count('errors')
+                insert_logger.warning(f'crawl {url} error: {type(e).__name__}: {e}')
+            finally:
+                queue.task_done()
+
+    def _host(self, url: str) -> _Host:
+        netloc = urlsplit(url).netloc
+        if netloc not in self.hosts:
+            self.hosts[netloc] = _Host(self.per_host_concurrency, self.host_delay)
+        return self.hosts[netloc]
+
+    async def _allowed(self, session: aiohttp.ClientSession, host: _Host, url: str) -> bool:
+        async with host.robots_lock:
+            if host.robots is None:
+                host.robots = await self._fetch_robots(session, host, url)
+                crawl_delay = host.robots.crawl_delay(self.user_agent)
+                if crawl_delay:
+                    host.delay = max(host.delay, float(crawl_delay))
+        return host.robots.can_fetch(self.user_agent, url)
+
+    async def _fetch_robots(self, session: aiohttp.ClientSession, host: _Host, url: str) -> RobotFileParser:
+        parts = urlsplit(url)
+        robots_url = urlunsplit((parts.scheme, parts.netloc, '/robots.txt', '', ''))
+        parser = RobotFileParser(robots_url)
+        try:
+            async with host.slot():
+                async with session.get(robots_url) as response:
+                    # 与RobotFileParser.read一致：401/403视为全部禁止，其他4xx视为没有限制
+                    if response.status in (401, 403):
+                        parser.disallow_all = True
+                    elif response.status >= 400:
+                        parser.allow_all = True
+                    else:
+                        parser.parse((await response.text(errors='replace')).splitlines())
+        except Exception as e:
+            insert_logger.warning(f'crawl robots.txt failed, allow all: {robots_url}, {type(e).__name__}: {e}')
+            parser.allow_all = True
+        return parser
+
+    async def _visit(self, session: aiohttp.ClientSession, queue: asyncio.Queue, executor, url: str, depth: int,
+                     order: int):
+        host = self._host(url)
+        # 起始URL是用户提交的，不受robots.txt限制
+        if depth > 0 and self.respect_robots and not await self._allowed(session, host, url):
+            self._count('skipped_robots')
+            return
+        cached = self.cache.get(url) if self.cache else None
+        headers = {}
+        if cached and cached.get('etag'):
+            headers['If-None-Match'] = cached['etag']
+        if cached and cached.get('last_modified'):
+            headers['If-Modified-Since'] = cached['last_modified']
+        body = None
+        async with host.slot():
+            async with session.get(url, headers=headers) as response:
+                final_url = normalize_url(str(response.url)) or url
+                if response.status == 304 and cached:
+                    pass
+                elif response.status != 200:
+                    self._count(f'http_{response.status}')
+                    return
+                elif 'html' not in response.headers.get('Content-Type', 'text/html').lower():
+                    self._count('skipped_type')
+                    return
+                elif (response.content_length or 0) > CRAWL_MAX_PAGE_BYTES:
+                    self._count('skipped_size')
+                    return
+                else:
+                    body = await response.content.read(CRAWL_MAX_PAGE_BYTES + 1)
+                    if len(body) > CRAWL_MAX_PAGE_BYTES:
+                        self._count('skipped_size')
+                        return
+                    charset = response.charset
+                    validators = {'etag': response.headers.get('ETag'),
+                                  'last_modified': response.headers.get('Last-Modified')}
+        if final_url != url and depth == 0:
+            # 起始URL重定向（http -> https、补全末尾的/等）后按重定向后的目录抓取
+            self.scope = crawl_scope(final_url)
+            self.seen.add(final_url)
+        elif final_url != url:
+            # 重定向到已抓取的页面或范围之外
+            if final_url in self.seen or not final_url.startswith(self.scope):
+                self._count('skipped_redirect')
+                return
+            self.seen.add(final_url)
+        if body is None:
+            title, text, links = cached['title'], cached['text'], cached['links']
+            self._count('not_modified')
+        else:
+            title, text, links = await asyncio.get_running_loop().run_in_executor(executor, extract_page, body,
+                                                                                   final_url, charset)
+            self._count('fetched')
+            if self.cache and (validators['etag'] or validators['last_modified']):
+                self.cache.put(url, {**validators, 'title': title, 'text': text, 'links': links})
+        if text:
+            self.pages[order] = CrawledPage(final_url, depth, title, text, body is None)
+        if depth >= self.max_depth:
+            return
+        for link in links:
+            link = normalize_url(link)
+            if link is None or not link.startswith(self.scope) or link in self.seen:
+                continue
+            if urlsplit(link).path.lower().endswith(SKIP_EXTENSIONS):
+                continue
+            if len(self.seen) >= self.max_pages:
+                self._count('skipped_max_pages')
+                break
+            self.seen.add(link)
+            queue.put_nowait((link, depth + 1, self.discovered))
+            self.discovered += 1
+
+
+def crawl_site(url: str, **kwargs) -> Tuple[List[CrawledPage], Dict[str, int]]:
+    """在没有运行事件循环的线程（解析子进程）中调用"""
+    crawler = AsyncCrawler(**kwargs)
+    pages = asyncio.run(crawler.crawl(url))
+    return pages, crawler.stats
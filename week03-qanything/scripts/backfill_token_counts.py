@@ -0,0 +1,64 @@
+"""
+为已入库的parent chunk补充预计算的token数（metadata['token_counts']），新入库的文档在入库时已经计算。
+按主键id分批扫描Documents表，已有token_counts的跳过，可重复执行。
+内容寻址存储的行（Documents中只有引用）是开启DOCUMENT_DEDUP后入库的，入库时已经计算，同样跳过。
+
+用法: python scripts/backfill_token_counts.py --batch 500
+"""
+import argparse
+import os
+import re
+import sys
+import time
+
+root_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(root_dir)
+
+from qanything_kernel.connector.database.mysql.mysql_client import KnowledgeBaseManager
+from qanything_kernel.utils.general_utils import compute_chunk_token_counts
+from qanything_kernel.utils.json_codec import encode_json_data, decode_json_data
+from qanything_kernel.utils.chunk_content import is_content_ref
+
+HEADERS_PREFIX = re.compile(r'^\[headers]\(.*?\)\n', re.S)
+
+
+def backfill(batch_size, dry_run=False):
+    mysql_client = KnowledgeBaseManager()
+    last_id = 0
+    scanned, updated = 0, 0
+    start = time.perf_counter()
+    while True:
+        rows = mysql_client.execute_query_(
+            "SELECT id, doc_id, json_data FROM Documents WHERE id > %s ORDER BY id LIMIT %s",
+            (last_id, batch_size), fetch=True)
+        if not rows:
+            break
+        last_id = rows[-1][0]
+        updates = []
+        for row_id, doc_id, json_data in rows:
+            scanned += 1
+            doc_json = decode_json_data(json_data)
+            if is_content_ref(doc_json):
+                continue
+            metadata = doc_json['kwargs']['metadata']
+            if metadata.get('token_counts'):
+                continue
+            # 问答时会去掉存储的headers前缀，这里保持一致
+            page_content = HEADERS_PREFIX.sub('', doc_json['kwargs']['page_content'], count=1)
+            metadata['token_counts'] = compute_chunk_token_counts(page_content, metadata.get('headers'))
+            updates.append((encode_json_data(doc_json), row_id))
+        if updates and not dry_run:
+            for params in updates:
+                mysql_client.execute_query_("UPDATE Documents SET json_data = %s WHERE id = %s", params, commit=True)
+        updated += len(updates)
+        print(f"scanned={scanned} updated={updated} last_id={last_id} "
+              f"elapsed={time.perf_counter() - start:.1f}s")
+    print(f"done, scanned {scanned} documents, backfilled {updated}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--batch', type=int, default=500)
+    parser.add_argument('--dry_run', action='store_true')
+    args = parser.parse_args()
+    backfill(args.batch, args.dry_run)
@@ -0,0 +1,244 @@
+"""
+URL抓取的耗时：在本地生成一个静态文档站（--sections个目录、共--pages个页面，每个页面有导航、交叉引用、站外链接、
+带fragment/./..的重复链接，另有robots.txt禁止抓取的private目录），用子进程中的HTTP服务提供，每个请求固定延迟
+--latency_ms模拟公网往返。服务端支持ETag/Last-Modified条件请求，并统计请求数、304数和同时处理的最大请求数。
+- legacy: MyRecursiveUrlLoader逐个页面阻塞请求（需要langchain_community，未安装时跳过）；
+- sequential: AsyncCrawler限制为1个并发，与legacy的差别只在去重和每页只请求一次；
+- crawl: AsyncCrawler并发抓取，空缓存；
+- recrawl: 用crawl留下的条件请求缓存再抓一遍，页面未修改，服务端全部返回304。
+校验并发抓取拿到了所有公开页面、没有抓取private目录、同时处理的请求数不超过--per_host，recrawl全部命中304。
+
+用法: python scripts/bench_crawler.py --pages 300 --latency_ms 50
+      python scripts/bench_crawler.py --pages 500 --cases sequential,crawl,recrawl --extract_processes 0
+"""
+import argparse
+import email.utils
+import json
+import multiprocessing
+import os
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, unquote, urlsplit
+
+root_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(root_dir)
+
+PARAGRAPHS = ['QAnything支持多种格式的文件入库，包括PDF、Word、PPT、Markdown、Excel、CSV、JSON和网页链接。',
+              'The insert service splits each document into parent and child chunks before computing embeddings.',
+              '检索时先召回子chunk，再按parent chunk返回完整的上下文，兼顾召回率和回答所需的信息量。',
+              'Rerank scores are computed on the parent chunks, and low-score chunks are filtered before the LLM call.',
+              '知识库之间相互隔离，删除知识库时会同时删除其中文件在向量库、全文索引和MySQL中的全部数据。']
+
+
+def page_path(section, index):
+    return f'/docs/s{section}/p{index}.html'
+
+
+def build_site(site_dir, pages, sections, private_pages=5):
+    """返回公开页面（含目录页）的路径集合"""
+    rng = random.Random(0)
+    per_section = [pages // sections + (1 if i < pages % sections else 0) for i in range(sections)]
+    all_pages = [(s, i) for s in range(sections) for i in range(per_section[s])]
+    public = {'/docs/'}
+
+    def write(path, title, body_links):
+        file_path = os.path.join(site_dir, path.lstrip('/'))
+        if path.endswith('/'):
+            file_path = os.path.join(file_path, 'index.html')
+        os.makedirs(os.path.dirname(file_path), exist_ok=True)
+        paragraphs = ''.join(f'<p>{rng.choice(PARAGRAPHS)}</p>' for _ in range(rng.randint(10, 30)))
+        links = ''.join(f'<li><a href="{href}">{text}</a></li>' for href, text in body_links)
+        with open(file_path, 'w', encoding='utf-8') as f:
+            f.write(f'<!DOCTYPE html><html><head><meta charset="utf-8"><title>{title}</title>'
+                    f'<style>body {{font-family: sans-serif}}</style><script>var x = 1;</script></head>'
+                    f'<body><nav><a href="/docs/">首页</a> <a href="#main">跳到正文</a></nav>'
+                    f'<h1 id="main">{title}</h1>{paragraphs}<ul>{links}</ul></body></html>')
+
+    write('/docs/', '文档首页', [(f's{s}/', f'第{s}章') for s in range(sections)] +
+          [('private/secret0.html', '内部资料'), ('mailto:support@example.com', '联系我们'),
+           ('https://example.invalid/outside.html', '站外链接')])
+    for s in range(sections):
+        public.add(f'/docs/s{s}/')
+        write(f'/docs/s{s}/', f'第{s}章',
+              [(f'p{i}.html', f'{s}.{i}') for i in range(per_section[s])] + [('../', '返回首页')])
+    for s, i in all_pages:
+        public.add(page_path(s, i))
+        links = [('./', '本章目录'), (f'p{i}.html#top', '回到顶部'), ('manual.pdf', 'PDF版本'),
+                 (f'../private/secret{rng.randrange(private_pages)}.html', '内部资料')]
+        if i > 0:
+            links.append((f'p{i - 1}.html', '上一页'))
+        if i + 1 < per_section[s]:
+            links.append((f'./p{i + 1}.html', '下一页'))
+            links.append((f'../s{s}/p{i + 1}.html#main', '下一页'))
+        for cs, ci in rng.sample(all_pages, 3):
+            links.append((f'../s{cs}/p{ci}.html', f'参见{cs}.{ci}'))
+        write(page_path(s, i), f'第{s}章第{i}节', links)
+    for k in range(private_pages):
+        write(f'/docs/private/secret{k}.html', f'内部资料{k}', [])
+    with open(os.path.join(site_dir, 'robots.txt'), 'w') as f:
+        f.write('User-agent: *\nDisallow: /docs/private/\n')
+    return public
+
+
+def serve(site_dir, latency, port_queue):
+    """在子进程中运行：静态文件 + ETag/Last-Modified条件请求 + /__stats统计"""
+    lock = threading.Lock()
+    stats = {'requests': 0, 'not_modified': 0, 'inflight': 0, 'max_inflight': 0, 'private': 0}
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def log_message(self, format, *args):
+            pass
+
+        def send(self, status, body=b'', headers=None):
+            self.send_response(status)
+            for key, value in (headers or {}).items():
+                self.send_header(key, value)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            if body and self.command != 'HEAD':
+                self.wfile.write(body)
+
+        def do_GET(self):
+            parts = urlsplit(self.path)
+            if parts.path == '/__stats':
+                with lock:
+                    body = json.dumps(stats).encode()
+                    if 'reset' in parse_qs(parts.query):
+                        stats.update({key: 0 for key in stats})
+                return self.send(200, body, {'Content-Type': 'application/json'})
+            with lock:
+                stats['requests'] += 1
+                stats['inflight'] += 1
+                stats['max_inflight'] = max(stats['max_inflight'], stats['inflight'])
+                stats['private'] += parts.path.startswith('/docs/private/')
+            try:
+                time.sleep(latency)
+                self.serve_file(unquote(parts.path))
+            finally:
+                with lock:
+                    stats['inflight'] -= 1
+
+        def serve_file(self, path):
+            file_path = os.path.realpath(os.path.join(site_dir, path.lstrip('/')))
+            if path.endswith('/'):
+                file_path = os.path.join(file_path, 'index.html')
+            if not file_path.startswith(os.path.realpath(site_dir)) or not os.path.isfile(file_path):
+                return self.send(404, b'not found', {'Content-Type': 'text/plain'})
+            stat = os.stat(file_path)
+            headers = {'ETag': f'"{stat.st_mtime_ns:x}-{stat.st_size:x}"',
+                       'Last-Modified': email.utils.formatdate(stat.st_mtime, usegmt=True),
+                       'Content-Type': 'text/plain' if path.endswith('.txt') else 'text/html; charset=utf-8'}
+            if self.headers.get('If-None-Match') == headers['ETag']:
+                with lock:
+                    stats['not_modified'] += 1
+                return self.send(304, headers={'ETag': headers['ETag']})
+            with open(file_path, 'rb') as f:
+                self.send(200, f.read(), headers)
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    server.daemon_threads = True
+    port_queue.put(server.server_address[1])
+    server.serve_forever()
+
+
+def fetch_stats(base_url, reset=False):
+    from urllib.request import urlopen
+    with urlopen(f'{base_url}/__stats' + ('?reset=1' if reset else '')) as response:
+        return json.loads(response.read())
+
+
+def run_legacy(start_url):
+    try:
+        from qanything_kernel.utils.loader.my_recursive_url_loader import MyRecursiveUrlLoader
+    except ImportError as e:
+        print(f'legacy skipped: {e}')
+        return None
+    docs = MyRecursiveUrlLoader(url=start_url).load()
+    return [doc.metadata.get('source', '') for doc in docs], {}
+
+
+def run_crawler(start_url, cache_dir, args, concurrency, per_host):
+    from qanything_kernel.utils.web_crawler import crawl_site
+    pages, stats = crawl_site(start_url, concurrency=concurrency, per_host_concurrency=per_host,
+                              host_delay=args.host_delay, max_pages=args.pages * 2, max_depth=10,
+                              extract_processes=args.extract_processes, respect_robots=True, cache_dir=cache_dir)
+    return [urlsplit(page.url).path for page in pages], stats
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--pages', type=int, default=300)
+    parser.add_argument('--sections', type=int, default=10)
+    parser.add_argument('--latency_ms', type=float, default=50, help='服务端每个请求的固定延迟')
+    parser.add_argument('--concurrency', type=int, default=16)
+    parser.add_argument('--per_host', type=int, default=8, help='同一host同时进行的请求数，本地站点只有一个host')
+    parser.add_argument('--host_delay', type=float, default=0.0, help='同一host相邻请求的最小间隔(秒)')
+    parser.add_argument('--extract_processes', type=int, default=2)
+    parser.add_argument('--cases', type=str, default='legacy,sequential,crawl,recrawl')
+    args = parser.parse_args()
+
+    site_dir = tempfile.mkdtemp(prefix='bench_site_')
+    cache_dir = tempfile.mkdtemp(prefix='bench_crawl_cache_')
+    public = build_site(site_dir, args.pages, args.sections)
+    port_queue = multiprocessing.Queue()
+    server = multiprocessing.Process(target=serve, args=(site_dir, args.latency_ms / 1000, port_queue), daemon=True)
+    server.start()
+    base_url = f'http://127.0.0.1:{port_queue.get(timeout=10)}'
+    start_url = f'{base_url}/docs/'
+    print(f'site: {len(public)} public pages at {start_url}, latency {args.latency_ms:g}ms')
+
+    print(f'{"case":<12}{"seconds":>9}{"pages/s":>9}{"pages":>7}{"requests":>10}{"304":>6}{"private":>9}'
+          f'{"max inflight":>14}')
+    results = {}
+    try:
+        for case in args.cases.split(','):
+            fetch_stats(base_url, reset=True)
+            if case == 'recrawl' and 'crawl' not in results:
+                print('recrawl needs the crawl case first')
+                continue
+            start = time.perf_counter()
+            if case == 'legacy':
+                result = run_legacy(start_url)
+            elif case == 'sequential':
+                result = run_crawler(start_url, None, args, 1, 1)
+            else:
+                result = run_crawler(start_url, cache_dir, args, args.concurrency, args.per_host)
+            cost = time.perf_counter() - start
+            if result is None:
+                continue
+            paths, crawl_stats = result
+            server_stats = fetch_stats(base_url)
+            results[case] = {'paths': paths, 'stats': crawl_stats, 'server': server_stats, 'seconds': cost}
+            print(f'{case:<12}{cost:>9.2f}{len(paths) / cost:>9.1f}{len(paths):>7}{server_stats["requests"]:>10}'
+                  f'{server_stats["not_modified"]:>6}{server_stats["private"]:>9}{server_stats["max_inflight"]:>14}'
+                  + (f'  {crawl_stats}' if crawl_stats else ''))
+    finally:
+        server.terminate()
+        shutil.rmtree(site_dir, ignore_errors=True)
+        shutil.rmtree(cache_dir, ignore_errors=True)
+
+    for case in ('sequential', 'crawl', 'recrawl'):
+        result = results.get(case)
+        if result is None:
+            continue
+        assert set(result['paths']) == public and len(result['paths']) == len(public), f'{case} missed pages'
+        assert result['server']['private'] == 0, f'{case} fetched pages disallowed by robots.txt'
+    if 'crawl' in results:
+        assert results['crawl']['server']['max_inflight'] <= args.per_host, 'per-host concurrency exceeded'
+    if 'recrawl' in results:
+        assert results['recrawl']['stats'].get('not_modified') == len(public), 'recrawl did not hit the cache'
+    for baseline in ('legacy', 'sequential'):
+        if baseline in results and 'crawl' in results:
+            print(f'{baseline} -> crawl: {results[baseline]["seconds"] / results["crawl"]["seconds"]:.1f}x faster')
+    print('crawler check passed')
+
+
+if __name__ == '__main__':
+    main()
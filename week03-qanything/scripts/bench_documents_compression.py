@@ -0,0 +1,131 @@
+"""
+Documents.json_data压缩基准：用接近真实的合成parent chunk（带headers前缀的中英文内容 + 完整metadata），
+对比none / zlib / zstd三种格式的：
+- 每个chunk的存储字节数
+- 编码、解码的CPU耗时
+- 从MySQL取30个parent（与MysqlStore.mget一次召回的数量相当）并解码的延迟（--no_mysql跳过）
+
+用法: python scripts/bench_documents_compression.py --chunks 2000 --rounds 200
+"""
+import argparse
+import os
+import random
+import statistics
+import sys
+import time
+import uuid
+
+root_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(root_dir)
+
+from qanything_kernel.utils.json_codec import encode_json_data, decode_json_data, zstandard
+
+SENTENCES = ['检索增强生成（RAG）把知识库中的相关文档作为上下文交给大模型，', '向量检索擅长语义匹配，BM25擅长关键词匹配，',
+             '重排序模型对候选文档逐一打分，过滤掉相关性较低的片段。', 'The parent chunk is stored in MySQL and the child chunks in Milvus. ',
+             '表格会被转换为markdown格式，保留行列结构，', '图片以![figure](xxx.jpg)的形式引用，问答时再替换为可访问的链接。',
+             'Token budgets are enforced before the prompt is sent to the LLM. ', '每个文件在入库时被切分为若干parent chunk，']
+
+
+def synthetic_chunk(rng, idx, chars):
+    file_id = uuid.uuid4().hex
+    headers = {'一级标题': f'第{idx % 12}章 系统设计', '二级标题': f'{idx % 12}.{idx % 7} 检索流程'}
+    content = ''
+    while len(content) < chars:
+        content += rng.choice(SENTENCES)
+    return {
+        'lc': 1, 'type': 'constructor', 'id': ['langchain', 'schema', 'document', 'Document'],
+        'kwargs': {
+            'page_content': f'[headers]({headers})\n' + content,
+            'metadata': {
+                'user_id': 'zzp__1234', 'kb_id': 'KB' + uuid.uuid4().hex, 'file_id': file_id,
+                'file_name': f'产品手册_{idx}.pdf', 'nos_key': f'/workspace/QAnything/file/{file_id}/产品手册_{idx}.pdf',
+                'file_url': '', 'title_lst': [], 'has_table': bool(idx % 5 == 0), 'images': [],
+                'page_id': idx % 40, 'headers': headers, 'faq_dict': {}, 'doc_id': f'{file_id}_{idx % 50}',
+                'token_counts': {'content_len': len(content), 'embed': len(content) // 2,
+                                 'cl100k_base': len(content) // 2, 'o200k_base': len(content) // 3},
+            },
+            'type': 'Document',
+        },
+    }
+
+
+def cpu_cost(func, items, repeat=3):
+    best = None
+    for _ in range(repeat):
+        start = time.process_time()
+        for item in items:
+            func(item)
+        cost = (time.process_time() - start) / len(items)
+        best = cost if best is None else min(best, cost)
+    return best
+
+
+def bench_mysql(stored_by_format, rounds, fetch_num):
+    import mysql.connector
+    from qanything_kernel.configs.model_config import (MYSQL_HOST_LOCAL, MYSQL_PORT_LOCAL, MYSQL_USER_LOCAL,
+                                                       MYSQL_PASSWORD_LOCAL)
+    conn = mysql.connector.connect(host=MYSQL_HOST_LOCAL, port=MYSQL_PORT_LOCAL, user=MYSQL_USER_LOCAL,
+                                   password=MYSQL_PASSWORD_LOCAL)
+    cursor = conn.cursor(buffered=True)
+    cursor.execute("CREATE DATABASE IF NOT EXISTS qanything_bench")
+    conn.database = 'qanything_bench'
+    rng = random.Random(1)
+    results = {}
+    for fmt, stored in stored_by_format.items():
+        table = f'DocumentsCompression_{fmt}'
+        cursor.execute(f"DROP TABLE IF EXISTS {table}")
+        cursor.execute(f"CREATE TABLE {table} (id INT AUTO_INCREMENT PRIMARY KEY, doc_id VARCHAR(255) UNIQUE, "
+                       f"json_data LONGTEXT) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4")
+        rows = [(f'doc_{i}', s) for i, s in enumerate(stored)]
+        for i in range(0, len(rows), 500):
+            cursor.executemany(f"INSERT INTO {table} (doc_id, json_data) VALUES (%s, %s)", rows[i:i + 500])
+        conn.commit()
+        costs = []
+        for _ in range(rounds):
+            doc_ids = [f'doc_{i}' for i in rng.sample(range(len(rows)), fetch_num)]
+            start = time.perf_counter()
+            cursor.execute(f"SELECT doc_id, json_data FROM {table} WHERE doc_id IN ({','.join(['%s'] * fetch_num)})",
+                           doc_ids)
+            for _, json_data in cursor.fetchall():
+                decode_json_data(json_data)
+            costs.append(time.perf_counter() - start)
+        costs.sort()
+        results[fmt] = (statistics.median(costs), costs[int(len(costs) * 0.95)])
+        cursor.execute(f"DROP TABLE {table}")
+    cursor.close()
+    conn.close()
+    return results
+
+
+def main(args):
+    rng = random.Random(0)
+    chunks = [synthetic_chunk(rng, i, args.chars) for i in range(args.chunks)]
+    formats = ['none', 'zlib'] + (['zstd'] if zstandard is not None else [])
+    if zstandard is None:
+        print('zstandard is not installed, skip zstd')
+    stored_by_format = {}
+    print(f'chunks={args.chunks} content_chars~{args.chars}')
+    base_size = None
+    for fmt in formats:
+        stored = [encode_json_data(chunk, compression=fmt) for chunk in chunks]
+        stored_by_format[fmt] = stored
+        assert all(decode_json_data(s) == c for s, c in zip(stored[:50], chunks[:50]))
+        size = statistics.mean(len(s.encode('utf-8')) for s in stored)
+        base_size = base_size or size
+        encode_us = cpu_cost(lambda c: encode_json_data(c, compression=fmt), chunks) * 1e6
+        decode_us = cpu_cost(decode_json_data, stored) * 1e6
+        print(f'[{fmt:>4}] bytes/chunk={size:.0f} ({size / base_size:.2f}x) '
+              f'encode={encode_us:.1f}us decode={decode_us:.1f}us cpu/chunk')
+    if not args.no_mysql:
+        for fmt, (p50, p95) in bench_mysql(stored_by_format, args.rounds, args.fetch).items():
+            print(f'[{fmt:>4}] fetch+decode {args.fetch} parents: p50={p50 * 1000:.2f}ms p95={p95 * 1000:.2f}ms')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--chunks', type=int, default=2000)
+    parser.add_argument('--chars', type=int, default=1200, help='每个parent chunk的正文字符数')
+    parser.add_argument('--rounds', type=int, default=200)
+    parser.add_argument('--fetch', type=int, default=30, help='每次取回的parent数')
+    parser.add_argument('--no_mysql', action='store_true')
+    main(parser.parse_args())
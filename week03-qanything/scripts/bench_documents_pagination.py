@@ -0,0 +1,175 @@
+"""
+Documents按文件取chunk的基准：在本地MySQL的独立库中生成数百万行的Documents表，
+对比旧方式（doc_id LIKE 'file_id_%' + LIMIT/OFFSET分页）与新方式（(file_id, ordinal)索引 + keyset分页）
+取整个文件、取某一页chunk的耗时。
+
+用法: python scripts/bench_documents_pagination.py --rows 3000000 --files 200
+      已生成过的数据会复用，加 --rebuild 重新生成
+"""
+import argparse
+import json
+import os
+import random
+import statistics
+import sys
+import time
+import uuid
+
+root_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(root_dir)
+
+import mysql.connector
+
+from qanything_kernel.configs.model_config import (MYSQL_HOST_LOCAL, MYSQL_PORT_LOCAL, MYSQL_USER_LOCAL,
+                                                   MYSQL_PASSWORD_LOCAL)
+
+BENCH_DATABASE = 'qanything_bench'
+
+
+def connect():
+    conn = mysql.connector.connect(host=MYSQL_HOST_LOCAL, port=MYSQL_PORT_LOCAL, user=MYSQL_USER_LOCAL,
+                                   password=MYSQL_PASSWORD_LOCAL)
+    cursor = conn.cursor()
+    cursor.execute(f"CREATE DATABASE IF NOT EXISTS {BENCH_DATABASE}")
+    cursor.close()
+    conn.database = BENCH_DATABASE
+    return conn
+
+
+def build_fixture(conn, rows, payload_chars, rebuild):
+    cursor = conn.cursor()
+    if rebuild:
+        cursor.execute("DROP TABLE IF EXISTS Documents")
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS Documents (
+            id INT AUTO_INCREMENT PRIMARY KEY,
+            doc_id VARCHAR(255) UNIQUE,
+            file_id VARCHAR(64) DEFAULT NULL,
+            ordinal INT DEFAULT NULL,
+            json_data LONGTEXT,
+            INDEX idx_file_id_ordinal (file_id, ordinal)
+        ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4
+    """)
+    cursor.execute("SELECT COUNT(*) FROM Documents")
+    existing = cursor.fetchone()[0]
+    if existing >= rows:
+        print(f"reuse fixture: {existing} rows")
+        cursor.close()
+        return
+    print(f"generating {rows - existing} rows ...")
+    payload = json.dumps({'kwargs': {'page_content': '测' * payload_chars, 'metadata': {}}}, ensure_ascii=False)
+    rng = random.Random(existing)
+    start = time.perf_counter()
+    inserted, batch, batches = existing, [], 0
+    while inserted < rows:
+        file_id = uuid.uuid4().hex
+        for ordinal in range(rng.randint(5, 200)):
+            batch.append((f"{file_id}_{ordinal}", file_id, ordinal, payload))
+        if len(batch) >= 5000:
+            cursor.executemany("INSERT INTO Documents (doc_id, file_id, ordinal, json_data) VALUES (%s, %s, %s, %s)",
+                               batch)
+            conn.commit()
+            inserted += len(batch)
+            batch = []
+            batches += 1
+            if batches % 40 == 0:
+                print(f"  {inserted} rows, {time.perf_counter() - start:.0f}s")
+    if batch:
+        cursor.executemany("INSERT INTO Documents (doc_id, file_id, ordinal, json_data) VALUES (%s, %s, %s, %s)",
+                           batch)
+        conn.commit()
+    cursor.close()
+
+
+def sample_files(conn, files):
+    cursor = conn.cursor()
+    cursor.execute("SELECT MAX(id) FROM Documents")
+    max_id = cursor.fetchone()[0]
+    file_ids = set()
+    rng = random.Random(0)
+    while len(file_ids) < files:
+        cursor.execute("SELECT file_id FROM Documents WHERE id >= %s LIMIT 1", (rng.randint(1, max_id),))
+        row = cursor.fetchone()
+        if row:
+            file_ids.add(row[0])
+    cursor.close()
+    return list(file_ids)
+
+
+def legacy_fetch_file(cursor, file_id, batch_size=100):
+    results, offset = [], 0
+    while True:
+        cursor.execute("SELECT doc_id, json_data FROM Documents WHERE doc_id LIKE %s LIMIT %s OFFSET %s",
+                       (f"{file_id}_%", batch_size, offset))
+        rows = cursor.fetchall()
+        if not rows:
+            break
+        results.extend(rows)
+        offset += batch_size
+    results.sort(key=lambda x: int(x[0].split('_')[-1]))
+    return results
+
+
+def keyset_fetch_file(cursor, file_id, batch_size=500):
+    results, last_ordinal = [], -1
+    while True:
+        cursor.execute("SELECT doc_id, ordinal, json_data FROM Documents WHERE file_id = %s AND ordinal > %s "
+                       "ORDER BY ordinal LIMIT %s", (file_id, last_ordinal, batch_size))
+        rows = cursor.fetchall()
+        results.extend(rows)
+        if len(rows) < batch_size:
+            break
+        last_ordinal = rows[-1][1]
+    return results
+
+
+def legacy_page(cursor, file_id, page_id, page_limit):
+    # 旧版get_doc_completed：取整个文件后在内存里切页
+    return legacy_fetch_file(cursor, file_id)[(page_id - 1) * page_limit: page_id * page_limit]
+
+
+def keyset_page(cursor, file_id, page_id, page_limit):
+    cursor.execute("SELECT COUNT(*) FROM Documents WHERE file_id = %s", (file_id,))
+    cursor.fetchall()
+    cursor.execute("SELECT doc_id, json_data FROM Documents WHERE file_id = %s AND ordinal >= %s "
+                   "ORDER BY ordinal LIMIT %s", (file_id, (page_id - 1) * page_limit, page_limit))
+    return cursor.fetchall()
+
+
+def timeit(name, func, file_ids):
+    costs = []
+    for file_id in file_ids:
+        start = time.perf_counter()
+        func(file_id)
+        costs.append(time.perf_counter() - start)
+    costs.sort()
+    print(f"[{name:>16}] p50={statistics.median(costs) * 1000:.1f}ms "
+          f"p95={costs[int(len(costs) * 0.95)] * 1000:.1f}ms max={costs[-1] * 1000:.1f}ms")
+
+
+def main(args):
+    conn = connect()
+    build_fixture(conn, args.rows, args.payload_chars, args.rebuild)
+    file_ids = sample_files(conn, args.files)
+    cursor = conn.cursor(buffered=True)
+    # 结果一致性校验
+    for file_id in file_ids[:10]:
+        legacy = [row[0] for row in legacy_fetch_file(cursor, file_id)]
+        keyset = [row[0] for row in keyset_fetch_file(cursor, file_id)]
+        assert legacy == keyset, f"mismatch for {file_id}"
+    timeit('legacy_file', lambda f: legacy_fetch_file(cursor, f), file_ids)
+    timeit('keyset_file', lambda f: keyset_fetch_file(cursor, f), file_ids)
+    timeit('legacy_page', lambda f: legacy_page(cursor, f, 3, args.page_limit), file_ids)
+    timeit('keyset_page', lambda f: keyset_page(cursor, f, 3, args.page_limit), file_ids)
+    cursor.close()
+    conn.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rows', type=int, default=3000000)
+    parser.add_argument('--files', type=int, default=200, help='随机抽取用于测试的文件数')
+    parser.add_argument('--payload_chars', type=int, default=300, help='每个chunk的json_data内容长度')
+    parser.add_argument('--page_limit', type=int, default=10)
+    parser.add_argument('--rebuild', action='store_true')
+    main(parser.parse_args())
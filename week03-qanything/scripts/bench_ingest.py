@@ -0,0 +1,894 @@
+"""
+入库各阶段的基准，--stage选择：
+- docstore: 用合成的parent chunk在本地MySQL的独立库(qanything_bench)中测试MysqlStore.mset的写入吞吐(chunks/sec)，
+  对比旧方式（逐条add_document，每条一次INSERT IGNORE和提交）与新方式（add_documents_bulk，多行INSERT，每批一个事务），
+  并用同一批doc_id再写一遍模拟重新入库，校验ON DUPLICATE KEY UPDATE覆盖为新内容。
+- split: parent/child切分的CPU耗时(每MB文本)，对比旧方式（RecursiveCharacterTextSplitter对子串反复tokenize + deepcopy）
+  与新方式（TokenOffsetTextSplitter每段只tokenize一次 + metadata浅拷贝），并校验两者切分结果在容差内一致。
+- inject: LocalFileForInsert.inject_metadata的耗时，用小片段最多的两种文件：5万行的CSV（每行一个片段）和500页的PPTX
+  （按元素加载，每个标题/段落一个片段）。对比旧实现（每个片段查一次知识库名、对不断变长的合并文本反复tokenize）与新实现，
+  知识库名查询用模拟的MySQL往返耗时(--sql_rtt)，并校验两者合并结果一致。
+- pipeline: 单个文件的子chunk切分 -> embedding -> 写入Milvus/ES/MySQL。embedding服务和各存储用按批固定开销 + 按条耗时
+  模拟（--embed_ms_per_1k_tokens等），对比旧的串行方式（整个文件切完再整体embedding、再依次写三个存储）与
+  IngestPipeline的有界队列流水线，输出总耗时、各阶段利用率和瓶颈阶段，并校验写入的子chunk数、ES id一致。
+- parse: 混合语料（md/txt/csv/json/pptx/docx）的解析吞吐(files/min)随并发数的变化，对比旧方式（asyncio.to_thread，
+  受GIL限制）与ParseProcessPool子进程解析，并校验两种方式的解析结果一致。语料不含表格，子进程不需要连接MySQL。
+- reingest: 500页的合成手册先整体入库，再分别修改其中一页、在中间插入一页后重新入库，对比整体重新入库与按chunk指纹
+  增量入库（IncrementalPlan）需要embedding的子chunk数和耗时，存储与embedding服务同pipeline阶段的模拟方式。
+  另外模拟第一次入库写到约60%时中断，校验从指纹检查点续传只处理剩余部分，且最终指纹与不中断时一致。
+- dedup: 合成的一批手册依次上传到各自的知识库，其中--dup_ratio的文件是之前某个文件再次上传到另一个知识库。
+  对比Documents表每行存完整json与内容寻址（Documents存引用 + ChunkContent按hash存一份）的字节数，以及子chunk
+  headers带/不带知识库名时需要embedding的子chunk数和耗时（跨知识库复用向量走SelfParentRetriever._load_shared_vectors）。
+  同时比较两种前缀下的检索效果：与线上一样按知识库过滤，用子chunk中的原文片段作为问题，统计recall@k和MRR，
+  --quality_embedding service时请求embedding服务，默认用离线的字符bigram向量代替（只反映前缀对排序的影响）。
+
+用法: python scripts/bench_ingest.py --stage docstore --files 5 --chunks 2000
+      python scripts/bench_ingest.py --stage split --mb 2
+      python scripts/bench_ingest.py --stage inject --csv_rows 50000 --pptx_slides 500
+      python scripts/bench_ingest.py --stage pipeline --mb 2 --embed_concurrency 2 --store_concurrency 2
+      python scripts/bench_ingest.py --stage parse --parse_files 60 --processes 1,2,4,8
+      python scripts/bench_ingest.py --stage reingest --pages 500
+      python scripts/bench_ingest.py --stage dedup --dedup_files 20 --dup_ratio 0.3
+      python scripts/bench_ingest.py --stage dedup --quality_embedding service --quality_queries 20
+"""
+import argparse
+import asyncio
+import copy
+import functools
+import os
+import csv
+import json
+import math
+import random
+import re
+import sys
+import tempfile
+import time
+import uuid
+from collections import Counter
+from types import SimpleNamespace
+
+root_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(root_dir)
+
+from langchain_core.documents import Document
+from langchain.text_splitter import RecursiveCharacterTextSplitter
+from langchain_community.document_loaders import UnstructuredPowerPointLoader
+from pptx import Presentation
+import docx
+
+import qanything_kernel.connector.database.mysql.mysql_client as mysql_client_module
+import qanything_kernel.core.retriever.parent_retriever as parent_retriever_module
+from qanything_kernel.configs.model_config import (DEFAULT_CHILD_CHUNK_SIZE, DEFAULT_PARENT_CHUNK_SIZE, SEPARATORS,
+                                                   INGEST_SPLIT_BATCH, INGEST_QUEUE_SIZE, INGEST_EMBED_CONCURRENCY,
+                                                   INGEST_STORE_CONCURRENCY, INGEST_EMBED_TOKEN_BUDGET,
+                                                   PARSE_TIMEOUT_SECONDS)
+from qanything_kernel.core.retriever.docstrore import MysqlStore
+from qanything_kernel.core.retriever.general_document import LocalFileForInsert
+from qanything_kernel.core.retriever.incremental import IncrementalPlan, FingerprintCheckpoint, text_fingerprint
+from qanything_kernel.core.retriever.ingest_pipeline import IngestPipeline
+from qanything_kernel.core.retriever.parse_pool import ParseProcessPool
+from qanything_kernel.core.retriever.parent_retriever import SelfParentRetriever
+from qanything_kernel.utils.general_utils import num_tokens_embed, compute_chunk_token_counts, clear_string
+from qanything_kernel.utils.loader.csv_loader import CSVLoader
+from qanything_kernel.utils.json_codec import encode_json_data
+from qanything_kernel.utils.chunk_content import split_document_json, content_hash
+from qanything_kernel.utils.splitter import TokenOffsetTextSplitter
+
+BENCH_DATABASE = 'qanything_bench'
+SENTENCES = ['检索增强生成（RAG）把知识库中的相关文档作为上下文交给大模型，', '向量检索擅长语义匹配，BM25擅长关键词匹配，',
+             'The parent chunk is stored in MySQL and the child chunks in Milvus. ', '表格会被转换为markdown格式，保留行列结构，']
+
+
+def synthetic_file(rng, chunks, chars, version=0):
+    file_id = uuid.uuid4().hex
+    pairs = []
+    for i in range(chunks):
+        content = f'v{version} '
+        while len(content) < chars:
+            content += rng.choice(SENTENCES)
+        doc_id = f'{file_id}_{i}'
+        pairs.append((doc_id, Document(page_content=content, metadata={
+            'user_id': 'bench__1234', 'kb_id': 'KBbench', 'file_id': file_id, 'file_name': 'bench.pdf',
+            'doc_id': doc_id, 'headers': {}, 'page_id': i // 5,
+            'token_counts': {'content_len': len(content), 'embed': len(content) // 2}})))
+    return pairs
+
+
+def legacy_mset(store, pairs):
+    for doc_id, doc in pairs:
+        doc_json = doc.to_json()
+        if doc_json['kwargs'].get('metadata') is None:
+            doc_json['kwargs']['metadata'] = doc.metadata
+        store.mysql_client.add_document(doc_id, doc_json)
+
+
+def run_docstore(name, func, files):
+    chunks = sum(len(pairs) for pairs in files)
+    start = time.perf_counter()
+    for pairs in files:
+        func(pairs)
+    cost = time.perf_counter() - start
+    print(f'[{name:>12}] {chunks} chunks in {cost:.2f}s, {chunks / cost:.0f} chunks/sec')
+
+
+def synthetic_loader_docs(rng, total_bytes):
+    """模拟loader的输出：长短不一的段落，带完整的metadata"""
+    file_id = uuid.uuid4().hex
+    docs, size = [], 0
+    while size < total_bytes:
+        content = ''
+        target = rng.choice([200, 600, 1500, 4000, 12000])
+        while len(content) < target:
+            content += rng.choice(SENTENCES) + rng.choice(['', '', '\n', '\n\n'])
+        docs.append(Document(page_content=content, metadata={
+            'user_id': 'bench__1234', 'kb_id': 'KBbench', 'file_id': file_id, 'file_name': 'bench.pdf',
+            'nos_key': f'/workspace/QAnything/file/{file_id}/bench.pdf', 'file_url': '', 'title_lst': [],
+            'has_table': False, 'images': [], 'page_id': len(docs), 'faq_dict': {},
+            'headers': {'一级标题': f'第{len(docs) % 9}章'}}))
+        size += len(content.encode('utf-8'))
+    return docs, size
+
+
+def legacy_split(documents, parent_chunk_size):
+    """改动前aadd_documents中的切分流程，仅用于对比"""
+    parent_splitter = RecursiveCharacterTextSplitter(separators=SEPARATORS, chunk_size=parent_chunk_size,
+                                                     chunk_overlap=0, length_function=num_tokens_embed)
+    child_chunk_size = min(DEFAULT_CHILD_CHUNK_SIZE, int(parent_chunk_size / 2))
+    child_splitter = RecursiveCharacterTextSplitter(separators=SEPARATORS, chunk_size=child_chunk_size,
+                                                    chunk_overlap=int(child_chunk_size / 4),
+                                                    length_function=num_tokens_embed)
+    split_documents, need_split_docs = [], []
+    for doc in documents:
+        if doc.metadata['has_table'] or num_tokens_embed(doc.page_content) <= parent_chunk_size:
+            if need_split_docs:
+                split_documents.extend(parent_splitter.split_documents(need_split_docs))
+                need_split_docs = []
+            split_documents.append(doc)
+        else:
+            need_split_docs.append(doc)
+    if need_split_docs:
+        split_documents.extend(parent_splitter.split_documents(need_split_docs))
+    children = []
+    for i, doc in enumerate(split_documents):
+        sub_docs = child_splitter.split_documents([doc])
+        for _doc in sub_docs:
+            _doc.metadata['doc_id'] = f'{doc.metadata["file_id"]}_{i}'
+            _doc.page_content = f"[headers]({_doc.metadata['headers']})\n" + _doc.page_content
+            _doc.metadata['embed_tokens'] = num_tokens_embed(_doc.page_content)
+        children.append(sub_docs)
+        doc.metadata['token_counts'] = compute_chunk_token_counts(doc.page_content, doc.metadata.get('headers'))
+        doc.page_content = f"[headers]({doc.metadata['headers']})\n" + doc.page_content
+    embed_docs = copy.deepcopy([d for sub_docs in children for d in sub_docs])
+    for doc in embed_docs:
+        for key in ('title_lst', 'has_table', 'images', 'file_name', 'nos_key', 'faq_dict', 'page_id'):
+            del doc.metadata[key]
+    return split_documents, [[d.page_content for d in sub_docs] for sub_docs in children]
+
+
+def new_split(documents, parent_chunk_size):
+    child_chunk_size = min(DEFAULT_CHILD_CHUNK_SIZE, int(parent_chunk_size / 2))
+    # 直接调用SelfParentRetriever中的切分方法，不需要连接Milvus/MySQL
+    retriever = SimpleNamespace(
+        parent_splitter=TokenOffsetTextSplitter(separators=SEPARATORS, chunk_size=parent_chunk_size, chunk_overlap=0),
+        child_splitter=TokenOffsetTextSplitter(separators=SEPARATORS, chunk_size=child_chunk_size,
+                                               chunk_overlap=int(child_chunk_size / 4)),
+        child_metadata_fields=None, id_key='doc_id')
+    split_documents = SelfParentRetriever.split_parent_documents(retriever, documents, parent_chunk_size)
+    doc_ids = [f'{doc.metadata["file_id"]}_{i}' for i, doc in enumerate(split_documents)]
+    embed_docs, _ = SelfParentRetriever.build_child_documents(retriever, split_documents, doc_ids)
+    children = {}
+    for doc in embed_docs:
+        children.setdefault(doc.metadata['doc_id'], []).append(doc.page_content)
+    return split_documents, [children.get(doc_id, []) for doc_id in doc_ids]
+
+
+def bench_split(args):
+    rng = random.Random(0)
+    documents, size = synthetic_loader_docs(rng, int(args.mb * 1024 * 1024))
+    mb = size / 1024 / 1024
+    print(f'loader docs={len(documents)} text={mb:.2f}MB parent_chunk_size={args.parent_chunk_size}')
+    results = {}
+    for name, func in (('legacy', legacy_split), ('token_offset', new_split)):
+        docs = copy.deepcopy(documents)
+        start = time.process_time()
+        parents, children = func(docs, args.parent_chunk_size)
+        cost = time.process_time() - start
+        results[name] = (parents, children)
+        print(f'[{name:>12}] parents={len(parents)} children={sum(len(c) for c in children)} '
+              f'cpu={cost:.2f}s cpu/MB={cost / mb:.2f}s')
+
+    # 切分结果一致性：parent完全一致的比例、子chunk数的相对差异、新切分子chunk的真实token数是否超出chunk_size
+    legacy_parents, legacy_children = results['legacy']
+    new_parents, new_children = results['token_offset']
+    same_parents = sum(a.page_content == b.page_content for a, b in zip(legacy_parents, new_parents))
+    same_children = sum(a == b for a, b in zip(legacy_children, new_children))
+    legacy_total = sum(len(c) for c in legacy_children)
+    new_total = sum(len(c) for c in new_children)
+    diff = abs(new_total - legacy_total) / max(legacy_total, 1)
+    child_chunk_size = min(DEFAULT_CHILD_CHUNK_SIZE, int(args.parent_chunk_size / 2))
+    overflow = max(num_tokens_embed(c.split('\n', 1)[1]) - child_chunk_size
+                   for sub_docs in new_children for c in sub_docs)
+    print(f'identical parents: {same_parents}/{len(legacy_parents)}, '
+          f'parents with identical children: {same_children}/{len(legacy_children)}, '
+          f'children count diff: {diff:.2%}, max child overflow: {overflow} tokens')
+    assert abs(len(legacy_parents) - len(new_parents)) / max(len(legacy_parents), 1) <= args.tolerance, \
+        'parent chunks differ beyond tolerance'
+    assert diff <= args.tolerance, 'child chunks differ beyond tolerance'
+    print('equivalence check passed')
+
+
+class SimulatedKBClient:
+    """只实现inject_metadata用到的get_knowledge_base_name，每次查询按固定往返耗时计"""
+
+    def __init__(self, rtt):
+        self.rtt = rtt
+        self.queries = 0
+
+    def get_knowledge_base_name(self, kb_ids):
+        self.queries += 1
+        time.sleep(self.rtt)
+        return [('bench__1234', kb_ids[0], '基准测试知识库')]
+
+
+def legacy_inject_metadata(local_file, docs):
+    """改动前的inject_metadata，仅用于对比"""
+    new_docs = []
+    for doc in docs:
+        page_content = re.sub(r'\t+', ' ', doc.page_content)
+        page_content = re.sub(r'\n{3,}', '\n\n', page_content)
+        page_content = page_content.strip()
+        new_doc = Document(page_content=page_content)
+        new_doc.metadata.update({'user_id': local_file.user_id, 'kb_id': local_file.kb_id,
+                                 'file_id': local_file.file_id, 'file_name': local_file.file_name,
+                                 'nos_key': local_file.file_location, 'file_url': local_file.file_url,
+                                 'title_lst': doc.metadata.get("title_lst", []),
+                                 'has_table': doc.metadata.get("has_table", False),
+                                 'images': re.findall(r'!\[figure]\(\d+-figure-\d+.jpg.*?\)', page_content),
+                                 'page_id': doc.metadata.get("page_id", 0)})
+        kb_name = local_file.mysql_client.get_knowledge_base_name([local_file.kb_id])[0][2]
+        new_doc.metadata['headers'] = {"知识库名": kb_name, '文件名': local_file.file_name}
+        new_doc.metadata['faq_dict'] = doc.metadata.get('faq_dict', {})
+        new_docs.append(new_doc)
+    child_chunk_size = min(DEFAULT_CHILD_CHUNK_SIZE, int(local_file.chunk_size / 2))
+    merged_docs = []
+    for doc in new_docs:
+        if not merged_docs:
+            merged_docs.append(doc)
+            continue
+        last_doc = merged_docs[-1]
+        if num_tokens_embed(last_doc.page_content) + num_tokens_embed(doc.page_content) <= child_chunk_size or \
+                num_tokens_embed(doc.page_content) < child_chunk_size / 4:
+            tmp_content_slices = doc.page_content.split('\n')
+            tmp_content_slices_clear = [line for line in tmp_content_slices if clear_string(line) not in
+                                        [clear_string(t) for t in last_doc.metadata['title_lst']]]
+            last_doc.page_content += '\n\n' + '\n'.join(tmp_content_slices_clear)
+            last_doc.metadata['title_lst'] += doc.metadata.get('title_lst', [])
+            last_doc.metadata['has_table'] = last_doc.metadata.get('has_table', False) or doc.metadata.get(
+                'has_table', False)
+            last_doc.metadata['images'] += doc.metadata.get('images', [])
+        else:
+            merged_docs.append(doc)
+    local_file.docs = merged_docs
+
+
+def build_csv(path, rows):
+    rng = random.Random(0)
+    with open(path, 'w', newline='', encoding='utf-8') as f:
+        writer = csv.writer(f)
+        writer.writerow(['订单号', '客户', '城市', '商品', '数量', '备注'])
+        for i in range(rows):
+            writer.writerow([f'SO{i:08d}', f'客户{rng.randint(1, 5000)}', rng.choice(['北京', '上海', '广州', '杭州']),
+                             rng.choice(['笔记本', '显示器', '键盘', '鼠标']), rng.randint(1, 20), rng.choice(SENTENCES)])
+
+
+def build_pptx(path, slides):
+    rng = random.Random(0)
+    prs = Presentation()
+    for i in range(slides):
+        slide = prs.slides.add_slide(prs.slide_layouts[1])
+        slide.shapes.title.text = f'第{i + 1}页 检索流程'
+        body = slide.placeholders[1].text_frame
+        body.text = rng.choice(SENTENCES)
+        for _ in range(rng.randint(2, 5)):
+            body.add_paragraph().text = rng.choice(SENTENCES)
+    prs.save(path)
+
+
+def bench_inject(args):
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        csv_path, pptx_path = os.path.join(tmp_dir, 'orders.csv'), os.path.join(tmp_dir, 'slides.pptx')
+        build_csv(csv_path, args.csv_rows)
+        build_pptx(pptx_path, args.pptx_slides)
+        cases = [
+            (f'csv_{args.csv_rows}_rows', csv_path,
+             CSVLoader(csv_path, autodetect_encoding=True, csv_args={"delimiter": ",", "quotechar": '"'}).load()),
+            (f'pptx_{args.pptx_slides}_slides', pptx_path,
+             UnstructuredPowerPointLoader(pptx_path, mode='elements', strategy="fast").load()),
+        ]
+    for case, path, docs in cases:
+        print(f'{case}: {len(docs)} loader docs')
+        outputs = {}
+        for name in ('legacy', 'new'):
+            kb_client = SimulatedKBClient(args.sql_rtt / 1000)
+            local_file = LocalFileForInsert('bench__1234', 'KBbench', uuid.uuid4().hex, path, os.path.basename(path),
+                                            '', args.parent_chunk_size, kb_client)
+            run_docs = copy.deepcopy(docs)
+            start = time.perf_counter()
+            if name == 'legacy':
+                legacy_inject_metadata(local_file, run_docs)
+            else:
+                local_file.inject_metadata(run_docs)
+            cost = time.perf_counter() - start
+            outputs[name] = [doc.page_content for doc in local_file.docs]
+            print(f'  [{name:>6}] {cost:.2f}s, kb name queries={kb_client.queries}, merged docs={len(local_file.docs)}')
+        same = sum(a == b for a, b in zip(outputs['legacy'], outputs['new']))
+        diff = abs(len(outputs['legacy']) - len(outputs['new'])) / max(len(outputs['legacy']), 1)
+        print(f'  identical merged docs: {same}/{len(outputs["legacy"])}, merged count diff: {diff:.2%}')
+        assert diff <= args.tolerance, 'merged docs differ beyond tolerance'
+
+
+class SimulatedEmbeddings:
+    """按token预算合并请求，每个请求耗时 = 固定开销 + token数 * 单位耗时，服务端最多同时处理server_workers个请求"""
+
+    def __init__(self, args):
+        self.args = args
+        self.server = asyncio.Semaphore(args.embed_server_workers)
+
+    async def aembed_documents(self, texts, token_budget=None):
+        batches, batch, batch_tokens = [], [], 0
+        for text in texts:
+            tokens = len(text) // 2
+            if batch and token_budget and batch_tokens + tokens > token_budget:
+                batches.append(batch_tokens)
+                batch, batch_tokens = [], 0
+            batch.append(text)
+            batch_tokens += tokens
+        batches.append(batch_tokens)
+        for tokens in batches:
+            async with self.server:
+                await asyncio.sleep((self.args.rpc_ms + tokens / 1000 * self.args.embed_ms_per_1k_tokens) / 1000)
+        return [[0.0] for _ in texts]
+
+
+class SimulatedStore:
+    def __init__(self, rpc_ms, item_ms):
+        self.rpc_ms, self.item_ms = rpc_ms, item_ms
+        self.ids = []
+        self.writes = 0
+        self.fail_after = None  # 写入这么多次后抛错，模拟入库中断
+
+    async def write(self, count):
+        if self.fail_after is not None and self.writes >= self.fail_after:
+            raise RuntimeError(f'simulated crash after {self.writes} writes')
+        self.writes += 1
+        await asyncio.sleep((self.rpc_ms + count * self.item_ms) / 1000)
+
+    async def ainsert_embeddings(self, texts, embeddings, metadatas=None, **kwargs):
+        await self.write(len(texts))
+        self.ids.extend(zip([metadata['doc_id'] for metadata in metadatas or [{}] * len(texts)], texts, embeddings))
+        return list(range(len(texts)))
+
+    async def aadd_documents(self, docs, ids=None):
+        await self.write(len(docs))
+        self.ids.extend(ids)
+        return ids
+
+    async def amset(self, pairs):
+        await self.write(len(pairs))
+
+
+def simulated_retriever(args):
+    child_chunk_size = min(DEFAULT_CHILD_CHUNK_SIZE, int(args.parent_chunk_size / 2))
+    retriever = SimpleNamespace(
+        child_splitter=TokenOffsetTextSplitter(separators=SEPARATORS, chunk_size=child_chunk_size,
+                                               chunk_overlap=int(child_chunk_size / 4)),
+        child_metadata_fields=None, id_key='doc_id')
+    retriever.build_child_documents = functools.partial(SelfParentRetriever.build_child_documents, retriever)
+    vectorstore = SimulatedStore(args.rpc_ms, args.milvus_item_ms)
+    vectorstore.embedding_func = SimulatedEmbeddings(args)
+    retriever.vectorstore = vectorstore
+    retriever.docstore = SimulatedStore(args.rpc_ms, args.docstore_item_ms)
+    return retriever, SimulatedStore(args.rpc_ms, args.es_item_ms)
+
+
+async def legacy_ingest(retriever, es_store, documents, doc_ids, token_budget):
+    """改动前aadd_documents的执行顺序：全部切完 -> 全部embedding -> Milvus -> ES -> MySQL"""
+    embed_docs, full_docs = retriever.build_child_documents(documents, doc_ids)
+    texts = [doc.page_content for doc in embed_docs]
+    embeddings = await retriever.vectorstore.embedding_func.aembed_documents(texts, token_budget=token_budget)
+    await retriever.vectorstore.ainsert_embeddings(texts, embeddings)
+    await es_store.aadd_documents(embed_docs, ids=[doc.metadata['file_id'] + '_' + str(i)
+                                                   for i, doc in enumerate(embed_docs)])
+    await retriever.docstore.amset(full_docs)
+    return len(embed_docs)
+
+
+def bench_pipeline(args):
+    rng = random.Random(0)
+    documents, size = synthetic_loader_docs(rng, int(args.mb * 1024 * 1024))
+    parent_splitter = TokenOffsetTextSplitter(separators=SEPARATORS, chunk_size=args.parent_chunk_size, chunk_overlap=0)
+    parents = SelfParentRetriever.split_parent_documents(SimpleNamespace(parent_splitter=parent_splitter),
+                                                         documents, args.parent_chunk_size)
+    doc_ids = [f'{doc.metadata["file_id"]}_{i}' for i, doc in enumerate(parents)]
+    print(f'text={size / 1024 / 1024:.2f}MB parents={len(parents)} split_batch={args.split_batch} '
+          f'queue={args.queue_size} embed_concurrency={args.embed_concurrency} '
+          f'store_concurrency={args.store_concurrency}')
+
+    retriever, legacy_es = simulated_retriever(args)
+    start = time.perf_counter()
+    legacy_children = asyncio.run(legacy_ingest(retriever, legacy_es, copy.deepcopy(parents), doc_ids,
+                                                 args.token_budget))
+    legacy_wall = time.perf_counter() - start
+    print(f'[  legacy] children={legacy_children} wall={legacy_wall:.2f}s')
+
+    retriever, es_store = simulated_retriever(args)
+    time_record = {}
+    pipeline = IngestPipeline(retriever, es_store=es_store, time_record=time_record, split_batch=args.split_batch,
+                              queue_size=args.queue_size, embed_concurrency=args.embed_concurrency,
+                              store_concurrency=args.store_concurrency, embed_token_budget=args.token_budget)
+    start = time.perf_counter()
+    pks = asyncio.run(pipeline.run(copy.deepcopy(parents), doc_ids))
+    wall = time.perf_counter() - start
+    print(f'[pipeline] children={len(pks)} wall={wall:.2f}s speedup={legacy_wall / wall:.2f}x')
+    for name, stage in time_record['pipeline']['stages'].items():
+        print(f'  {name:>5}: util={stage["util"]:.0%} busy={stage["busy"]:.2f}s blocked={stage["blocked"]:.2f}s '
+              f'batches={stage["batches"]}')
+    print(f'  bottleneck: {time_record["pipeline"]["bottleneck"]}')
+    assert len(pks) == legacy_children == pipeline.child_count, 'child chunk count differs'
+    # ES id由文件内序号改为parent内序号，只校验数量和唯一性
+    assert len(set(es_store.ids)) == len(es_store.ids) == len(legacy_es.ids), 'es ids differ'
+    print('pipeline check passed')
+
+
+def synthetic_manual(rng, pages, file_id):
+    """每页一个Document，正文带页内编号，不同页的子chunk文本互不相同"""
+    docs = []
+    for page in range(pages):
+        content = f'第{page + 1}页\n'
+        target = rng.choice([600, 1200, 2400])
+        while len(content) < target:
+            content += rng.choice(SENTENCES) + f'（编号{rng.randint(0, 10 ** 6)}）' + rng.choice(['', '\n'])
+        docs.append(manual_page(file_id, page, content))
+    return docs
+
+
+def manual_page(file_id, page, content):
+    return Document(page_content=content, metadata={
+        'user_id': 'bench__1234', 'kb_id': 'KBbench', 'file_id': file_id, 'file_name': 'manual.pdf',
+        'nos_key': f'/workspace/QAnything/file/{file_id}/manual.pdf', 'file_url': '', 'title_lst': [],
+        'has_table': False, 'images': [], 'page_id': page, 'faq_dict': {}, 'headers': {'一级标题': f'第{page // 20}章'}})
+
+
+class SimulatedFingerprintDB:
+    """FingerprintCheckpoint落盘的目标，保存最后一次写入的指纹"""
+
+    def __init__(self):
+        self.fingerprints = None
+
+    def upsert_chunk_fingerprints(self, file_id, fingerprints):
+        self.fingerprints = json.loads(json.dumps(fingerprints))
+
+
+async def ingest_manual(args, retriever, es_store, parents, plan, db, reuse_vectors=None, interval=0.0):
+    """只把plan中变动的parent送入流水线，返回(pipeline, checkpoint, 耗时)；中途出错时返回已完成的部分"""
+    checkpoint = FingerprintCheckpoint(db, plan, interval=interval)
+    await checkpoint.begin()
+    pipeline = IngestPipeline(retriever, es_store=es_store, split_batch=args.split_batch, queue_size=args.queue_size,
+                              embed_concurrency=args.embed_concurrency, store_concurrency=args.store_concurrency,
+                              embed_token_budget=args.token_budget, reuse_vectors=reuse_vectors,
+                              checkpoint=checkpoint)
+    start = time.perf_counter()
+    try:
+        await pipeline.run([parents[i] for i in plan.changed], [plan.doc_ids[i] for i in plan.changed])
+        await checkpoint.finish()
+    except RuntimeError as e:
+        print(f'  interrupted: {e}')
+    return pipeline, checkpoint, time.perf_counter() - start
+
+
+def reuse_from(rows, plan):
+    sources = set(plan.vector_source_doc_ids)
+    return {text_fingerprint(text): vector for doc_id, text, vector in rows if doc_id in sources}
+
+
+def bench_reingest(args):
+    rng = random.Random(0)
+    file_id = uuid.uuid4().hex
+    pages = synthetic_manual(rng, args.pages, file_id)
+    parent_splitter = TokenOffsetTextSplitter(separators=SEPARATORS, chunk_size=args.parent_chunk_size, chunk_overlap=0)
+    split = functools.partial(SelfParentRetriever.split_parent_documents,
+                              SimpleNamespace(parent_splitter=parent_splitter))
+
+    # 第一次入库，得到指纹和写入Milvus的(doc_id, 文本, 向量)
+    parents = split(copy.deepcopy(pages), args.parent_chunk_size)
+    plan = IncrementalPlan(file_id, args.parent_chunk_size, parents)
+    retriever, es_store = simulated_retriever(args)
+    db = SimulatedFingerprintDB()
+    pipeline, checkpoint, _ = asyncio.run(ingest_manual(args, retriever, es_store, parents, plan, db))
+    old = db.fingerprints
+    rows = retriever.vectorstore.ids
+    print(f'manual: pages={args.pages} parents={len(parents)} children={pipeline.child_count}')
+
+    edited = copy.deepcopy(pages)
+    page = args.pages // 2
+    edited[page].page_content = edited[page].page_content.replace('。', '；', 1) + '本页内容已更新。'
+    inserted = copy.deepcopy(pages)
+    inserted.insert(page, manual_page(file_id, page, f'第{page + 1}页（新增）\n' + '新增的一页说明。' * 40))
+    for scenario, new_pages in (('edit one page', edited), ('insert one page', inserted)):
+        print(f'[{scenario}]')
+        new_parents = split(copy.deepcopy(new_pages), args.parent_chunk_size)
+        full_plan = IncrementalPlan(file_id, args.parent_chunk_size, new_parents)
+        retriever, es_store = simulated_retriever(args)
+        full_db = SimulatedFingerprintDB()
+        full, _, full_wall = asyncio.run(ingest_manual(args, retriever, es_store, new_parents, full_plan, full_db))
+        print(f'  [       full] parents={len(full_plan.changed)} embedded={full.embedded_count} wall={full_wall:.2f}s')
+
+        new_plan = IncrementalPlan(file_id, args.parent_chunk_size, new_parents, old=old)
+        retriever, es_store = simulated_retriever(args)
+        incr_db = SimulatedFingerprintDB()
+        incr, incr_checkpoint, incr_wall = asyncio.run(ingest_manual(args, retriever, es_store, new_parents, new_plan,
+                                                                     incr_db, reuse_from(rows, new_plan)))
+        print(f'  [incremental] parents={len(new_plan.changed)} unchanged={new_plan.unchanged_count} '
+              f'dirty={len(new_plan.dirty_doc_ids)} embedded={incr.embedded_count} '
+              f'reused={incr.child_count - incr.embedded_count} wall={incr_wall:.2f}s '
+              f'speedup={full_wall / max(incr_wall, 1e-6):.1f}x')
+        assert incr_db.fingerprints == full_db.fingerprints, 'incremental fingerprints differ from full re-ingest'
+        assert len(incr_checkpoint.manifest_chunks()) == len(new_parents)
+        assert incr.embedded_count < full.embedded_count / 10, 'incremental re-ingest embedded too many chunks'
+
+    # 第一次入库在写入约60%的批次后中断（进程被杀、卡住被取消），重新领取后从指纹检查点继续
+    print('[resume after interrupt]')
+    retriever, es_store = simulated_retriever(args)
+    batches = (len(parents) + args.split_batch - 1) // args.split_batch
+    retriever.docstore.fail_after = int(batches * 0.6)
+    crash_db = SimulatedFingerprintDB()
+    first, _, first_wall = asyncio.run(ingest_manual(args, retriever, es_store, parents,
+                                                     IncrementalPlan(file_id, args.parent_chunk_size, parents),
+                                                     crash_db))
+    resume_plan = IncrementalPlan(file_id, args.parent_chunk_size, parents, old=crash_db.fingerprints)
+    rows = retriever.vectorstore.ids
+    retriever, es_store = simulated_retriever(args)
+    resume, _, resume_wall = asyncio.run(ingest_manual(args, retriever, es_store, parents, resume_plan, crash_db,
+                                                       reuse_from(rows, resume_plan)))
+    print(f'  [first run] embedded={first.embedded_count} committed parents={resume_plan.unchanged_count} '
+          f'wall={first_wall:.2f}s')
+    print(f'  [   resume] parents={len(resume_plan.changed)} embedded={resume.embedded_count} '
+          f'reused={resume.child_count - resume.embedded_count} wall={resume_wall:.2f}s')
+    assert crash_db.fingerprints == old, 'resumed fingerprints differ from uninterrupted ingest'
+    assert first.embedded_count + resume.embedded_count < pipeline.embedded_count * 1.2, 'resume redid too much work'
+    print('reingest check passed')
+
+
+class SimulatedDedupDocstore(SimulatedStore):
+    """统计两种Documents存储方式的字节数，并按content_hash记录引用了该内容的doc_id，充当_load_shared_vectors的mysql_client"""
+    document_json = staticmethod(MysqlStore.document_json)
+
+    def __init__(self, rpc_ms, item_ms):
+        super().__init__(rpc_ms, item_ms)
+        self.mysql_client = self
+        self.full_bytes = 0
+        self.ref_bytes = 0
+        self.content_bytes = 0
+        self.owners = {}  # content_hash -> [(file_id, doc_id)]
+
+    async def amset(self, pairs):
+        await self.write(len(pairs))
+        for doc_id, doc in pairs:
+            doc_json = self.document_json(doc)
+            self.full_bytes += len(encode_json_data(doc_json))
+            shared, ref = split_document_json(doc_json)
+            ref['content_ref'] = ref_hash = content_hash(shared)
+            self.ref_bytes += len(encode_json_data(ref))
+            if ref_hash not in self.owners:
+                self.content_bytes += len(encode_json_data(shared))
+            self.owners.setdefault(ref_hash, []).append((doc.metadata['file_id'], doc_id))
+
+    def get_doc_ids_by_content_hashes(self, hashes, exclude_file_id=None):
+        found = {}
+        for ref_hash in hashes:
+            doc_ids = [doc_id for file_id, doc_id in self.owners.get(ref_hash, []) if file_id != exclude_file_id]
+            if doc_ids:
+                found[ref_hash] = min(doc_ids)
+        return found
+
+
+def dedup_corpus(args):
+    """返回[(kb_name, file_id, pages)]，重复上传的文件内容与源文件相同，归属信息换成新的知识库和file_id"""
+    rng = random.Random(0)
+    files = []
+    for i in range(args.dedup_files):
+        kb_name = f'知识库{i}'
+        file_id = uuid.uuid4().hex
+        if files and rng.random() < args.dup_ratio:
+            pages = copy.deepcopy(rng.choice(files)[2])
+            pages = [manual_page(file_id, page.metadata['page_id'], page.page_content) for page in pages]
+        else:
+            pages = synthetic_manual(rng, args.dedup_pages, file_id)
+        for page in pages:
+            page.metadata['kb_id'] = f'KBbench{i}'
+            page.metadata['headers'] = {'知识库名': kb_name, '文件名': 'manual.pdf', **page.metadata['headers']}
+        files.append((kb_name, file_id, pages))
+    return files
+
+
+async def ingest_dedup_corpus(args, retriever, es_store, files, split):
+    for _, file_id, pages in files:
+        parents = split(copy.deepcopy(pages), args.parent_chunk_size)
+        doc_ids = [f'{file_id}_{i}' for i in range(len(parents))]
+
+        async def shared_vectors(full_docs, file_id=file_id):
+            return await SelfParentRetriever._load_shared_vectors(retriever, file_id, full_docs)
+        pipeline = IngestPipeline(retriever, es_store=es_store, split_batch=args.split_batch,
+                                  queue_size=args.queue_size, embed_concurrency=args.embed_concurrency,
+                                  store_concurrency=args.store_concurrency, embed_token_budget=args.token_budget,
+                                  shared_vectors=shared_vectors)
+        await pipeline.run(parents, doc_ids)
+        retriever.stats['children'] += pipeline.child_count
+        retriever.stats['embedded'] += pipeline.embedded_count
+        retriever.stats['shared'] += pipeline.shared_count
+
+
+def bigram_embedding(text):
+    """离线的代理向量：归一化的字符bigram词频"""
+    counts = Counter(text[i:i + 2] for i in range(len(text) - 1))
+    norm = math.sqrt(sum(v * v for v in counts.values())) or 1.0
+    return {k: v / norm for k, v in counts.items()}
+
+
+def sparse_cosine(a, b):
+    if len(a) > len(b):
+        a, b = b, a
+    return sum(v * b.get(k, 0.0) for k, v in a.items())
+
+
+def dense_cosine(a, b):
+    dot = sum(x * y for x, y in zip(a, b))
+    return dot / ((math.sqrt(sum(x * x for x in a)) * math.sqrt(sum(y * y for y in b))) or 1.0)
+
+
+def retrieval_quality(args, files, results):
+    """按知识库过滤检索（与线上一致），原文片段作为问题，返回{是否带知识库名: (recall@k, MRR)}"""
+    kb_of = {file_id: kb_name for kb_name, file_id, _ in files}
+    children = {}  # 是否带知识库名 -> 知识库名 -> [子chunk文本]
+    for with_kb_name, retriever in results.items():
+        per_kb = children.setdefault(with_kb_name, {})
+        for doc_id, text, _ in retriever.vectorstore.ids:
+            per_kb.setdefault(kb_of[doc_id.rsplit('_', 1)[0]], []).append(text)
+    rng = random.Random(1)
+    queries = {}
+    for kb_name, texts in children[True].items():
+        segments = sorted({seg for text in texts for seg in re.findall(r'[^（）\n]+（编号\d+）', text)})
+        queries[kb_name] = rng.sample(segments, min(args.quality_queries, len(segments)))
+    if args.quality_embedding == 'service':
+        from qanything_kernel.connector.embedding.embedding_for_online_client import YouDaoEmbeddings
+        model = YouDaoEmbeddings()
+        embed_docs, embed_query, score = model.embed_documents, model.embed_query, dense_cosine
+    else:
+        embed_docs, embed_query, score = lambda texts: [bigram_embedding(t) for t in texts], bigram_embedding, \
+            sparse_cosine
+    quality = {}
+    for with_kb_name, per_kb in children.items():
+        hits, reciprocal, total = 0, 0.0, 0
+        for kb_name, segments in queries.items():
+            texts = per_kb[kb_name]
+            vectors = embed_docs(texts)
+            for segment in segments:
+                query = embed_query(segment)
+                ranked = sorted(range(len(texts)), key=lambda i: -score(query, vectors[i]))
+                # 片段可能因为overlap同时出现在相邻的两个子chunk中，召回其中任意一个都算命中
+                rank = next((r for r, i in enumerate(ranked) if segment in texts[i]), None)
+                total += 1
+                if rank is not None:
+                    hits += rank < args.quality_k
+                    reciprocal += 1 / (rank + 1)
+        quality[with_kb_name] = (hits / max(total, 1), reciprocal / max(total, 1))
+    return quality
+
+
+def bench_dedup(args):
+    files = dedup_corpus(args)
+    parent_splitter = TokenOffsetTextSplitter(separators=SEPARATORS, chunk_size=args.parent_chunk_size, chunk_overlap=0)
+    split = functools.partial(SelfParentRetriever.split_parent_documents,
+                              SimpleNamespace(parent_splitter=parent_splitter))
+    unique_texts = {pages[0].page_content for _, _, pages in files}
+    print(f'files={len(files)} unique={len(unique_texts)} duplicated uploads={len(files) - len(unique_texts)} '
+          f'pages/file={args.dedup_pages}')
+    results = {}
+    for with_kb_name in (True, False):
+        parent_retriever_module.CHILD_HEADERS_WITH_KB_NAME = with_kb_name
+        retriever, es_store = simulated_retriever(args)
+        retriever.docstore = SimulatedDedupDocstore(args.rpc_ms, args.docstore_item_ms)
+        vectorstore = retriever.vectorstore
+        # 与_load_reuse_vectors相同：按doc_id取出已写入Milvus的子chunk向量，按文本指纹索引
+        retriever._load_reuse_vectors = lambda doc_ids, vectorstore=vectorstore: {
+            text_fingerprint(text): vector for doc_id, text, vector in vectorstore.ids if doc_id in set(doc_ids)}
+        retriever.stats = {'children': 0, 'embedded': 0, 'shared': 0}
+        start = time.perf_counter()
+        asyncio.run(ingest_dedup_corpus(args, retriever, es_store, files, split))
+        wall = time.perf_counter() - start
+        results[with_kb_name] = retriever
+        docstore, stats = retriever.docstore, retriever.stats
+        print(f'[child headers {"with" if with_kb_name else "without"} kb name] children={stats["children"]} '
+              f'embedded={stats["embedded"]} shared={stats["shared"]} wall={wall:.2f}s')
+    docstore = results[True].docstore
+    dedup_bytes = docstore.ref_bytes + docstore.content_bytes
+    print(f'Documents bytes: full json={docstore.full_bytes / 1024 / 1024:.2f}MB, '
+          f'refs+contents={dedup_bytes / 1024 / 1024:.2f}MB '
+          f'(refs={docstore.ref_bytes / 1024 / 1024:.2f}MB), saved={1 - dedup_bytes / docstore.full_bytes:.1%}')
+    with_name, without_name = results[True].stats, results[False].stats
+    # 带知识库名时子chunk文本不同，不能跨知识库复用；不带时重复上传的文件不需要再embedding
+    assert with_name['shared'] == 0
+    assert without_name['embedded'] + without_name['shared'] == without_name['children']
+    if len(files) > len(unique_texts):
+        assert without_name['embedded'] < with_name['embedded'], 'duplicate uploads were embedded again'
+        assert dedup_bytes < docstore.full_bytes, 'content-addressed storage is not smaller'
+    quality = retrieval_quality(args, files, results)
+    for with_kb_name in (True, False):
+        recall, mrr = quality[with_kb_name]
+        print(f'[child headers {"with" if with_kb_name else "without"} kb name] {args.quality_embedding} embedding: '
+              f'recall@{args.quality_k}={recall:.3f} MRR={mrr:.3f}')
+    # 检索按kb_id过滤，同一知识库内所有子chunk的知识库名都相同，去掉后召回不应变差
+    assert quality[False][0] >= quality[True][0] - args.quality_tolerance, 'recall dropped without kb name'
+    print('dedup check passed')
+
+
+def build_parse_corpus(dir_path, files):
+    """六种格式轮流生成，每个文件几十KB，与日常上传的文档规模相当"""
+    rng = random.Random(0)
+    paths = []
+    for i in range(files):
+        kind = ['md', 'txt', 'csv', 'json', 'pptx', 'docx'][i % 6]
+        path = os.path.join(dir_path, f'file_{i}.{kind}')
+        paragraphs = [''.join(rng.choice(SENTENCES) for _ in range(rng.randint(3, 12))) for _ in range(120)]
+        if kind == 'md':
+            with open(path, 'w', encoding='utf-8') as f:
+                for j, paragraph in enumerate(paragraphs):
+                    if j % 10 == 0:
+                        f.write(f'## 第{j // 10 + 1}节 检索流程\n\n')
+                    f.write(paragraph + '\n\n')
+        elif kind == 'txt':
+            with open(path, 'w', encoding='utf-8') as f:
+                f.write('\n\n'.join(paragraphs))
+        elif kind == 'csv':
+            build_csv(path, 2000)
+        elif kind == 'json':
+            with open(path, 'w', encoding='utf-8') as f:
+                json.dump({'sections': [{'title': f'第{j}节', 'content': p} for j, p in enumerate(paragraphs)]}, f,
+                          ensure_ascii=False)
+        elif kind == 'pptx':
+            build_pptx(path, 60)
+        else:
+            document = docx.Document()
+            for j, paragraph in enumerate(paragraphs):
+                if j % 10 == 0:
+                    document.add_heading(f'第{j // 10 + 1}节 检索流程', level=2)
+                document.add_paragraph(paragraph)
+            document.save(path)
+        paths.append(path)
+    return paths
+
+
+def parse_local_file(path, parent_chunk_size):
+    return LocalFileForInsert('bench__1234', 'KBbench', uuid.uuid4().hex, path, os.path.basename(path), '',
+                              parent_chunk_size, SimulatedKBClient(0), kb_name='基准测试知识库')
+
+
+async def parse_with_threads(paths, concurrency, parent_chunk_size):
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def parse(path):
+        async with semaphore:
+            local_file = parse_local_file(path, parent_chunk_size)
+            await asyncio.to_thread(local_file.split_file_to_docs)
+            return local_file
+
+    return await asyncio.gather(*[parse(path) for path in paths])
+
+
+async def parse_with_processes(paths, processes, parent_chunk_size):
+    pool = ParseProcessPool(processes)
+    await pool.start()  # 子进程启动、导入解析库的耗时不计入吞吐
+    try:
+        start = time.perf_counter()
+        local_files = [parse_local_file(path, parent_chunk_size) for path in paths]
+        await asyncio.gather(*[pool.parse(local_file, PARSE_TIMEOUT_SECONDS) for local_file in local_files])
+        return local_files, time.perf_counter() - start
+    finally:
+        pool.close()
+
+
+def bench_parse(args):
+    concurrencies = [int(n) for n in args.processes.split(',')]
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        paths = build_parse_corpus(tmp_dir, args.parse_files)
+        print(f'files={len(paths)} (md/txt/csv/json/pptx/docx) cpu_count={os.cpu_count()}')
+        baseline = {}
+        for concurrency in concurrencies:
+            start = time.perf_counter()
+            local_files = asyncio.run(parse_with_threads(paths, concurrency, args.parent_chunk_size))
+            wall = time.perf_counter() - start
+            baseline = {os.path.basename(f.file_path): [d.page_content for d in f.docs] for f in local_files}
+            print(f'[ thread x{concurrency}] files/min={len(paths) / wall * 60:.1f} wall={wall:.2f}s')
+        single = None
+        for concurrency in concurrencies:
+            local_files, wall = asyncio.run(parse_with_processes(paths, concurrency, args.parent_chunk_size))
+            files_per_min = len(paths) / wall * 60
+            single = single or files_per_min
+            print(f'[process x{concurrency}] files/min={files_per_min:.1f} wall={wall:.2f}s '
+                  f'scaling={files_per_min / single:.2f}x')
+            results = {os.path.basename(f.file_path): [d.page_content for d in f.docs] for f in local_files}
+            assert results == baseline, 'process pool parse result differs from in-process parse'
+    print('parse result check passed')
+
+
+def bench_docstore(args):
+    # 写到独立的基准库，不影响线上的Documents表
+    mysql_client_module.MYSQL_DATABASE_LOCAL = BENCH_DATABASE
+    mysql_client = mysql_client_module.KnowledgeBaseManager()
+    store = MysqlStore(mysql_client)
+    rng = random.Random(0)
+    legacy_files = [synthetic_file(rng, args.chunks, args.chars) for _ in range(args.files)]
+    bulk_files = [synthetic_file(rng, args.chunks, args.chars) for _ in range(args.files)]
+    print(f'files={args.files} chunks/file={args.chunks} chars/chunk~{args.chars}')
+
+    run_docstore('legacy', lambda pairs: legacy_mset(store, pairs), legacy_files)
+    run_docstore('bulk', store.mset, bulk_files)
+
+    # 重新入库：同样的doc_id、新的内容
+    reingest_files = [[(doc_id, Document(page_content='v1 ' + doc.page_content[3:], metadata=doc.metadata))
+                       for doc_id, doc in pairs] for pairs in bulk_files]
+    run_docstore('bulk_reingest', store.mset, reingest_files)
+    sample_ids = [pairs[0][0] for pairs in reingest_files]
+    # 开启DOCUMENT_DEDUP时Documents中只有内容引用，按读取接口还原后再校验
+    docs = mysql_client.get_documents_by_doc_ids(sample_ids)
+    assert len(docs) == len(sample_ids)
+    assert all(doc['kwargs']['page_content'].startswith('v1 ') for doc in docs.values()), \
+        're-ingest did not overwrite existing rows'
+    print('re-ingest check passed')
+
+    # 同时回收ChunkContent中不再被引用的内容
+    all_ids = [doc_id for pairs in legacy_files + bulk_files for doc_id, _ in pairs]
+    mysql_client.delete_documents_by_doc_ids(all_ids)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--stage',
+                        choices=['docstore', 'split', 'inject', 'pipeline', 'parse', 'reingest', 'dedup'],
+                        default='docstore')
+    parser.add_argument('--files', type=int, default=5)
+    parser.add_argument('--chunks', type=int, default=2000, help='每个文件的parent chunk数')
+    parser.add_argument('--chars', type=int, default=800, help='每个parent chunk的正文字符数')
+    parser.add_argument('--mb', type=float, default=2, help='split阶段的文本总量(MB)')
+    parser.add_argument('--parent_chunk_size', type=int, default=DEFAULT_PARENT_CHUNK_SIZE)
+    parser.add_argument('--tolerance', type=float, default=0.02, help='切分结果chunk数允许的相对差异')
+    parser.add_argument('--csv_rows', type=int, default=50000)
+    parser.add_argument('--pptx_slides', type=int, default=500)
+    parser.add_argument('--sql_rtt', type=float, default=0.5, help='模拟的知识库名查询耗时(ms)')
+    parser.add_argument('--split_batch', type=int, default=INGEST_SPLIT_BATCH)
+    parser.add_argument('--queue_size', type=int, default=INGEST_QUEUE_SIZE)
+    parser.add_argument('--embed_concurrency', type=int, default=INGEST_EMBED_CONCURRENCY)
+    parser.add_argument('--store_concurrency', type=int, default=INGEST_STORE_CONCURRENCY)
+    parser.add_argument('--token_budget', type=int, default=INGEST_EMBED_TOKEN_BUDGET)
+    parser.add_argument('--embed_server_workers', type=int, default=2, help='模拟的embedding服务并发处理能力')
+    parser.add_argument('--embed_ms_per_1k_tokens', type=float, default=20)
+    parser.add_argument('--rpc_ms', type=float, default=5, help='每次请求的固定开销(ms)')
+    parser.add_argument('--milvus_item_ms', type=float, default=0.05)
+    parser.add_argument('--es_item_ms', type=float, default=0.1)
+    parser.add_argument('--docstore_item_ms', type=float, default=0.2)
+    parser.add_argument('--parse_files', type=int, default=60)
+    parser.add_argument('--processes', type=str, default='1,2,4', help='parse阶段依次测试的并发数，逗号分隔')
+    parser.add_argument('--pages', type=int, default=500, help='reingest阶段合成手册的页数')
+    parser.add_argument('--dedup_files', type=int, default=20, help='dedup阶段上传的文件数')
+    parser.add_argument('--dedup_pages', type=int, default=40, help='dedup阶段每个文件的页数')
+    parser.add_argument('--dup_ratio', type=float, default=0.3, help='dedup阶段重复上传到其他知识库的文件比例')
+    parser.add_argument('--quality_embedding', choices=['bigram', 'service'], default='bigram',
+                        help='dedup阶段比较检索效果所用的向量，service请求embedding服务')
+    parser.add_argument('--quality_queries', type=int, default=10, help='dedup阶段每个知识库的问题数')
+    parser.add_argument('--quality_k', type=int, default=5)
+    parser.add_argument('--quality_tolerance', type=float, default=0.02, help='去掉知识库名后recall允许下降的幅度')
+    args = parser.parse_args()
+    {'docstore': bench_docstore, 'split': bench_split, 'inject': bench_inject,
+     'pipeline': bench_pipeline, 'parse': bench_parse, 'reingest': bench_reingest,
+     'dedup': bench_dedup}[args.stage](args)
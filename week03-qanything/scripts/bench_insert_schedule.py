@@ -0,0 +1,176 @@
+"""
+入库队列调度的离散事件模拟：用合成的上传轨迹对比原来按时间顺序领取(fifo)与多租户公平调度(fair，FairScheduler)
+下各租户文件的等待+处理延迟分布。不连接MySQL，领取逻辑与claim_files一致：每个(user_id, kb_id)最早的
+--head个大文件和小文件参与调度，并发上限按所有worker上正在入库的文件数计算。
+
+轨迹（时间单位秒）：
+- bulk: 一个用户在t=0向同一个知识库上传--bulk_files个文件（大小按对数正态分布，PDF/DOCX为主）；
+- multi_kb: 一个用户持续向--multi_kbs个知识库上传中等文件；
+- interactive_*: --interactive个用户按泊松过程零星上传，以小文件为主。
+处理耗时 = 固定开销 + 实际字符数 / --chars_per_sec，实际字符数在估算值上下随机浮动。
+两种调度的总并发相同：fifo每个worker有concurrency + express_slots个槽位，fair其中express_slots个只给小文件用。
+
+用法: python scripts/bench_insert_schedule.py --workers 4 --concurrency 2 --express_slots 1 --bulk_files 5000
+      python scripts/bench_insert_schedule.py --user_max_running 4 --duration 1800
+"""
+import argparse
+import heapq
+import os
+import random
+import sys
+
+root_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(root_dir)
+
+from qanything_kernel.utils.insert_scheduler import FairScheduler, PendingFile, estimate_chars
+
+EXTS = ['.pdf', '.docx', '.txt', '.md', '.pptx', '.xlsx']
+
+
+def synthetic_trace(args, rng):
+    """返回按到达时间排序的[(到达时间, PendingFile, 租户名)]"""
+    arrivals = []
+
+    def add(t, tenant, user_id, kb_id, size, ext):
+        file = PendingFile(len(arrivals) + 1, user_id, kb_id, f'{tenant}_{len(arrivals)}{ext}', int(size))
+        arrivals.append((t, file, tenant))
+
+    for i in range(args.bulk_files):
+        add(i * 1e-3, 'bulk', 'bulk_user', 'bulk_kb', rng.lognormvariate(13.5, 1.0), rng.choice(['.pdf', '.docx']))
+    t = 0.0
+    while True:
+        t += rng.expovariate(args.multi_rate)
+        if t > args.duration:
+            break
+        add(t, 'multi_kb', 'multi_user', f'kb_{rng.randrange(args.multi_kbs)}', rng.lognormvariate(12.5, 0.8),
+            rng.choice(EXTS))
+    for u in range(args.interactive):
+        t = 0.0
+        while True:
+            t += rng.expovariate(args.interactive_rate)
+            if t > args.duration:
+                break
+            small = rng.random() < 0.7
+            add(t, f'interactive_{u}', f'user_{u}', f'user_{u}_kb', rng.lognormvariate(10.5 if small else 13, 0.7),
+                rng.choice(['.txt', '.md', '.docx']) if small else rng.choice(EXTS))
+    arrivals.sort(key=lambda a: (a[0], a[1].id))
+    return arrivals
+
+
+def service_time(args, rng, file):
+    return args.overhead + estimate_chars(file.file_name, file.file_size) * rng.uniform(0.7, 1.3) / args.chars_per_sec
+
+
+def queue_key(args, file):
+    return file.user_id, file.kb_id, 0 < file.file_size <= args.express_max_bytes
+
+
+def heads(pending, per_flow):
+    """与claim_files的ROW_NUMBER() OVER (PARTITION BY user_id, kb_id, 是否小文件)一致，按到达顺序返回"""
+    return sorted((file for files in pending.values() for file in files[:per_flow]), key=lambda file: file.id)
+
+
+def simulate(args, trace, policy):
+    rng = random.Random(args.seed + 1)
+    schedulers = [FairScheduler(quantum=args.quantum, express_max_bytes=args.express_max_bytes,
+                                user_max_running=args.user_max_running, kb_max_running=args.kb_max_running,
+                                overrides={}) for _ in range(args.workers)]
+    slots = [[args.concurrency, args.express_slots] for _ in range(args.workers)]
+    if policy == 'fifo':
+        slots = [[args.concurrency + args.express_slots, 0] for _ in range(args.workers)]
+    tenants = {file.id: tenant for _, file, tenant in trace}
+    arrived_at = {file.id: t for t, file, _ in trace}
+    pending = {}  # (user_id, kb_id, 是否小文件) -> 按到达顺序的待入库文件
+    running = {}  # (user_id, kb_id) -> 正在入库的文件数
+    events = []  # (时间, 序号, 类型, 数据)
+    for i, (t, file, _) in enumerate(trace):
+        heapq.heappush(events, (t, i, 'arrive', file))
+    seq = len(trace)
+    latencies = {}
+    now = 0.0
+    while events:
+        now, _, kind, data = heapq.heappop(events)
+        if kind == 'arrive':
+            pending.setdefault(queue_key(args, data), []).append(data)
+        else:
+            worker, lane, file = data
+            slots[worker][lane] += 1
+            running[file.flow] -= 1
+            latencies.setdefault(tenants[file.id], []).append(now - arrived_at[file.id])
+        # 同一时刻的事件处理完再调度
+        if events and events[0][0] == now:
+            continue
+        for worker in range(args.workers):
+            free, express = slots[worker]
+            if not pending or (free <= 0 and express <= 0):
+                continue
+            candidates = heads(pending, args.head)
+            if policy == 'fifo':
+                selected = [(file, False) for file in candidates[:free]]
+            else:
+                selected = schedulers[worker].select(candidates, running, free, express)
+            taken = set()
+            for file, is_express in selected:
+                lane = 1 if is_express else 0
+                slots[worker][lane] -= 1
+                running[file.flow] = running.get(file.flow, 0) + 1
+                taken.add(file.id)
+                seq += 1
+                heapq.heappush(events, (now + service_time(args, rng, file), seq, 'done', (worker, lane, file)))
+            for file, _ in selected:
+                key = queue_key(args, file)
+                pending[key] = [other for other in pending[key] if other.id not in taken]
+                if not pending[key]:
+                    del pending[key]
+    return latencies, now
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(int(len(values) * p), len(values) - 1)]
+
+
+def report(policy, latencies, makespan):
+    print(f'\n[{policy}] makespan={makespan:.0f}s')
+    print(f'{"tenant":<16}{"files":>7}{"p50(s)":>10}{"p90(s)":>10}{"p99(s)":>10}{"max(s)":>10}')
+    for tenant in sorted(latencies, key=lambda t: (not t.startswith('bulk'), t)):
+        values = latencies[tenant]
+        print(f'{tenant:<16}{len(values):>7}{percentile(values, 0.5):>10.0f}{percentile(values, 0.9):>10.0f}'
+              f'{percentile(values, 0.99):>10.0f}{max(values):>10.0f}')
+    others = [v for tenant, values in latencies.items() if tenant.startswith('interactive') for v in values]
+    if others:
+        print(f'{"interactive(all)":<16}{len(others):>7}{percentile(others, 0.5):>10.0f}'
+              f'{percentile(others, 0.9):>10.0f}{percentile(others, 0.99):>10.0f}{max(others):>10.0f}')
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--concurrency', type=int, default=2, help='每个worker的普通并发(INSERT_WORKER_CONCURRENCY)')
+    parser.add_argument('--express_slots', type=int, default=1, help='每个worker只给小文件用的并发')
+    parser.add_argument('--express_max_bytes', type=int, default=512 * 1024)
+    parser.add_argument('--quantum', type=int, default=200000, help='DRR每轮配额(估算字符数)')
+    parser.add_argument('--head', type=int, default=16, help='每个流参与调度的文件数(INSERT_SCHEDULE_HEAD)')
+    parser.add_argument('--user_max_running', type=int, default=0)
+    parser.add_argument('--kb_max_running', type=int, default=0)
+    parser.add_argument('--bulk_files', type=int, default=5000)
+    parser.add_argument('--multi_kbs', type=int, default=10)
+    parser.add_argument('--multi_rate', type=float, default=0.05, help='multi_kb用户每秒上传的文件数')
+    parser.add_argument('--interactive', type=int, default=8)
+    parser.add_argument('--interactive_rate', type=float, default=0.01, help='每个interactive用户每秒上传的文件数')
+    parser.add_argument('--duration', type=float, default=3600, help='非bulk用户持续上传的时长(秒)')
+    parser.add_argument('--chars_per_sec', type=float, default=20000, help='单个文件入库的处理速度')
+    parser.add_argument('--overhead', type=float, default=2.0, help='每个文件的固定处理耗时(秒)')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    trace = synthetic_trace(args, random.Random(args.seed))
+    print(f'trace: {len(trace)} files, workers={args.workers}, concurrency={args.concurrency}, '
+          f'express_slots={args.express_slots}, quantum={args.quantum}')
+    for policy in ('fifo', 'fair'):
+        latencies, makespan = simulate(args, trace, policy)
+        report(policy, latencies, makespan)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,172 @@
+"""
+JSON解析的吞吐(MB/s)和峰值内存(RSS)：对比JSONLoader（json.load整体读入、递归展开、每条记录一个Document，
+inject_metadata再合并）与StreamingJSONLoader（ijson事件流迭代展开，直接输出按子chunk预算分好的块）。
+测试文件是记录数组，记录中有嵌套对象和数组，约--big_ratio的记录带一个很长的明细数组（超过一块，按路径分块）。
+每种方式在单独的子进程中执行，校验流式解析输出了每条记录的编号、且没有明显超过子chunk预算的块。
+--deep额外生成一个嵌套--deep层的文件，JSONLoader递归展开会超过递归深度，StreamingJSONLoader按max_depth截断路径。
+
+用法: python scripts/bench_json_loader.py --mb 200
+      python scripts/bench_json_loader.py --mb 50 --cases stream --deep 100000
+"""
+import argparse
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+
+root_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(root_dir)
+
+from bench_table_loader import SimulatedKBClient, max_rss_mb
+
+CITIES = ['北京', '上海', '广州', '深圳', '杭州', '成都']
+PRODUCTS = ['笔记本电脑', '显示器', '机械键盘', '无线鼠标', '移动硬盘', 'USB-C扩展坞']
+
+
+def synthetic_record(rng, i, big_ratio):
+    record = {'id': f'R{i:09d}', 'customer': {'name': f'客户{rng.randint(1, 5000)}', 'city': rng.choice(CITIES),
+                                              'vip': rng.random() < 0.2},
+              'items': [{'product': rng.choice(PRODUCTS), 'qty': rng.randint(1, 5),
+                         'price': round(rng.uniform(10, 5000), 2)} for _ in range(rng.randint(1, 4))],
+              'remark': '加急配送' if rng.random() < 0.1 else None}
+    if rng.random() < big_ratio:
+        record['details'] = [{'line': j, 'sku': f'SKU{rng.randint(0, 10 ** 6)}', 'note': rng.choice(PRODUCTS) * 3}
+                             for j in range(rng.randint(200, 600))]
+    return record
+
+
+def build_json(path, mb, big_ratio):
+    """逐条写入，生成过程不把整个文件放在内存里，返回记录数"""
+    rng = random.Random(0)
+    target = int(mb * 1024 * 1024)
+    count = 0
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write('[')
+        written = 1
+        while written < target:
+            text = json.dumps(synthetic_record(rng, count, big_ratio), ensure_ascii=False)
+            f.write((',' if count else '') + text)
+            written += len(text.encode('utf-8')) + 1
+            count += 1
+        f.write(']')
+    return count
+
+
+def build_deep_json(path, depth):
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write('{"root": ' + '{"child": ' * depth + '"leaf"' + '}' * depth + ', "after": 1}')
+
+
+def run_case(case, path, chunk_size):
+    """在子进程中执行，输出一行json结果"""
+    from qanything_kernel.core.retriever.general_document import LocalFileForInsert
+    from qanything_kernel.utils.loader.json_loader import JSONLoader, ijson
+    from qanything_kernel.utils.general_utils import num_tokens_embed
+    num_tokens_embed('预热tokenizer')
+    baseline = max_rss_mb()
+    local_file = LocalFileForInsert('bench__1234', 'KBbench', uuid.uuid4().hex, path, os.path.basename(path), '',
+                                    chunk_size, SimulatedKBClient())
+    start = time.perf_counter()
+    error = None
+    try:
+        if case == 'legacy':
+            local_file.inject_metadata(JSONLoader(path).load())
+        else:
+            local_file.split_file_to_docs()
+    except (RecursionError, RuntimeError) as e:
+        error = f'{type(e).__name__}: {e}'[:200]
+    cost = time.perf_counter() - start
+    texts = [doc.page_content for doc in local_file.docs]
+    ids = set()
+    for text in texts:
+        for part in text.replace('\n', ' & ').split(' & '):
+            if part.startswith('id: R'):
+                ids.add(part[4:])
+    budget = local_file.child_chunk_size()
+    result = {'case': case, 'seconds': round(cost, 2), 'mb_per_sec': round(os.path.getsize(path) / 2 ** 20 / cost, 2),
+              'peak_mb': round(max_rss_mb(), 1), 'baseline_mb': round(baseline, 1), 'docs': len(texts),
+              'record_ids': len(ids), 'error': error, 'backend': getattr(ijson, 'backend', None),
+              # merge_short_docs会把不到预算1/4的块并入前一块，允许超出这么多
+              'over_budget': sum(1 for text in texts if num_tokens_embed(text) > budget * 1.25)}
+    print(json.dumps(result, ensure_ascii=False))
+
+
+def run_subprocess(case, path, chunk_size):
+    proc = subprocess.run([sys.executable, os.path.abspath(__file__), '--run', case, '--path', path,
+                           '--chunk_size', str(chunk_size)], capture_output=True, text=True)
+    if proc.returncode != 0:
+        print(f'{case} failed:\n{proc.stderr[-2000:]}')
+        return None
+    return json.loads(proc.stdout.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--mb', type=float, default=200)
+    parser.add_argument('--big_ratio', type=float, default=0.01, help='带长明细数组的记录比例')
+    parser.add_argument('--chunk_size', type=int, default=800, help='parent chunk的token数')
+    parser.add_argument('--cases', type=str, default='legacy,stream')
+    parser.add_argument('--deep', type=int, default=0, help='额外测试的嵌套层数，0为不测')
+    parser.add_argument('--dir', type=str, default=None, help='生成的测试文件目录，默认临时目录；已存在的文件直接复用')
+    parser.add_argument('--run', type=str, default=None, help=argparse.SUPPRESS)
+    parser.add_argument('--path', type=str, default=None, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.run:
+        run_case(args.run, args.path, args.chunk_size)
+        return
+
+    work_dir = args.dir or tempfile.mkdtemp(prefix='bench_json_')
+    os.makedirs(work_dir, exist_ok=True)
+    path = os.path.join(work_dir, f'orders_{args.mb:g}mb.json')
+    count_path = path + '.count'
+    if not os.path.exists(path) or not os.path.exists(count_path):
+        start = time.perf_counter()
+        with open(count_path, 'w') as f:
+            f.write(str(build_json(path, args.mb, args.big_ratio)))
+        print(f'built {path} in {time.perf_counter() - start:.1f}s')
+    with open(count_path) as f:
+        records = int(f.read())
+    print(f'json: {os.path.getsize(path) / 2 ** 20:.1f}MB, {records} records')
+
+    print(f'{"case":<8}{"seconds":>9}{"MB/s":>8}{"peak MB":>10}{"over base":>11}{"docs":>9}{"ids":>10}'
+          f'{"over budget":>13}')
+    results = {}
+    for case in args.cases.split(','):
+        result = run_subprocess(case, path, args.chunk_size)
+        if result is None:
+            continue
+        results[case] = result
+        print(f'{case:<8}{result["seconds"]:>9.2f}{result["mb_per_sec"]:>8.2f}{result["peak_mb"]:>10.1f}'
+              f'{result["peak_mb"] - result["baseline_mb"]:>11.1f}{result["docs"]:>9}{result["record_ids"]:>10}'
+              f'{result["over_budget"]:>13}' + (f'  error={result["error"]}' if result['error'] else ''))
+    stream = results.get('stream')
+    if stream is not None:
+        print(f'ijson backend: {stream["backend"] or "not installed, json.load fallback"}')
+        assert stream['error'] is None and stream['record_ids'] == records, 'stream loader lost records'
+        assert stream['over_budget'] == 0, 'stream chunks exceed the child chunk budget'
+        legacy = results.get('legacy')
+        if legacy is not None:
+            print(f'throughput {legacy["mb_per_sec"]:.2f} -> {stream["mb_per_sec"]:.2f} MB/s, '
+                  f'peak RSS above baseline {legacy["peak_mb"] - legacy["baseline_mb"]:.0f}MB -> '
+                  f'{stream["peak_mb"] - stream["baseline_mb"]:.0f}MB')
+
+    if args.deep:
+        deep_path = os.path.join(work_dir, f'deep_{args.deep}.json')
+        build_deep_json(deep_path, args.deep)
+        for case in args.cases.split(','):
+            result = run_subprocess(case, deep_path, args.chunk_size)
+            if result is not None:
+                print(f'[deep {args.deep}] {case}: docs={result["docs"]} seconds={result["seconds"]} '
+                      f'error={result["error"]}')
+                if case == 'stream' and result['backend']:
+                    # 没有安装ijson时退回json.load，同样受递归深度限制
+                    assert result['error'] is None and result['docs'] > 0, 'stream loader failed on deep json'
+    print('json loader check passed')
+
+
+if __name__ == '__main__':
+    main()
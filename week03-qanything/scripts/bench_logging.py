@@ -0,0 +1,89 @@
+"""
+日志开销微基准：对比直接写ConcurrentRotatingFileHandler（旧方式，f-string即时格式化）
+与QueueHandler + 后台监听线程（新方式，延迟格式化 + 截断）在多进程下每个请求的日志耗时。
+
+用法: python scripts/bench_logging.py --workers 4 --requests 2000
+"""
+import argparse
+import multiprocessing as mp
+import os
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+
+root_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# 模拟一次问答请求中的典型日志：若干短日志 + 分数列表 + 完整文档列表
+DOCS = [{'file_id': f'file_{i}', 'file_name': f'doc_{i}.pdf', 'score': 0.5 + i / 100,
+         'content': '这是一段用于测试的文档内容。' * 60} for i in range(30)]
+SCORES = [doc['score'] for doc in DOCS]
+
+
+def one_request_eager(debug_logger, qa_logger):
+    debug_logger.info(f"local_doc_chat user_id: bench_user")
+    debug_logger.info(f"question: 这是一个测试问题")
+    debug_logger.info(f"kb_ids: {['KB_a', 'KB_b']}")
+    for i in range(8):
+        debug_logger.info(f"step {i} token nums: {i * 100}")
+    debug_logger.info(f"embed scores: {SCORES}")
+    debug_logger.info(f"rerank step1 scores: {SCORES}")
+    debug_logger.info(f"source documents: {DOCS}")
+    qa_logger.info(f"chat_data: { {'query': '测试问题', 'source_documents': DOCS} }")
+
+
+def one_request_lazy(debug_logger, qa_logger):
+    debug_logger.info("local_doc_chat user_id: %s", "bench_user")
+    debug_logger.info("question: %s", "这是一个测试问题")
+    debug_logger.info("kb_ids: %s", ['KB_a', 'KB_b'])
+    for i in range(8):
+        debug_logger.info("step %s token nums: %s", i, i * 100)
+    debug_logger.info("embed scores: %s", SCORES)
+    debug_logger.info("rerank step1 scores: %s", SCORES)
+    debug_logger.info("source documents: %s", DOCS)
+    qa_logger.info("chat_data: %s", {'query': '测试问题', 'source_documents': DOCS})
+
+
+def worker(mode, requests, log_dir, result_queue):
+    os.chdir(log_dir)
+    os.environ['LOG_USE_QUEUE'] = 'true' if mode == 'queue' else 'false'
+    sys.path.append(root_dir)
+    from qanything_kernel.utils.custom_log import debug_logger, qa_logger
+    one_request = one_request_lazy if mode == 'queue' else one_request_eager
+    costs = []
+    for _ in range(requests):
+        start = time.perf_counter()
+        one_request(debug_logger, qa_logger)
+        costs.append(time.perf_counter() - start)
+    result_queue.put(costs)
+
+
+def run(mode, workers, requests):
+    log_dir = tempfile.mkdtemp(prefix=f'bench_logging_{mode}_')
+    ctx = mp.get_context('spawn')
+    result_queue = ctx.Queue()
+    procs = [ctx.Process(target=worker, args=(mode, requests, log_dir, result_queue)) for _ in range(workers)]
+    start = time.perf_counter()
+    for p in procs:
+        p.start()
+    costs = []
+    for _ in procs:
+        costs.extend(result_queue.get())
+    for p in procs:
+        p.join()
+    wall = time.perf_counter() - start
+    shutil.rmtree(log_dir, ignore_errors=True)
+    costs.sort()
+    print(f"[{mode:>6}] workers={workers} requests/worker={requests} wall={wall:.2f}s "
+          f"mean={statistics.mean(costs) * 1e6:.0f}us p50={costs[len(costs) // 2] * 1e6:.0f}us "
+          f"p99={costs[int(len(costs) * 0.99)] * 1e6:.0f}us")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--requests', type=int, default=2000)
+    args = parser.parse_args()
+    run('direct', args.workers, args.requests)
+    run('queue', args.workers, args.requests)
@@ -0,0 +1,112 @@
+"""
+入库调用OCR服务的吞吐(images/sec)和请求字节数，需要先启动ocr_server.py：
+- legacy: 每张图片base64后作为表单字段单独请求/ocr（改动前图片文件和PDF扫描页的调用方式）；
+- batch: ocr_client.ocr_images，按--batch_size张一批以multipart原始字节请求/ocr_batch（扫描版PDF各页的调用方式）。
+--dir为扫描件目录（jpg/png），目录为空时先生成--images张合成扫描件（白底多行文字，带轻微旋转和噪点）。
+同时统计请求体总字节数和客户端构造请求的CPU时间，并校验两种方式每张图片的识别结果一致。
+
+用法: python scripts/bench_ocr.py --dir /data/scans --batch_size 16
+      python scripts/bench_ocr.py --images 500 --cases legacy,batch
+"""
+import argparse
+import base64
+import os
+import random
+import sys
+import tempfile
+import time
+
+root_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(root_dir)
+
+import cv2
+import numpy as np
+import requests
+
+WORDS = ['invoice', 'total', 'amount', 'date', 'customer', 'order', 'payment', 'tax', 'address', 'contract',
+         'quantity', 'price', 'shipping', 'account', 'number', 'signature', 'approved', 'department', 'report']
+
+
+def build_scans(scan_dir, count, seed=0):
+    rng = random.Random(seed)
+    os.makedirs(scan_dir, exist_ok=True)
+    for i in range(count):
+        page = np.full((1400, 1000, 3), 255, np.uint8)
+        y = 80
+        while y < 1340:
+            line = ' '.join(rng.choice(WORDS) for _ in range(rng.randint(3, 8)))
+            cv2.putText(page, line.capitalize(), (60, y), cv2.FONT_HERSHEY_SIMPLEX, 0.9, (20, 20, 20), 2)
+            y += rng.randint(40, 70)
+        matrix = cv2.getRotationMatrix2D((500, 700), rng.uniform(-1.5, 1.5), 1.0)
+        page = cv2.warpAffine(page, matrix, (1000, 1400), borderValue=(255, 255, 255))
+        noise = np.random.default_rng(seed + i).normal(0, 8, page.shape)
+        page = np.clip(page + noise, 0, 255).astype(np.uint8)
+        cv2.imwrite(os.path.join(scan_dir, f'scan_{i:04d}.jpg'), page, [cv2.IMWRITE_JPEG_QUALITY, 85])
+
+
+class CountingSession(requests.Session):
+    """统计请求体字节数"""
+
+    def __init__(self):
+        super().__init__()
+        self.sent_bytes = 0
+        self.requests = 0
+
+    def send(self, request, **kwargs):
+        self.sent_bytes += len(request.body or b'')
+        self.requests += 1
+        return super().send(request, **kwargs)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--dir', type=str, default=None, help='扫描件目录，默认临时目录并生成合成扫描件')
+    parser.add_argument('--images', type=int, default=500, help='目录为空时生成的扫描件数')
+    parser.add_argument('--batch_size', type=int, default=16)
+    parser.add_argument('--cases', type=str, default='legacy,batch')
+    args = parser.parse_args()
+
+    from qanything_kernel.utils import ocr_client
+    scan_dir = args.dir or tempfile.mkdtemp(prefix='bench_ocr_')
+    names = sorted(f for f in os.listdir(scan_dir) if f.lower().endswith(('.jpg', '.jpeg', '.png'))) \
+        if os.path.isdir(scan_dir) else []
+    if not names:
+        start = time.perf_counter()
+        build_scans(scan_dir, args.images)
+        names = sorted(os.listdir(scan_dir))
+        print(f'built {len(names)} scans in {scan_dir} in {time.perf_counter() - start:.1f}s')
+    images = []
+    for name in names:
+        with open(os.path.join(scan_dir, name), 'rb') as f:
+            images.append(f.read())
+    print(f'{len(images)} images, {sum(map(len, images)) / 2 ** 20:.1f}MB, server {ocr_client.LOCAL_OCR_SERVICE_URL}')
+
+    print(f'{"case":<8}{"seconds":>9}{"images/s":>10}{"requests":>10}{"sent MB":>9}{"client cpu s":>14}{"failed":>8}')
+    results = {}
+    for case in args.cases.split(','):
+        session = CountingSession()
+        ocr_client._session = session
+        start, cpu_start = time.perf_counter(), time.process_time()
+        if case == 'legacy':
+            outputs = [ocr_client.get_ocr_result_sync({"img64": base64.b64encode(image).decode("utf-8")})
+                       for image in images]
+        else:
+            ocr_client._batch_supported = True
+            outputs = []
+            # 与扫描版PDF一致，每批攒够batch_size张再调用
+            for i in range(0, len(images), args.batch_size):
+                outputs.extend(ocr_client.ocr_images(images[i:i + args.batch_size]))
+        cost, cpu = time.perf_counter() - start, time.process_time() - cpu_start
+        results[case] = {'outputs': outputs, 'seconds': cost}
+        print(f'{case:<8}{cost:>9.2f}{len(images) / cost:>10.2f}{session.requests:>10}'
+              f'{session.sent_bytes / 2 ** 20:>9.1f}{cpu:>14.2f}{sum(1 for o in outputs if o is None):>8}')
+    if 'legacy' in results and 'batch' in results:
+        mismatched = sum(1 for a, b in zip(results['legacy']['outputs'], results['batch']['outputs']) if a != b)
+        print(f'images/s {len(images) / results["legacy"]["seconds"]:.2f} -> '
+              f'{len(images) / results["batch"]["seconds"]:.2f}, mismatched results: {mismatched}')
+        assert mismatched == 0, 'batch OCR results differ from per-image results'
+    print('ocr batch check passed')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,215 @@
+"""
+OCR检测后处理和文本行裁剪的每页耗时，并校验与改动前逐框实现的输出完全一致（golden对比）：
+- legacy: 改动前的DBPostProcess.boxes_from_bitmap（逐轮廓fillPoly打分、shapely求扩张距离）、
+  filter_tag_det_res（逐框排序、逐点裁剪）和逐框warpPerspective裁剪，代码复制在本脚本中；
+- batch: 积分图批量打分、批量过滤，与坐标轴平行的框直接切片。
+概率图默认不依赖模型：ocr_server/test.jpg和--pages张合成的文本密集页面（每页--boxes个文本框，约10%倾斜）
+按文字像素膨胀、模糊后作为检测概率图；--model时用OCR_MODEL_PATH下的检测模型输出真实概率图。
+逐页对比文本框坐标、分数和每个裁剪图的像素，任何不一致都会报错。
+
+用法: python scripts/bench_ocr_postprocess.py --pages 5 --boxes 800 --repeat 5
+      python scripts/bench_ocr_postprocess.py --model --images /data/scans
+"""
+import argparse
+import os
+import random
+import statistics
+import sys
+import time
+
+root_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(root_dir)
+
+import cv2
+import numpy as np
+
+from qanything_kernel.dependent_server.ocr_server.postprocess import DBPostProcess
+from qanything_kernel.dependent_server.ocr_server.crop import filter_det_boxes, get_rotate_crop_images
+
+OCR_SERVER_DIR = os.path.join(root_dir, 'qanything_kernel', 'dependent_server', 'ocr_server')
+# 与TextDetector的配置一致
+POSTPROCESS_PARAMS = {"thresh": 0.3, "box_thresh": 0.5, "max_candidates": 1000, "unclip_ratio": 1.5,
+                      "use_dilation": False, "score_mode": "fast", "box_type": "quad"}
+
+
+class LegacyDBPostProcess(DBPostProcess):
+    def boxes_from_bitmap(self, pred, _bitmap, dest_width, dest_height):
+        bitmap = _bitmap
+        height, width = bitmap.shape
+        contours, _ = cv2.findContours((bitmap * 255).astype(np.uint8), cv2.RETR_LIST, cv2.CHAIN_APPROX_SIMPLE)[-2:]
+        num_contours = min(len(contours), self.max_candidates)
+        boxes = []
+        scores = []
+        for index in range(num_contours):
+            contour = contours[index]
+            points, sside = self.get_mini_boxes(contour)
+            if sside < self.min_size:
+                continue
+            points = np.array(points)
+            if self.score_mode == "fast":
+                score = self.box_score_fast(pred, points.reshape(-1, 2))
+            else:
+                score = self.box_score_slow(pred, contour)
+            if self.box_thresh > score:
+                continue
+            box = self.unclip(points, self.unclip_ratio).reshape(-1, 1, 2)
+            box, sside = self.get_mini_boxes(box)
+            if sside < self.min_size + 2:
+                continue
+            box = np.array(box)
+            box[:, 0] = np.clip(np.round(box[:, 0] / width * dest_width), 0, dest_width)
+            box[:, 1] = np.clip(np.round(box[:, 1] / height * dest_height), 0, dest_height)
+            boxes.append(box.astype("int32"))
+            scores.append(score)
+        return np.array(boxes, dtype="int32"), scores
+
+
+def legacy_order_points_clockwise(pts):
+    rect = np.zeros((4, 2), dtype="float32")
+    s = pts.sum(axis=1)
+    rect[0] = pts[np.argmin(s)]
+    rect[2] = pts[np.argmax(s)]
+    tmp = np.delete(pts, (np.argmin(s), np.argmax(s)), axis=0)
+    diff = np.diff(np.array(tmp), axis=1)
+    rect[1] = tmp[np.argmin(diff)]
+    rect[3] = tmp[np.argmax(diff)]
+    return rect
+
+
+def legacy_filter_tag_det_res(dt_boxes, image_shape):
+    img_height, img_width = image_shape[0:2]
+    dt_boxes_new = []
+    for box in dt_boxes:
+        box = legacy_order_points_clockwise(box)
+        for pno in range(box.shape[0]):
+            box[pno, 0] = int(min(max(box[pno, 0], 0), img_width - 1))
+            box[pno, 1] = int(min(max(box[pno, 1], 0), img_height - 1))
+        rect_width = int(np.linalg.norm(box[0] - box[1]))
+        rect_height = int(np.linalg.norm(box[0] - box[3]))
+        if rect_width <= 3 or rect_height <= 3:
+            continue
+        dt_boxes_new.append(box)
+    return np.array(dt_boxes_new)
+
+
+def legacy_crop(img, points):
+    img_crop_width = int(max(np.linalg.norm(points[0] - points[1]), np.linalg.norm(points[2] - points[3])))
+    img_crop_height = int(max(np.linalg.norm(points[0] - points[3]), np.linalg.norm(points[1] - points[2])))
+    pts_std = np.float32([[0, 0], [img_crop_width, 0], [img_crop_width, img_crop_height], [0, img_crop_height]])
+    M = cv2.getPerspectiveTransform(points, pts_std)
+    dst_img = cv2.warpPerspective(img, M, (img_crop_width, img_crop_height), borderMode=cv2.BORDER_REPLICATE,
+                                  flags=cv2.INTER_CUBIC)
+    if dst_img.shape[0] * 1.0 / dst_img.shape[1] >= 1.5:
+        dst_img = np.rot90(dst_img)
+    return dst_img
+
+
+def pseudo_map(img):
+    """文字像素横向膨胀成文本行后模糊，近似检测模型的概率图"""
+    gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+    text = (gray < 128).astype(np.uint8)
+    text = cv2.dilate(text, np.ones((3, 9), np.uint8))
+    return cv2.GaussianBlur(text.astype(np.float32), (5, 5), 0)
+
+
+def build_page(rng, boxes, size=(1280, 960)):
+    """文本密集的页面：小字号单词按行排列，约10%的单词整体倾斜"""
+    height, width = size
+    page = np.full((height, width, 3), 255, np.uint8)
+    placed, y = 0, 24
+    while placed < boxes and y < height - 16:
+        x = 10
+        while placed < boxes and x < width - 80:
+            word = ''.join(rng.choice('abcdefghijklmnopqrstuvwxyz0123456789') for _ in range(rng.randint(2, 7)))
+            (w, h), _ = cv2.getTextSize(word, cv2.FONT_HERSHEY_SIMPLEX, 0.4, 1)
+            if rng.random() < 0.1:
+                patch = np.full((h * 3, w + 10, 3), 255, np.uint8)
+                cv2.putText(patch, word, (5, h * 2), cv2.FONT_HERSHEY_SIMPLEX, 0.4, (0, 0, 0), 1)
+                matrix = cv2.getRotationMatrix2D(((w + 10) / 2, h * 1.5), rng.uniform(-20, 20), 1.0)
+                patch = cv2.warpAffine(patch, matrix, (w + 10, h * 3), borderValue=(255, 255, 255))
+                y0 = max(y - h * 2, 0)
+                region = page[y0:y0 + patch.shape[0], x:x + patch.shape[1]]
+                np.minimum(region, patch[:region.shape[0], :region.shape[1]], out=region)
+            else:
+                cv2.putText(page, word, (x, y), cv2.FONT_HERSHEY_SIMPLEX, 0.4, (0, 0, 0), 1)
+            x += w + rng.randint(14, 24)
+            placed += 1
+        y += rng.randint(20, 26)
+    return page
+
+
+def model_maps(images):
+    from qanything_kernel.dependent_server.ocr_server.ocr import TextDetector, transform
+    from qanything_kernel.configs.model_config import OCR_MODEL_PATH
+    detector = TextDetector(OCR_MODEL_PATH, 'cpu')
+    maps = []
+    for img in images:
+        data, shape_list = transform({'image': img}, detector.preprocess_op)
+        outputs = detector.predictor.run(None, {detector.input_tensor.name: np.expand_dims(data, axis=0)})
+        maps.append((outputs[0], np.expand_dims(shape_list, axis=0)))
+    return maps
+
+
+def run(postprocess, filter_boxes, crop_images, img, maps, shape_list):
+    dt_boxes = postprocess({'maps': maps}, shape_list)[0]['points']
+    dt_boxes = filter_boxes(dt_boxes, img.shape)
+    return dt_boxes, crop_images(img, dt_boxes)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--pages', type=int, default=5, help='合成页面数')
+    parser.add_argument('--boxes', type=int, default=800, help='每张合成页面的文本框数')
+    parser.add_argument('--images', type=str, default=None, help='额外的图片目录，默认只用ocr_server/test.jpg')
+    parser.add_argument('--model', action='store_true', help='用检测模型输出概率图')
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    rng = random.Random(0)
+    names = [os.path.join(OCR_SERVER_DIR, 'test.jpg')]
+    if args.images:
+        names += sorted(os.path.join(args.images, f) for f in os.listdir(args.images)
+                        if f.lower().endswith(('.jpg', '.jpeg', '.png')))
+    pages = [(os.path.basename(name), cv2.imread(name)) for name in names]
+    pages += [(f'dense_{i}', build_page(rng, args.boxes)) for i in range(args.pages)]
+    if args.model:
+        inputs = model_maps([img for _, img in pages])
+    else:
+        inputs = [(pseudo_map(img)[None, None], np.array([[img.shape[0], img.shape[1], 1.0, 1.0]]))
+                  for _, img in pages]
+
+    legacy = (LegacyDBPostProcess(**POSTPROCESS_PARAMS), legacy_filter_tag_det_res,
+              lambda img, boxes: [legacy_crop(img, box) for box in boxes])
+    batch = (DBPostProcess(**POSTPROCESS_PARAMS), filter_det_boxes, get_rotate_crop_images)
+
+    print(f'{"page":<14}{"boxes":>7}{"aligned":>9}{"legacy ms":>11}{"batch ms":>10}{"speedup":>9}')
+    totals = {'legacy': [], 'batch': []}
+    for (name, img), (maps, shape_list) in zip(pages, inputs):
+        costs, outputs = {}, {}
+        for case, fns in (('legacy', legacy), ('batch', batch)):
+            samples = []
+            for _ in range(args.repeat):
+                start = time.perf_counter()
+                outputs[case] = run(*fns, img, maps, shape_list)
+                samples.append(time.perf_counter() - start)
+            costs[case] = statistics.median(samples)
+            totals[case].append(costs[case])
+        (legacy_boxes, legacy_crops), (boxes, crops) = outputs['legacy'], outputs['batch']
+        # golden对比：文本框、裁剪图逐像素一致
+        assert legacy_boxes.shape == boxes.shape and np.array_equal(legacy_boxes, boxes), f'{name}: boxes differ'
+        assert len(legacy_crops) == len(crops), f'{name}: crop count differs'
+        for i, (a, b) in enumerate(zip(legacy_crops, crops)):
+            assert a.shape == b.shape and np.array_equal(a, b), f'{name}: crop {i} differs'
+        legacy_scores = legacy[0].boxes_from_bitmap(maps[0, 0], maps[0, 0] > 0.3, img.shape[1], img.shape[0])[1]
+        scores = batch[0].boxes_from_bitmap(maps[0, 0], maps[0, 0] > 0.3, img.shape[1], img.shape[0])[1]
+        assert np.allclose(legacy_scores, scores, rtol=0, atol=1e-9), f'{name}: scores differ'
+        aligned = sum(1 for box in boxes if box[0][1] == box[1][1] and box[0][0] == box[3][0])
+        print(f'{name:<14}{len(boxes):>7}{aligned:>9}{costs["legacy"] * 1000:>11.1f}{costs["batch"] * 1000:>10.1f}'
+              f'{costs["legacy"] / costs["batch"]:>8.1f}x')
+    print(f'median per page: {statistics.median(totals["legacy"]) * 1000:.1f}ms -> '
+          f'{statistics.median(totals["batch"]) * 1000:.1f}ms')
+    print('ocr postprocess golden check passed')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,149 @@
+"""
+OCR服务在不同并发下的吞吐(req/s)和延迟：
+- 默认请求已启动的ocr_server.py（--url），每个并发数下用--requests个/ocr请求，改动前后的服务各跑一次对比；
+- --inprocess直接加载OCR_MODEL_PATH下的模型，不经过HTTP，在同一进程里对比：
+  serial: 改动前的方式，async handler中同步调用OCRQAnything，并发请求串行执行；
+  pooled: 检测在线程池中执行，识别由RecognitionPool把并发图片的文本行合批，同时统计平均每次识别汇集的文本行数，
+  并对比两种方式的识别结果（合批后一批的padding宽度不同，个别低分文本行可能有差异，只报告不校验）。
+图片默认用ocr_server/test.jpg，--images指定目录时轮流使用目录中的图片。
+
+用法: python scripts/bench_ocr_server.py --url localhost:7001 --concurrency 1,4,16 --requests 200
+      python scripts/bench_ocr_server.py --inprocess --concurrency 1,4,16 --requests 64
+"""
+import argparse
+import asyncio
+import base64
+import os
+import statistics
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+root_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(root_dir)
+
+OCR_SERVER_DIR = os.path.join(root_dir, 'qanything_kernel', 'dependent_server', 'ocr_server')
+
+
+def load_images(images_dir):
+    if not images_dir:
+        paths = [os.path.join(OCR_SERVER_DIR, 'test.jpg')]
+    else:
+        paths = sorted(os.path.join(images_dir, f) for f in os.listdir(images_dir)
+                       if f.lower().endswith(('.jpg', '.jpeg', '.png')))
+    images = []
+    for path in paths:
+        with open(path, 'rb') as f:
+            images.append(f.read())
+    return images
+
+
+def percentile(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * q))]
+
+
+def bench_http(url, images, concurrency, requests_count):
+    import requests
+    payloads = [{"img64": base64.b64encode(image).decode("utf-8")} for image in images]
+    local = threading.local()
+    latencies = []
+
+    def one(i):
+        if not hasattr(local, 'session'):
+            local.session = requests.Session()
+        start = time.perf_counter()
+        response = local.session.post(f'http://{url}/ocr', data=payloads[i % len(payloads)], timeout=600)
+        response.raise_for_status()
+        latencies.append(time.perf_counter() - start)
+        return response.json()['result']
+
+    # 预热
+    one(0)
+    latencies.clear()
+    start = time.perf_counter()
+    with ThreadPoolExecutor(concurrency) as executor:
+        list(executor.map(one, range(requests_count)))
+    return time.perf_counter() - start, latencies
+
+
+async def bench_inprocess(mode, ocr, decoded, concurrency, requests_count):
+    from qanything_kernel.dependent_server.ocr_server.recognition_pool import RecognitionPool
+    from qanything_kernel.configs.model_config import OCR_INFER_THREADS, OCR_REC_MAX_CROPS, OCR_REC_BATCH_WAIT_MS
+    executor = ThreadPoolExecutor(OCR_INFER_THREADS)
+    pool = RecognitionPool(ocr, executor, max_crops=OCR_REC_MAX_CROPS, wait_seconds=OCR_REC_BATCH_WAIT_MS / 1000)
+    pool.start()
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies, outputs = [], {}
+
+    async def one(i):
+        async with semaphore:
+            start = time.perf_counter()
+            img = decoded[i % len(decoded)]
+            if mode == 'serial':
+                # 改动前：在事件循环里同步执行
+                result = ocr(img)
+            else:
+                result = await pool.ocr_image(img)
+            latencies.append(time.perf_counter() - start)
+            outputs[i % len(decoded)] = result
+
+    try:
+        start = time.perf_counter()
+        await asyncio.gather(*[one(i) for i in range(requests_count)])
+        cost = time.perf_counter() - start
+    finally:
+        pool.close()
+        executor.shutdown()
+    return cost, latencies, outputs, pool.crops / max(pool.batches, 1)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--url', type=str, default='localhost:7001')
+    parser.add_argument('--images', type=str, default=None, help='图片目录，默认ocr_server/test.jpg')
+    parser.add_argument('--concurrency', type=str, default='1,4,16')
+    parser.add_argument('--requests', type=int, default=100, help='每个并发数下的请求数')
+    parser.add_argument('--inprocess', action='store_true', help='不经过HTTP，直接对比改动前后的调度方式')
+    parser.add_argument('--use_gpu', action='store_true')
+    args = parser.parse_args()
+
+    images = load_images(args.images)
+    levels = [int(c) for c in args.concurrency.split(',')]
+    print(f'{len(images)} images, {args.requests} requests per level')
+    print(f'{"mode":<8}{"conc":>6}{"req/s":>9}{"p50 ms":>9}{"p95 ms":>9}{"crops/rec":>11}')
+    if not args.inprocess:
+        for concurrency in levels:
+            cost, latencies = bench_http(args.url, images, concurrency, args.requests)
+            print(f'{"http":<8}{concurrency:>6}{args.requests / cost:>9.2f}{statistics.median(latencies) * 1000:>9.0f}'
+                  f'{percentile(latencies, 0.95) * 1000:>9.0f}{"-":>11}')
+        return
+
+    import cv2
+    import numpy as np
+    from qanything_kernel.dependent_server.ocr_server.ocr import OCRQAnything
+    from qanything_kernel.configs.model_config import OCR_MODEL_PATH
+    ocr = OCRQAnything(model_dir=OCR_MODEL_PATH, device='cuda' if args.use_gpu else 'cpu')
+    decoded = [cv2.imdecode(np.frombuffer(image, np.uint8), cv2.IMREAD_COLOR) for image in images]
+    ocr(decoded[0])  # 预热
+    throughput = {}
+    for concurrency in levels:
+        outputs = {}
+        for mode in ('serial', 'pooled'):
+            cost, latencies, outputs[mode], crops_per_rec = asyncio.run(
+                bench_inprocess(mode, ocr, decoded, concurrency, args.requests))
+            throughput[(mode, concurrency)] = args.requests / cost
+            print(f'{mode:<8}{concurrency:>6}{args.requests / cost:>9.2f}{statistics.median(latencies) * 1000:>9.0f}'
+                  f'{percentile(latencies, 0.95) * 1000:>9.0f}'
+                  f'{(f"{crops_per_rec:.1f}" if mode == "pooled" else "-"):>11}')
+        differing = sum(1 for i in outputs['serial'] if outputs['serial'][i] != outputs['pooled'][i])
+        if differing:
+            print(f'  {differing}/{len(outputs["serial"])} images have different lines after pooling')
+    for concurrency in levels:
+        print(f'concurrency {concurrency}: {throughput[("serial", concurrency)]:.2f} -> '
+              f'{throughput[("pooled", concurrency)]:.2f} req/s')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,153 @@
+"""
+回答-引用图文相关性计算(calculate_relevance_optimized)的回归基准。
+构造约2k token的合成LLM回答和若干带图片的引用文档，对比旧实现（逐段embedding请求 + 每次构建cKDTree）
+与新实现（内容hash缓存 + 按token预算合并请求 + 矩阵乘法/argpartition取top_k），并校验top_k结果与暴力余弦排序一致。
+
+默认使用模拟的embedding服务（每个请求固定往返耗时 + 按token计的推理耗时，单worker串行），
+加 --real 则请求LOCAL_EMBED_SERVICE_URL上真实的embedding服务。
+
+用法: python scripts/bench_relevance.py --docs 8 --rounds 20 --answer_tokens 2000
+"""
+import argparse
+import asyncio
+import hashlib
+import os
+import random
+import statistics
+import sys
+import time
+
+root_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(root_dir)
+
+import numpy as np
+from scipy.spatial import cKDTree
+from scipy.spatial.distance import cosine
+from scipy.stats import gmean
+from langchain.schema import Document
+
+from qanything_kernel.configs.model_config import LOCAL_EMBED_MAX_LENGTH
+from qanything_kernel.connector.embedding.embedding_for_online_client import YouDaoEmbeddings
+from qanything_kernel.core.local_doc_qa import LocalDocQA
+from qanything_kernel.utils.general_utils import num_tokens_embed
+
+WORDS = ['检索', '增强', '生成', '知识库', '文档', '向量', '模型', '图片', '段落', '相关性', '问答', '系统',
+         'the', 'figure', 'shows', 'pipeline', 'latency', 'embedding', 'rerank', 'table', '。', '，']
+
+
+class SimulatedEmbeddings(YouDaoEmbeddings):
+    """模拟embedding服务：向量由文本hash决定，耗时 = 往返耗时 + token数 * 单token耗时，服务端单worker串行处理"""
+
+    def __init__(self, dim, rtt, per_token):
+        super().__init__()
+        self.dim = dim
+        self.rtt = rtt
+        self.per_token = per_token
+        self.requests = 0
+        self._server = None
+
+    def _vector(self, text):
+        seed = int.from_bytes(hashlib.sha1(text.encode('utf-8')).digest()[:8], 'little')
+        return np.random.default_rng(seed).standard_normal(self.dim).astype(np.float32).tolist()
+
+    async def _get_embedding_async(self, session, queries):
+        if self._server is None:
+            self._server = asyncio.Semaphore(1)
+        self.requests += 1
+        tokens = sum(min(num_tokens_embed(q), LOCAL_EMBED_MAX_LENGTH) for q in queries)
+        await asyncio.sleep(self.rtt)
+        async with self._server:
+            await asyncio.sleep(tokens * self.per_token)
+        return [self._vector(q) for q in queries]
+
+
+async def legacy_calculate_relevance(qa, question, llm_answer, reference_docs, top_k=5):
+    """改动前的实现，仅用于对比"""
+    question_scores = [doc.metadata['score'] for doc in reference_docs]
+    llm_answer_embedding = await qa.embeddings.aembed_query(llm_answer)
+    all_segments_docs = qa.doc_splitter.split_documents(reference_docs)
+    all_segments = [doc.page_content for doc in all_segments_docs]
+    reference_embeddings = await qa.embeddings.aembed_documents(all_segments)
+    llm_answer_embedding = np.array(llm_answer_embedding)
+    reference_embeddings = np.array(reference_embeddings)
+    tree = cKDTree(reference_embeddings)
+    _, indices = tree.query(llm_answer_embedding.reshape(1, -1), k=top_k)
+    if isinstance(indices[0], np.int64):
+        indices = [indices]
+    doc_segment_lengths = [len(qa.doc_splitter.split_documents([doc])) for doc in reference_docs]
+    cumulative_lengths = np.cumsum([0] + doc_segment_lengths)
+    relevant_docs = []
+    for doc_index in indices[0]:
+        doc_id = np.searchsorted(cumulative_lengths, doc_index, side='right') - 1
+        similarity_llm = 1 - cosine(llm_answer_embedding, reference_embeddings[doc_index])
+        combined_score = gmean([similarity_llm ** 0.5, question_scores[doc_id] ** 0.5])
+        relevant_docs.append({'document': reference_docs[doc_id], 'segment': all_segments_docs[doc_index],
+                              'similarity_llm': float(similarity_llm), 'combined_score': float(combined_score)})
+    relevant_docs.sort(key=lambda x: x['combined_score'], reverse=True)
+    return relevant_docs
+
+
+def synthetic_text(rng, target_tokens):
+    parts, tokens = [], 0
+    while tokens < target_tokens:
+        sentence = ''.join(rng.choice(WORDS) for _ in range(rng.randint(8, 30))) + '\n'
+        parts.append(sentence)
+        tokens += num_tokens_embed(sentence)
+    return ''.join(parts)
+
+
+def build_docs(rng, docs_num, doc_tokens):
+    return [Document(page_content=synthetic_text(rng, doc_tokens),
+                     metadata={'score': round(rng.uniform(0.3, 0.99), 2), 'file_id': f'file_{i}',
+                               'images': [f'![figure](image_{i}.jpg)']}) for i in range(docs_num)]
+
+
+def check_topk(qa, answer, docs, result, top_k):
+    """与暴力计算的余弦相似度排序比对"""
+    segments = [seg for doc in docs for seg in qa.doc_splitter.split_documents([doc])]
+    vectors = np.asarray([qa.embeddings._vector(text) for text in [answer] + [seg.page_content for seg in segments]])
+    answer_vec, seg_vecs = vectors[0], vectors[1:]
+    sims = seg_vecs @ answer_vec / (np.linalg.norm(seg_vecs, axis=1) * np.linalg.norm(answer_vec))
+    expected = sorted(np.argsort(-sims)[:min(top_k, len(sims))].tolist())
+    got = sorted(segments.index(item['segment']) for item in result)
+    assert got == expected, f'top_k mismatch: {got} != {expected}'
+
+
+async def run(args):
+    rng = random.Random(0)
+    qa = LocalDocQA(port=0)
+    if args.real:
+        qa.embeddings = YouDaoEmbeddings()
+    else:
+        qa.embeddings = SimulatedEmbeddings(args.dim, args.rtt / 1000, args.per_token / 1000)
+    docs = build_docs(rng, args.docs, args.doc_tokens)
+    answers = [synthetic_text(rng, args.answer_tokens) for _ in range(args.rounds)]
+    print(f'docs={args.docs} doc_tokens~{args.doc_tokens} answer_tokens={num_tokens_embed(answers[0])} '
+          f'rounds={args.rounds} top_k={args.top_k}')
+
+    for name, func in (('legacy', lambda a: legacy_calculate_relevance(qa, 'q', a, docs, args.top_k)),
+                       ('optimized', lambda a: qa.calculate_relevance_optimized('q', a, docs, args.top_k))):
+        costs, requests_before = [], getattr(qa.embeddings, 'requests', 0)
+        for answer in answers:
+            start = time.perf_counter()
+            result = await func(answer)
+            costs.append(time.perf_counter() - start)
+            if name == 'optimized' and not args.real:
+                check_topk(qa, answer, docs, result, args.top_k)
+        requests = getattr(qa.embeddings, 'requests', 0) - requests_before
+        print(f'[{name:>9}] first={costs[0] * 1000:.1f}ms p50={statistics.median(costs) * 1000:.1f}ms '
+              f'mean={statistics.mean(costs) * 1000:.1f}ms embed_requests/round={requests / len(answers):.1f}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--docs', type=int, default=8)
+    parser.add_argument('--doc_tokens', type=int, default=800)
+    parser.add_argument('--answer_tokens', type=int, default=2000)
+    parser.add_argument('--rounds', type=int, default=20)
+    parser.add_argument('--top_k', type=int, default=5)
+    parser.add_argument('--dim', type=int, default=768)
+    parser.add_argument('--rtt', type=float, default=2.0, help='模拟的单次请求往返耗时(ms)')
+    parser.add_argument('--per_token', type=float, default=0.02, help='模拟的单token推理耗时(ms)')
+    parser.add_argument('--real', action='store_true', help='使用真实的embedding服务')
+    asyncio.run(run(parser.parse_args()))
@@ -0,0 +1,190 @@
+"""
+CSV/XLSX解析的峰值内存(RSS)和耗时：对比原来的方式与StreamingCSVLoader/StreamingXLSXLoader按行流式读取。
+- legacy_csv: CSVLoader每行一个Document，全部读完后inject_metadata合并；
+- legacy_xlsx: openpyxl读出整个sheet转成markdown文件，convert_markdown_to_langchaindoc + markdown_process按表格切分
+  （markdown_process会把整张表写入Documents，这里用不保存内容的模拟mysql_client）；
+- stream_csv / stream_xlsx: LocalFileForInsert.split_file_to_docs，与入库时的调用一致。
+每种方式在单独的子进程中执行，峰值RSS取子进程的ru_maxrss，并扣除导入模块、加载tokenizer后的基线。
+同时校验流式解析没有丢行，且每个块都以表头开头。
+
+用法: python scripts/bench_table_loader.py --rows 1000000
+      python scripts/bench_table_loader.py --rows 200000 --cases stream_csv,stream_xlsx
+"""
+import argparse
+import csv
+import json
+import os
+import random
+import re
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+
+root_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(root_dir)
+
+COLUMNS = ['订单号', '下单日期', '客户', '城市', '商品', '数量', '金额', '备注']
+CITIES = ['北京', '上海', '广州', '深圳', '杭州', '成都']
+PRODUCTS = ['笔记本电脑', '显示器', '机械键盘', '无线鼠标', '移动硬盘', 'USB-C扩展坞']
+
+
+def fixture_rows(rows, seed=0):
+    rng = random.Random(seed)
+    for i in range(rows):
+        yield [f'SO{i:08d}', f'2024-{rng.randint(1, 12):02d}-{rng.randint(1, 28):02d}', f'客户{rng.randint(1, 5000)}',
+               rng.choice(CITIES), rng.choice(PRODUCTS), rng.randint(1, 20), round(rng.uniform(10, 20000), 2),
+               '加急' if rng.random() < 0.1 else '']
+
+
+def build_csv(path, rows):
+    with open(path, 'w', newline='', encoding='utf-8') as f:
+        writer = csv.writer(f)
+        writer.writerow(COLUMNS)
+        writer.writerows(fixture_rows(rows))
+
+
+def build_xlsx(path, rows):
+    import openpyxl
+    workbook = openpyxl.Workbook(write_only=True)
+    sheet = workbook.create_sheet('订单')
+    sheet.append(COLUMNS)
+    for row in fixture_rows(rows):
+        sheet.append(row)
+    workbook.save(path)
+
+
+class SimulatedKBClient:
+    def get_knowledge_base_name(self, kb_ids):
+        return [(None, kb_ids[0], 'KBbench')]
+
+    def add_document(self, doc_id, doc_json):
+        pass
+
+
+def legacy_excel_to_markdown(file_path, markdown_path):
+    """改动前的LocalFileForInsert.excel_to_markdown"""
+    import openpyxl
+
+    def clean_cell_content(cell):
+        if cell is None:
+            return ''
+        return re.sub(r'\s+', ' ', str(cell)).strip()
+    basename = os.path.splitext(os.path.basename(file_path))[0]
+    markdown_file = os.path.join(markdown_path, f"{basename}.md")
+    workbook = openpyxl.load_workbook(file_path, read_only=True, data_only=True)
+    with open(markdown_file, 'w', encoding='utf-8') as md_file:
+        for sheet_name in workbook.sheetnames:
+            sheet = workbook[sheet_name]
+            md_file.write(f"# {sheet_name}\n\n")
+            rows = [[clean_cell_content(cell) for cell in row] for row in sheet.iter_rows(values_only=True)]
+            non_empty_rows = [row for row in rows if any(cell != '' for cell in row)]
+            if not non_empty_rows:
+                continue
+            max_cols = max(len(row) for row in non_empty_rows)
+            for row_index, row in enumerate(non_empty_rows):
+                padded_row = row + [''] * (max_cols - len(row))
+                md_file.write('| ' + ' | '.join(padded_row) + ' |\n')
+                if row_index == 0:
+                    md_file.write('|' + '|'.join(['---' for _ in range(max_cols)]) + '|\n')
+            md_file.write('\n\n')
+    return markdown_file
+
+
+def max_rss_mb():
+    # Linux上ru_maxrss单位为KB
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def run_case(case, path, chunk_size):
+    """在子进程中执行，输出一行json结果"""
+    from qanything_kernel.core.retriever.general_document import LocalFileForInsert
+    from qanything_kernel.utils.loader.csv_loader import CSVLoader
+    from qanything_kernel.utils.loader.markdown_parser import convert_markdown_to_langchaindoc
+    from qanything_kernel.utils.general_utils import num_tokens_embed
+    num_tokens_embed('预热tokenizer')
+    baseline = max_rss_mb()
+    local_file = LocalFileForInsert('bench__1234', 'KBbench', uuid.uuid4().hex, path, os.path.basename(path), '',
+                                    chunk_size, SimulatedKBClient())
+    start = time.perf_counter()
+    if case == 'legacy_csv':
+        docs = CSVLoader(path, autodetect_encoding=True, csv_args={"delimiter": ",", "quotechar": '"'}).load()
+        local_file.inject_metadata(docs)
+    elif case == 'legacy_xlsx':
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            markdown_file = legacy_excel_to_markdown(path, tmp_dir)
+            docs = local_file.markdown_process(convert_markdown_to_langchaindoc(markdown_file))
+        local_file.inject_metadata(docs)
+    else:
+        local_file.split_file_to_docs()
+    cost = time.perf_counter() - start
+    header = '| ' + ' | '.join(COLUMNS) + ' |'
+    lines = [line for doc in local_file.docs for line in doc.page_content.split('\n')]
+    result = {'case': case, 'seconds': round(cost, 2), 'peak_mb': round(max_rss_mb(), 1),
+              'baseline_mb': round(baseline, 1), 'docs': len(local_file.docs),
+              'table_rows': sum(1 for line in lines if line.startswith('| ') and line != header),
+              'no_header_docs': sum(1 for doc in local_file.docs if header not in doc.page_content.split('\n')),
+              'max_doc_tokens': max((num_tokens_embed(doc.page_content) for doc in local_file.docs), default=0)}
+    print(json.dumps(result, ensure_ascii=False))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rows', type=int, default=1000000)
+    parser.add_argument('--chunk_size', type=int, default=800, help='parent chunk的token数')
+    parser.add_argument('--cases', type=str, default='legacy_csv,stream_csv,legacy_xlsx,stream_xlsx')
+    parser.add_argument('--dir', type=str, default=None, help='生成的测试文件目录，默认临时目录；已存在的文件直接复用')
+    parser.add_argument('--run', type=str, default=None, help=argparse.SUPPRESS)
+    parser.add_argument('--path', type=str, default=None, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.run:
+        run_case(args.run, args.path, args.chunk_size)
+        return
+
+    work_dir = args.dir or tempfile.mkdtemp(prefix='bench_table_')
+    os.makedirs(work_dir, exist_ok=True)
+    cases = args.cases.split(',')
+    paths = {}
+    for ext, build in (('csv', build_csv), ('xlsx', build_xlsx)):
+        if not any(case.endswith(ext) for case in cases):
+            continue
+        path = os.path.join(work_dir, f'orders_{args.rows}.{ext}')
+        if not os.path.exists(path):
+            start = time.perf_counter()
+            build(path, args.rows)
+            print(f'built {path} in {time.perf_counter() - start:.1f}s')
+        paths[ext] = path
+        print(f'{ext}: {args.rows} rows, {os.path.getsize(path) / 1024 / 1024:.1f}MB')
+
+    print(f'{"case":<12}{"seconds":>9}{"peak MB":>10}{"over base":>11}{"docs":>9}{"rows":>10}'
+          f'{"no header":>11}{"max tokens":>12}')
+    results = {}
+    for case in cases:
+        proc = subprocess.run([sys.executable, os.path.abspath(__file__), '--run', case,
+                               '--path', paths[case.split('_')[-1]], '--chunk_size', str(args.chunk_size)],
+                              capture_output=True, text=True)
+        if proc.returncode != 0:
+            print(f'{case:<12} failed:\n{proc.stderr[-2000:]}')
+            continue
+        result = json.loads(proc.stdout.strip().splitlines()[-1])
+        results[case] = result
+        print(f'{case:<12}{result["seconds"]:>9.2f}{result["peak_mb"]:>10.1f}'
+              f'{result["peak_mb"] - result["baseline_mb"]:>11.1f}{result["docs"]:>9}{result["table_rows"]:>10}'
+              f'{result["no_header_docs"]:>11}{result["max_doc_tokens"]:>12}')
+    for ext in ('csv', 'xlsx'):
+        stream = results.get(f'stream_{ext}')
+        if stream is None:
+            continue
+        assert stream['table_rows'] == args.rows, f'stream_{ext} lost rows'
+        assert stream['no_header_docs'] == 0, f'stream_{ext} chunks without header'
+        legacy = results.get(f'legacy_{ext}')
+        if legacy is not None:
+            print(f'{ext}: peak RSS above baseline {legacy["peak_mb"] - legacy["baseline_mb"]:.0f}MB -> '
+                  f'{stream["peak_mb"] - stream["baseline_mb"]:.0f}MB')
+    print('table loader check passed')
+
+
+if __name__ == '__main__':
+    main()
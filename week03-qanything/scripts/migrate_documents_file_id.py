@@ -0,0 +1,99 @@
+"""
+Documents表在线迁移：补充file_id、ordinal列，按主键分批回填历史数据，最后在线创建(file_id, ordinal)索引。
+迁移期间服务可以正常读写（新写入的行已经带file_id），完成后重启服务即切换到按file_id的keyset查询。
+可重复执行，已回填的行会跳过。
+
+用法: python scripts/migrate_documents_file_id.py --batch 2000 --sleep 0.05
+"""
+import argparse
+import os
+import sys
+import time
+
+root_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(root_dir)
+
+from qanything_kernel.connector.database.mysql.mysql_client import KnowledgeBaseManager
+
+
+def run_ddl(conn, statements):
+    # 依次尝试INSTANT/INPLACE等算法，老版本MySQL不支持时退回默认算法
+    cursor = conn.cursor()
+    try:
+        for statement in statements:
+            try:
+                cursor.execute(statement)
+                print(f"ok: {statement}")
+                return True
+            except Exception as e:
+                if getattr(e, 'errno', None) in (1060, 1061):  # 列/索引已存在
+                    print(f"already exists: {statement}")
+                    return True
+                print(f"failed: {statement}, {e}")
+        return False
+    finally:
+        cursor.close()
+
+
+def backfill(mysql_client, conn, batch_size, sleep):
+    cursor = conn.cursor()
+    last_id, updated = 0, 0
+    start = time.perf_counter()
+    try:
+        while True:
+            cursor.execute("SELECT id, doc_id FROM Documents WHERE id > %s AND file_id IS NULL ORDER BY id LIMIT %s",
+                           (last_id, batch_size))
+            rows = cursor.fetchall()
+            if not rows:
+                break
+            last_id = rows[-1][0]
+            params = []
+            for row_id, doc_id in rows:
+                file_id, ordinal = mysql_client.split_doc_id(doc_id)
+                if file_id is None:
+                    # markdown表格等整块存入的行，doc_id是uuid，保持NULL，不影响documents_file_id_ready
+                    print(f"skip non-chunk doc_id: {doc_id}")
+                    continue
+                params.append((file_id, ordinal, row_id))
+            cursor.executemany("UPDATE Documents SET file_id = %s, ordinal = %s WHERE id = %s", params)
+            conn.commit()
+            updated += len(params)
+            print(f"backfilled={updated} last_id={last_id} elapsed={time.perf_counter() - start:.1f}s")
+            if sleep:
+                time.sleep(sleep)  # 给线上流量让出IO
+    finally:
+        cursor.close()
+    return updated
+
+
+def main(args):
+    mysql_client = KnowledgeBaseManager()
+    conn = mysql_client.cnxpool.get_connection()
+    try:
+        # 服务启动时已经尝试加列，这里再确认一次
+        for column in ("file_id VARCHAR(64) DEFAULT NULL", "ordinal INT DEFAULT NULL"):
+            run_ddl(conn, [f"ALTER TABLE Documents ADD COLUMN {column}, ALGORITHM=INSTANT",
+                           f"ALTER TABLE Documents ADD COLUMN {column}, ALGORITHM=INPLACE, LOCK=NONE",
+                           f"ALTER TABLE Documents ADD COLUMN {column}"])
+        # 先回填再建索引，建索引时一次排序，比边回填边维护索引快
+        updated = backfill(mysql_client, conn, args.batch, args.sleep)
+        print(f"backfill done, {updated} rows")
+        run_ddl(conn, ["CREATE INDEX idx_file_id_ordinal ON Documents (file_id, ordinal) ALGORITHM=INPLACE LOCK=NONE",
+                       "CREATE INDEX idx_file_id_ordinal ON Documents (file_id, ordinal)"])
+        # 建索引期间新写入的行也带了file_id，这里补扫一遍
+        updated = backfill(mysql_client, conn, args.batch, 0)
+        print(f"catch-up backfill done, {updated} rows")
+    finally:
+        conn.close()
+    mysql_client.refresh_documents_schema()
+    if mysql_client.documents_file_id_ready:
+        print("migration finished, restart the services to use file_id keyset queries")
+    else:
+        print("migration not finished, please check the errors above and run again")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--batch', type=int, default=2000)
+    parser.add_argument('--sleep', type=float, default=0.05, help='每批之间休眠的秒数')
+    main(parser.parse_args())
@@ -0,0 +1,71 @@
+"""
+后台重压缩Documents.json_data：按主键分批扫描，把不是目标格式的行（未压缩的老数据、或切换压缩算法前写入的行）
+重新编码为DOCUMENT_COMPRESSION指定的格式。可随时中断，用--start_id从上次的位置继续。
+
+用法: python scripts/recompress_documents.py --batch 500 --sleep 0.05
+      python scripts/recompress_documents.py --compression none   # 全部还原为未压缩的json
+"""
+import argparse
+import os
+import sys
+import time
+
+root_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(root_dir)
+
+from qanything_kernel.configs.model_config import DOCUMENT_COMPRESSION
+from qanything_kernel.connector.database.mysql.mysql_client import KnowledgeBaseManager
+from qanything_kernel.utils.json_codec import (encode_json_data, decode_json_data, json_data_format,
+                                               resolve_compression)
+
+
+def recompress(args):
+    compression = resolve_compression(args.compression)
+    mysql_client = KnowledgeBaseManager()
+    conn = mysql_client.cnxpool.get_connection()
+    cursor = conn.cursor()
+    last_id = args.start_id
+    scanned, rewritten, bytes_before, bytes_after = 0, 0, 0, 0
+    start = time.perf_counter()
+    try:
+        while True:
+            cursor.execute("SELECT id, json_data FROM Documents WHERE id > %s ORDER BY id LIMIT %s",
+                           (last_id, args.batch))
+            rows = cursor.fetchall()
+            if not rows:
+                break
+            last_id = rows[-1][0]
+            params = []
+            for row_id, stored in rows:
+                scanned += 1
+                if json_data_format(stored) == compression:
+                    continue
+                encoded = encode_json_data(decode_json_data(stored), compression=compression)
+                if encoded == stored:  # 太短不压缩的行
+                    continue
+                bytes_before += len(stored.encode('utf-8'))
+                bytes_after += len(encoded.encode('utf-8'))
+                # 带上原值做条件，避免覆盖扫描之后被update_chunks修改过的行
+                params.append((encoded, row_id, stored))
+            if params and not args.dry_run:
+                cursor.executemany("UPDATE Documents SET json_data = %s WHERE id = %s AND json_data = %s", params)
+                conn.commit()
+            rewritten += len(params)
+            print(f"scanned={scanned} rewritten={rewritten} last_id={last_id} "
+                  f"bytes {bytes_before} -> {bytes_after} elapsed={time.perf_counter() - start:.1f}s")
+            if args.sleep:
+                time.sleep(args.sleep)  # 给线上流量让出IO
+    finally:
+        cursor.close()
+        conn.close()
+    print(f"done, scanned {scanned} documents, rewritten {rewritten} to {compression}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--compression', default=DOCUMENT_COMPRESSION, help='zstd / zlib / none')
+    parser.add_argument('--batch', type=int, default=500)
+    parser.add_argument('--sleep', type=float, default=0.05, help='每批之间休眠的秒数')
+    parser.add_argument('--start_id', type=int, default=0)
+    parser.add_argument('--dry_run', action='store_true')
+    recompress(parser.parse_args())